@@ -0,0 +1,169 @@
+"""
+Harness for the resource bootstrap of vod-basic-encoder (bootstrap.py) when a cached resource was deleted on the
+Bitmovin side.
+
+<p>vod-basic-encoder submits an upload against the local fake Bitmovin API server, which resolves the GCS input, the
+GCS output and (with WEBHOOK_SCOPE "ORGANIZATION") the organization-wide finished webhook and remembers their IDs in
+memory and in the snapshot file. All three are then deleted on the server, and a second upload is submitted
+  <ul>
+   <li>by a new instance, which only finds the stale IDs in the snapshot,
+   <li>by the warm instance, which still has the stale IDs in memory.
+ </ul>
+The server answers references to the deleted input and output with "404 Not Found". Every second upload must be
+encoded with exactly one new input and one new output, and its streams and muxings must reference them. A new
+instance must also register the organization webhook again. The scenarios run for the encoding graph (with the
+manifests created by the function and at the start of the encoding) and for encoding templates.
+
+Requires the Bitmovin API SDK (vod-basic-encoder/requirements.txt).
+
+Usage:
+    python benchmarks/bootstrap_harness.py
+"""
+
+import logging
+import os
+import sys
+import tempfile
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'vod-basic-encoder'))
+
+import config as Config
+
+from fake_bitmovin_server import FakeBitmovinServer
+
+INPUTS = "/encoding/inputs/gcs"
+OUTPUTS = "/encoding/outputs/gcs"
+WEBHOOKS = "/notifications/webhooks/encoding/encodings/finished"
+
+# Submission mode, manifest generation, whether the second upload comes from a new instance
+SCENARIOS = [
+    ("GRAPH", "WEBHOOK", True),
+    ("GRAPH", "WEBHOOK", False),
+    ("GRAPH", "START", True),
+    ("TEMPLATE", "WEBHOOK", True),
+    ("TEMPLATE", "WEBHOOK", False),
+]
+
+
+def upload(main, index):
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        main.encoding_h264_vod_preset(dict(bucket="input-bucket", name="uploads/asset-{}.mp4".format(index),
+                                           contentType="video/mp4", size="1048576", metageneration="1"), None)
+        return None
+    except Exception as e:
+        return e
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def references(server, field):
+    # The IDs the streams, muxings and manifests stored on the server reference in the given field
+    found = set()
+
+    def collect(value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if key == field:
+                    found.add(item)
+                collect(item)
+        elif isinstance(value, list):
+            for item in value:
+                collect(item)
+
+    for collection, resources in list(server.collections.items()):
+        if collection not in (INPUTS, OUTPUTS):
+            collect(list(resources.values()))
+    return found
+
+
+def run_scenario(server, main, bootstrap, submission_mode, manifest_generation, new_instance, index):
+    # type: (FakeBitmovinServer, object, object, str, str, bool, int) -> list
+    """
+    Submits an upload, deletes the resolved resources on the server, submits a second upload and returns the failures
+    """
+
+    Config.SUBMISSION_MODE = submission_mode
+    Config.MANIFEST_GENERATION = manifest_generation
+    bootstrap.invalidate()
+
+    failures = []
+    first_error = upload(main, 2 * index)
+    stale_input, stale_output = bootstrap.get_input().id, bootstrap.get_output().id
+    for collection in (INPUTS, OUTPUTS, WEBHOOKS):
+        for resource in server.stored(collection):
+            server.handle_call("DELETE", collection + "/" + resource['id'], dict(), None)
+    referenced = references(server, 'inputId'), references(server, 'outputId')
+
+    if new_instance:
+        # A new instance only shares the snapshot file
+        bootstrap._cache.clear()
+    second_error = upload(main, 2 * index + 1)
+
+    inputs, outputs, webhooks = server.stored(INPUTS), server.stored(OUTPUTS), server.stored(WEBHOOKS)
+    new_input = inputs[0]['id'] if len(inputs) == 1 else None
+    new_output = outputs[0]['id'] if len(outputs) == 1 else None
+    input_references = references(server, 'inputId') - referenced[0]
+    output_references = references(server, 'outputId') - referenced[1]
+
+    label = "{} {}{}".format(submission_mode.lower(), "manifests at start" if manifest_generation == "START" else
+                             "manifest generator", ", new instance" if new_instance else ", warm instance")
+    print("{:<45} second upload {}, inputs created again: {}, outputs: {}, organization webhooks: {}".format(
+        label, "failed" if second_error else "encoded", len(inputs), len(outputs), len(webhooks)))
+
+    if first_error or second_error:
+        failures.append("{}: upload failed: {}".format(label, first_error or second_error))
+        return failures
+    if new_input is None or new_output is None:
+        failures.append("{}: expected one new input and output, got {} and {}".format(label, len(inputs),
+                                                                                   len(outputs)))
+    if input_references != {new_input} or stale_input in input_references:
+        failures.append("{}: streams reference inputs {}".format(label, sorted(input_references)))
+    if output_references != {new_output} or stale_output in output_references:
+        failures.append("{}: muxings and manifests reference outputs {}".format(label, sorted(output_references)))
+    if manifest_generation != "START" and new_instance and len(webhooks) != 1:
+        failures.append("{}: organization webhook registered {} times again".format(label, len(webhooks)))
+    return failures
+
+
+def main():
+    workdir = tempfile.mkdtemp()
+
+    # The SDK logs every request and response
+    logging.disable(logging.DEBUG)
+    Config.BITMOVIN_API_KEY = "bootstrap"
+    Config.SOURCE_PROBE_ENABLED = False
+    Config.WEBHOOK_SCOPE = "ORGANIZATION"
+    for name in dir(Config):
+        if name.endswith('_DB_FILE') or name.endswith('_INDEX_FILE') or name.endswith('_SNAPSHOT_FILE'):
+            setattr(Config, name, os.path.join(workdir, name.lower()))
+    # The shared stores need Firestore, the local ones are enough for a single process
+    Config.STATE_STORE = "SQLITE"
+    Config.LEDGER_IMPORT_JSON_FILE = None
+
+    server = FakeBitmovinServer(encode_duration=0.05, manifest_duration=0.05).start()
+    Config.BITMOVIN_API_BASE_URL = server.base_url
+
+    import bootstrap as Bootstrap
+    import main as Main
+
+    failures = []
+    try:
+        for index, (submission_mode, manifest_generation, new_instance) in enumerate(SCENARIOS):
+            failures += run_scenario(server, Main, Bootstrap, submission_mode, manifest_generation, new_instance,
+                                     index)
+    finally:
+        server.shutdown()
+
+    if failures:
+        for failure in failures:
+            print("FAILED: " + failure)
+        sys.exit(1)
+    print("stale inputs, outputs and organization webhooks are resolved again")
+
+
+if __name__ == '__main__':
+    main()
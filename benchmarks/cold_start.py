@@ -0,0 +1,318 @@
+"""
+Cold-start benchmark of the Cloud Functions.
+
+<p>Every run starts a fresh interpreter with -X importtime that imports main.py of the function, exactly as the
+Cloud Functions runtime does on a cold start, and then runs synthetic invocations against the in-process fake
+Bitmovin API:
+  <ul>
+   <li>vod-basic-encoder: an ignored upload (hot path, must not load the SDK), the first accepted upload and a
+       second one (warm);
+   <li>manifest-generator: the first and a second finished webhook of a CMAF encoding.
+ </ul>
+The SDK import the first API call triggers is timed on its own ("sdk load"), so the invocations show the work of
+the function only.
+
+<p>The import-time tree of main is parsed and reported (top modules by cumulative time, grouped by top-level
+package). Interpreter startup (site and .pth hooks) is reported separately and not counted. The benchmark fails if
+importing main imports one of DEFERRED_MODULES (the SDK, its HTTP stack and the Google Cloud clients), or the hot
+path loads one of them. These checks do not depend on the machine or its load.
+
+<p>Timings are only compared with --baseline FILE: the benchmark then also fails if the median import time or
+hot-path time exceeds the timings in FILE by more than the tolerance. Milliseconds are only comparable on the same
+machine, so record FILE there first with --update-baseline (e.g. on the commit before a change) instead of keeping
+one in the repository.
+
+Requires the Bitmovin API SDK (vod-basic-encoder/requirements.txt).
+
+Usage:
+    python benchmarks/cold_start.py [--runs 7] [--baseline FILE [--tolerance 0.3] [--update-baseline]] [function ...]
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from collections import defaultdict
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCHMARKS, '..')
+
+FUNCTIONS = ('vod-basic-encoder', 'manifest-generator')
+
+# Modules main.py must not import at cold start; they are loaded on first use of the API
+DEFERRED_MODULES = ('bitmovin_api_sdk', 'requests', 'urllib3', 'google.cloud')
+
+# Measured timings below this many milliseconds over the baseline never count as a regression (timer noise)
+NOISE_MS = 3.0
+
+# Runs in the fresh interpreter: nothing but sys and time may be imported before main, or the modules would be
+# missing from the import-time tree of main
+_CHILD = """
+import sys, time
+sys.path.insert(0, {function_dir!r})
+sys.path.insert(0, {benchmarks!r})
+started = time.perf_counter()
+import main
+import_ms = (time.perf_counter() - started) * 1000
+import cold_start
+cold_start.invoke({function!r}, main, import_ms)
+"""
+
+_IMPORTTIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)$")
+
+EVENT = dict(bucket="input-bucket", contentType="video/mp4", size="1048576", metageneration="1")
+
+
+class ImportNode(object):
+
+    def __init__(self, name, self_us, cumulative_us, depth):
+        self.name = name
+        self.self_us = self_us
+        self.cumulative_us = cumulative_us
+        self.depth = depth
+        self.children = []
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            for node in child.walk():
+                yield node
+
+
+def parse_importtime(stderr):
+    # type: (str) -> list
+    """
+    Parses the -X importtime output into trees and returns the top-level imports in import order. A module is
+    reported after its children, with two more spaces of indentation per level.
+    """
+
+    pending = []
+    for line in stderr.splitlines():
+        match = _IMPORTTIME.match(line)
+        if match is None:
+            continue
+        node = ImportNode(name=match.group(4), self_us=int(match.group(1)), cumulative_us=int(match.group(2)),
+                          depth=(len(match.group(3)) - 1) // 2)
+        while pending and pending[-1].depth > node.depth:
+            node.children.insert(0, pending.pop())
+        pending.append(node)
+    return pending
+
+
+def invoke(function, main, import_ms):
+    """
+    Runs in the child interpreter after main was imported, prints the timings as JSON
+    """
+
+    import time
+
+    import config as Config
+    import utils as Utils
+    from lazy_sdk import Sdk
+
+    from fake_bitmovin_api import FakeBitmovinApi
+
+    def timed(call):
+        started = time.perf_counter()
+        call()
+        return (time.perf_counter() - started) * 1000
+
+    workdir = tempfile.mkdtemp()
+    for name in dir(Config):
+        if name.endswith('_DB_FILE') or name.endswith('_INDEX_FILE') or name.endswith('_SNAPSHOT_FILE'):
+            setattr(Config, name, os.path.join(workdir, name.lower()))
+    # The shared stores need Firestore, the local ones are enough for a single process
+    Config.STATE_STORE = Config.WEBHOOK_STORE = "SQLITE"
+
+    result = dict(import_ms=import_ms, sdk_loaded_at_import=Sdk.loaded())
+
+    if function == 'vod-basic-encoder':
+        Config.SOURCE_PROBE_ENABLED = False
+        result['hot_path_ms'] = timed(lambda: main.encoding_h264_vod_preset(dict(EVENT, name="uploads/movie.json"),
+                                                                            None))
+        result['sdk_loaded_by_hot_path'] = Sdk.loaded()
+        result['deferred_loaded_by_hot_path'] = sorted(module for module in sys.modules if is_deferred(module))
+        result['sdk_load_ms'] = timed(Sdk.load)
+
+        api = FakeBitmovinApi(status_type=lambda status: Sdk.Status[status])
+        Utils.bitmovin_api = main.bitmovin_api = api
+        main.encoding_api = api.encoding
+        result['first_invocation_ms'] = timed(
+            lambda: main.encoding_h264_vod_preset(dict(EVENT, name="uploads/first.mp4"), None))
+        result['warm_invocation_ms'] = timed(
+            lambda: main.encoding_h264_vod_preset(dict(EVENT, name="uploads/second.mp4"), None))
+    else:
+        result['sdk_load_ms'] = timed(Sdk.load)
+
+        api = FakeBitmovinApi(status_type=lambda status: Sdk.Status[status])
+        Utils.bitmovin_api = main.bitmovin_api = api
+        main.manifest_api = api.encoding.manifests
+        Config.MANIFEST_POLL_INITIAL_INTERVAL = 0.001
+
+        def webhook(encoding_id):
+            for media_type, name, bitrate in (("video", "1080p_3500", 3500000), ("video", "720p_2000", 2000000),
+                                              ("audio", "128kbit", 128000)):
+                if media_type == "video":
+                    configuration = api.encoding.configurations.video.h264.create(
+                        h264_video_configuration=Sdk.H264VideoConfiguration(bitrate=bitrate))
+                else:
+                    configuration = api.encoding.configurations.audio.aac.create(
+                        aac_audio_configuration=Sdk.AacAudioConfiguration(bitrate=bitrate))
+                stream = api.encoding.encodings.streams.create(
+                    encoding_id=encoding_id, stream=Sdk.Stream(codec_config_id=configuration.id))
+                api.encoding.encodings.muxings.fmp4.create(
+                    encoding_id=encoding_id,
+                    fmp4_muxing=Sdk.Fmp4Muxing(
+                        outputs=[Sdk.EncodingOutput(output_id="output",
+                                                    output_path="outputs/movie.mp4/{}/{}/fmp4".format(media_type,
+                                                                                                      name))],
+                        streams=[Sdk.MuxingStream(stream_id=stream.id)]))
+            request = _Request(dict(eventType="ENCODING_FINISHED", encoding=dict(id=encoding_id)))
+            return lambda: main.generate_hls_dash_manifests(request)
+
+        result['first_invocation_ms'] = timed(webhook("encoding-1"))
+        result['warm_invocation_ms'] = timed(webhook("encoding-2"))
+
+    result['api_calls'] = api.total_calls()
+    sys.stdout.write("\n" + json.dumps(result) + "\n")
+
+
+class _Request(object):
+    """
+    The parts of flask.Request the functions use
+    """
+
+    def __init__(self, body):
+        self.body = body
+        self.args = dict()
+
+    def get_json(self, silent=False):
+        return self.body
+
+
+def run_once(function):
+    # type: (str) -> (dict, list)
+    code = _CHILD.format(function_dir=os.path.abspath(os.path.join(ROOT, function)), benchmarks=BENCHMARKS,
+                         function=function)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=os.path.join(ROOT, function),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        raise Exception("{} failed:\n{}".format(function, process.stderr[-3000:]))
+    return json.loads(process.stdout.strip().splitlines()[-1]), parse_importtime(process.stderr)
+
+
+def breakdown(trees):
+    # type: (list) -> dict
+    """
+    Sums up the import tree of main, the imports made by the invocations and the interpreter startup
+    """
+
+    main_tree = next(tree for tree in trees if tree.name == 'main')
+    by_package = defaultdict(int)
+    for node in main_tree.walk():
+        by_package[node.name.split('.')[0]] += node.self_us
+
+    startup = sum(tree.cumulative_us for tree in trees[:trees.index(main_tree)])
+    deferred = sum(tree.cumulative_us for tree in trees[trees.index(main_tree) + 1:])
+    return dict(main_us=main_tree.cumulative_us,
+                modules=[node.name for node in main_tree.walk()],
+                top=sorted(((child.cumulative_us, child.name) for child in main_tree.children), reverse=True),
+                by_package=sorted(((us, name) for name, us in by_package.items()), reverse=True),
+                startup_us=startup,
+                deferred_us=deferred)
+
+
+def is_deferred(module):
+    return any(module == name or module.startswith(name + '.') for name in DEFERRED_MODULES)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('functions', nargs='*', default=list(FUNCTIONS))
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--top', type=int, default=8)
+    parser.add_argument('--baseline', help="timings recorded on this machine to compare with (JSON)")
+    parser.add_argument('--tolerance', type=float, default=0.3,
+                        help="allowed slowdown relative to the baseline, 0.3 = 30%%")
+    parser.add_argument('--update-baseline', action='store_true', help="write the timings to --baseline")
+    args = parser.parse_args()
+    if args.update_baseline and not args.baseline:
+        parser.error("--update-baseline requires --baseline")
+
+    baseline = dict()
+    if args.baseline and os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+
+    failures = []
+    for function in args.functions:
+        runs = [run_once(function) for _ in range(args.runs)]
+        results = [result for result, _ in runs]
+        breakdowns = [breakdown(trees) for _, trees in runs]
+
+        def median(values):
+            return statistics.median(values)
+
+        measured = dict(import_ms=median([b['main_us'] / 1000.0 for b in breakdowns]),
+                        sdk_load_ms=median([r['sdk_load_ms'] for r in results]),
+                        first_invocation_ms=median([r['first_invocation_ms'] for r in results]),
+                        warm_invocation_ms=median([r['warm_invocation_ms'] for r in results]))
+        if 'hot_path_ms' in results[0]:
+            measured['hot_path_ms'] = median([r['hot_path_ms'] for r in results])
+        cold_start_ms = measured['import_ms'] + measured['sdk_load_ms'] + measured['first_invocation_ms']
+
+        print("== {} (median of {} runs)".format(function, args.runs))
+        print("interpreter startup   {:8.1f} ms (not counted)".format(
+            median([b['startup_us'] for b in breakdowns]) / 1000.0))
+        print("import main           {:8.1f} ms ({:.1f} ms wall)".format(
+            measured['import_ms'], median([r['import_ms'] for r in results])))
+        for us, name in breakdowns[0]['top'][:args.top]:
+            print("  {:<30} {:8.1f} ms".format(name, us / 1000.0))
+        print("  by package: " + ", ".join("{} {:.1f}".format(name, us / 1000.0)
+                                           for us, name in breakdowns[0]['by_package'][:args.top]))
+        if 'hot_path_ms' in measured:
+            print("hot path invocation   {:8.1f} ms".format(measured['hot_path_ms']))
+        print("sdk load              {:8.1f} ms (deferred to the first API call)".format(measured['sdk_load_ms']))
+        print("first invocation      {:8.1f} ms ({} fake API calls)".format(measured['first_invocation_ms'],
+                                                                           results[0]['api_calls']))
+        print("warm invocation       {:8.1f} ms".format(measured['warm_invocation_ms']))
+        print("cold start to first response {:.1f} ms".format(cold_start_ms))
+
+        eager = sorted(set(module for b in breakdowns for module in b['modules'] if is_deferred(module)))
+        if eager or any(r['sdk_loaded_at_import'] for r in results):
+            failures.append("{}: importing main imports {}".format(function, ", ".join(eager[:5]) or "the SDK"))
+        if any(r.get('sdk_loaded_by_hot_path') for r in results):
+            failures.append("{}: the hot path loads the SDK".format(function))
+        hot_path_deferred = sorted(set(module for r in results for module in r.get('deferred_loaded_by_hot_path', [])))
+        if hot_path_deferred:
+            failures.append("{}: the hot path imports {}".format(function, ", ".join(hot_path_deferred[:5])))
+
+        for key in ('import_ms', 'hot_path_ms'):
+            reference = baseline.get(function, dict()).get(key)
+            if reference is not None and key in measured and \
+                    measured[key] > reference * (1 + args.tolerance) and measured[key] - reference > NOISE_MS:
+                failures.append("{}: {} regressed from {:.1f} to {:.1f} ms".format(function, key, reference,
+                                                                                   measured[key]))
+        baseline[function] = dict((key, round(value, 2)) for key, value in measured.items())
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as fp:
+            json.dump(baseline, fp, indent=2, sort_keys=True)
+            fp.write("\n")
+        print("baseline written to {}".format(args.baseline))
+        return
+
+    if failures:
+        for failure in failures:
+            print("FAILED: " + failure)
+        sys.exit(1)
+    print("cold start within budget")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""
+Measures how many codec configuration API calls and how much submission time the content-addressed configuration
+registry saves per upload.
+
+<p>The Bitmovin API is replaced by an in-memory stand-in with a fixed per-call latency, so the numbers show the
+round trips saved rather than the speed of any particular network.
+
+<p>Afterwards vod-basic-encoder submits two uploads against the local fake Bitmovin API server, and a codec
+configuration the registry knows is deleted on the server between them. The second upload must still be encoded:
+its stream creation is rejected, the registry forgets the configuration and resolves it again. This check requires
+the Bitmovin API SDK (vod-basic-encoder/requirements.txt).
+
+Usage:
+    python benchmarks/config_registry_benchmark.py [--uploads 50] [--latency-ms 60]
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'vod-basic-encoder'))
+
+import config as Config
+import config_registry as ConfigRegistry
+
+# The ladder built by encoding_h264_vod_preset: 7 H.264 and 4 AAC configurations
+LADDER = [
+    ("h264", 1080, 1980, 3500000, "HIGH"),
+    ("h264", 720, 1280, 2000000, "HIGH"),
+    ("h264", 720, 1280, 1200000, "MAIN"),
+    ("h264", 540, 960, 900000, "MAIN"),
+    ("h264", 360, 640, 664000, "BASELINE"),
+    ("h264", 288, 512, 412000, "BASELINE"),
+    ("h264", 216, 384, 224000, "BASELINE"),
+    ("aac", None, None, 256000, None),
+    ("aac", None, None, 128000, None),
+    ("aac", None, None, 96000, None),
+    ("aac", None, None, 64000, None),
+]
+
+
+class FakeConfigurationApi(object):
+    """In-memory codec configuration endpoint with a fixed round trip latency"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.configurations = dict()
+
+    def create(self, name):
+        self._round_trip()
+        configuration_id = "cfg-{}".format(len(self.configurations))
+        self.configurations[configuration_id] = name
+        return configuration_id
+
+    def list_by_name(self, name):
+        self._round_trip()
+        return [configuration_id for configuration_id, n in self.configurations.items() if n == name]
+
+    def _round_trip(self):
+        self.calls += 1
+        time.sleep(self.latency)
+
+
+def run_upload(api, registry):
+    for codec, height, width, bitrate, profile in LADDER:
+        name = "{} {} {}".format(codec, height, bitrate)
+        if registry is None:
+            api.create(name)
+            continue
+
+        config_fingerprint = ConfigRegistry.fingerprint(codec=codec, height=height, width=width, bitrate=bitrate,
+                                                        profile=profile, preset="VOD_STANDARD")
+        tagged = ConfigRegistry.tag_name(name, config_fingerprint)
+        registry.resolve(config_fingerprint,
+                         lookup=lambda: api.list_by_name(tagged),
+                         create=lambda: api.create(tagged))
+
+
+def measure(label, uploads, latency, registry_factory):
+    api = FakeConfigurationApi(latency)
+    registry = registry_factory()
+    durations = []
+
+    for _ in range(uploads):
+        calls_before = api.calls
+        start = time.perf_counter()
+        run_upload(api, registry)
+        durations.append(((time.perf_counter() - start) * 1000, api.calls - calls_before))
+
+    first_ms, first_calls = durations[0]
+    steady = durations[1:] or durations
+    steady_ms = sum(d[0] for d in steady) / len(steady)
+    steady_calls = sum(d[1] for d in steady) / float(len(steady))
+    print("{:<28} first upload: {:>3} calls {:>8.1f} ms | steady state: {:>5.1f} calls {:>8.1f} ms/upload"
+          .format(label, first_calls, first_ms, steady_calls, steady_ms))
+    return steady_calls, steady_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uploads', type=int, default=50)
+    parser.add_argument('--latency-ms', type=float, default=60.0)
+    args = parser.parse_args()
+    latency = args.latency_ms / 1000.0
+
+    index_dir = tempfile.mkdtemp()
+
+    baseline_calls, baseline_ms = measure("create per upload", args.uploads, latency, lambda: None)
+    warm_calls, warm_ms = measure("registry (warm instance)", args.uploads, latency,
+                                  lambda: ConfigRegistry.ConfigRegistry(index_path=os.path.join(index_dir, 'warm.json')))
+    # A fresh registry object on every upload models cold starts that only share the persistent index
+    cold_calls, cold_ms = measure("registry (cold, index file)", args.uploads, latency,
+                                  lambda: ColdRegistry(os.path.join(index_dir, 'cold.json')))
+
+    print("")
+    print("saved per upload (warm): {:.1f} API calls, {:.1f} ms".format(baseline_calls - warm_calls,
+                                                                       baseline_ms - warm_ms))
+    print("saved per upload (cold): {:.1f} API calls, {:.1f} ms".format(baseline_calls - cold_calls,
+                                                                       baseline_ms - cold_ms))
+
+    print("")
+    failure = check_deleted_configuration(index_dir)
+    if failure:
+        print("FAILED: " + failure)
+        sys.exit(1)
+
+
+def check_deleted_configuration(workdir):
+    # type: (str) -> str
+    """
+    Submits two uploads with a configuration deleted on the server in between, returns a failure or None
+    """
+
+    from fake_bitmovin_server import FakeBitmovinServer
+
+    # The SDK logs every request and response
+    logging.disable(logging.DEBUG)
+    server = FakeBitmovinServer().start()
+    Config.BITMOVIN_API_KEY = "registry"
+    Config.BITMOVIN_API_BASE_URL = server.base_url
+    Config.SOURCE_PROBE_ENABLED = False
+    for name in dir(Config):
+        if name.endswith('_DB_FILE') or name.endswith('_INDEX_FILE') or name.endswith('_SNAPSHOT_FILE'):
+            setattr(Config, name, os.path.join(workdir, name.lower()))
+    # The shared stores need Firestore, the local ones are enough for a single process
+    Config.STATE_STORE = "SQLITE"
+    Config.LEDGER_IMPORT_JSON_FILE = None
+
+    import main as Main
+
+    def upload(index):
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            Main.encoding_h264_vod_preset(dict(bucket="input-bucket", name="uploads/asset-{}.mp4".format(index),
+                                               contentType="video/mp4", size="1048576", metageneration="1"), None)
+            return None
+        except Exception as e:
+            return e
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    try:
+        first_error = upload(1)
+        configurations = server.stored("/encoding/configurations/video/h264")
+        deleted = configurations[0]['id']
+        server.handle_call("DELETE", "/encoding/configurations/video/h264/" + deleted, dict(), None)
+        second_error = upload(2)
+        recreated = [c for c in server.stored("/encoding/configurations/video/h264")
+                     if c['name'] == configurations[0]['name']]
+        streams = [stream for collection, resources in server.collections.items()
+                   if collection.endswith("/streams") for stream in resources.values()]
+    finally:
+        server.shutdown()
+
+    print("deleted configuration: second upload {}, configuration created again: {}, streams on it: {}".format(
+        "failed ({})".format(second_error) if second_error else "encoded", len(recreated),
+        sum(1 for stream in streams if stream.get('codecConfigId') == deleted)))
+    if first_error or second_error:
+        return "upload failed: {}".format(first_error or second_error)
+    if len(recreated) != 1:
+        return "the deleted configuration was not created again"
+    return None
+
+
+class ColdRegistry(object):
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+
+    def resolve(self, *args, **kwargs):
+        return ConfigRegistry.ConfigRegistry(index_path=self.index_path, lru_size=0).resolve(*args, **kwargs)
+
+
+if __name__ == '__main__':
+    main()
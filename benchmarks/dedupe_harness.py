@@ -0,0 +1,189 @@
+"""
+Harness for the duplicate suppression of vod-basic-encoder (dedupe.py) against the in-process fake Bitmovin API, with
+the SQLite stores or (--store FIRESTORE) the Firestore stores on the in-memory Firestore of fake_firestore.py. Every
+scenario uploads objects with the same md5Hash and size and checks how many encodings are started:
+  <ul>
+   <li>failed original: once the error webhook of the first encoding reached release_encoding_quota, the next upload
+       of the content is encoded again instead of being served the outputs of the failed encoding; the ledger has
+       the first encoding in ERROR,
+   <li>same name: the object is uploaded again (new generation) with the same content; it is neither encoded again
+       nor aliased to itself,
+   <li>held in queue: the content claim of an upload waiting in the job queue for longer than DEDUPE_CLAIM_TTL is not
+       taken over by a later upload of the content, and confirming it succeeds; without the hold it is taken over
+       and confirming it reports the loss,
+   <li>ledger down: the ledger fails every write (as with Firestore unavailable); the upload still succeeds, so its
+       event is not delivered again, a redelivery starts no second encoding and the webhook is answered.
+ </ul>
+
+Requires the Bitmovin API SDK (vod-basic-encoder/requirements.txt).
+
+Usage:
+    python benchmarks/dedupe_harness.py [--store SQLITE|FIRESTORE]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'vod-basic-encoder'))
+
+import config as Config
+
+from e2e_benchmark import _Request
+from fake_bitmovin_api import FakeBitmovinApi
+from fake_firestore import FakeFirestore
+
+CONTENT = dict(bucket="input-bucket", contentType="video/mp4", size="1048576", metageneration="1")
+
+# The functions print their progress, the harness reports on the original stdout
+REPORT = sys.stdout
+
+
+def upload(name, generation, content):
+    # type: (str, int, str) -> dict
+    """
+    The finalize event of an upload, content stands in for its md5Hash
+    """
+    return dict(CONTENT, name=name, generation=str(generation), md5Hash=content)
+
+
+class Checks(object):
+
+    def __init__(self):
+        self.failures = []
+
+    def check(self, scenario, condition, message):
+        REPORT.write("{} {:<16} {}\n".format("ok  " if condition else "FAIL", scenario, message))
+        if not condition:
+            self.failures.append("{}: {}".format(scenario, message))
+
+
+def failed_original(Main, api, checks):
+    Main.encoding_h264_vod_preset(upload("uploads/failed.mp4", 1, "failed"), None)
+    encoding_id = list(api.started)[-1]
+    Main.release_encoding_quota(_Request(dict(eventType="ENCODING_ERROR", encoding=dict(id=encoding_id))))
+    recorded = [(row['encoding_id'], row['status'])
+                for row in Main.Ledger.init_ledger().jobs_by_asset("uploads/failed.mp4")]
+    checks.check("failed original", recorded == [(encoding_id, Main.Ledger.ERROR)],
+                 "the ledger recorded {}".format(recorded))
+
+    started = len(api.started)
+    Main.encoding_h264_vod_preset(upload("uploads/failed-again.mp4", 1, "failed"), None)
+    checks.check("failed original", len(api.started) == started + 1,
+                 "the content of a failed encoding was encoded again ({} encodings started)".format(
+                     len(api.started) - started))
+
+
+def same_name(Main, api, checks):
+    Main.encoding_h264_vod_preset(upload("uploads/same.mp4", 1, "same"), None)
+    started = len(api.started)
+    Main.encoding_h264_vod_preset(upload("uploads/same.mp4", 2, "same"), None)
+    checks.check("same name", len(api.started) == started,
+                 "uploading the same content under the same name started {} encodings".format(
+                     len(api.started) - started))
+
+
+def held_in_queue(Dedupe, checks):
+    store = Dedupe.init_dedupe_store()
+    for held in (True, False):
+        content = "held-{}".format(held)
+        waiting, later = upload("uploads/waiting.mp4", 1, content), upload("uploads/later.mp4", 1, content)
+
+        checks.check("held in queue", store.claim_content(waiting, output_root="waiting") is None,
+                     "the first upload claimed the content")
+        if held:
+            store.hold_content(waiting)
+        time.sleep(Config.DEDUPE_CLAIM_TTL * 2)
+
+        original = store.claim_content(later, output_root="later")
+        confirmed = store.confirm_content(waiting, encoding_id="encoding-waiting")
+        if held:
+            checks.check("held in queue", original is not None and original.asset_name == waiting['name'] and
+                         confirmed, "a held claim outlived DEDUPE_CLAIM_TTL and was confirmed")
+        else:
+            checks.check("held in queue", original is None and not confirmed,
+                         "an unheld claim was taken over after DEDUPE_CLAIM_TTL and confirming it failed")
+
+
+class FailingLedger(object):
+
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise Exception("ledger unavailable")
+        return fail
+
+
+def ledger_down(Main, Ledger, api, checks):
+    event = upload("uploads/ledger-down.mp4", 1, "ledger-down")
+    ledger, Ledger.ledger = Ledger.ledger, FailingLedger()
+    try:
+        started = len(api.started)
+        Main.encoding_h264_vod_preset(event, None)
+        Main.encoding_h264_vod_preset(event, None)
+        checks.check("ledger down", len(api.started) == started + 1,
+                     "the upload and its redelivery started {} encodings".format(len(api.started) - started))
+        response = Main.release_encoding_quota(_Request(dict(eventType="ENCODING_FINISHED",
+                                                             encoding=dict(id=list(api.started)[-1]))))
+        checks.check("ledger down", response == "OK", "the finished webhook was answered with {}".format(response))
+    finally:
+        Ledger.ledger = ledger
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--store', default="SQLITE", choices=("SQLITE", "FIRESTORE"))
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    Config.STATE_STORE = args.store
+    for name in dir(Config):
+        if name.endswith('_DB_FILE') or name.endswith('_INDEX_FILE') or name.endswith('_SNAPSHOT_FILE'):
+            setattr(Config, name, os.path.join(workdir, name.lower()))
+    Config.LEDGER_IMPORT_JSON_FILE = None
+    Config.SOURCE_PROBE_ENABLED = False
+    Config.BOOTSTRAP_ENABLED = False
+    Config.METRICS_ENABLED = False
+    Config.DEDUPE_ENABLED = True
+    Config.DEDUPE_CLAIM_TTL = 0.05
+
+    import main as Main
+    import dedupe as Dedupe
+    import firestore_client as Firestore
+    import ledger as Ledger
+
+    if args.store == "FIRESTORE":
+        Firestore.client = FakeFirestore()
+
+    api = FakeBitmovinApi(status_type=lambda status: Main.Sdk.Status[status])
+    Main.Utils.bitmovin_api = Main.bitmovin_api = api
+    Main.encoding_api = api.encoding
+
+    checks = Checks()
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        for scenario, run in (("failed original", lambda: failed_original(Main, api, checks)),
+                              ("same name", lambda: same_name(Main, api, checks)),
+                              ("held in queue", lambda: held_in_queue(Dedupe, checks)),
+                              ("ledger down", lambda: ledger_down(Main, Ledger, api, checks))):
+            try:
+                run()
+            except Exception as e:
+                # e.g. serving a duplicate, which needs Cloud Storage credentials
+                checks.check(scenario, False, "raised {!r}".format(e))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    if checks.failures:
+        for failure in checks.failures:
+            print("FAILED: " + failure)
+        sys.exit(1)
+    print("duplicate suppression follows the encodings of the claims ({})".format(args.store))
+
+
+if __name__ == '__main__':
+    main()
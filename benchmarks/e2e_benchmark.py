@@ -0,0 +1,310 @@
+"""
+End-to-end benchmark of both Cloud Functions against the local fake Bitmovin API server (fake_bitmovin_server.py).
+
+<p>The server runs in this process. Every function runs in a child interpreter of its own (both have a main.py,
+config.py, ...) that imports its main.py, points BITMOVIN_API_BASE_URL at the server and invokes its entry point
+with the real SDK, HTTP transport and instrumentation:
+  <ul>
+   <li>vod-basic-encoder: encoding_h264_vod_preset for --uploads upload events, --concurrency at a time,
+   <li>manifest-generator: generate_hls_dash_manifests for the finished webhook of every encoding created before,
+       once the simulated encodes have finished.
+ </ul>
+
+<p>The API calls of every invocation are grouped into stages by SDK endpoint (STAGES), e.g. all
+encoding.encodings.streams.* calls are the "streams" stage. Per function the benchmark reports the wall time of an
+invocation and the time spent in the calls of each stage (p50 and p99 over the invocations) and the calls per
+invocation. The stage time is the sum of the call latencies, so calls made concurrently by the encoding graph can
+add up to more than the wall time.
+
+<p>--update-baseline saves the results to e2e_baseline.json. Later runs with the same server settings fail if the
+p50 of the wall time or of a stage exceeds the baseline by more than the tolerance, or if an invocation makes more
+API calls than before.
+
+Requires the Bitmovin API SDK (vod-basic-encoder/requirements.txt).
+
+Usage:
+    python benchmarks/e2e_benchmark.py [--uploads 20] [--concurrency 1] [--latency 0.02] [--error-rate 0.0]
+                                       [--muxing-mode TS_MP4|CMAF] [--mode GRAPH|TEMPLATE] [--update-baseline]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import defaultdict
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCHMARKS, '..')
+BASELINE_FILE = os.path.join(BENCHMARKS, 'e2e_baseline.json')
+
+# Stage of an SDK endpoint: the first entry whose prefix (or suffix, for ".status" and ".start") matches
+STAGES = (
+    ('status', ('.status',)),
+    ('start', ('.start',)),
+    ('configurations', ('encoding.configurations.',)),
+    ('streams', ('encoding.encodings.streams.',)),
+    ('muxings', ('encoding.encodings.muxings.',)),
+    ('manifests', ('encoding.manifests.',)),
+    ('webhooks', ('notifications.',)),
+    ('encodings', ('encoding.encodings.',)),
+    ('setup', ('',)),
+)
+
+# Differences below this many milliseconds never count as a regression
+NOISE_MS = 5.0
+
+RESULT_PREFIX = "E2E_RESULT "
+
+_CHILD = """
+import sys
+sys.path.insert(0, {function_dir!r})
+sys.path.insert(0, {benchmarks!r})
+import e2e_benchmark
+e2e_benchmark.drive({function!r}, {settings!r})
+"""
+
+
+def stage_of(endpoint):
+    # type: (str) -> str
+    for stage, patterns in STAGES:
+        for pattern in patterns:
+            if (pattern.startswith('.') and endpoint.endswith(pattern)) or endpoint.startswith(pattern):
+                return stage
+    return 'setup'
+
+
+class _Request(object):
+    """
+    The parts of a flask.Request the manifest generator reads
+    """
+
+    def __init__(self, body):
+        self._body = body
+        self.args = dict()
+
+    def get_json(self, silent=False):
+        return self._body
+
+
+def drive(function, settings):
+    """
+    Runs in the child interpreter: configures the function, runs its invocations and prints the result line
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    import config as Config
+    import instrumentation as Instrumentation
+
+    workdir = settings['workdir']
+    Config.BITMOVIN_API_KEY = "benchmark"
+    Config.BITMOVIN_API_BASE_URL = settings['base_url']
+    for name in dir(Config):
+        if name.endswith('_DB_FILE') or name.endswith('_INDEX_FILE') or name.endswith('_SNAPSHOT_FILE'):
+            setattr(Config, name, os.path.join(workdir, "{}-{}".format(function, name.lower())))
+    # The shared stores need Firestore, the local ones are enough for a single process
+    Config.STATE_STORE = Config.WEBHOOK_STORE = "SQLITE"
+    Config.LEDGER_IMPORT_JSON_FILE = None
+    Config.METRICS_FILE = os.path.join(workdir, function + "-metrics.txt")
+
+    invocations = []
+
+    def collect(function_name, invocation, seconds):
+        stages = defaultdict(lambda: dict(ms=0.0, calls=0))
+        for endpoint, stats in invocation.endpoints().items():
+            stage = stages[stage_of(endpoint)]
+            stage['ms'] += stats['seconds'] * 1000.0
+            stage['calls'] += stats['calls']
+        invocations.append(dict(wall_ms=seconds * 1000.0, stages=dict(stages),
+                                errors=sum(stats['errors'] for stats in invocation.endpoints().values())))
+
+    Instrumentation.add_listener(collect)
+
+    if function == 'vod-basic-encoder':
+        Config.SOURCE_PROBE_ENABLED = False
+        Config.MUXING_MODE = settings['muxing_mode']
+        Config.SUBMISSION_MODE = settings['mode']
+        import main
+
+        def invoke(index):
+            event = dict(bucket="input-bucket", name="uploads/{}/asset-{}.mp4".format(index % 7, index),
+                         contentType="video/mp4", size=str(1048576 + index), md5Hash="md5-{}".format(index),
+                         generation=str(1000 + index), metageneration="1")
+            main.encoding_h264_vod_preset(event, None)
+        jobs = list(range(settings['uploads']))
+    else:
+        import main
+
+        def invoke(encoding_id):
+            main.generate_hls_dash_manifests(_Request(dict(eventType="ENCODING_FINISHED",
+                                                           encoding=dict(id=encoding_id))))
+        jobs = settings['encoding_ids']
+
+    def run(job):
+        try:
+            invoke(job)
+            return None
+        except Exception as e:
+            return "{}: {}".format(type(e).__name__, str(e).splitlines()[0] if str(e) else "")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=settings['concurrency']) as executor:
+        failures = [failure for failure in executor.map(run, jobs) if failure]
+    elapsed = time.perf_counter() - started
+
+    sys.stdout.write(RESULT_PREFIX + json.dumps(dict(invocations=invocations, failures=failures,
+                                                     elapsed_ms=elapsed * 1000.0)) + "\n")
+    sys.stdout.flush()
+
+
+def run_function(function, settings):
+    code = _CHILD.format(function_dir=os.path.abspath(os.path.join(ROOT, function)),
+                         benchmarks=BENCHMARKS, function=function, settings=settings)
+    completed = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               universal_newlines=True, cwd=settings['workdir'])
+    for line in completed.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise Exception("{} did not report a result:\n{}".format(function, completed.stderr[-3000:]))
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(result):
+    # type: (dict) -> dict
+    invocations = result['invocations']
+    count = float(len(invocations) or 1)
+    summary = dict(invocations=len(invocations),
+                   failures=len(result['failures']),
+                   wall_p50_ms=round(percentile([i['wall_ms'] for i in invocations], 0.5), 2),
+                   wall_p99_ms=round(percentile([i['wall_ms'] for i in invocations], 0.99), 2),
+                   calls_per_invocation=round(sum(s['calls'] for i in invocations for s in i['stages'].values())
+                                              / count, 2),
+                   stages=dict())
+    for stage, _ in STAGES:
+        values = [i['stages'][stage]['ms'] for i in invocations if stage in i['stages']]
+        if not values:
+            continue
+        summary['stages'][stage] = dict(
+            p50_ms=round(percentile(values, 0.5), 2),
+            p99_ms=round(percentile(values, 0.99), 2),
+            calls_per_invocation=round(sum(i['stages'][stage]['calls'] for i in invocations if stage in i['stages'])
+                                       / count, 2))
+    return summary
+
+
+def report(function, summary):
+    print("== {}: {} invocations, {} failed, {:.1f} API calls per invocation".format(
+        function, summary['invocations'], summary['failures'], summary['calls_per_invocation']))
+    print("  {:<16} {:>10} {:>10} {:>8}".format("", "p50 ms", "p99 ms", "calls"))
+    print("  {:<16} {:>10.1f} {:>10.1f} {:>8}".format("wall", summary['wall_p50_ms'], summary['wall_p99_ms'], ""))
+    for stage, _ in STAGES:
+        if stage in summary['stages']:
+            values = summary['stages'][stage]
+            print("  {:<16} {:>10.1f} {:>10.1f} {:>8.1f}".format(stage, values['p50_ms'], values['p99_ms'],
+                                                                  values['calls_per_invocation']))
+
+
+def compare(function, summary, reference, tolerance):
+    # type: (str, dict, dict, float) -> list
+    failures = []
+
+    def slower(measured, base):
+        return measured > base * (1 + tolerance) and measured - base > NOISE_MS
+
+    if slower(summary['wall_p50_ms'], reference['wall_p50_ms']):
+        failures.append("{}: wall p50 regressed from {:.1f} to {:.1f} ms".format(
+            function, reference['wall_p50_ms'], summary['wall_p50_ms']))
+    if summary['calls_per_invocation'] > reference['calls_per_invocation']:
+        failures.append("{}: API calls per invocation grew from {} to {}".format(
+            function, reference['calls_per_invocation'], summary['calls_per_invocation']))
+    for stage, values in summary['stages'].items():
+        base = reference['stages'].get(stage)
+        if base is not None and slower(values['p50_ms'], base['p50_ms']):
+            failures.append("{}: {} p50 regressed from {:.1f} to {:.1f} ms".format(
+                function, stage, base['p50_ms'], values['p50_ms']))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uploads', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds every API call takes")
+    parser.add_argument('--jitter', type=float, default=0.005)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of API calls failing with a 503")
+    parser.add_argument('--encode-duration', type=float, default=1.0)
+    parser.add_argument('--manifest-duration', type=float, default=0.2)
+    parser.add_argument('--mode', default="GRAPH", choices=("GRAPH", "TEMPLATE"))
+    parser.add_argument('--muxing-mode', default="TS_MP4", choices=("TS_MP4", "CMAF"))
+    parser.add_argument('--tolerance', type=float, default=0.3,
+                        help="allowed slowdown relative to the baseline, 0.3 = 30%%")
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args()
+
+    from fake_bitmovin_server import FakeBitmovinServer
+
+    server = FakeBitmovinServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                                encode_duration=args.encode_duration,
+                                manifest_duration=args.manifest_duration).start()
+    workdir = tempfile.mkdtemp()
+    settings = dict(base_url=server.base_url, workdir=workdir, uploads=args.uploads, concurrency=args.concurrency,
+                    mode=args.mode, muxing_mode=args.muxing_mode)
+    # Results are only comparable to a baseline recorded with the same server and workload
+    key = "{mode}-{muxing_mode}-latency{latency}-errors{error_rate}-uploads{uploads}-concurrency{concurrency}".format(
+        latency=args.latency, error_rate=args.error_rate, **settings)
+
+    summaries = dict()
+    vod = run_function('vod-basic-encoder', settings)
+    summaries['vod-basic-encoder'] = summarize(vod)
+    report('vod-basic-encoder', summaries['vod-basic-encoder'])
+
+    encoding_ids = [encoding['id'] for encoding in server.stored("/encoding/encodings")]
+    time.sleep(args.encode_duration)
+    manifests = run_function('manifest-generator', dict(settings, encoding_ids=encoding_ids))
+    summaries['manifest-generator'] = summarize(manifests)
+    report('manifest-generator', summaries['manifest-generator'])
+
+    print("fake server: {} calls, {} injected errors".format(server.total_calls(), sum(server.errors.values())))
+    for failure in (vod['failures'] + manifests['failures'])[:5]:
+        print("  invocation failed: " + failure)
+    server.shutdown()
+
+    baseline = dict()
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as fp:
+            baseline = json.load(fp)
+
+    if args.update_baseline:
+        baseline[key] = summaries
+        with open(BASELINE_FILE, 'w') as fp:
+            json.dump(baseline, fp, indent=2, sort_keys=True)
+            fp.write("\n")
+        print("baseline {} written to {}".format(key, BASELINE_FILE))
+        return
+
+    if key not in baseline:
+        print("no baseline for {}, record one with --update-baseline".format(key))
+        return
+
+    failures = []
+    for function, summary in summaries.items():
+        failures.extend(compare(function, summary, baseline[key][function], args.tolerance))
+    if failures:
+        for failure in failures:
+            print("FAILED: " + failure)
+        sys.exit(1)
+    print("within baseline {}".format(key))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+"""
+Harness for the rollback and error reporting of the encoding graph (vod-basic-encoder/encoding_graph.py).
+
+<p>Every round injects failures into the middle of a graph whose nodes take a random time to build, so the nodes
+complete in a different order each round:
+  <ul>
+   <li>graph: a synthetic graph (encoding -> stream -> muxings per rendition) with two failing muxings, the one added
+       first failing last, and a rollback that raises,
+   <li>submission: the encoding of an upload built by vod-basic-encoder against the in-process fake Bitmovin API,
+       with the create calls of two muxings failing the same way.
+ </ul>
+Every round checks that
+  <ul>
+   <li>the error raised names the first of the failed nodes in the order the nodes were added and carries its
+       exception, whichever failed first (a node that was not started yet when the first failure happened is not
+       started any more and cannot fail),
+   <li>every built node is rolled back exactly once (every created resource deleted), after the nodes depending on
+       it and even if the rollback of another node fails, and failed or never built nodes are not rolled back,
+   <li>no node depending on a failed node is built.
+ </ul>
+
+Requires the Bitmovin API SDK (vod-basic-encoder/requirements.txt) for the submission rounds.
+
+Usage:
+    python benchmarks/encoding_graph_harness.py [--rounds 30] [--jitter 0.003] [--seed 5]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'vod-basic-encoder'))
+
+import config as Config
+import encoding_graph as EncodingGraph
+
+from fake_bitmovin_api import FakeBitmovinApi
+
+RENDITIONS = 6
+
+EVENT = dict(bucket="input-bucket", name="uploads/movie.mp4", contentType="video/mp4", size="1048576",
+             metageneration="1")
+
+
+class InjectedError(Exception):
+    pass
+
+
+def check(condition, message, failures):
+    if not condition:
+        failures.append(message)
+
+
+def graph_round(rng, jitter, failures):
+    """
+    Builds a synthetic graph in which muxing/1 fails late and muxing/4 fails early
+    """
+
+    events = []
+    lock = threading.Lock()
+    injected = dict(("muxing/{}".format(index), InjectedError("muxing/{}".format(index))) for index in (1, 4))
+
+    def log(*entry):
+        with lock:
+            events.append(entry)
+
+    def build(key):
+        def run(*_):
+            log("started", key)
+            time.sleep(rng.uniform(0, jitter) * (3 if key == "muxing/1" else 1))
+            if key in injected:
+                raise injected[key]
+            log("built", key)
+            return key
+        return run
+
+    def rollback(key):
+        def run(resource, *_):
+            log("rolled back", key)
+            if key == "stream/2":
+                raise Exception("rollback of stream/2 failed")
+        return run
+
+    graph = EncodingGraph.EncodingGraph(max_workers=8)
+    graph.add("encoding", build("encoding"), rollback=rollback("encoding"))
+    dependencies = dict(encoding=[])
+    for index in range(RENDITIONS):
+        stream, muxing = "stream/{}".format(index), "muxing/{}".format(index)
+        graph.add(stream, build(stream), depends_on=["encoding"], rollback=rollback(stream))
+        graph.add(muxing, build(muxing), depends_on=[stream], rollback=rollback(muxing))
+        dependencies[stream], dependencies[muxing] = ["encoding"], [stream]
+        graph.add(muxing + "/manifest", build(muxing + "/manifest"), depends_on=[muxing])
+        dependencies[muxing + "/manifest"] = [muxing]
+
+    # printed by the failing rollback
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        graph.execute()
+        error = None
+    except EncodingGraph.EncodingGraphError as e:
+        error = e
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    # muxing/4 can fail before stream/1 is built, then muxing/1 is never started
+    started = [key for kind, key in events if kind == "started"]
+    expected_key = "muxing/1" if "muxing/1" in started else "muxing/4"
+    check(error is not None and error.key == expected_key and error.cause is injected[expected_key] and
+          error.__cause__ is injected[expected_key],
+          "graph: raised {!r} instead of the failure of {}".format(error, expected_key), failures)
+
+    built = [key for kind, key in events if kind == "built"]
+    rolled_back = [key for kind, key in events if kind == "rolled back"]
+    expected = sorted(key for key in built if not key.endswith("/manifest"))
+    check(sorted(rolled_back) == expected,
+          "graph: rolled back {} instead of {}".format(sorted(rolled_back), expected), failures)
+    check(not any(key.startswith(failed + "/") for key in built for failed in injected),
+          "graph: built a node depending on a failed node", failures)
+    for key in rolled_back:
+        for dependency in dependencies[key]:
+            check(dependency in rolled_back and rolled_back.index(dependency) > rolled_back.index(key),
+                  "graph: {} rolled back before {}".format(dependency, key), failures)
+
+
+def submission_round(Main, rng, jitter, failures):
+    """
+    Submits the encoding of an upload whose ts muxing of the first video rendition fails late and whose mp4 muxing
+    of the last audio rendition fails early
+    """
+
+    first = "video/" + Main._video_rendition_path(Main.VIDEO_LADDER[0])
+    last = "audio/" + Main._audio_rendition_path(Main.AUDIO_LADDER[-1])
+    injected = {first + "/ts": InjectedError(first + "/ts"), last + "/mp4": InjectedError(last + "/mp4")}
+    models = []
+    lock = threading.Lock()
+
+    def injected_key(endpoint, model):
+        outputs = getattr(model, 'outputs', None)
+        for key in injected:
+            media_type, rendition_path, muxing_type = key.split("/")
+            if outputs and endpoint.endswith("muxings." + muxing_type) and outputs[0].output_path.endswith(
+                    "/{}/{}/clear/{}".format(media_type, muxing_type, rendition_path)):
+                return key
+        return None
+
+    def fail(endpoint, model):
+        with lock:
+            models.append((endpoint, model))
+        time.sleep(rng.uniform(0, jitter))
+        key = injected_key(endpoint, model)
+        if key is None:
+            return None
+        # The first failure in add order is the last one to happen
+        time.sleep(jitter * 3 if key.startswith("video") else 0)
+        return injected[key]
+
+    api = FakeBitmovinApi(status_type=lambda status: Main.Sdk.Status[status], fail=fail)
+    Main.Utils.bitmovin_api = Main.bitmovin_api = api
+    Main.encoding_api = api.encoding
+
+    try:
+        Main.encoding_h264_vod_preset(dict(EVENT), None)
+        error = None
+    except Exception as e:
+        error = e
+
+    # The audio muxing can fail before the video muxing was started, which then never is
+    started = [injected_key(endpoint, model) for endpoint, model in models]
+    expected_key = first + "/ts" if first + "/ts" in started else last + "/mp4"
+    check(isinstance(error, EncodingGraph.EncodingGraphError) and error.key == expected_key and
+          error.cause is injected[expected_key],
+          "submission: raised {!r} instead of the failure of {}".format(error, expected_key), failures)
+
+    # Codec configurations are shared by all encodings and stay
+    graph_endpoints = ("encoding.encodings", "encoding.encodings.streams", "encoding.encodings.muxings")
+    created = [(endpoint, resource_id) for kind, endpoint, resource_id in api.history
+               if kind == "create" and endpoint.startswith(graph_endpoints)]
+    deleted = [(endpoint, resource_id) for kind, endpoint, resource_id in api.history if kind == "delete"]
+    check(sorted(deleted) == sorted(created),
+          "submission: deleted {} of {} created resources".format(len(set(deleted) & set(created)), len(created)),
+          failures)
+
+    position = dict((resource_id, index) for index, (_, resource_id) in enumerate(deleted))
+    encoding_ids = [resource_id for endpoint, resource_id in created if endpoint == "encoding.encodings"]
+    for endpoint, model in models:
+        model_id = getattr(model, 'id', None)
+        if model_id not in position:
+            continue
+        if endpoint.startswith("encoding.encodings.muxings"):
+            stream_id = model.streams[0].stream_id
+            check(position.get(stream_id, -1) > position[model_id],
+                  "submission: stream {} deleted before its muxing {}".format(stream_id, model_id), failures)
+        elif endpoint == "encoding.encodings.streams":
+            check(all(position.get(encoding_id, -1) > position[model_id] for encoding_id in encoding_ids),
+                  "submission: encoding deleted before its stream {}".format(model_id), failures)
+
+    check(not api.started, "submission: the failed encoding was started", failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=30)
+    parser.add_argument('--jitter', type=float, default=0.003, help="maximum seconds a node or fake API call takes")
+    parser.add_argument('--seed', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    failures = []
+    for _ in range(args.rounds):
+        graph_round(rng, args.jitter, failures)
+    print("{} graph rounds, {} failures".format(args.rounds, len(failures)))
+
+    workdir = tempfile.mkdtemp()
+    Config.SOURCE_PROBE_ENABLED = False
+    Config.BOOTSTRAP_ENABLED = False
+    Config.WEBHOOK_SCOPE = "ENCODING"
+    for name in dir(Config):
+        if name.endswith('_DB_FILE') or name.endswith('_INDEX_FILE') or name.endswith('_SNAPSHOT_FILE'):
+            setattr(Config, name, os.path.join(workdir, name.lower()))
+    # The shared stores need Firestore, the local ones are enough for a single process
+    Config.STATE_STORE = "SQLITE"
+    Config.LEDGER_IMPORT_JSON_FILE = None
+
+    import main as Main
+
+    before = len(failures)
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        for _ in range(args.rounds):
+            submission_round(Main, rng, args.jitter, failures)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    print("{} submission rounds, {} failures".format(args.rounds, len(failures) - before))
+
+    if failures:
+        for failure in sorted(set(failures))[:20]:
+            print("FAILED: " + failure)
+        sys.exit(1)
+    print("rollback order and reported failure independent of scheduling")
+
+
+if __name__ == '__main__':
+    main()
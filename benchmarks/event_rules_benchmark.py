@@ -0,0 +1,89 @@
+"""
+Measures the cost of evaluating upload events against the compiled EVENT_RULES of vod-basic-encoder.
+
+<p>A synthetic mix of uploads (videos, sidecars, zero-byte placeholders, metadata rewrites and temporary objects)
+is routed through the compiled matcher. Prints the cost of compiling the rules, the cost per event and how many
+events each rule matched. Rules routing to an unknown ladder profile or priority class have to be rejected when
+they are compiled.
+
+Usage:
+    python benchmarks/event_rules_benchmark.py [--events 200000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vod-basic-encoder'))
+
+import config as Config
+import event_rules as EventRules
+
+# Names of LADDER_PROFILES in main.py, which needs the Bitmovin API SDK
+PROFILES = ("default", "preview")
+
+INVALID_RULES = [
+    dict(name="unknown-profile", prefix=["uploads/"], profile="premium"),
+    dict(name="unknown-priority-class", prefix=["uploads/"], priority_class="urgent"),
+]
+
+
+def synthetic_events(count, rng):
+    kinds = [
+        lambda i: dict(name="uploads/movie-{}.mp4".format(i), contentType="video/mp4", size=str(rng.randint(1, 10 ** 10)),
+                       metageneration="1"),
+        lambda i: dict(name="uploads/movie-{}.json".format(i), contentType="application/json", size="512",
+                       metageneration="1"),
+        lambda i: dict(name="uploads/placeholder-{}/".format(i), contentType="text/plain", size="0",
+                       metageneration="1"),
+        lambda i: dict(name="uploads/movie-{}.mov".format(i), contentType="video/quicktime", size="123456789",
+                       metageneration="3", metadata=dict(priority="rush")),
+        lambda i: dict(name="tmp/upload-{}.part".format(i), contentType="application/octet-stream", size="4096",
+                       metageneration="1"),
+    ]
+    return [rng.choice(kinds)(i) for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    events = synthetic_events(args.events, random.Random(args.seed))
+
+    start = time.perf_counter()
+    matcher = EventRules.compile_rules(Config.EVENT_RULES, profiles=PROFILES,
+                                       priority_classes=Config.JOB_PRIORITY_CLASSES)
+    compile_us = (time.perf_counter() - start) * 1e6
+
+    matches = Counter()
+    start = time.perf_counter()
+    for event in events:
+        matches[matcher.route(event).rule] += 1
+    elapsed = time.perf_counter() - start
+
+    print("rules: {}  compile: {:.1f} us".format(len(Config.EVENT_RULES), compile_us))
+    print("events: {}  total: {:.3f} s  per event: {:.2f} us".format(args.events, elapsed,
+                                                                     elapsed / args.events * 1e6))
+    for rule, count in matches.most_common():
+        print("  {:<20} {:>8}".format(str(rule), count))
+
+    accepted = []
+    for rule in INVALID_RULES:
+        try:
+            EventRules.compile_rules([rule], profiles=PROFILES, priority_classes=Config.JOB_PRIORITY_CLASSES)
+            accepted.append(rule['name'])
+        except ValueError as e:
+            print("rejected at compile: {}".format(e))
+    if accepted:
+        print("FAILED: invalid rules compiled: {}".format(accepted))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""
+In-process stand-in for the parts of the Bitmovin API SDK used by the Cloud Functions.
+
+<p>Resource endpoints are modelled generically: any attribute path (e.g. encoding.encodings.muxings.mp4) supports
+create, create_by_encoding_id, list, get and delete, and the resources are stored per endpoint together with the
+parent IDs they were created under (encoding_id, manifest_id, ...). get on a parent endpoint also finds the resources
+of its children, get on a customdata endpoint returns the custom data its parent resource was created with. Encodings and manifests additionally support start and status; a started task reports RUNNING
+until its simulated duration has passed.
+
+<p>Every call is counted per endpoint and can be delayed by a fixed latency, so submission code can be measured
+and verified without the live API. Creates and deletes are also logged in order (history), and a create can be made
+to fail (fail), so the rollback of a failed submission can be checked.
+"""
+
+import itertools
+import threading
+import time
+
+from collections import Counter, OrderedDict
+
+
+class Page(object):
+
+    def __init__(self, items, total_count):
+        self.items = items
+        self.total_count = total_count
+
+
+class Task(object):
+
+    def __init__(self, status, progress):
+        self.status = status
+        self.progress = progress
+        self.messages = []
+
+
+class CustomData(object):
+
+    def __init__(self, custom_data):
+        self.custom_data = custom_data
+
+
+class NotFoundError(KeyError):
+    """
+    Raised by get for an unknown resource, with the HTTP status a BitmovinError carries
+    """
+
+    http_status_code = 404
+
+
+class FakeBitmovinApi(object):
+
+    def __init__(self, latency=0.0, task_duration=0.0, status_type=None, fail=None):
+        """
+        :param latency: seconds every call takes
+        :param task_duration: seconds a started encoding or manifest stays RUNNING
+        :param status_type: callable turning "RUNNING"/"FINISHED" into the status values the caller compares
+                            against (e.g. the SDK's Status enum); plain strings by default
+        :param fail: callable (endpoint, model) returning the exception a create call raises instead of creating the
+                     resource, or None to let it succeed
+        """
+
+        self.latency = latency
+        self.task_duration = task_duration
+        self.status_type = status_type or (lambda status: status)
+        self.fail = fail
+        self.calls = Counter()
+        # ("create" or "delete", endpoint, resource ID) of every resource created or deleted, in order
+        self.history = []
+        self.resources = dict()
+        self.started = dict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._nodes = dict()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._node(name)
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def stored(self, endpoint):
+        # type: (str) -> list
+        """
+        Returns the (parents, model) pairs created through an endpoint, in creation order
+        """
+
+        return list(self.resources.get(endpoint, OrderedDict()).values())
+
+    def _node(self, path):
+        with self._lock:
+            if path not in self._nodes:
+                self._nodes[path] = _Endpoint(self, path)
+            return self._nodes[path]
+
+    def _call(self, path, method):
+        with self._lock:
+            self.calls["{}.{}".format(path, method)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _next_id(self):
+        with self._lock:
+            return "fake-{:08d}".format(next(self._ids))
+
+
+class _Endpoint(object):
+
+    def __init__(self, api, path):
+        self._api = api
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._api._node(self._path + "." + name)
+
+    def create(self, *args, **kwargs):
+        self._api._call(self._path, 'create')
+        parents = dict((k, v) for k, v in kwargs.items() if isinstance(v, str))
+        models = [v for v in list(args) + list(kwargs.values()) if not isinstance(v, str)]
+        model = models[0] if models else None
+        error = self._api.fail(self._path, model) if self._api.fail is not None else None
+        if error is not None:
+            raise error
+        resource_id = self._api._next_id()
+        if model is not None:
+            model.id = resource_id
+        with self._api._lock:
+            self._api.resources.setdefault(self._path, OrderedDict())[resource_id] = (parents, model)
+            self._api.history.append(("create", self._path, resource_id))
+        return model
+
+    create_by_encoding_id = create
+
+    def list(self, query_params=None, **parents):
+        self._api._call(self._path, 'list')
+        items = [model for stored_parents, model in self._api.stored(self._path)
+                 if all(stored_parents.get(k) == v for k, v in parents.items())]
+
+        name = getattr(query_params, 'name', None)
+        if name is not None:
+            items = [model for model in items if getattr(model, 'name', None) == name]
+
+        total_count = len(items)
+        offset = getattr(query_params, 'offset', None) or 0
+        limit = getattr(query_params, 'limit', None) or 25
+        return Page(items=items[offset:offset + limit], total_count=total_count)
+
+    def get(self, **kwargs):
+        self._api._call(self._path, 'get')
+        if self._path.endswith(".customdata"):
+            # The custom data the resource of the parent endpoint was created with
+            parent = self._api.resources.get(self._path[:-len(".customdata")], dict()).get(list(kwargs.values())[0])
+            return CustomData(custom_data=getattr(parent[1], 'custom_data', None) if parent else None)
+        resource_id = [v for k, v in kwargs.items() if k.endswith('_id') and k[:-3] in self._path][-1:]
+        stored = self._api.resources.get(self._path, dict())
+        for key in resource_id or list(kwargs.values())[-1:]:
+            if key in stored:
+                return stored[key][1]
+            # A parent endpoint returns the resources of its children too, as encoding.configurations does for
+            # the codec configurations of every type
+            for path, resources in list(self._api.resources.items()):
+                if path.startswith(self._path + ".") and key in resources:
+                    return resources[key][1]
+        raise NotFoundError("{} not found".format(kwargs))
+
+    get_by_webhook_id = get
+
+    def delete(self, **kwargs):
+        self._api._call(self._path, 'delete')
+        with self._api._lock:
+            stored = self._api.resources.get(self._path, dict())
+            for value in kwargs.values():
+                if stored.pop(value, None) is not None:
+                    self._api.history.append(("delete", self._path, value))
+
+    def start(self, **kwargs):
+        self._api._call(self._path, 'start')
+        with self._api._lock:
+            self._api.started[list(kwargs.values())[0]] = time.time()
+
+    def status(self, **kwargs):
+        self._api._call(self._path, 'status')
+        started = self._api.started.get(list(kwargs.values())[0])
+        if started is None or time.time() - started < self._api.task_duration:
+            return Task(status=self._api.status_type("RUNNING"), progress=50)
+        return Task(status=self._api.status_type("FINISHED"), progress=100)
@@ -0,0 +1,322 @@
+"""
+Local HTTP stand-in for the Bitmovin API, for running both Cloud Functions end to end with the real SDK.
+
+<p>Unlike fake_bitmovin_api.py, which replaces the SDK in process, this server speaks the REST API the SDK calls,
+so the SDK, the HTTP transport and the instrumentation are exercised as in production. Resources are modelled
+generically: a POST to a collection (e.g. /encoding/encodings/{id}/muxings/fmp4) stores the JSON body under a new
+ID, GET lists the collection (filtered by name, paged by offset and limit) or returns a resource, DELETE removes it.
+On top of that the server implements
+  <ul>
+   <li>start and status of encodings and manifests: a started task is QUEUED for queue_time seconds, RUNNING until
+       encode_duration (manifest_duration) seconds have passed, then FINISHED (or ERROR, see fail_rate),
+   <li>encoding templates (/encoding/templates/start), which create one encoding with its streams and muxings and
+       start it,
+   <li>custom data of encodings, the list of all muxings of an encoding and the input details of a stream (with
+       input_duration as duration),
+   <li>a resource or template referencing a codec configuration, input or output ID the server does not know (e.g.
+       a deleted one) is answered with "404 Not Found", as the API does.
+ </ul>
+Every response is delayed by latency plus a random jitter, and error_rate of the calls fail with an injected
+"503 Service Unavailable" Bitmovin error response. Calls are counted per method and path (IDs replaced by {id}).
+
+Usage (standalone, e.g. to run a function against it with BITMOVIN_API_BASE_URL = "http://127.0.0.1:8080/v1"):
+    python benchmarks/fake_bitmovin_server.py [--port 8080] [--latency 0.02] [--error-rate 0.01]
+"""
+
+import argparse
+import json
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+API_PREFIX = "/v1"
+ID_PATTERN = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+# Fields referencing other resources by ID, with the name of the resource in the "404 Not Found" response
+REFERENCES = OrderedDict([('codecConfigId', "Codec configuration"), ('inputId', "Input"), ('outputId', "Output")])
+
+
+def normalize(method, path):
+    # type: (str, str) -> str
+    return "{} {}".format(method, "/".join("{id}" if ID_PATTERN.match(s) else s for s in path.split("/")))
+
+
+class FakeBitmovinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, error_rate=0.0, queue_time=0.0, encode_duration=1.0,
+                 manifest_duration=0.2, fail_rate=0.0, input_duration=600.0, seed=1):
+        """
+        :param latency: seconds every response is delayed
+        :param jitter: maximum additional random delay in seconds
+        :param error_rate: share of calls answered with an injected 503 error
+        :param queue_time: seconds a started encoding stays QUEUED
+        :param encode_duration: seconds a started encoding is RUNNING
+        :param manifest_duration: seconds a started manifest is RUNNING
+        :param fail_rate: share of started encodings that end in ERROR
+        :param input_duration: seconds of the input of every stream
+        """
+
+        HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.queue_time = queue_time
+        self.encode_duration = encode_duration
+        self.manifest_duration = manifest_duration
+        self.fail_rate = fail_rate
+        self.input_duration = input_duration
+        self.calls = Counter()
+        self.errors = Counter()
+        self.collections = dict()
+        self.resources = dict()
+        self.tasks = dict()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:{}{}".format(self.server_address[1], API_PREFIX)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-bitmovin-server", daemon=True).start()
+        return self
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def stored(self, collection):
+        # type: (str) -> list
+        """
+        The resources created in a collection, e.g. "/encoding/encodings", in creation order
+        """
+
+        with self._lock:
+            return list(self.collections.get(collection, OrderedDict()).values())
+
+    def handle_call(self, method, path, query, body):
+        # type: (str, str, dict, object) -> tuple
+        """
+        Returns (HTTP status, result) for a call, path relative to /v1
+        """
+
+        key = normalize(method, path)
+        with self._lock:
+            self.calls[key] += 1
+            delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0.0)
+            inject = self.error_rate and self._rng.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if inject:
+            with self._lock:
+                self.errors[key] += 1
+            return 503, dict(code=1001, message="Injected error", developerMessage="Injected by the fake server")
+
+        segments = [s for s in path.split("/") if s]
+        with self._lock:
+            unknown = self._unknown_reference(body) if method == "POST" else None
+            if unknown is not None:
+                return 404, dict(code=1000, message="{} not found".format(REFERENCES[unknown[0]]),
+                                 developerMessage="{} {} is not known".format(REFERENCES[unknown[0]], unknown[1]))
+            if method == "POST" and path == "/encoding/templates/start":
+                return 200, self._start_template(body)
+            if len(segments) >= 2 and segments[-1] in ("start", "stop") and segments[-2] in self.resources:
+                return 200, self._start(segments[-2], path, stop=segments[-1] == "stop")
+            if method == "GET" and len(segments) >= 2 and segments[-1] == "status" and segments[-2] in self.resources:
+                return self._status(segments[-2])
+            if method == "GET" and len(segments) >= 2 and segments[-1].lower() == "customdata" and \
+                    segments[-2] in self.resources:
+                return 200, dict(customData=self.resources[segments[-2]][1].get('customData'))
+            if method == "GET" and len(segments) >= 2 and segments[-1] == "input" and segments[-2] in self.resources:
+                return 200, dict(formatName="mov,mp4,m4a,3gp,3g2,mj2", duration=self.input_duration)
+
+            if method == "POST":
+                return 201, self._create("/" + "/".join(segments), body)
+            if segments and segments[-1] in self.resources:
+                collection, resource = self.resources[segments[-1]]
+                if method == "DELETE":
+                    del self.resources[segments[-1]]
+                    self.collections[collection].pop(segments[-1], None)
+                    return 200, dict(id=segments[-1])
+                return 200, resource
+            if method == "GET" and segments and not ID_PATTERN.match(segments[-1]):
+                return 200, self._list("/" + "/".join(segments), query)
+        return 404, dict(code=1000, message="Not found", developerMessage="{} is not known".format(key))
+
+    def _unknown_reference(self, body):
+        # Returns (field, ID) of the first reference in the body to a resource the server does not know, or None
+        if isinstance(body, dict):
+            for field, value in body.items():
+                if field in REFERENCES and isinstance(value, str) and ID_PATTERN.match(value) and \
+                        value not in self.resources:
+                    return field, value
+                unknown = self._unknown_reference(value)
+                if unknown is not None:
+                    return unknown
+        elif isinstance(body, list):
+            for value in body:
+                unknown = self._unknown_reference(value)
+                if unknown is not None:
+                    return unknown
+        return None
+
+    def _create(self, collection, body):
+        resource = dict(body) if isinstance(body, dict) else dict()
+        resource['id'] = str(uuid.uuid4())
+        resource.setdefault('createdAt', time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
+        self.collections.setdefault(collection, OrderedDict())[resource['id']] = resource
+        self.resources[resource['id']] = (collection, resource)
+        return resource
+
+    def _list(self, collection, query):
+        if collection.endswith("/muxings"):
+            # All muxings of an encoding, whatever their type
+            items = []
+            for child, resources in self.collections.items():
+                if child.startswith(collection + "/") and child.count("/") == collection.count("/") + 1:
+                    items.extend(dict(r, type=child.rsplit("/", 1)[-1].upper()) for r in resources.values())
+        else:
+            items = list(self.collections.get(collection, OrderedDict()).values())
+        if 'name' in query:
+            items = [item for item in items if item.get('name') == query['name'][0]]
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', ['25'])[0])
+        return dict(totalCount=len(items), offset=offset, limit=limit, items=items[offset:offset + limit])
+
+    def _start(self, task_id, path, stop=False):
+        if stop:
+            self.tasks.pop(task_id, None)
+            return dict(id=task_id)
+        manifest = path.startswith("/encoding/manifests/")
+        failed = not manifest and self.fail_rate and self._rng.random() < self.fail_rate
+        self.tasks[task_id] = dict(started=time.time(),
+                                   queue_time=0.0 if manifest else self.queue_time,
+                                   duration=self.manifest_duration if manifest else self.encode_duration,
+                                   failed=bool(failed))
+        return dict(id=task_id)
+
+    def _status(self, task_id):
+        task = self.tasks.get(task_id)
+        if task is None:
+            return 200, dict(status="CREATED", progress=0, messages=[])
+        elapsed = time.time() - task['started']
+        if elapsed < task['queue_time']:
+            return 200, dict(status="QUEUED", progress=0, messages=[])
+        running = elapsed - task['queue_time']
+        if running < task['duration']:
+            return 200, dict(status="RUNNING", progress=int(100 * running / task['duration']), messages=[])
+        if task['failed']:
+            return 200, dict(status="ERROR", progress=100,
+                             messages=[dict(type="ERROR", text="Injected encoding failure")])
+        return 200, dict(status="FINISHED", progress=100, messages=[])
+
+    def _start_template(self, document):
+        # Creates the encoding with the streams and muxings of the template, as the API does
+        encodings = (document or dict()).get('encodings') or dict()
+        key, template = next(iter(encodings.items()), (None, dict()))
+        encoding = self._create("/encoding/encodings", template.get('properties', dict()))
+        collection = "/encoding/encodings/{}".format(encoding['id'])
+
+        stream_ids = dict()
+        for stream_key, stream in (template.get('streams') or dict()).items():
+            created = self._create(collection + "/streams", stream.get('properties', dict()))
+            stream_ids["$/encodings/{}/streams/{}".format(key, stream_key)] = created['id']
+        for muxing_type, muxings in (template.get('muxings') or dict()).items():
+            for muxing in muxings.values():
+                properties = dict(muxing.get('properties', dict()))
+                properties['streams'] = [dict(stream, streamId=stream_ids.get(stream.get('streamId'),
+                                                                              stream.get('streamId')))
+                                         for stream in properties.get('streams', [])]
+                self._create("{}/muxings/{}".format(collection, muxing_type), properties)
+
+        self._start(encoding['id'], collection + "/start")
+        return dict(id=encoding['id'], encodingId=encoding['id'])
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # Headers and body are written separately, which would otherwise wait for delayed ACKs
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            body = json.loads(raw.decode('utf-8')) if raw else None
+        except ValueError:
+            body = None
+
+        url = urlparse(self.path)
+        path = url.path[len(API_PREFIX):] if url.path.startswith(API_PREFIX) else url.path
+        status, result = self.server.handle_call(method, path.rstrip("/"), parse_qs(url.query), body)
+
+        if status < 400:
+            envelope = dict(requestId=str(uuid.uuid4()), status="SUCCESS", data=dict(result=result))
+        else:
+            envelope = dict(requestId=str(uuid.uuid4()), status="ERROR", data=result)
+        payload = json.dumps(envelope).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if method != "HEAD":
+            self.wfile.write(payload)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def do_HEAD(self):
+        self._handle("HEAD")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--queue-time', type=float, default=0.0)
+    parser.add_argument('--encode-duration', type=float, default=5.0)
+    parser.add_argument('--manifest-duration', type=float, default=0.5)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeBitmovinServer(port=args.port, latency=args.latency, jitter=args.jitter,
+                                error_rate=args.error_rate, queue_time=args.queue_time,
+                                encode_duration=args.encode_duration, manifest_duration=args.manifest_duration,
+                                fail_rate=args.fail_rate)
+    print("Fake Bitmovin API listening on {}".format(server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,503 @@
+"""
+In-memory stand-in for the parts of the Firestore client (google-cloud-firestore) used by the stores of the Cloud
+Functions (firestore_client.py).
+
+<p>FirestoreBackend holds the documents, FakeFirestore is the client the stores talk to: collections, document
+references (get, create, set, update, delete), queries (where with FieldFilter, order_by, limit, stream), get_all,
+batched writes and transactions. Replacing the client of firestore_client.py runs the stores unchanged:
+
+    Firestore.client = FakeFirestore()
+
+<p>The semantics the stores rely on follow Firestore:
+  <ul>
+   <li>create fails with AlreadyExists and update with NotFound (google.api_core.exceptions), in a batch or a
+       transaction the whole commit fails,
+   <li>filters only match documents that have the field, range filters only values of the same type (None is not
+       a number), and order_by leaves out documents without the field; results are ordered by document ID last,
+   <li>transactions are run by google.cloud.firestore.transactional itself: reads record the version of every
+       document and the result of every query, and the commit fails with Aborted if any of them changed in the
+       meantime, which makes transactional() run the function again (up to MAX_ATTEMPTS times). A read after a
+       write of the same transaction raises ReadAfterWriteError,
+   <li>batches and transactions take at most MAX_WRITES writes.
+ </ul>
+Indexes are not needed, and field paths are top-level field names.
+
+<p>serve() makes a backend reachable from other processes (multiprocessing.managers, served by a thread of the
+calling process), connect() returns a client on it, so a child process shares the documents of the harness.
+"""
+
+import copy
+import random
+import string
+import threading
+
+from multiprocessing.managers import BaseManager
+
+from google.api_core.exceptions import Aborted, AlreadyExists, InvalidArgument, NotFound
+from google.cloud.firestore_v1 import ReadAfterWriteError
+from google.cloud.firestore_v1.base_transaction import MAX_ATTEMPTS
+
+MAX_WRITES = 500
+
+_ID_ALPHABET = string.ascii_letters + string.digits
+
+
+class FirestoreBackend(object):
+    """
+    The documents of all collections, by collection name and document ID, with the version of their last write.
+    Stored documents are replaced on every write, never changed in place, so reads hand them out as they are.
+    """
+
+    def __init__(self):
+        self._collections = dict()
+        # Version of the last write per collection, queries of a transaction only run again if it changed
+        self._collection_versions = dict()
+        # Document IDs by collection, field and value, as the single-field index Firestore keeps for every field
+        self._indexes = dict()
+        self._versions = 0
+        self._lock = threading.RLock()
+
+    def get(self, collection, document_id):
+        # type: (str, str) -> tuple
+        """
+        Returns (data, version) of a document, (None, None) if it does not exist
+        """
+
+        with self._lock:
+            return self._collections.get(collection, dict()).get(document_id, (None, None))
+
+    def query(self, collection, filters, orders, limit):
+        # type: (str, tuple, tuple, int) -> tuple
+        """
+        Returns the version of the collection and (document ID, data, version) of the documents matching a query
+
+        :param filters: (field, operator, value) tuples, every one has to match
+        :param orders: (field, "ASCENDING" or "DESCENDING") tuples
+        :param limit: maximum number of documents, None for all
+        """
+
+        with self._lock:
+            return self._collection_versions.get(collection), self._query(collection, filters, orders, limit)
+
+    def commit(self, writes, reads=(), queries=()):
+        # type: (list, tuple, tuple) -> str
+        """
+        Applies the writes at once if the reads of the transaction are still current. Returns "OK", "ABORTED" if
+        they are not, or the code of the first write that failed ("ALREADY_EXISTS", "NOT_FOUND"); nothing is written
+        unless it returns "OK".
+
+        :param writes: (operation, collection, document ID, data) tuples, operation one of "create", "set", "merge",
+                       "update" and "delete"
+        :param reads: (collection, document ID, version) of every document the transaction read
+        :param queries: (collection, filters, orders, limit, version of the collection, [(document ID, version),
+                        ...]) of every query the transaction ran
+        """
+
+        with self._lock:
+            for collection, document_id, version in reads:
+                if self._collections.get(collection, dict()).get(document_id, (None, None))[1] != version:
+                    return "ABORTED"
+            for collection, filters, orders, limit, collection_version, result in queries:
+                if self._collection_versions.get(collection) == collection_version:
+                    continue
+                if [(document_id, version) for document_id, _, version in
+                        self._query(collection, filters, orders, limit)] != list(result):
+                    return "ABORTED"
+
+            # Every write sees the writes before it in the same commit
+            staged = dict()
+            for operation, collection, document_id, data in writes:
+                key = (collection, document_id)
+                current = staged[key] if key in staged else \
+                    self._collections.get(collection, dict()).get(document_id, (None, None))[0]
+                if operation == "create" and current is not None:
+                    return "ALREADY_EXISTS"
+                if operation == "update" and current is None:
+                    return "NOT_FOUND"
+                if operation == "delete":
+                    staged[key] = None
+                elif operation in ("merge", "update"):
+                    staged[key] = dict(current or dict(), **copy.deepcopy(data))
+                else:
+                    staged[key] = copy.deepcopy(data)
+
+            for (collection, document_id), data in staged.items():
+                documents = self._collections.setdefault(collection, dict())
+                index = self._indexes.setdefault(collection, dict())
+                self._versions += 1
+                self._collection_versions[collection] = self._versions
+                _unindex(index, document_id, documents.get(document_id, (None, None))[0])
+                if data is None:
+                    documents.pop(document_id, None)
+                else:
+                    documents[document_id] = (data, self._versions)
+                    _index(index, document_id, data)
+            return "OK"
+
+    def _query(self, collection, filters, orders, limit):
+        documents = self._collections.get(collection, dict())
+
+        # Equality filters only scan the documents the index has for the value, the smallest set first
+        candidates = None
+        index = self._indexes.get(collection, dict())
+        for field, operator, value in filters:
+            key = _index_key(value) if operator == "==" else None
+            if key is not None:
+                indexed = index.get(field, dict()).get(key, ())
+                if candidates is None or len(indexed) < len(candidates):
+                    candidates = indexed
+        if candidates is None:
+            candidates = documents
+
+        matches = []
+        for document_id in candidates:
+            data, version = documents[document_id]
+            for field, operator, value in filters:
+                if field not in data or not _OPERATORS[operator](data[field], value):
+                    break
+            else:
+                for field, _ in orders:
+                    if field not in data:
+                        break
+                else:
+                    matches.append((document_id, data, version))
+
+        # Sorted by the last key first, so the first order_by ends up deciding
+        matches.sort(key=lambda match: match[0])
+        for field, direction in reversed(orders):
+            matches.sort(key=lambda match: _sort_key(match[1][field]), reverse=direction == "DESCENDING")
+        return matches[:limit] if limit is not None else matches
+
+
+class FakeFirestore(object):
+    """
+    Client on a FirestoreBackend, the surface of google.cloud.firestore.Client used by the stores
+    """
+
+    def __init__(self, backend=None):
+        # type: (FirestoreBackend) -> None
+        self.backend = backend if backend is not None else FirestoreBackend()
+
+    def collection(self, name):
+        # type: (str) -> CollectionReference
+        return CollectionReference(self, name)
+
+    def transaction(self):
+        # type: () -> Transaction
+        return Transaction(self)
+
+    def batch(self):
+        # type: () -> WriteBatch
+        return WriteBatch(self)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        """
+        Yields a snapshot of every reference, in a transaction recording the versions read
+        """
+
+        for reference in references:
+            yield reference.get(transaction=transaction)
+
+    def _commit(self, writes, reads=(), queries=()):
+        if len(writes) > MAX_WRITES:
+            raise InvalidArgument("maximum {} writes allowed per request".format(MAX_WRITES))
+        code = self.backend.commit(writes, reads, queries)
+        if code == "ABORTED":
+            raise Aborted("Transaction lock timeout, the documents it read were changed")
+        if code == "ALREADY_EXISTS":
+            raise AlreadyExists("Document already exists")
+        if code == "NOT_FOUND":
+            raise NotFound("No document to update")
+
+
+class DocumentSnapshot(object):
+
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        # type: () -> dict
+        return copy.deepcopy(self._data) if self.exists else None
+
+    def get(self, field_path):
+        if not self.exists or field_path not in self._data:
+            raise KeyError("'{}' is not contained in the data".format(field_path))
+        return copy.deepcopy(self._data[field_path])
+
+
+class DocumentReference(object):
+
+    def __init__(self, client, collection, document_id):
+        self._client = client
+        self._collection = collection
+        self.id = document_id
+
+    @property
+    def path(self):
+        return "{}/{}".format(self._collection, self.id)
+
+    def get(self, field_paths=None, transaction=None):
+        # type: (list, Transaction) -> DocumentSnapshot
+        if transaction is not None:
+            transaction._check_read()
+        data, version = self._client.backend.get(self._collection, self.id)
+        if transaction is not None:
+            transaction._reads.append((self._collection, self.id, version))
+        return DocumentSnapshot(self, data)
+
+    def create(self, document_data):
+        # type: (dict) -> None
+        self._client._commit([("create", self._collection, self.id, document_data)])
+
+    def set(self, document_data, merge=False):
+        # type: (dict, bool) -> None
+        self._client._commit([("merge" if merge else "set", self._collection, self.id, document_data)])
+
+    def update(self, field_updates):
+        # type: (dict) -> None
+        self._client._commit([("update", self._collection, self.id, field_updates)])
+
+    def delete(self):
+        # type: () -> None
+        self._client._commit([("delete", self._collection, self.id, None)])
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class Query(object):
+
+    def __init__(self, client, collection, filters=(), orders=(), limit=None):
+        self._client = client
+        self._collection = collection
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        # type: (str, str, object, object) -> Query
+        if filter is not None:
+            # google.cloud.firestore.FieldFilter; composite filters (And, Or) are not used by the stores
+            if not hasattr(filter, 'op_string'):
+                raise ValueError("Only FieldFilter filters are supported, not {!r}".format(filter))
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string not in _OPERATORS:
+            raise ValueError("Unsupported operator {!r}".format(op_string))
+        return Query(self._client, self._collection, self._filters + ((field_path, op_string, value),),
+                     self._orders, self._limit)
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        # type: (str, str) -> Query
+        return Query(self._client, self._collection, self._filters, self._orders + ((field_path, direction),),
+                     self._limit)
+
+    def limit(self, count):
+        # type: (int) -> Query
+        return Query(self._client, self._collection, self._filters, self._orders, count)
+
+    def stream(self, transaction=None):
+        """
+        Yields the snapshots of the matching documents, in a transaction recording the result
+        """
+
+        if transaction is not None:
+            transaction._check_read()
+        collection_version, result = self._client.backend.query(self._collection, self._filters, self._orders,
+                                                                 self._limit)
+        if transaction is not None:
+            transaction._queries.append((self._collection, self._filters, self._orders, self._limit, collection_version,
+                                         [(document_id, version) for document_id, _, version in result]))
+        for document_id, data, _ in result:
+            yield DocumentSnapshot(DocumentReference(self._client, self._collection, document_id), data)
+
+    def get(self, transaction=None):
+        # type: (Transaction) -> list
+        return list(self.stream(transaction=transaction))
+
+
+class CollectionReference(Query):
+
+    def __init__(self, client, name):
+        super(CollectionReference, self).__init__(client, name)
+        self.id = name
+
+    def document(self, document_id=None):
+        # type: (str) -> DocumentReference
+        if document_id is None:
+            document_id = "".join(random.choice(_ID_ALPHABET) for _ in range(20))
+        return DocumentReference(self._client, self._collection, document_id)
+
+    def add(self, document_data, document_id=None):
+        # type: (dict, str) -> tuple
+        reference = self.document(document_id)
+        reference.create(document_data)
+        return None, reference
+
+
+class WriteBatch(object):
+
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def create(self, reference, document_data):
+        self._writes.append(("create", reference._collection, reference.id, document_data))
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(("merge" if merge else "set", reference._collection, reference.id, document_data))
+
+    def update(self, reference, field_updates):
+        self._writes.append(("update", reference._collection, reference.id, field_updates))
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference._collection, reference.id, None))
+
+    def commit(self):
+        # type: () -> None
+        writes, self._writes = self._writes, []
+        self._client._commit(writes)
+
+
+class Transaction(WriteBatch):
+    """
+    Transaction with the protected members google.cloud.firestore.transactional drives
+    """
+
+    _read_only = False
+    _max_attempts = MAX_ATTEMPTS
+
+    def __init__(self, client):
+        super(Transaction, self).__init__(client)
+        self._id = None
+        self._reads = []
+        self._queries = []
+
+    def get(self, ref_or_query):
+        if isinstance(ref_or_query, DocumentReference):
+            return self._client.get_all([ref_or_query], transaction=self)
+        if isinstance(ref_or_query, Query):
+            return ref_or_query.stream(transaction=self)
+        raise ValueError('Value for argument "ref_or_query" must be a DocumentReference or a Query.')
+
+    def _check_read(self):
+        if self._writes:
+            raise ReadAfterWriteError("Attempted read after write in a transaction.")
+
+    def _clean_up(self):
+        self._writes, self._reads, self._queries = [], [], []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        if self._id is not None:
+            raise ValueError("The transaction has already begun.")
+        self._id = "".join(random.choice(_ID_ALPHABET) for _ in range(16)).encode('ascii')
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _commit(self):
+        try:
+            self._client._commit(self._writes, self._reads, self._queries)
+        finally:
+            self._clean_up()
+        return []
+
+
+class _ServingManager(BaseManager):
+    pass
+
+
+class _ConnectingManager(BaseManager):
+    pass
+
+
+_ConnectingManager.register('backend')
+
+
+def serve(backend):
+    # type: (FirestoreBackend) -> tuple
+    """
+    Serves a backend to other processes from a thread of this one, returns the (address, authkey) to connect to
+    """
+
+    authkey = "".join(random.choice(_ID_ALPHABET) for _ in range(32)).encode('ascii')
+    # Registered per server, the registry of a manager class is shared by its instances
+    manager_type = type('BackendManager', (_ServingManager,), dict())
+    manager_type.register('backend', callable=lambda: backend)
+    server = manager_type(address=('127.0.0.1', 0), authkey=authkey).get_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.address, authkey
+
+
+def connect(address, authkey):
+    # type: (tuple, bytes) -> FakeFirestore
+    """
+    Returns a client on the backend served by serve() in another process
+    """
+
+    manager = _ConnectingManager(address=tuple(address), authkey=authkey)
+    manager.connect()
+    return FakeFirestore(manager.backend())
+
+
+# Firestore orders values of different types by type: null, booleans, numbers, strings, bytes, arrays, maps
+_KINDS = {type(None): 0, bool: 1, int: 2, float: 2, str: 3, bytes: 4, list: 5, tuple: 5, dict: 6}
+
+
+def _kind(value):
+    return _KINDS.get(type(value), 6)
+
+
+def _index_key(value):
+    # Arrays and maps are not indexed for equality here, queries on them scan the collection
+    kind = _kind(value)
+    return (kind, value) if kind < 5 else None
+
+
+def _index(index, document_id, data):
+    for field, value in data.items():
+        key = _index_key(value)
+        if key is not None:
+            index.setdefault(field, dict()).setdefault(key, set()).add(document_id)
+
+
+def _unindex(index, document_id, data):
+    for field, value in (data or dict()).items():
+        key = _index_key(value)
+        if key is not None:
+            index[field][key].discard(document_id)
+
+
+def _sort_key(value):
+    if isinstance(value, dict):
+        return _kind(value), sorted((key, _sort_key(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return _kind(value), [_sort_key(item) for item in value]
+    return _kind(value), value
+
+
+def _equal(a, b):
+    return _kind(a) == _kind(b) and a == b
+
+
+_OPERATORS = {
+    "==": _equal,
+    "!=": lambda field_value, value: field_value is not None and not _equal(field_value, value),
+    "<": lambda field_value, value: _kind(field_value) == _kind(value) and field_value < value,
+    "<=": lambda field_value, value: _kind(field_value) == _kind(value) and field_value <= value,
+    ">": lambda field_value, value: _kind(field_value) == _kind(value) and field_value > value,
+    ">=": lambda field_value, value: _kind(field_value) == _kind(value) and field_value >= value,
+    "array_contains": lambda field_value, value: isinstance(field_value, list) and
+    any(_equal(item, value) for item in field_value),
+    "array_contains_any": lambda field_value, value: isinstance(field_value, list) and
+    any(_equal(item, candidate) for item in field_value for candidate in value),
+    "in": lambda field_value, value: any(_equal(field_value, candidate) for candidate in value),
+    "not-in": lambda field_value, value: field_value is not None and
+    not any(_equal(field_value, candidate) for candidate in value),
+}
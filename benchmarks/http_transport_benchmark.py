@@ -0,0 +1,247 @@
+"""
+Per-call latency of Bitmovin API calls with and without the pooled HTTP transport (http_transport.py).
+
+<p>A local TLS server stands in for the Bitmovin API. It answers every call with a Bitmovin response envelope
+(compressed if the client accepts gzip) after one simulated round trip, and delays the TLS handshake of every new
+connection by two round trips (TCP and TLS 1.3), as a remote API would. The self-signed certificate is created with
+the openssl command line tool.
+
+<p>The calls are made through the real SDK client (encodings.get and encodings.list), once sequentially and once
+from concurrent threads, as the encoding graph makes them. For every transport the per-call latency, the number of
+TLS connections the server accepted and the response bytes on the wire are reported. The "warm" row measures the
+first calls after warm_up() opened the connections.
+
+Requires the Bitmovin API SDK (vod-basic-encoder/requirements.txt), "HTTP2" additionally httpx[http2].
+
+Usage:
+    python benchmarks/http_transport_benchmark.py [--rtt 0.01] [--calls 200] [--threads 16] [--items 50]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vod-basic-encoder'))
+
+import config as Config
+import http_transport as HttpTransport
+
+
+def create_certificate(workdir):
+    certificate = os.path.join(workdir, 'stand-in.pem')
+    key = os.path.join(workdir, 'stand-in.key')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                           '-subj', '/CN=localhost', '-addext', 'subjectAltName=IP:127.0.0.1,DNS:localhost',
+                           '-keyout', key, '-out', certificate],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certificate, key
+
+
+def encoding_json(index):
+    return dict(id="encoding-{:06d}".format(index),
+                name="benchmark-encoding-{}".format(index),
+                description="Stand-in encoding for the HTTP transport benchmark",
+                cloudRegion="GOOGLE_US_CENTRAL_1",
+                encoderVersion="STABLE",
+                status="FINISHED",
+                createdAt="2020-01-01T00:00:00Z",
+                modifiedAt="2020-01-01T00:00:00Z",
+                labels=["benchmark", "transport"])
+
+
+class StandInApi(ThreadingMixIn, HTTPServer):
+    """
+    TLS server that answers like the Bitmovin API. The handshake runs in the thread of the connection, after the
+    simulated network delay.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, certificate, key, rtt, items):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(certificate, key)
+        self.rtt = rtt
+        self.items = items
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.body_bytes = 0
+
+    def finish_request(self, request, client_address):
+        time.sleep(2 * self.rtt)
+        # Headers and body are written separately, which would otherwise wait for delayed ACKs
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            request = self.ssl_context.wrap_socket(request, server_side=True)
+        except (ssl.SSLError, OSError):
+            return
+        with self.lock:
+            self.connections += 1
+        HTTPServer.finish_request(self, request, client_address)
+
+    def counters(self):
+        with self.lock:
+            return self.connections, self.requests, self.body_bytes
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, send_body=True):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        time.sleep(self.server.rtt)
+
+        path = self.path.split('?')[0].rstrip('/')
+        if path.endswith('/encoding/encodings'):
+            result = dict(totalCount=self.server.items, offset=0, limit=self.server.items,
+                          items=[encoding_json(index) for index in range(self.server.items)])
+        else:
+            result = encoding_json(0)
+        body = json.dumps(dict(requestId="stand-in", status="SUCCESS", data=dict(result=result))).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            body = gzip.compress(body, compresslevel=5)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.body_bytes += len(body) if send_body else 0
+
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        self._respond()
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def timed_call(call):
+    started = time.perf_counter()
+    call()
+    return time.perf_counter() - started
+
+
+def run_scenario(server, api, calls, threads, warm):
+    def call(index):
+        if index % 10 == 9:
+            return timed_call(lambda: api.encoding.encodings.list())
+        return timed_call(lambda: api.encoding.encodings.get(encoding_id="encoding-000000"))
+
+    before = server.counters()
+    if threads == 1:
+        latencies = [call(index) for index in range(calls)]
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            latencies = list(executor.map(call, range(calls)))
+    after = server.counters()
+    return dict(latencies=latencies,
+                connections=after[0] - before[0] + warm,
+                bytes=after[2] - before[2])
+
+
+def report(name, result):
+    latencies = [latency * 1000.0 for latency in result['latencies']]
+    print("{:<26} {:>6} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f} {:>7} {:>10}".format(
+        name, len(latencies), sum(latencies) / len(latencies), percentile(latencies, 0.5),
+        percentile(latencies, 0.99), latencies[0], result['connections'], result['bytes']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rtt', type=float, default=0.01, help="simulated network round trip in seconds")
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--items', type=int, default=50, help="encodings per list response")
+    parser.add_argument('--pool-size', type=int, default=Config.HTTP_POOL_SIZE)
+    parser.add_argument('--accept-encoding', default=Config.HTTP_ACCEPT_ENCODING)
+    parser.add_argument('--transports', default="SDK,POOLED,HTTP2")
+    args = parser.parse_args()
+
+    from bitmovin_api_sdk import BitmovinApi
+
+    workdir = tempfile.mkdtemp()
+    try:
+        certificate, key = create_certificate(workdir)
+        server = StandInApi(certificate, key, rtt=args.rtt, items=args.items)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = "https://127.0.0.1:{}/v1".format(server.server_address[1])
+
+        # Both requests (SDK, POOLED) and httpx (HTTP2) trust the self-signed certificate through the environment
+        os.environ['REQUESTS_CA_BUNDLE'] = certificate
+        os.environ['SSL_CERT_FILE'] = certificate
+        Config.HTTP_ACCEPT_ENCODING = args.accept_encoding
+
+        api = BitmovinApi(api_key="benchmark", base_url=base_url)
+
+        print("stand-in API at {}, round trip {:.0f} ms, pool size {}, Accept-Encoding: {}".format(
+            base_url, args.rtt * 1000, args.pool_size, args.accept_encoding))
+        print("{:<26} {:>6} {:>8} {:>8} {:>8} {:>8} {:>7} {:>10}".format(
+            "ms per call", "calls", "mean", "p50", "p99", "first", "conns", "bytes"))
+
+        for kind in args.transports.split(','):
+            if kind == "HTTP2":
+                try:
+                    import httpx  # noqa: F401
+                except ImportError:
+                    print("{:<26} skipped, httpx[http2] is not installed".format(kind))
+                    continue
+
+            sequential = HttpTransport.create_transport(kind, pool_size=args.pool_size)
+            HttpTransport.install(sequential)
+            report(kind + " sequential", run_scenario(server, api, args.calls, 1, 0))
+            sequential.close()
+
+            concurrent = HttpTransport.create_transport(kind, pool_size=args.pool_size)
+            HttpTransport.install(concurrent)
+            report(kind + " {} threads".format(args.threads),
+                   run_scenario(server, api, args.calls, args.threads, 0))
+            concurrent.close()
+
+            if kind != "SDK":
+                warm = HttpTransport.create_transport(kind, pool_size=args.pool_size)
+                HttpTransport.install(warm)
+                before = server.counters()[0]
+                HttpTransport.warm_up(warm, base_url, connections=args.threads)
+                warmed = server.counters()[0] - before
+                report(kind + " warm, {} threads".format(args.threads),
+                       run_scenario(server, api, args.threads, args.threads, warmed))
+                warm.close()
+        server.shutdown()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Replays a stream of jobs against the infrastructure pool of vod-basic-encoder without the Bitmovin API.
+
+<p>Three infrastructures with different weights and regions are configured. Jobs arrive with inputs in different
+bucket locations, running encodings end at random, and one region rejects a configurable share of its jobs (e.g. a
+quota error at start). The harness reports per infrastructure how many jobs it got, how many it rejected, how many
+of them were local to their input, and its peak utilization, plus how many jobs needed a failover. The replay
+runs in well under the failure window and cooldown, so a region that is cooled down stays out for the whole run.
+
+<p>The assignments are kept in SQLite, or with --store FIRESTORE in the in-memory Firestore of fake_firestore.py.
+Either way the in-flight encodings the pool reports must match the encodings the replay still runs.
+
+Usage:
+    python benchmarks/infrastructure_pool_harness.py [--jobs 2000] [--reject-rate 0.5] [--rejecting europe-west]
+                                                     [--store SQLITE|FIRESTORE]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vod-basic-encoder'))
+
+import config as Config
+import firestore_client as Firestore
+import infrastructure_pool as InfrastructurePool
+
+from fake_firestore import FakeFirestore
+
+POOL = [
+    dict(name="us-central", infrastructure_id="gce-us-central", cloud_region="GOOGLE_US_CENTRAL_1", weight=2,
+         max_in_flight=8),
+    dict(name="us-east", infrastructure_id="gce-us-east", cloud_region="GOOGLE_US_EAST_1", weight=1,
+         max_in_flight=4),
+    dict(name="europe-west", infrastructure_id="gce-europe-west", cloud_region="GOOGLE_EUROPE_WEST_1", weight=1,
+         max_in_flight=4, locations=["EU", "EUROPE-WEST1"]),
+]
+
+BUCKET_LOCATIONS = (("US", 0.5), ("US-CENTRAL1", 0.2), ("EU", 0.3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=2000)
+    parser.add_argument('--end-probability', type=float, default=0.35,
+                        help="probability that a running encoding ends in each step")
+    parser.add_argument('--rejecting', default="europe-west")
+    parser.add_argument('--reject-rate', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=11)
+    parser.add_argument('--store', default="SQLITE", choices=("SQLITE", "FIRESTORE"))
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    Config.INFRASTRUCTURE_POOL = POOL
+    Config.STATE_STORE = args.store
+    if args.store == "FIRESTORE":
+        Firestore.client = FakeFirestore()
+    Config.INFRASTRUCTURE_POOL_DB_FILE = os.path.join(tempfile.mkdtemp(), 'pool.db')
+    pool = InfrastructurePool.init_pool()
+
+    running = dict()
+    assigned, rejected, local, failovers, no_capacity = Counter(), Counter(), Counter(), 0, 0
+    peak = Counter()
+    encoding_ids = iter(range(10 ** 9))
+
+    for job in range(args.jobs):
+        location = rng.choices([l for l, _ in BUCKET_LOCATIONS], [w for _, w in BUCKET_LOCATIONS])[0]
+        attempts = []
+
+        def submit(infrastructure):
+            attempts.append(infrastructure.name)
+            if infrastructure.name == args.rejecting and rng.random() < args.reject_rate:
+                rejected[infrastructure.name] += 1
+                raise Exception("quota exceeded in {}".format(infrastructure.cloud_region))
+            encoding_id = "encoding-{}".format(next(encoding_ids))
+            running[encoding_id] = infrastructure.name
+            assigned[infrastructure.name] += 1
+            local[infrastructure.name] += InfrastructurePool.is_local(infrastructure, location)
+            return [encoding_id]
+
+        try:
+            InfrastructurePool.submit_with_failover(location=location, submit=submit)
+        except Exception:
+            no_capacity += 1
+        failovers += len(attempts) > 1
+
+        for entry in pool.utilization():
+            peak[entry['name']] = max(peak[entry['name']], entry['utilization'])
+
+        for encoding_id in [e for e in running if rng.random() < args.end_probability]:
+            assert pool.finish(encoding_id=encoding_id, state=InfrastructurePool.FINISHED), \
+                "the assignment of {} was not found".format(encoding_id)
+            del running[encoding_id]
+
+    in_flight = Counter(running.values())
+    utilization = pool.utilization()
+    reported = dict((entry['name'], entry['in_flight']) for entry in utilization)
+    assert all(reported[name] == in_flight[name] for name in reported), \
+        "in-flight encodings {} instead of {}".format(reported, dict(in_flight))
+
+    print("{:<12} {:>8} {:>9} {:>8} {:>14} {:>13}".format("", "jobs", "rejected", "local", "peak util", "failure rate"))
+    for entry in utilization:
+        name = entry['name']
+        print("{:<12} {:>8} {:>9} {:>7.0%} {:>14.0%} {:>13.0%}".format(
+            name, assigned[name], rejected[name], local[name] / float(assigned[name] or 1), peak[name],
+            entry['failure_rate']))
+    print("jobs with failover: {}, jobs without capacity: {} ({})".format(failovers, no_capacity, args.store))
+
+
+if __name__ == '__main__':
+    main()
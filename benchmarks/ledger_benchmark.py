@@ -0,0 +1,156 @@
+"""
+Benchmark of the encoding ledger against the former encodings.json read-modify-write.
+
+<p>The ledger (SqliteLedger or, with --store FIRESTORE, FirestoreLedger on the in-memory Firestore of fake_firestore.py)
+is filled up to --jobs encodings in batched writes. At every checkpoint the latency of --samples single upserts (a new
+encoding and a status update each) and of the queries is measured, which should stay flat while the ledger grows. The
+answers are checked along the way: the latest encoding of a new asset, the order of jobs_by_state and the total of
+throughput_per_hour. The in-memory Firestore scans what its indexes do not cover, so its latencies only show the
+number of calls, and --jobs defaults to 20000 for it. The JSON file is measured the same way up to --json-jobs
+encodings, where every write already rewrites the whole file.
+
+Usage:
+    python benchmarks/ledger_benchmark.py [--store SQLITE|FIRESTORE] [--jobs 1000000] [--checkpoints 5]
+                                          [--json-jobs 20000]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'vod-basic-encoder'))
+
+import firestore_client as Firestore
+import ledger as Ledger
+
+from fake_firestore import FakeFirestore
+
+BATCH_SIZE = 10000
+
+# Default --jobs per store
+JOBS = dict(SQLITE=1000000, FIRESTORE=20000)
+CODEC_TYPES = ("h264", "h265")
+
+
+def jobs(start, count):
+    for i in range(start, start + count):
+        yield ("asset-{:07d}.mp4".format(i // 2), CODEC_TYPES[i % 2], "encoding-{:08d}".format(i), Ledger.FINISHED)
+
+
+def measure(call, samples):
+    durations = []
+    for i in range(samples):
+        started = time.perf_counter()
+        call(i)
+        durations.append(time.perf_counter() - started)
+    durations.sort()
+    return durations[len(durations) // 2] * 1000, durations[int(len(durations) * 0.99)] * 1000
+
+
+def new_ledger(workdir, store):
+    if store == "FIRESTORE":
+        Firestore.client = FakeFirestore()
+        return Ledger.FirestoreLedger(collection_name="ledger-benchmark")
+    return Ledger.SqliteLedger(db_path=os.path.join(workdir, 'ledger.db'))
+
+
+def benchmark_ledger(workdir, store, total, checkpoints, samples):
+    ledger = new_ledger(workdir, store)
+    filled = 0
+    probe = [0]
+    errored = set()
+
+    print("ledger ({}):".format(store))
+    print("{:>10} {:>14} {:>14} {:>14} {:>14} {:>14}".format(
+        "jobs", "insert p50 ms", "insert p99 ms", "update p50 ms", "by asset ms", "by state ms"))
+
+    for checkpoint in range(1, checkpoints + 1):
+        target = total * checkpoint // checkpoints
+        while filled < target:
+            count = min(BATCH_SIZE, target - filled)
+            ledger.record_many(jobs(filled, count))
+            filled += count
+
+        def insert(i):
+            probe[0] += 1
+            ledger.record(asset_name="probe-{}.mp4".format(probe[0]), codec_type="h264",
+                          encoding_id="probe-{:08d}".format(probe[0]))
+
+        def update(i):
+            encoding_id = "encoding-{:08d}".format(i * 7 % filled)
+            assert ledger.set_status(encoding_id, Ledger.ERROR), "{} is not in the ledger".format(encoding_id)
+            errored.add(encoding_id)
+
+        insert_p50, insert_p99 = measure(insert, samples)
+        update_p50, _ = measure(update, samples)
+        by_asset, _ = measure(lambda i: ledger.jobs_by_asset("asset-{:07d}.mp4".format(i * 13 % (filled // 2))),
+                              samples)
+        by_state, _ = measure(lambda i: ledger.jobs_by_state(Ledger.ERROR, limit=10), samples)
+
+        latest = ledger.latest("probe-{}.mp4".format(probe[0]), "h264")
+        assert latest == "probe-{:08d}".format(probe[0]), "latest encoding of the last probe: {}".format(latest)
+        assert [row['codec_type'] for row in ledger.jobs_by_asset("asset-0000000.mp4")] == list(CODEC_TYPES)
+        updated = [row['updated_at'] for row in ledger.jobs_by_state(Ledger.ERROR, limit=10)]
+        assert len(updated) == 10 and updated == sorted(updated, reverse=True), "jobs_by_state is not in order"
+
+        print("{:>10} {:>14.3f} {:>14.3f} {:>14.3f} {:>14.3f} {:>14.3f}".format(
+            filled, insert_p50, insert_p99, update_p50, by_asset, by_state))
+
+    started = time.perf_counter()
+    hours = ledger.throughput_per_hour(since=0)
+    print("throughput per hour over {} jobs: {:.1f} ms".format(filled, (time.perf_counter() - started) * 1000))
+    assert sum(count for _, count in hours) == filled - len(errored), "throughput does not add up to the jobs"
+    return hours
+
+
+def benchmark_json(workdir, total, checkpoints, samples):
+    filename = os.path.join(workdir, 'encodings.json')
+    encoding_data = dict()
+
+    def write(asset_name, codec_type, encoding_id):
+        # The former write_encoding_info_to_file
+        data = dict()
+        if os.path.exists(filename):
+            with open(filename, 'r') as fp:
+                data = json.load(fp)
+        data.setdefault(asset_name, dict())[codec_type] = encoding_id
+        with open(filename, 'w') as fp:
+            json.dump(data, fp)
+
+    print("encodings.json:")
+    print("{:>10} {:>14} {:>14}".format("jobs", "write p50 ms", "write p99 ms"))
+
+    for checkpoint in range(1, checkpoints + 1):
+        target = total * checkpoint // checkpoints
+        for asset_name, codec_type, encoding_id, _ in jobs(sum(len(v) for v in encoding_data.values()),
+                                                           target - sum(len(v) for v in encoding_data.values())):
+            encoding_data.setdefault(asset_name, dict())[codec_type] = encoding_id
+        with open(filename, 'w') as fp:
+            json.dump(encoding_data, fp)
+
+        p50, p99 = measure(lambda i: write("probe-{}.mp4".format(i), "h264", "probe"), samples)
+        print("{:>10} {:>14.3f} {:>14.3f}".format(target, p50, p99))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--store', choices=sorted(JOBS), default="SQLITE")
+    parser.add_argument('--jobs', type=int, help="defaults to {}".format(
+        ", ".join("{} for {}".format(jobs, store) for store, jobs in sorted(JOBS.items()))))
+    parser.add_argument('--checkpoints', type=int, default=5)
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--json-jobs', type=int, default=20000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    benchmark_ledger(workdir, args.store, args.jobs or JOBS[args.store], args.checkpoints, args.samples)
+    benchmark_json(workdir, args.json_jobs, args.checkpoints, min(args.samples, 50))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Harness for the paginated list calls (pagination.py) against the local fake Bitmovin API server.
+
+<p>The server holds one encoding with thousands of TS muxings (video and audio renditions) and a thousand named H264
+codec configurations. The harness checks that
+  <ul>
+   <li>a single list call, as the functions made it before, only sees the first page,
+   <li>manifest-generator's _retrieve_ts_muxings sees every muxing exactly once and in order,
+   <li>a name filter is applied by the server: the lookup of one configuration is a single call,
+ </ul>
+and reports the time to iterate over all muxings with and without prefetching of the next page, with --work-ms of
+simulated processing per item.
+
+Requires the Bitmovin API SDK (manifest-generator/requirements.txt).
+
+Usage:
+    python benchmarks/pagination_harness.py [--muxings 3000] [--latency 0.02] [--work-ms 0.2] [--page-size 100]
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'manifest-generator'))
+
+import config as Config
+import pagination as Pagination
+
+from fake_bitmovin_server import FakeBitmovinServer
+
+
+def populate(server, muxings, configurations):
+    """
+    Stores an encoding with the given number of TS muxings and named configurations, returns the encoding ID and
+    the muxing IDs in creation order
+    """
+
+    latency, server.latency = server.latency, 0.0
+    _, encoding = server.handle_call("POST", "/encoding/encodings", dict(), dict(name="pagination"))
+    muxing_ids = []
+    for index in range(muxings):
+        media_type = "audio" if index % 4 == 3 else "video"
+        _, muxing = server.handle_call(
+            "POST", "/encoding/encodings/{}/muxings/ts".format(encoding['id']), dict(),
+            dict(segmentLength=4.0,
+                 outputs=[dict(outputId="output",
+                               outputPath="/outputs/catalog/{}/ts/clear/{:05d}".format(media_type, index))],
+                 streams=[dict(streamId="stream-{}".format(index))]))
+        muxing_ids.append(muxing['id'])
+    for index in range(configurations):
+        server.handle_call("POST", "/encoding/configurations/video/h264", dict(),
+                           dict(name="config-{:04d}".format(index), bitrate=1000 + index))
+    server.latency = latency
+    return encoding['id'], muxing_ids
+
+
+def timed_iteration(iterable, work_seconds):
+    started = time.perf_counter()
+    ids = []
+    for item in iterable:
+        ids.append(item.id)
+        if work_seconds:
+            # Busy work, as parsing and building manifest resources would do
+            until = time.perf_counter() + work_seconds
+            while time.perf_counter() < until:
+                pass
+    return ids, time.perf_counter() - started
+
+
+def check(condition, message, failures):
+    print("{} {}".format("ok  " if condition else "FAIL", message))
+    if not condition:
+        failures.append(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--muxings', type=int, default=3000)
+    parser.add_argument('--configurations', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds per API call")
+    parser.add_argument('--work-ms', type=float, default=0.2, help="processing per item in milliseconds")
+    parser.add_argument('--page-size', type=int, default=Config.API_LIST_PAGE_SIZE)
+    args = parser.parse_args()
+
+    # The SDK logs every request and response
+    logging.disable(logging.DEBUG)
+
+    server = FakeBitmovinServer(latency=args.latency).start()
+    encoding_id, muxing_ids = populate(server, args.muxings, args.configurations)
+
+    workdir = tempfile.mkdtemp()
+    Config.BITMOVIN_API_KEY = "pagination"
+    Config.BITMOVIN_API_BASE_URL = server.base_url
+    Config.STATE_STORE = "SQLITE"
+    Config.LEDGER_DB_FILE = os.path.join(workdir, "ledger.db")
+    Config.LEDGER_IMPORT_JSON_FILE = None
+    Config.METRICS_ENABLED = False
+    Config.API_LIST_PAGE_SIZE = args.page_size
+
+    import main as ManifestGenerator
+    from bitmovin_api_sdk import H264VideoConfigurationListQueryParams, TsMuxingListQueryParams
+
+    api = ManifestGenerator.bitmovin_api
+    ts_api = api.encoding.encodings.muxings.ts
+    failures = []
+
+    single_page = ts_api.list(encoding_id=encoding_id).items
+    check(len(single_page) < len(muxing_ids),
+          "a single list call returns {} of {} muxings".format(len(single_page), len(muxing_ids)), failures)
+
+    before = server.total_calls()
+    retrieved = ManifestGenerator._retrieve_ts_muxings(encoding_id=encoding_id)
+    calls = server.total_calls() - before
+    retrieved_ids = [muxing.id for muxing in retrieved]
+    check(retrieved_ids == muxing_ids,
+          "_retrieve_ts_muxings returns all {} muxings once and in order ({} calls)".format(len(retrieved_ids),
+                                                                                            calls), failures)
+
+    before = server.total_calls()
+    found = Pagination.first(api.encoding.configurations.video.h264.list, H264VideoConfigurationListQueryParams,
+                             filters=dict(name="config-{:04d}".format(args.configurations - 1)))
+    calls = server.total_calls() - before
+    check(found is not None and found.name == "config-{:04d}".format(args.configurations - 1) and calls == 1,
+          "the name filter finds the last of {} configurations with {} call".format(args.configurations, calls),
+          failures)
+
+    print()
+    print("{:<22} {:>8} {:>8} {:>10}".format("iteration", "items", "calls", "seconds"))
+    work_seconds = args.work_ms / 1000.0
+    for prefetch in (False, True):
+        before = server.total_calls()
+        ids, seconds = timed_iteration(Pagination.iterate(ts_api.list, TsMuxingListQueryParams, prefetch=prefetch,
+                                                          encoding_id=encoding_id), work_seconds)
+        label = "prefetch" if prefetch else "no prefetch"
+        print("{:<22} {:>8} {:>8} {:>10.3f}".format(label, len(ids), server.total_calls() - before, seconds))
+        if ids != muxing_ids:
+            failures.append("iteration with {} did not return every muxing once and in order".format(label))
+
+    server.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""
+Startup of a simulated HLS player on the master playlists of manifest-generator, per device class.
+
+<p>A finished encoding of the ladder of verify_local_manifests.py is stored in the local fake Bitmovin API server,
+its renditions created from the highest to the lowest as vod-basic-encoder creates them. generate_hls_dash_manifests
+then writes its manifests locally (MANIFEST_WRITER "LOCAL") with a master playlist per device class of --start-bitrates.
+
+<p>The player starts on the first variant of a master playlist, as most HLS players do: it loads the master and the
+media playlist and downloads the first segment at the throughput of its device class, then plays while it downloads
+the following segments, switching after every segment to the highest variant whose BANDWIDTH fits 80% of the
+throughput it measured. Per device class the harness reports the startup time (until the first segment is loaded),
+the start variant, the stall time and the average bitrate of the first --watch seconds for
+  <ul>
+   <li>"listed": the master playlist with the variants in the order the API lists the muxings, as before the
+       rendition index,
+   <li>"indexed": the master playlist of the device class (see rendition_index.py).
+ </ul>
+The manifests of a second encoding are then generated through the API (MANIFEST_WRITER "API"), whose master playlist
+lists the variants in the order of their creation: the first stream info of every HLS manifest must be the start
+variant of its device class.
+The network and player are a model, not a measurement: compare the two orderings, not the absolute numbers.
+
+Requires the Bitmovin API SDK (manifest-generator/requirements.txt).
+
+Usage:
+    python benchmarks/player_startup_harness.py [--start-bitrates default=1500000,mobile=800000,tv=5000000]
+                                                [--watch 30]
+"""
+
+import argparse
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'manifest-generator'))
+
+import config as Config
+
+from e2e_benchmark import _Request
+from fake_bitmovin_server import FakeBitmovinServer
+from verify_local_manifests import INPUT_DURATION, OUTPUT_ROOT, SEGMENT_LENGTH, create_encoding
+
+# Network of a device class: (throughput in bits per second, round trip time in seconds)
+NETWORKS = dict(mobile=(1200000, 0.12), default=(4000000, 0.05), tv=(12000000, 0.03))
+
+# Share of the measured throughput a variant may use
+SAFETY = 0.8
+
+STREAM_INF = re.compile(r'^#EXT-X-STREAM-INF:(.*)$')
+
+
+def parse_master(text):
+    # type: (str) -> list
+    """
+    Returns the variants of a master playlist in their order: dict(uri, bandwidth, average_bandwidth)
+    """
+
+    variants = []
+    lines = text.splitlines()
+    for number, line in enumerate(lines):
+        match = STREAM_INF.match(line)
+        if match:
+            attributes = dict(re.findall(r'([A-Z-]+)=("[^"]*"|[^,]*)', match.group(1)))
+            bandwidth = int(attributes['BANDWIDTH'])
+            variants.append(dict(uri=lines[number + 1], bandwidth=bandwidth,
+                                 average_bandwidth=int(attributes.get('AVERAGE-BANDWIDTH', bandwidth))))
+    return variants
+
+
+def play(variants, throughput, rtt, watch, segment_length=SEGMENT_LENGTH):
+    # type: (list, float, float, float, float) -> dict
+    """
+    Plays the first watch seconds of a master playlist on a network, returns the startup metrics
+    """
+
+    by_bandwidth = sorted(variants, key=lambda v: v['bandwidth'])
+
+    def download(variant):
+        return rtt + variant['average_bandwidth'] * segment_length / float(throughput)
+
+    # Master and media playlist, then the first segment of the first variant
+    variant = variants[0]
+    clock = 2 * rtt + download(variant)
+    startup = clock
+    buffered = segment_length
+    stalled = 0.0
+    played_bits = variant['average_bandwidth'] * segment_length
+
+    while buffered < watch:
+        measured = variant['average_bandwidth'] * segment_length / (download(variant) - rtt)
+        fitting = [v for v in by_bandwidth if v['bandwidth'] <= SAFETY * measured]
+        variant = fitting[-1] if fitting else by_bandwidth[0]
+
+        # Playback drains the buffer while the next segment downloads
+        seconds = download(variant)
+        playable = buffered - (clock - startup - stalled)
+        if seconds > playable:
+            stalled += seconds - playable
+        clock += seconds
+        buffered += segment_length
+        played_bits += variant['average_bandwidth'] * segment_length
+
+    return dict(startup=startup, start_variant=variants[0], stalled=stalled, average_bitrate=played_bits / buffered)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--start-bitrates', default="default=1500000,mobile=800000,tv=5000000",
+                        help="start bitrate per device class, see HLS_START_BITRATES")
+    parser.add_argument('--watch', type=float, default=30.0, help="seconds of playback to simulate")
+    args = parser.parse_args()
+
+    # The SDK logs every request and response
+    logging.disable(logging.DEBUG)
+
+    start_bitrates = dict((device_class, int(bitrate)) for device_class, bitrate in
+                          (entry.split("=") for entry in args.start_bitrates.split(",")))
+    unknown = set(start_bitrates) - set(NETWORKS)
+    if unknown:
+        parser.error("no network modelled for {}".format(", ".join(sorted(unknown))))
+
+    workdir = tempfile.mkdtemp()
+    storage_root = os.path.join(workdir, "bucket")
+    server = FakeBitmovinServer(input_duration=INPUT_DURATION).start()
+
+    Config.BITMOVIN_API_KEY = "startup"
+    Config.BITMOVIN_API_BASE_URL = server.base_url
+    Config.STATE_STORE = "SQLITE"
+    Config.LEDGER_DB_FILE = os.path.join(workdir, "ledger.db")
+    Config.WEBHOOK_STORE = "SQLITE"
+    Config.WEBHOOK_STORE_DB_FILE = os.path.join(workdir, "webhook-deliveries.db")
+    Config.LEDGER_IMPORT_JSON_FILE = None
+    Config.METRICS_ENABLED = False
+    Config.MANIFEST_WRITER = "LOCAL"
+    Config.MANIFEST_STORAGE_DIR = storage_root
+    Config.HLS_START_BITRATES = start_bitrates
+
+    import main as ManifestGenerator
+    from bitmovin_api_sdk import BitmovinApi
+
+    try:
+        encoding_id, _ = create_encoding(BitmovinApi(api_key="startup", base_url=server.base_url), storage_root,
+                                         "TS_MP4")
+        ManifestGenerator.generate_hls_dash_manifests(
+            _Request(dict(eventType="ENCODING_FINISHED", encoding=dict(id=encoding_id))))
+        listed_paths = [ManifestGenerator._extract_relative_muxing_path(muxing.outputs[0].output_path, OUTPUT_ROOT)
+                        for muxing in ManifestGenerator._retrieve_ts_muxings(encoding_id=encoding_id)]
+
+        masters = dict()
+        for device_class in start_bitrates:
+            name = "{}.m3u8".format(ManifestGenerator._hls_manifest_name(device_class))
+            with open(os.path.join(storage_root, OUTPUT_ROOT.lstrip("/"), name)) as fp:
+                masters[device_class] = parse_master(fp.read())
+
+        # The stream infos the API writer creates first, per master playlist
+        Config.MANIFEST_WRITER = "API"
+        encoding_id, _ = create_encoding(BitmovinApi(api_key="startup", base_url=server.base_url), storage_root,
+                                         "TS_MP4")
+        ManifestGenerator.generate_hls_dash_manifests(
+            _Request(dict(eventType="ENCODING_FINISHED", encoding=dict(id=encoding_id))))
+        first_stream_infos = dict()
+        for manifest in server.stored("/encoding/manifests/hls"):
+            stream_infos = server.stored("/encoding/manifests/hls/{}/streams".format(manifest['id']))
+            first_stream_infos[manifest['manifestName']] = stream_infos[0]['uri'] if stream_infos else None
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # The variants in the order the API lists their muxings
+    variants = masters[sorted(masters)[0]]
+    listed = sorted(variants, key=lambda v: min(n for n, p in enumerate(listed_paths) if v['uri'].startswith(p)))
+
+    print("{:<9} {:<8} {:>10} {:>12} {:>10} {:>14}".format("device", "master", "startup s", "start kbps",
+                                                            "stalled s", "average kbps"))
+    failures = []
+    for device_class in sorted(start_bitrates):
+        throughput, rtt = NETWORKS[device_class]
+        results = dict()
+        for ordering, ordered in (("listed", listed), ("indexed", masters[device_class])):
+            results[ordering] = result = play(ordered, throughput, rtt, args.watch)
+            print("{:<9} {:<8} {:>10.2f} {:>12.0f} {:>10.2f} {:>14.0f}".format(
+                device_class, ordering, result['startup'], result['start_variant']['bandwidth'] / 1000.0,
+                result['stalled'], result['average_bitrate'] / 1000.0))
+        if results['indexed']['startup'] > results['listed']['startup']:
+            failures.append("{} starts slower on its indexed master playlist".format(device_class))
+
+    for device_class in sorted(start_bitrates):
+        name = "{}.m3u8".format(ManifestGenerator._hls_manifest_name(device_class))
+        # The media playlist directory of the start variant
+        start_variant = os.path.dirname(masters[device_class][0]['uri'])
+        print("{:<9} api      first stream info {}".format(device_class, first_stream_infos.get(name)))
+        if not (first_stream_infos.get(name) or "").startswith(start_variant):
+            failures.append("{} does not start on {} with the API writer".format(device_class, start_variant))
+
+    for failure in failures:
+        print("FAIL " + failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+Harness for the source probe of vod-basic-encoder (source_probe.py) against the MP4 files in benchmarks/fixtures.
+
+<p>Uploads of the fixtures go through the ladder selection of the function with the default SOURCE_PROBE_ENABLED,
+with the GCS object replaced by the local file (LocalFileReader). The fixtures are small, so the first read of the probe
+is shortened to INITIAL_READ_SIZE below, and the boxes are walked with ranged reads as for a large upload. For every
+fixture the probed properties, the pruned ladders and that the media data was not read are checked:
+  <ul>
+   <li>landscape-720p.mp4: 1280x720 at 25 fps with stereo AAC at 128 kbit/s, 'moov' before 'mdat' (faststart),
+   <li>rotated-portrait.mp4: 960x540 coded, displayed rotated by 90 degrees, with mono AAC at 96 kbit/s and 'moov'
+       after 'mdat', so the probe has to skip the media data,
+   <li>audio-only.mp4: stereo AAC at 64 kbit/s without a video track, the video ladder is empty,
+   <li>a file that is not an MP4: the probe fails and the full ladders are used.
+ </ul>
+The audio-only upload is then submitted against the local fake Bitmovin API server with the encoding graph (with the
+manifests created by the function and at the start of the encoding) and with encoding templates. Every encoding must
+only have streams of AAC configurations.
+
+The fixtures were generated with ffmpeg 7 from its color and sine sources (libx264 and aac encoders, 2 s each,
+keyframes every second), the rotated one with the input option -display_rotation 90 and without -movflags +faststart.
+
+Requires the Bitmovin API SDK (vod-basic-encoder/requirements.txt).
+
+Usage:
+    python benchmarks/source_probe_harness.py
+"""
+
+import logging
+import os
+import sys
+import tempfile
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'vod-basic-encoder'))
+
+import config as Config
+import source_probe as SourceProbe
+
+from fake_bitmovin_server import FakeBitmovinServer
+
+FIXTURES = os.path.join(BENCHMARKS, 'fixtures')
+
+# Fixture, expected source properties (audio bitrate: nominal, the encoder hits it within a few percent), heights of
+# the pruned video ladder and bitrates of the pruned audio ladder
+EXPECTED = [
+    ("landscape-720p.mp4",
+     dict(width=1280, height=720, frame_rate=25.0, duration=2.0, audio_channels=2, audio_bitrate=128000,
+          audio_sample_rate=48000, keyframes=(0.0, 1.0), has_video=True),
+     [720, 720, 540, 360, 288, 216], [128000, 96000, 64000]),
+    ("rotated-portrait.mp4",
+     dict(width=540, height=960, frame_rate=30.0, duration=2.0, audio_channels=1, audio_bitrate=96000,
+          audio_sample_rate=44100, keyframes=(0.0, 1.0), has_video=True),
+     [540, 360, 288, 216], [96000, 64000]),
+    ("audio-only.mp4",
+     dict(width=None, height=None, frame_rate=None, duration=2.0, audio_channels=2, audio_bitrate=64000,
+          audio_sample_rate=48000, keyframes=None, has_video=False),
+     [], [64000]),
+]
+
+AUDIO_BITRATE_TOLERANCE = 0.05
+
+INITIAL_READ_SIZE = 1024
+
+AAC_CONFIGURATIONS = "/encoding/configurations/audio/aac"
+
+# Submission mode and manifest generation of the audio-only submissions
+SUBMISSIONS = [
+    ("GRAPH", "WEBHOOK"),
+    ("GRAPH", "START"),
+    ("TEMPLATE", "WEBHOOK"),
+]
+
+
+class CountingReader(SourceProbe.LocalFileReader):
+    """
+    LocalFileReader that counts the reads and bytes of the probe
+    """
+
+    reads = 0
+    bytes_read = 0
+
+    def read(self, offset, length):
+        data = super(CountingReader, self).read(offset, length)
+        CountingReader.reads += 1
+        CountingReader.bytes_read += len(data)
+        return data
+
+
+def fixture_reader(root):
+    def reader(bucket_name, object_name, size=None):
+        return CountingReader(os.path.join(root, os.path.basename(object_name)))
+    return reader
+
+
+def check(failures, fixture, condition, message):
+    print("{} {:<22} {}".format("ok  " if condition else "FAIL", fixture, message))
+    if not condition:
+        failures.append("{}: {}".format(fixture, message))
+
+
+def submit_audio_only(failures, main):
+    """
+    Submits the audio-only fixture against the fake Bitmovin API server and checks the streams of its encodings
+    """
+
+    workdir = tempfile.mkdtemp()
+    logging.disable(logging.DEBUG)
+    Config.BITMOVIN_API_KEY = "source-probe"
+    for name in dir(Config):
+        if name.endswith('_DB_FILE') or name.endswith('_INDEX_FILE') or name.endswith('_SNAPSHOT_FILE'):
+            setattr(Config, name, os.path.join(workdir, name.lower()))
+    # The shared stores need Firestore, the local ones are enough for a single process
+    Config.STATE_STORE = "SQLITE"
+    Config.LEDGER_IMPORT_JSON_FILE = None
+
+    server = FakeBitmovinServer(encode_duration=0.05, manifest_duration=0.05).start()
+    Config.BITMOVIN_API_BASE_URL = server.base_url
+    SourceProbe.GcsRangeReader = fixture_reader(FIXTURES)
+    size = str(os.path.getsize(os.path.join(FIXTURES, "audio-only.mp4")))
+
+    try:
+        for index, (submission_mode, manifest_generation) in enumerate(SUBMISSIONS):
+            Config.SUBMISSION_MODE = submission_mode
+            Config.MANIFEST_GENERATION = manifest_generation
+            label = "{} {}".format(submission_mode.lower(), manifest_generation.lower())
+            encodings = set(encoding['id'] for encoding in server.stored("/encoding/encodings"))
+            stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+            try:
+                # Every submission is an upload of its own, so the dedupe does not drop it
+                main.encoding_h264_vod_preset(dict(bucket="input-bucket", name="{}/audio-only.mp4".format(index),
+                                                   contentType="video/mp4", size=size, metageneration="1"), None)
+                error = None
+            except Exception as e:
+                error = e
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            if error is not None:
+                check(failures, label, False, "audio-only upload failed: {}".format(error))
+                continue
+
+            aac = set(configuration['id'] for configuration in server.stored(AAC_CONFIGURATIONS))
+            new = [encoding['id'] for encoding in server.stored("/encoding/encodings")
+                   if encoding['id'] not in encodings]
+            streams = [stream for encoding_id in new
+                       for stream in server.stored("/encoding/encodings/{}/streams".format(encoding_id))]
+            not_aac = [stream for stream in streams if stream['codecConfigId'] not in aac]
+            check(failures, label, len(new) == 1 and streams and not not_aac,
+                  "audio-only upload: {} encodings, {} streams, {} not AAC".format(len(new), len(streams),
+                                                                                  len(not_aac)))
+    finally:
+        server.shutdown()
+
+
+def main():
+    failures = []
+    check(failures, "config", Config.SOURCE_PROBE_ENABLED, "SOURCE_PROBE_ENABLED is on by default")
+
+    import main as Main
+
+    video_ladder, audio_ladder = Main.VIDEO_LADDER, Main.AUDIO_LADDER
+    SourceProbe.GcsRangeReader = fixture_reader(FIXTURES)
+    SourceProbe.INITIAL_READ_SIZE = INITIAL_READ_SIZE
+
+    for fixture, expected, video_heights, audio_bitrates in EXPECTED:
+        CountingReader.reads = CountingReader.bytes_read = 0
+        event = dict(bucket="input-bucket", name=fixture, size=str(os.path.getsize(os.path.join(FIXTURES, fixture))))
+        video, audio, source_info = Main._select_ladder(event=event, video_ladder=video_ladder,
+                                                        audio_ladder=audio_ladder)
+        if source_info is None:
+            check(failures, fixture, False, "could not be probed")
+            continue
+
+        probed = source_info._asdict()
+        bitrate = probed.pop('audio_bitrate')
+        nominal = expected.pop('audio_bitrate')
+        check(failures, fixture, probed == expected, "probed {}".format(probed))
+        check(failures, fixture, abs(bitrate - nominal) <= nominal * AUDIO_BITRATE_TOLERANCE,
+              "audio bitrate {} bit/s".format(bitrate))
+        check(failures, fixture, [rendition['height'] for rendition in video] == video_heights,
+              "video ladder {}".format([rendition['height'] for rendition in video]))
+        check(failures, fixture, [rendition['bitrate'] for rendition in audio] == audio_bitrates,
+              "audio ladder {}".format([rendition['bitrate'] for rendition in audio]))
+        check(failures, fixture, CountingReader.bytes_read < int(event['size']) / 2,
+              "header only: {} reads, {} of {} bytes".format(CountingReader.reads, CountingReader.bytes_read,
+                                                             event['size']))
+
+    # A source that is not an MP4/MOV file falls back to the full ladders
+    workdir = tempfile.mkdtemp()
+    with open(os.path.join(workdir, "not-an-mp4.ts"), 'wb') as fp:
+        fp.write(b'\x47' + b'\xff' * 187)
+    SourceProbe.GcsRangeReader = fixture_reader(workdir)
+    video, audio, source_info = Main._select_ladder(event=dict(bucket="input-bucket", name="not-an-mp4.ts"),
+                                                    video_ladder=video_ladder, audio_ladder=audio_ladder)
+    check(failures, "not-an-mp4.ts", source_info is None and video == video_ladder and audio == audio_ladder,
+          "not probed, full ladders")
+
+    submit_audio_only(failures, Main)
+
+    if failures:
+        for failure in failures:
+            print("FAILED: " + failure)
+        sys.exit(1)
+    print("probed properties and pruned ladders match the fixtures")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+Local harness for split-and-stitch encodings of long-form sources.
+
+<p>A synthetic source (duration and keyframe times as the source probe would report them) is split by
+vod-basic-encoder, and every chunk encoding is built and started against the in-process fake Bitmovin API. The split
+plan is written to a temporary folder instead of GCS. The chunks are then stitched by manifest-generator/stitcher.py
+and the result is checked:
+  <ul>
+   <li>the chunks are contiguous, lie on the segment grid and cover the whole source,
+   <li>every chunk encoding trims exactly its range and runs on its planned infrastructure,
+   <li>the stitched HLS playlists and the DASH manifest list every segment once, in order, with the source duration,
+   <li>every stitched master playlist lists all video renditions, starting on the start variant of its device class.
+ </ul>
+
+Requires the Bitmovin API SDK (vod-basic-encoder/requirements.txt).
+
+Usage:
+    python benchmarks/split_stitch_harness.py [--duration 10800] [--chunk-duration 600] [--latency 0.02]
+"""
+
+import argparse
+import importlib.util
+import math
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ElementTree
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'vod-basic-encoder'))
+
+from bitmovin_api_sdk import CloudRegion, InfrastructureSettings, Status
+
+import config as Config
+import utils as Utils
+import source_probe as SourceProbe
+import split_encode as SplitEncode
+
+from fake_bitmovin_api import FakeBitmovinApi
+
+
+class LocalStorage(object):
+
+    def __init__(self, root):
+        self.root = root
+
+    def read_text(self, object_path):
+        with open(os.path.join(self.root, object_path.lstrip("/")), 'r') as fp:
+            return fp.read()
+
+    def write_text(self, object_path, text, content_type):
+        file_path = os.path.join(self.root, object_path.lstrip("/"))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w') as fp:
+            fp.write(text)
+
+
+def load_stitcher():
+    # The manifest generator has its own config and utils modules, so only the stitcher is loaded from it
+    spec = importlib.util.spec_from_file_location("stitcher", os.path.join(ROOT, 'manifest-generator', 'stitcher.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_keyframes(duration, gop, seed):
+    # A fixed GOP with extra keyframes at scene cuts, and edited-in passages whose GOP is out of phase, so some
+    # segment boundaries are not keyframe-aligned and have to be moved
+    rng = random.Random(seed)
+    keyframes = set(round(i * gop, 3) for i in range(int(duration / gop) + 1))
+    for _ in range(int(duration / 120)):
+        keyframes.add(round(rng.uniform(0, duration), 3))
+    for _ in range(int(duration / 300)):
+        start = rng.uniform(0, duration - 60)
+        end = start + rng.uniform(20, 60)
+        keyframes = set(k for k in keyframes if not start <= k < end)
+        keyframes.update(round(start + i * gop, 3) for i in range(int((end - start) / gop) + 1))
+    return tuple(sorted(k for k in keyframes if k < duration))
+
+
+def check(condition, message, failures):
+    if not condition:
+        failures.append(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=10800.0)
+    parser.add_argument('--chunk-duration', type=float, default=600.0)
+    parser.add_argument('--gop', type=float, default=2.0)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds every fake API call takes")
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    Config.SPLIT_CHUNK_DURATION = args.chunk_duration
+    Config.SPLIT_INFRASTRUCTURE_IDS = ["gce-account-a", "gce-account-b"]
+    Config.CONFIG_REGISTRY_INDEX_FILE = os.path.join(workdir, 'configurations.json')
+    Config.BOOTSTRAP_SNAPSHOT_FILE = os.path.join(workdir, 'bootstrap.json')
+    Config.STATE_STORE = "SQLITE"
+    Config.LEDGER_DB_FILE = os.path.join(workdir, 'ledger.db')
+
+    api = FakeBitmovinApi(latency=args.latency, status_type=lambda status: Status[status])
+    Utils.bitmovin_api = api
+    storage = LocalStorage(os.path.join(workdir, 'bucket'))
+    SplitEncode.plan_storage = storage
+
+    import main as Main
+    import job_context as JobContext
+
+    source_info = SourceProbe.SourceInfo(width=1920, height=1080, frame_rate=25.0, duration=args.duration,
+                                         audio_channels=2, audio_bitrate=192000, audio_sample_rate=48000,
+                                         keyframes=synthetic_keyframes(args.duration, args.gop, args.seed),
+                                         has_video=True)
+    context = JobContext.create(event=dict(bucket="input-bucket", name="feature-film.mp4"),
+                                profile_name="default",
+                                output_prefix="",
+                                video_ladder=Main.VIDEO_LADDER,
+                                audio_ladder=Main.AUDIO_LADDER,
+                                source_info=source_info,
+                                name_prefix=Main.EXAMPLE_NAME)
+    context = context._replace(infrastructure=InfrastructureSettings(cloud_region=CloudRegion[Config.CLOUD_REGION],
+                                                                     infrastructure_id=Config.GCE_ACCOUNT_ID))
+    output_root = context.output_root
+
+    started = time.perf_counter()
+    Main._submit_split_encoding(context=context)
+    submission_time = time.perf_counter() - started
+
+    Stitcher = load_stitcher()
+    plan = Stitcher.load_plan(storage, SplitEncode.plan_object_path(output_root))
+    statuses = [api.encoding.encodings.status(encoding_id=chunk['encoding_id']).status for chunk in plan['chunks']]
+    # Master playlist per device class as written by the manifest generator for HLS_START_BITRATES
+    start_bitrates = {"hls-manifest": 1500000, "hls-manifest-mobile": 800000, "hls-manifest-tv": 10 ** 9}
+    written = Stitcher.stitch(plan=plan, storage=storage, output_base_path=Config.OUTPUT_BASE_PATH,
+                              start_bitrates=start_bitrates)
+
+    failures = []
+    chunks = plan['chunks']
+    segment_length = plan['segment_length']
+    total_segments = int(math.ceil(args.duration / segment_length - 1e-9))
+
+    # Planning
+    for previous, chunk in zip(chunks, chunks[1:]):
+        check(abs(previous['offset'] + previous['duration'] - chunk['offset']) < 1e-6,
+              "chunk {} does not start where chunk {} ends".format(chunk['index'], previous['index']), failures)
+        check(previous['first_segment'] + previous['segment_count'] == chunk['first_segment'],
+              "segment numbering of chunk {} is not continuous".format(chunk['index']), failures)
+    for chunk in chunks:
+        check(abs(chunk['offset'] / segment_length - round(chunk['offset'] / segment_length)) < 1e-9,
+              "chunk {} does not start on the segment grid".format(chunk['index']), failures)
+    check(abs(sum(chunk['duration'] for chunk in chunks) - args.duration) < 1e-6, "chunks do not cover the source",
+          failures)
+    check(sum(chunk['segment_count'] for chunk in chunks) == total_segments, "segment count differs", failures)
+    aligned = sum(1 for chunk in chunks[1:] if SplitEncode._is_keyframe(source_info.keyframes, chunk['offset']))
+
+    # Chunk encodings
+    trimmings = dict((parents['encoding_id'], model)
+                     for parents, model in api.stored('encoding.encodings.input_streams.trimming.time_based'))
+    encodings = dict((model.id, model) for _, model in api.stored('encoding.encodings'))
+    for chunk in chunks:
+        trimming = trimmings.get(chunk['encoding_id'])
+        check(trimming is not None and trimming.offset == chunk['offset'] and trimming.duration == chunk['duration'],
+              "chunk {} is not trimmed to its range".format(chunk['index']), failures)
+        check(encodings[chunk['encoding_id']].infrastructure.infrastructure_id == chunk['infrastructure_id'],
+              "chunk {} runs on the wrong infrastructure".format(chunk['index']), failures)
+    check(all(getattr(status, 'value', status) == "FINISHED" for status in statuses), "chunks not finished", failures)
+
+    # Stitched manifests
+    for rendition in plan['renditions']:
+        playlist = storage.read_text(os.path.join(Config.OUTPUT_BASE_PATH, output_root,
+                                                  "{}-{}.m3u8".format(rendition['media_type'],
+                                                                      rendition['rendition_path'])))
+        durations = [float(value) for value in re.findall(r"#EXTINF:([0-9.]+),", playlist)]
+        segments = re.findall(r"^(chunk-\d+/.*segment_(\d+)\.m4s)$", playlist, re.MULTILINE)
+        check(len(durations) == total_segments and len(segments) == total_segments,
+              "{} does not list every segment once".format(rendition['rendition_path']), failures)
+        check(abs(sum(durations) - args.duration) < 1e-3,
+              "{} playlist duration is {:.3f} s".format(rendition['rendition_path'], sum(durations)), failures)
+        check(playlist.count("#EXT-X-DISCONTINUITY") == len(chunks) - 1,
+              "{} has wrong discontinuities".format(rendition['rendition_path']), failures)
+
+    video_bitrates = sorted(r['bitrate'] for r in plan['renditions'] if r['media_type'] == "video")
+    for master_name, start_bitrate in start_bitrates.items():
+        master = storage.read_text(os.path.join(Config.OUTPUT_BASE_PATH, output_root, master_name + ".m3u8"))
+        bitrates = [int(value) for value in re.findall(r"BANDWIDTH=(\d+)", master)]
+        audio_bitrate = max(r['bitrate'] for r in plan['renditions'] if r['media_type'] == "audio")
+        expected = max([b for b in video_bitrates if b <= start_bitrate] or video_bitrates[:1])
+        check(sorted(b - audio_bitrate for b in bitrates) == video_bitrates,
+              "{} does not list every video rendition once".format(master_name), failures)
+        check(bitrates and bitrates[0] - audio_bitrate == expected,
+              "{} does not start on its start variant".format(master_name), failures)
+
+    mpd = ElementTree.fromstring(storage.read_text(os.path.join(Config.OUTPUT_BASE_PATH, output_root,
+                                                                Stitcher.DASH_MANIFEST_NAME)))
+    periods = mpd.findall('{urn:mpeg:dash:schema:mpd:2011}Period')
+    check(len(periods) == len(chunks), "DASH manifest has {} periods".format(len(periods)), failures)
+    for period, chunk in zip(periods, chunks):
+        check(period.get('start') == "PT{:.3f}S".format(chunk['offset']),
+              "period {} starts at {}".format(chunk['index'], period.get('start')), failures)
+
+    print("source:        {:.0f} s, {} keyframes, {:.0f} s segments -> {} segments".format(
+        args.duration, len(source_info.keyframes), segment_length, total_segments))
+    print("chunks:        {} (~{:.0f} s each), {} of {} boundaries on source keyframes".format(
+        len(chunks), args.chunk_duration, aligned, len(chunks) - 1))
+    print("submission:    {:.2f} s, {} fake API calls".format(submission_time, api.total_calls()))
+    print("stitched:      {} objects, {} renditions".format(len(written), len(plan['renditions'])))
+
+    if failures:
+        for failure in failures:
+            print("FAILED: " + failure)
+        sys.exit(1)
+    print("split plan and stitched manifests are consistent")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+Stress test for concurrent uploads served by one instance of vod-basic-encoder.
+
+<p>Many upload events are handled at the same time by a thread pool calling the entry point of the function, as an
+instance with a concurrency above 1 would, against the in-process fake Bitmovin API. Every fake API call is delayed
+by a random jitter, so the builders of different uploads interleave. Duplicate suppression, the encoding ledger and
+the infrastructure pool are enabled, so their SQLite stores are exercised from all threads as well.
+
+<p>Afterwards every created resource is checked against the upload it was created for (identified by the name of
+its encoding):
+  <ul>
+   <li>every stream reads the input file of its own upload,
+   <li>every muxing writes below the output root of its own upload,
+   <li>every upload has exactly one encoding with the complete ladder, recorded in the ledger under its asset,
+   <li>identical codec configurations and the input/output resources were created only once for all uploads.
+ </ul>
+With SUBMISSION_MODE "TEMPLATE" the rendered template documents are checked instead of the resources.
+
+Requires the Bitmovin API SDK (vod-basic-encoder/requirements.txt).
+
+Usage:
+    python benchmarks/stress_job_context.py [--uploads 300] [--threads 64] [--jitter 0.004] [--mode GRAPH|TEMPLATE]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vod-basic-encoder'))
+
+from bitmovin_api_sdk import Status
+
+import config as Config
+import utils as Utils
+
+from fake_bitmovin_api import FakeBitmovinApi
+
+POOL = [
+    dict(name="us-central", infrastructure_id="gce-us-central", cloud_region="GOOGLE_US_CENTRAL_1", weight=2,
+         max_in_flight=10 ** 6),
+    dict(name="us-east", infrastructure_id="gce-us-east", cloud_region="GOOGLE_US_EAST_1", weight=1,
+         max_in_flight=10 ** 6),
+]
+
+
+class JitteryFakeBitmovinApi(FakeBitmovinApi):
+    """
+    Delays every call by a random time, so concurrent submissions interleave at every API call
+    """
+
+    def __init__(self, jitter, seed, **kwargs):
+        super(JitteryFakeBitmovinApi, self).__init__(**kwargs)
+        self._jitter = jitter
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+    def _call(self, path, method):
+        super(JitteryFakeBitmovinApi, self)._call(path, method)
+        with self._rng_lock:
+            delay = self._rng.uniform(0, self._jitter)
+        time.sleep(delay)
+
+
+def upload_event(index):
+    # Names that are prefixes of each other, so a muxing of asset-1 below asset-10 would be caught
+    return dict(bucket="input-bucket",
+                name="uploads/{}/asset-{}.mp4".format(index % 7, index),
+                contentType="video/mp4",
+                size=str(1048576 + index),
+                md5Hash="md5-{}".format(index),
+                generation=str(1000 + index),
+                metageneration="1")
+
+
+def check(condition, message, failures):
+    if not condition:
+        failures.append(message)
+
+
+def verify_graph(api, Main, events, failures):
+    assets = dict((Main.EXAMPLE_NAME + "-" + event['name'], event['name']) for event in events)
+    encodings = dict()
+    for _, encoding in api.stored('encoding.encodings'):
+        encodings[encoding.id] = assets.get(encoding.name)
+        check(encoding.name in assets, "encoding {} belongs to no upload".format(encoding.name), failures)
+    check(sorted(encodings.values()) == sorted(assets.values()), "not exactly one encoding per upload", failures)
+
+    per_encoding = defaultdict(int)
+    for parents, stream in api.stored('encoding.encodings.streams'):
+        asset = encodings.get(parents.get('encoding_id'))
+        input_path = stream.input_streams[0].input_path
+        check(input_path == Utils.build_absolute_input_path("", asset),
+              "stream of {} reads {}".format(asset, input_path), failures)
+
+    for muxing_type in ('mp4', 'ts', 'fmp4'):
+        for parents, muxing in api.stored('encoding.encodings.muxings.' + muxing_type):
+            asset = encodings.get(parents.get('encoding_id'))
+            per_encoding[parents.get('encoding_id')] += 1
+            output_path = muxing.outputs[0].output_path
+            check(output_path.startswith(Utils.build_absolute_output_path("", asset) + "/"),
+                  "muxing of {} writes to {}".format(asset, output_path), failures)
+
+    muxings_per_rendition = 1 if Config.MUXING_MODE == "CMAF" else 2
+    expected = (len(Main.VIDEO_LADDER) + len(Main.AUDIO_LADDER)) * muxings_per_rendition
+    incomplete = [encodings[encoding_id] for encoding_id in encodings if per_encoding[encoding_id] != expected]
+    check(not incomplete, "{} encodings without the complete ladder, e.g. {}".format(len(incomplete),
+                                                                                      incomplete[:3]), failures)
+    return encodings
+
+
+def verify_templates(documents, Main, events, failures):
+    assets = dict((Main.EXAMPLE_NAME + "-" + event['name'], event['name']) for event in events)
+    encodings = dict()
+    for encoding_id, document in documents:
+        encoding = json.loads(document)['encodings']['main']
+        asset = assets.get(encoding['properties']['name'])
+        encodings[encoding_id] = asset
+        for stream in encoding['streams'].values():
+            input_path = stream['properties']['inputStreams'][0]['inputPath']
+            check(input_path == Utils.build_absolute_input_path("", asset),
+                  "template stream of {} reads {}".format(asset, input_path), failures)
+        for muxings in encoding['muxings'].values():
+            for muxing in muxings.values():
+                output_path = muxing['properties']['outputs'][0]['outputPath']
+                check(output_path.startswith(Utils.build_absolute_output_path("", asset) + "/"),
+                      "template muxing of {} writes to {}".format(asset, output_path), failures)
+    check(sorted(encodings.values()) == sorted(assets.values()), "not exactly one template per upload", failures)
+    return encodings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uploads', type=int, default=300)
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--jitter', type=float, default=0.004, help="maximum seconds every fake API call takes")
+    parser.add_argument('--mode', default="GRAPH", choices=("GRAPH", "TEMPLATE"))
+    parser.add_argument('--muxing-mode', default=Config.MUXING_MODE, choices=("TS_MP4", "CMAF"))
+    parser.add_argument('--seed', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    Config.SUBMISSION_MODE = args.mode
+    Config.MUXING_MODE = args.muxing_mode
+    Config.SOURCE_PROBE_ENABLED = False
+    Config.ADMISSION_CONTROL_ENABLED = False
+    Config.DEDUPE_ENABLED = True
+    Config.INFRASTRUCTURE_POOL = POOL
+    Config.INPUT_BUCKET_LOCATIONS = {"input-bucket": "US"}
+    for name in dir(Config):
+        if name.endswith('_DB_FILE') or name.endswith('_INDEX_FILE') or name.endswith('_SNAPSHOT_FILE'):
+            setattr(Config, name, os.path.join(workdir, name.lower()))
+    # The shared stores need Firestore, the local ones are enough for a single process
+    Config.STATE_STORE = "SQLITE"
+    Config.LEDGER_IMPORT_JSON_FILE = None
+
+    api = JitteryFakeBitmovinApi(jitter=args.jitter, seed=args.seed, status_type=lambda status: Status[status])
+    Utils.bitmovin_api = api
+
+    import main as Main
+    import encoding_template as EncodingTemplate
+    import infrastructure_pool as InfrastructurePool
+    import ledger as Ledger
+
+    documents = []
+    documents_lock = threading.Lock()
+
+    def start_template(document):
+        with documents_lock:
+            encoding_id = "template-{:06d}".format(len(documents))
+            documents.append((encoding_id, document))
+        return encoding_id
+
+    EncodingTemplate.start = start_template
+
+    events = [upload_event(index) for index in range(args.uploads)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        errors = [future.exception() for future in
+                  [executor.submit(Main.encoding_h264_vod_preset, event, None) for event in events]]
+    elapsed = time.perf_counter() - started
+
+    failures = ["upload failed: {!r}".format(error) for error in errors if error is not None][:10]
+    if args.mode == "GRAPH":
+        encodings = verify_graph(api, Main, events, failures)
+    else:
+        encodings = verify_templates(documents, Main, events, failures)
+
+    ledger = Ledger.init_ledger()
+    for encoding_id, asset in encodings.items():
+        check(ledger.latest(asset_name=asset, codec_type="h264") == encoding_id,
+              "ledger does not record {} for {}".format(encoding_id, asset), failures)
+
+    configurations = len(api.stored('encoding.configurations.video.h264')) + \
+        len(api.stored('encoding.configurations.audio.aac'))
+    expected_configurations = len(Main.VIDEO_LADDER) + len(Main.AUDIO_LADDER)
+    check(configurations == expected_configurations,
+          "{} codec configurations created for {} renditions".format(configurations, expected_configurations),
+          failures)
+    check(len(api.stored('encoding.inputs.gcs')) <= 1 and len(api.stored('encoding.outputs.gcs')) <= 1,
+          "input or output created more than once", failures)
+
+    assigned = sum(entry['in_flight'] for entry in InfrastructurePool.init_pool().utilization())
+    check(assigned == args.uploads, "{} pool assignments for {} uploads".format(assigned, args.uploads), failures)
+
+    print("uploads:         {} on {} threads, {} mode, {}".format(args.uploads, args.threads, args.mode,
+                                                                  args.muxing_mode))
+    print("elapsed:         {:.2f} s ({:.1f} uploads/s), {} fake API calls".format(
+        elapsed, args.uploads / elapsed, api.total_calls()))
+    print("configurations:  {} created for {} uploads".format(configurations, args.uploads))
+
+    if failures:
+        for failure in failures[:20]:
+            print("FAILED: " + failure)
+        print("{} failures".format(len(failures)))
+        sys.exit(1)
+    print("no cross-talk between concurrent uploads")
+
+
+if __name__ == '__main__':
+    main()
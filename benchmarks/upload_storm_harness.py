@@ -0,0 +1,192 @@
+"""
+Replays a storm of upload events against the admission controller and job queue of vod-basic-encoder.
+
+<p>Starting an encoding is replaced by a stand-in that "runs" each encoding for a random, scaled-down duration and
+then delivers the finished webhook. The harness checks that the quota is never exceeded, that rush jobs overtake
+backlog jobs and that every upload is eventually started, and prints queue depth and wait time metrics. It then checks
+with shortened leases that a job claimed by an invocation that died before starting its encoding is queued again, and
+that a running job whose webhook never arrives expires, both releasing their footprint. Finally it checks that a split
+upload is admitted with the footprint of all its chunks and releases it chunk by chunk.
+
+<p>The job queue is kept in SQLite, or with --store FIRESTORE in the in-memory Firestore of fake_firestore.py, which
+runs FirestoreJobQueue and its transactions unchanged.
+
+Usage:
+    python benchmarks/upload_storm_harness.py [--uploads 200] [--rush-share 0.1] [--seed 7] [--store SQLITE|FIRESTORE]
+"""
+
+import argparse
+import heapq
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vod-basic-encoder'))
+
+import config as Config
+import admission as Admission
+import firestore_client as Firestore
+import job_queue as JobQueue
+
+from fake_firestore import FakeFirestore
+
+
+def new_queue(name):
+    # An empty queue: a new SQLite file, or new Firestore collections
+    Config.JOB_QUEUE_DB_FILE = os.path.join(tempfile.mkdtemp(), name + '.db')
+    Config.FIRESTORE_COLLECTION_PREFIX = name + "-"
+    Admission.queue = None
+    return Admission.init_job_queue()
+
+
+def job_waits(queue):
+    # (priority class, seconds from enqueued to started) of every started job
+    if isinstance(queue, JobQueue.FirestoreJobQueue):
+        return [(job['priority_class'], job['started_at'] - job['enqueued_at'])
+                for job in (snapshot.to_dict() for snapshot in queue._jobs().stream()) if job['started_at'] is not None]
+    return list(queue._connection().execute("SELECT priority_class, started_at - enqueued_at FROM jobs"))
+
+
+def check_leases():
+    Config.JOB_CLAIM_TTL, Config.JOB_RUNNING_TTL = 0.05, 0.1
+    queue = new_queue("leases")
+
+    # Every job takes the whole quota, so a job holding its footprint blocks the next one
+    for name in ("crashed-invocation", "lost-webhook"):
+        queue.enqueue(payload=dict(name=name), priority_class="backlog", priority=10, footprint=dict(Config.GCE_QUOTA))
+
+    crashed = queue.claim_next(admit=Admission.fits)
+    assert queue.claim_next(admit=Admission.fits) is None, "a claimed job released its footprint before its lease"
+
+    time.sleep(Config.JOB_CLAIM_TTL * 1.5)
+    requeued = queue.claim_next(admit=Admission.fits)
+    assert requeued is not None and requeued['id'] == crashed['id'], "a claimed job was not queued again"
+
+    queue.set_encoding_ids(requeued['id'], ["encoding-crashed-invocation"])
+    time.sleep(Config.JOB_CLAIM_TTL * 1.5)
+    assert queue.claim_next(admit=Admission.fits) is None, "a running job expired after the claim lease"
+
+    time.sleep(Config.JOB_RUNNING_TTL)
+    following = queue.claim_next(admit=Admission.fits)
+    assert following is not None and following['payload']['name'] == "lost-webhook", "a running job did not expire"
+    assert not queue.finish(state=JobQueue.FINISHED, encoding_id="encoding-crashed-invocation"), \
+        "a late webhook released an expired job"
+    print("leases:  claimed job queued again, running job without webhook expired")
+
+
+def check_split():
+    queue = new_queue("split")
+    chunks = ["encoding-chunk-{}".format(index) for index in range(3)]
+
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        started = Admission.submit(event=dict(name="feature-film.mp4"), start_job=lambda event: chunks,
+                                   encodings=len(chunks))
+        used = [queue.metrics()['used_footprint']['cpus']]
+        ended = []
+        for encoding_id in chunks:
+            ended.append(queue.finish(state=JobQueue.FINISHED, encoding_id=encoding_id))
+            used.append(queue.metrics()['used_footprint'].get('cpus', 0))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    assert len(started) == 1 and used[0] == Admission.footprint(encodings=len(chunks))['cpus'], \
+        "a split upload was not admitted with the footprint of all its chunks"
+    assert all(ended), "the webhook of a chunk found no running job"
+    shares = [used[0] * (len(chunks) - index) / len(chunks) for index in range(len(used))]
+    assert all(abs(amount - share) < 1e-9 for amount, share in zip(used, shares)), \
+        "the chunks of a split upload did not release their share of the footprint: {}".format(used)
+    assert queue.metrics()['running'] == 0, "a split upload kept running after its last chunk"
+    print("split:   {} chunks admitted as one job with {} CPUs, released chunk by chunk".format(len(chunks), used[0]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uploads', type=int, default=200)
+    parser.add_argument('--rush-share', type=float, default=0.1)
+    parser.add_argument('--arrival-ms', type=float, default=2.0, help="mean time between uploads")
+    parser.add_argument('--encode-ms', type=float, default=40.0, help="mean encoding duration")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--store', default="SQLITE", choices=("SQLITE", "FIRESTORE"))
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    Config.ADMISSION_MAX_STARTS_PER_DRAIN = 1000
+    Config.STATE_STORE = args.store
+    if args.store == "FIRESTORE":
+        Firestore.client = FakeFirestore()
+    queue = new_queue("storm")
+
+    completions = []
+    started = dict()
+    max_used = dict()
+
+    def start_job(event):
+        encoding_id = "encoding-{}".format(event['name'])
+        started[encoding_id] = event
+        duration = rng.expovariate(1000.0 / args.encode_ms)
+        heapq.heappush(completions, (time.time() + duration, encoding_id))
+
+        used = Admission.init_job_queue().metrics()['used_footprint']
+        for resource, amount in used.items():
+            max_used[resource] = max(max_used.get(resource, 0), amount)
+            assert amount <= Config.GCE_QUOTA[resource] + 1e-9, "quota exceeded for {}".format(resource)
+        return [encoding_id]
+
+    arrivals = []
+    at = time.time()
+    for index in range(args.uploads):
+        at += rng.expovariate(1000.0 / args.arrival_ms)
+        priority = "rush" if rng.random() < args.rush_share else "backlog"
+        arrivals.append((at, dict(name="upload-{:05d}.mp4".format(index), metadata=dict(priority=priority))))
+
+    begin = time.time()
+    waits = dict(rush=[], backlog=[])
+    max_depth = 0
+
+    # Silence the per-drain metrics log lines of the admission controller
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        while arrivals or completions:
+            next_arrival = arrivals[0][0] if arrivals else float('inf')
+            next_completion = completions[0][0] if completions else float('inf')
+            time.sleep(max(0.0, min(next_arrival, next_completion) - time.time()))
+
+            if next_arrival <= next_completion:
+                _, event = arrivals.pop(0)
+                Admission.submit(event=event, start_job=start_job)
+            else:
+                _, encoding_id = heapq.heappop(completions)
+                Admission.release(encoding_id=encoding_id, state=JobQueue.FINISHED, start_job=start_job)
+
+            depth = sum(Admission.init_job_queue().metrics()['queue_depth'].values())
+            max_depth = max(max_depth, depth)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    for priority_class, wait in job_waits(queue):
+        waits[priority_class].append(wait * 1000)
+
+    assert len(started) == args.uploads, "only {} of {} uploads started".format(len(started), args.uploads)
+
+    print("store:   {}".format(args.store))
+    print("uploads: {}  wall time: {:.2f} s  max queue depth: {}".format(args.uploads, time.time() - begin, max_depth))
+    print("quota:   {}".format(Config.GCE_QUOTA))
+    print("peak:    {}".format(max_used))
+    for priority_class, values in sorted(waits.items()):
+        values.sort()
+        if values:
+            print("{:<8} jobs: {:>4}  wait p50: {:>8.1f} ms  p99: {:>8.1f} ms  max: {:>8.1f} ms".format(
+                priority_class, len(values), values[len(values) // 2], values[int(len(values) * 0.99)], values[-1]))
+
+    check_leases()
+    check_split()
+
+
+if __name__ == '__main__':
+    main()
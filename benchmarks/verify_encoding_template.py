@@ -0,0 +1,115 @@
+"""
+Verifies that the encoding template compiled by vod-basic-encoder describes the same encoding as the resource graph
+main.py builds call by call.
+
+<p>Both submission modes are run against the in-process fake Bitmovin API for the same upload event. The streams
+and muxings created by the graph are compared with those declared in the rendered template (muxing type, output
+path, codec configuration and input path), and the number of API calls of both modes is reported. Loading the function
+with SUBMISSION_MODE "TEMPLATE" and MANIFEST_GENERATION "START" has to fail, as templates do not declare manifests.
+
+Requires the Bitmovin API SDK (vod-basic-encoder/requirements.txt).
+
+Usage:
+    python benchmarks/verify_encoding_template.py [--muxing-mode TS_MP4|CMAF]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vod-basic-encoder'))
+
+from bitmovin_api_sdk import Status
+
+import config as Config
+import utils as Utils
+
+from fake_bitmovin_api import FakeBitmovinApi
+
+EVENT = dict(bucket="input-bucket", name="uploads/movie.mp4", contentType="video/mp4", size="1048576",
+             metageneration="1")
+
+
+def graph_muxings(api):
+    streams = dict((stream.id, stream) for _, stream in api.stored('encoding.encodings.streams'))
+    described = set()
+    for muxing_type in ('mp4', 'ts', 'fmp4'):
+        for _, muxing in api.stored('encoding.encodings.muxings.' + muxing_type):
+            stream = streams[muxing.streams[0].stream_id]
+            described.add((muxing_type, muxing.outputs[0].output_path, stream.codec_config_id,
+                           stream.input_streams[0].input_path))
+    return described
+
+
+def template_muxings(document):
+    encoding = json.loads(document)['encodings']['main']
+    described = set()
+    for muxing_type, muxings in encoding['muxings'].items():
+        for muxing in muxings.values():
+            properties = muxing['properties']
+            stream_key = properties['streams'][0]['streamId'].split('/')[-1]
+            stream = encoding['streams'][stream_key]['properties']
+            described.add((muxing_type, properties['outputs'][0]['outputPath'], stream['codecConfigId'],
+                           stream['inputStreams'][0]['inputPath']))
+    return described
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--muxing-mode', default=Config.MUXING_MODE, choices=("TS_MP4", "CMAF"))
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    Config.MUXING_MODE = args.muxing_mode
+    Config.SOURCE_PROBE_ENABLED = False
+    Config.ADMISSION_CONTROL_ENABLED = False
+    Config.CONFIG_REGISTRY_INDEX_FILE = os.path.join(workdir, 'configurations.json')
+    Config.BOOTSTRAP_SNAPSHOT_FILE = os.path.join(workdir, 'bootstrap.json')
+
+    api = FakeBitmovinApi(status_type=lambda status: Status[status])
+    Utils.bitmovin_api = api
+
+    Config.SUBMISSION_MODE, Config.MANIFEST_GENERATION = "TEMPLATE", "START"
+    try:
+        import main as Main
+        print("FAILED: the function loads with SUBMISSION_MODE TEMPLATE and MANIFEST_GENERATION START")
+        sys.exit(1)
+    except ValueError as e:
+        print("rejected at load: {}".format(e))
+    Config.MANIFEST_GENERATION = "WEBHOOK"
+
+    import main as Main
+    import encoding_template as EncodingTemplate
+
+    Config.SUBMISSION_MODE = "GRAPH"
+    Main._submit_encoding(EVENT)
+    graph_calls = api.total_calls()
+    expected = graph_muxings(api)
+
+    submitted = []
+    EncodingTemplate.start = lambda document: submitted.append(document) or "template-encoding"
+
+    calls_before = api.total_calls()
+    Config.SUBMISSION_MODE = "TEMPLATE"
+    Main._submit_encoding(EVENT)
+    template_calls = api.total_calls() - calls_before + len(submitted)
+    actual = template_muxings(submitted[0])
+
+    print("graph submission:    {} API calls, {} muxings".format(graph_calls, len(expected)))
+    print("template submission: {} API calls, {} muxings".format(template_calls, len(actual)))
+
+    if expected != actual:
+        for line in sorted(expected - actual):
+            print("only in graph:    {}".format(line))
+        for line in sorted(actual - expected):
+            print("only in template: {}".format(line))
+        sys.exit(1)
+
+    print("compiled template matches the encoding graph")
+
+
+if __name__ == '__main__':
+    main()
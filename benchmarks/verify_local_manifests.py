@@ -0,0 +1,235 @@
+"""
+Golden-file check of the manifests manifest-generator renders locally (MANIFEST_WRITER "LOCAL", manifest_writer.py).
+
+<p>A finished encoding as vod-basic-encoder creates it (H264 and AAC codec configurations, streams and either TS and
+MP4 or fragmented MP4 muxings, with the bitrates and segment counts the API reports after encoding) is stored in the
+local fake Bitmovin API server. The single-file MP4 renditions get the head of an MP4 file (ftyp, moov and sidx
+boxes) in a temporary folder that stands in for the output bucket (MANIFEST_STORAGE_DIR).
+
+<p>generate_hls_dash_manifests then runs for its finished webhook with the real SDK, and every manifest file written
+is compared with benchmarks/golden/manifests/<muxing mode>/ (<muxing mode>-audio-only/ with --audio-only, for an
+encoding of a source without a video track, which has the audio renditions only). Muxing IDs are replaced by the rendition they belong to
+before comparing. The same webhook is handled with MANIFEST_WRITER "API" as well, and the wall time and API calls of
+both writers are reported.
+
+The golden files are self-generated: they were written by the local writer with --update-golden and reviewed by
+hand to follow what the Bitmovin manifest API documents for these resources (file layout, URIs, bandwidths, codecs,
+resolutions and segment references). They were not captured from manifests the API wrote, so they guard the local
+writer against regressions but do not prove it matches the API; attribute order and formatting of numbers can differ.
+Update them with --update-golden after an intended change of the output, or replace them with the files of an API
+generated manifest of the same encoding.
+
+Requires the Bitmovin API SDK (manifest-generator/requirements.txt).
+
+Usage:
+    python benchmarks/verify_local_manifests.py [--muxing-mode TS_MP4|CMAF] [--audio-only] [--latency 0.02]
+                                                [--update-golden]
+"""
+
+import argparse
+import difflib
+import logging
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+GOLDEN_DIR = os.path.join(BENCHMARKS, 'golden', 'manifests')
+sys.path.insert(0, BENCHMARKS)
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'manifest-generator'))
+
+import config as Config
+
+from e2e_benchmark import _Request
+from fake_bitmovin_server import FakeBitmovinServer
+
+OUTPUT_ROOT = "/outputs/movie"
+INPUT_DURATION = 21.5
+SEGMENT_LENGTH = 4.0
+
+# A short ladder of vod-basic-encoder: (rendition path, width, height, bitrate, profile, average bitrate)
+VIDEO = [("1080p", 1920, 1080, 4800000, "HIGH", 4512000),
+         ("720p", 1280, 720, 2400000, "MAIN", 2296000),
+         ("360p", 640, 360, 664000, "BASELINE", 640000)]
+AUDIO = [("128000", 128000, 127500), ("64000", 64000, 63800)]
+
+
+def mp4_head(index, segments):
+    """
+    The ftyp, moov and sidx boxes of a DASH on-demand MP4 file, followed by the header of the first moof
+    """
+
+    def box(box_type, payload_size):
+        return struct.pack('>I4s', 8 + payload_size, box_type) + b'\0' * payload_size
+
+    return (box(b'ftyp', 24) + box(b'moov', 750 + 40 * index) + box(b'sidx', 24 + 12 * segments) +
+            struct.pack('>I4s', 1024, b'moof'))
+
+
+def create_encoding(api, storage_root, muxing_mode, video=VIDEO):
+    """
+    Stores a finished encoding of the ladder (with the given video renditions), returns its ID and the muxing IDs by
+    rendition
+    """
+
+    from bitmovin_api_sdk import (AacAudioConfiguration, Encoding, EncodingOutput, Fmp4Muxing,
+                                  H264VideoConfiguration, Mp4Muxing, MuxingStream, ProfileH264, Stream, TsMuxing)
+
+    encoding = api.encoding.encodings.create(encoding=Encoding(name="golden"))
+    segments = 6
+    labels = dict()
+
+    renditions = [("video", path, H264VideoConfiguration(width=width, height=height, bitrate=bitrate,
+                                                         profile=ProfileH264[profile]), average)
+                  for path, width, height, bitrate, profile, average in video]
+    renditions += [("audio", path, AacAudioConfiguration(bitrate=bitrate), average)
+                   for path, bitrate, average in AUDIO]
+
+    for index, (media_type, rendition_path, configuration, average) in enumerate(renditions):
+        if media_type == "video":
+            configuration = api.encoding.configurations.video.h264.create(h264_video_configuration=configuration)
+        else:
+            configuration = api.encoding.configurations.audio.aac.create(aac_audio_configuration=configuration)
+        stream = api.encoding.encodings.streams.create(encoding_id=encoding.id,
+                                                       stream=Stream(codec_config_id=configuration.id))
+
+        def output(kind):
+            return [EncodingOutput(output_id="output",
+                                   output_path="{}/{}/{}/clear/{}".format(OUTPUT_ROOT, media_type, kind,
+                                                                          rendition_path))]
+
+        common = dict(streams=[MuxingStream(stream_id=stream.id)], avg_bitrate=average,
+                      max_bitrate=configuration.bitrate)
+        label = "{}-{}".format(media_type, rendition_path)
+        muxings = api.encoding.encodings.muxings
+        if muxing_mode == "CMAF":
+            muxing = muxings.fmp4.create(encoding_id=encoding.id, fmp4_muxing=Fmp4Muxing(
+                outputs=output("cmaf"), segment_length=SEGMENT_LENGTH, segment_naming="segment_%number%.m4s",
+                init_segment_name="init.mp4", segments_muxed=segments, **common))
+            labels[muxing.id] = label
+            continue
+
+        muxing = muxings.ts.create(encoding_id=encoding.id, ts_muxing=TsMuxing(
+            outputs=output("ts"), segment_length=SEGMENT_LENGTH, segments_muxed=segments, **common))
+        labels[muxing.id] = label + "-ts"
+        muxing = muxings.mp4.create(encoding_id=encoding.id, mp4_muxing=Mp4Muxing(
+            outputs=output("mp4"), filename=media_type, fragment_duration=4000, **common))
+        labels[muxing.id] = label + "-mp4"
+
+        file_path = os.path.join(storage_root, output("mp4")[0].output_path.lstrip("/"), media_type + ".mp4")
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as fp:
+            fp.write(mp4_head(index, segments))
+
+    return encoding.id, labels
+
+
+def written_manifests(storage_root):
+    manifests = dict()
+    for directory, _, files in os.walk(storage_root):
+        for name in files:
+            if name.endswith(".m3u8") or name.endswith(".mpd"):
+                file_path = os.path.join(directory, name)
+                with open(file_path) as fp:
+                    manifests[os.path.relpath(file_path, storage_root)] = fp.read()
+    return manifests
+
+
+def normalize(text, labels):
+    for muxing_id, label in labels.items():
+        text = text.replace(muxing_id, label)
+    return text
+
+
+def run_writer(server, main, encoding_id, writer):
+    Config.MANIFEST_WRITER = writer
+    before = server.total_calls()
+    started = time.perf_counter()
+    main.generate_hls_dash_manifests(_Request(dict(eventType="ENCODING_FINISHED", encoding=dict(id=encoding_id))))
+    return time.perf_counter() - started, server.total_calls() - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--muxing-mode', default="TS_MP4", choices=["TS_MP4", "CMAF"])
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds per API call")
+    parser.add_argument('--manifest-duration', type=float, default=1.0,
+                        help="seconds the API takes to write a started manifest")
+    parser.add_argument('--audio-only', action='store_true', help="encoding without video renditions")
+    parser.add_argument('--update-golden', action='store_true')
+    args = parser.parse_args()
+
+    # The SDK logs every request and response
+    logging.disable(logging.DEBUG)
+
+    workdir = tempfile.mkdtemp()
+    storage_root = os.path.join(workdir, "bucket")
+    server = FakeBitmovinServer(latency=args.latency, manifest_duration=args.manifest_duration,
+                                input_duration=INPUT_DURATION).start()
+
+    Config.BITMOVIN_API_KEY = "golden"
+    Config.BITMOVIN_API_BASE_URL = server.base_url
+    Config.STATE_STORE = "SQLITE"
+    Config.LEDGER_DB_FILE = os.path.join(workdir, "ledger.db")
+    Config.LEDGER_IMPORT_JSON_FILE = None
+    Config.METRICS_FILE = os.path.join(workdir, "metrics.txt")
+    Config.MANIFEST_STORAGE_DIR = storage_root
+    # Both writers handle the same webhook, which the webhook store would only let through once
+    Config.WEBHOOK_STORE = None
+
+    import main as ManifestGenerator
+    from bitmovin_api_sdk import BitmovinApi
+
+    encoding_id, labels = create_encoding(BitmovinApi(api_key="golden", base_url=server.base_url), storage_root,
+                                          args.muxing_mode, video=[] if args.audio_only else VIDEO)
+
+    try:
+        local_seconds, local_calls = run_writer(server, ManifestGenerator, encoding_id, "LOCAL")
+        manifests = dict((name, normalize(text, labels)) for name, text in written_manifests(storage_root).items())
+        api_seconds, api_calls = run_writer(server, ManifestGenerator, encoding_id, "API")
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print("{:<8} {:>10} {:>8}".format("writer", "seconds", "calls"))
+    print("{:<8} {:>10.3f} {:>8}".format("LOCAL", local_seconds, local_calls))
+    print("{:<8} {:>10.3f} {:>8}".format("API", api_seconds, api_calls))
+
+    golden_dir = os.path.join(GOLDEN_DIR, args.muxing_mode.lower() + ("-audio-only" if args.audio_only else ""))
+    if args.update_golden:
+        for name, text in manifests.items():
+            file_path = os.path.join(golden_dir, name)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'w') as fp:
+                fp.write(text)
+        print("Updated {} golden files in {}".format(len(manifests), golden_dir))
+        return
+
+    expected = dict()
+    for directory, _, files in os.walk(golden_dir):
+        for name in files:
+            with open(os.path.join(directory, name)) as fp:
+                expected[os.path.relpath(os.path.join(directory, name), golden_dir)] = fp.read()
+
+    failures = []
+    for name in sorted(set(expected) | set(manifests)):
+        if name not in manifests:
+            failures.append("{} was not written".format(name))
+        elif name not in expected:
+            failures.append("{} has no golden file".format(name))
+        elif manifests[name] != expected[name]:
+            failures.append("{} differs from its golden file:\n{}".format(name, "".join(difflib.unified_diff(
+                expected[name].splitlines(True), manifests[name].splitlines(True), 'golden', 'written'))))
+
+    for failure in failures:
+        print("FAIL " + failure)
+    if failures:
+        sys.exit(1)
+    print("OK: {} manifest files match {}".format(len(manifests), golden_dir))
+
+
+if __name__ == '__main__':
+    main()
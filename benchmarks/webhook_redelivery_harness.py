@@ -0,0 +1,310 @@
+"""
+Harness for the idempotent webhook handling of manifest-generator (webhook_store.py) against the local fake Bitmovin
+API server, with the manifests generated through the API (MANIFEST_WRITER "API").
+
+<p>For every store backend (--stores; FIRESTORE keeps the claims and the ledger in the in-memory Firestore of
+fake_firestore.py, shared with the child process of the killed scenario) it delivers the finished webhook of
+encodings of the ladder of verify_local_manifests.py the way Bitmovin redelivers it and checks the manifests the
+server ends up with:
+  <ul>
+   <li>concurrent: while the first delivery waits for its manifests, --duplicates further deliveries arrive; they
+       are answered at once with a 503 and a Retry-After, so Bitmovin keeps delivering, and exactly one HLS and one
+       DASH manifest are created,
+   <li>after done: a delivery for an encoding whose manifests are done returns OK at once without API calls,
+   <li>timed out: the first delivery gives up polling (MANIFEST_POLL_DEADLINE), the redelivery waits for the started
+       manifests instead of creating new ones,
+   <li>killed: the first delivery runs in a child process; once both manifests were started a repeated delivery is
+       rejected with a 503, then the child is killed. Delivering again after each Retry-After, as Bitmovin does
+       until it gets a 2xx, resumes the started manifests once the claim went stale (WEBHOOK_CLAIM_TTL shortened to
+       --claim-ttl),
+   <li>manifests at start: the webhook of an encoding that declared its manifests in the start request (custom data
+       manifests_at_start, as with WEBHOOK_SCOPE "ORGANIZATION") creates no manifests.
+ </ul>
+
+Requires the Bitmovin API SDK (manifest-generator/requirements.txt).
+
+Usage:
+    python benchmarks/webhook_redelivery_harness.py [--stores SQLITE,FILE,FIRESTORE] [--duplicates 4] [--latency 0.02]
+                                                    [--manifest-duration 1.5] [--claim-ttl 1.0]
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+MANIFEST_GENERATOR = os.path.join(BENCHMARKS, '..', 'manifest-generator')
+sys.path.insert(0, BENCHMARKS)
+sys.path.insert(0, MANIFEST_GENERATOR)
+
+import config as Config
+
+from e2e_benchmark import _Request
+from fake_bitmovin_server import FakeBitmovinServer
+from fake_firestore import FirestoreBackend, connect, serve
+from verify_local_manifests import INPUT_DURATION, create_encoding
+
+MANIFEST_COLLECTIONS = ("/encoding/manifests/hls", "/encoding/manifests/dash")
+
+# The functions print their progress, the harness reports on the original stdout
+REPORT = sys.stdout
+
+
+def configure(settings):
+    # type: (dict) -> None
+    Config.BITMOVIN_API_KEY = "redelivery"
+    Config.BITMOVIN_API_BASE_URL = settings['base_url']
+    Config.STATE_STORE = "FIRESTORE" if settings['store'] == "FIRESTORE" else "SQLITE"
+    if 'firestore' in settings:
+        import firestore_client as Firestore
+        address, authkey = settings['firestore']
+        Firestore.client = connect(address, authkey.encode('ascii'))
+    Config.LEDGER_DB_FILE = os.path.join(settings['workdir'], "ledger.db")
+    Config.LEDGER_IMPORT_JSON_FILE = None
+    Config.METRICS_ENABLED = False
+    Config.MANIFEST_WRITER = "API"
+    Config.MANIFEST_POLL_MAX_INTERVAL = 0.25
+    Config.WEBHOOK_STORE = settings['store']
+    Config.WEBHOOK_STORE_DB_FILE = os.path.join(settings['workdir'], "webhook-deliveries.db")
+    Config.WEBHOOK_STORE_DIR = os.path.join(settings['workdir'], "webhook-deliveries")
+
+
+def deliver(main, encoding_id):
+    # type: (object, str) -> tuple
+    """
+    Delivers the finished webhook of an encoding, returns (seconds, HTTP status, Retry-After or None) as Flask would
+    answer: 200 for "OK", the status of a (body, status, headers) response, 500 for an exception. Bitmovin delivers
+    the webhook again for anything but a 2xx.
+    """
+
+    started = time.perf_counter()
+    try:
+        response = main.generate_hls_dash_manifests(_Request(dict(eventType="ENCODING_FINISHED",
+                                                                  encoding=dict(id=encoding_id))))
+    except Exception:
+        response = ("error", 500, dict())
+    if response == "OK":
+        response = (response, 200, dict())
+    _, status, headers = response if isinstance(response, tuple) else (response, 500, dict())
+    retry_after = headers.get('Retry-After')
+    return time.perf_counter() - started, status, int(retry_after) if retry_after is not None else None
+
+
+def redeliver(main, encoding_id, attempts=10):
+    # type: (object, str, int) -> tuple
+    """
+    Delivers the webhook again after every Retry-After until it is answered with a 2xx, returns (deliveries, seconds,
+    HTTP status of the last one)
+    """
+
+    started = time.perf_counter()
+    for delivery in range(1, attempts + 1):
+        _, status, retry_after = deliver(main, encoding_id)
+        if status < 300 or delivery == attempts:
+            break
+        time.sleep((retry_after or 1) + 0.05)
+    return delivery, time.perf_counter() - started, status
+
+def child(settings_json):
+    """
+    Runs in the child process of the "killed" scenario: delivers one webhook
+    """
+
+    settings = json.loads(settings_json)
+    logging.disable(logging.DEBUG)
+    configure(settings)
+    import main as ManifestGenerator
+    deliver(ManifestGenerator, settings['encoding_id'])
+
+
+class Scenario(object):
+
+    def __init__(self, server, store, name):
+        self.server = server
+        self.store = store
+        self.name = name
+        self.manifests = self._manifests()
+        self.calls = server.total_calls()
+        self.failures = []
+
+    def check(self, condition, message):
+        REPORT.write("{} {:<9} {:<12} {}\n".format("ok  " if condition else "FAIL", self.store, self.name, message))
+        if not condition:
+            self.failures.append("{} {}: {}".format(self.store, self.name, message))
+
+    def created(self):
+        # type: () -> tuple
+        """
+        HLS and DASH manifests created and API calls made since the scenario started
+        """
+
+        hls, dash = self._manifests()
+        return hls - self.manifests[0], dash - self.manifests[1], self.server.total_calls() - self.calls
+
+    def _manifests(self):
+        return tuple(len(self.server.stored(collection)) for collection in MANIFEST_COLLECTIONS)
+
+
+def run_store(server, store_name, args, workdir):
+    # type: (FakeBitmovinServer, str, argparse.Namespace, str) -> list
+    import main as ManifestGenerator
+    import ledger as Ledger
+    import webhook_store as WebhookStore
+    from bitmovin_api_sdk import BitmovinApi
+
+    settings = dict(base_url=server.base_url, workdir=os.path.join(workdir, store_name.lower()), store=store_name)
+    if store_name == "FIRESTORE":
+        # Served to the child process of the killed scenario as well
+        address, authkey = serve(FirestoreBackend())
+        settings['firestore'] = (address, authkey.decode('ascii'))
+    os.makedirs(settings['workdir'])
+    configure(settings)
+    WebhookStore.store = None
+    Ledger.ledger = None
+    store = WebhookStore.init_webhook_store()
+    api = BitmovinApi(api_key="redelivery", base_url=server.base_url)
+    failures = []
+
+    def new_encoding():
+        encoding_id, _ = create_encoding(api, os.path.join(settings['workdir'], "bucket"), "TS_MP4")
+        return encoding_id
+
+    # Concurrent deliveries
+    encoding_id = new_encoding()
+    scenario = Scenario(server, store_name, "concurrent")
+    first = []
+    thread = threading.Thread(target=lambda: first.append(deliver(ManifestGenerator, encoding_id)))
+    thread.start()
+    time.sleep(args.latency * 5)
+    duplicates = []
+    threads = [threading.Thread(target=lambda: duplicates.append(deliver(ManifestGenerator, encoding_id)))
+               for _ in range(args.duplicates)]
+    for duplicate in threads:
+        duplicate.start()
+    for duplicate in threads:
+        duplicate.join()
+    thread.join()
+    hls, dash, calls = scenario.created()
+    slowest = max(seconds for seconds, _, _ in duplicates)
+    scenario.check(first[0][1] == 200 and all(status == 503 and retry_after >= 1
+                                              for _, status, retry_after in duplicates) and slowest < first[0][0] / 2,
+                   "{} duplicates answered 503 within {:.3f} s, the first delivery took {:.3f} s".format(
+                       len(duplicates), slowest, first[0][0]))
+    scenario.check((hls, dash) == (1, 1) and store.get(encoding_id).state == WebhookStore.DONE,
+                   "{} HLS and {} DASH manifest created, claim {}".format(hls, dash, store.get(encoding_id).state))
+    failures += scenario.failures
+
+    # Delivery after done
+    scenario = Scenario(server, store_name, "after done")
+    seconds, status, _ = deliver(ManifestGenerator, encoding_id)
+    hls, dash, calls = scenario.created()
+    scenario.check(status == 200 and (hls, dash, calls) == (0, 0, 0),
+                   "returned OK in {:.3f} s with {} API calls".format(seconds, calls))
+    failures += scenario.failures
+
+    # First delivery times out polling, the redelivery resumes
+    encoding_id = new_encoding()
+    scenario = Scenario(server, store_name, "timed out")
+    deadline, Config.MANIFEST_POLL_DEADLINE = Config.MANIFEST_POLL_DEADLINE, args.manifest_duration / 3
+    _, status, _ = deliver(ManifestGenerator, encoding_id)
+    Config.MANIFEST_POLL_DEADLINE = deadline
+    state = store.get(encoding_id).state
+    seconds, retry_status, _ = deliver(ManifestGenerator, encoding_id)
+    hls, dash, calls = scenario.created()
+    scenario.check(status == 500 and state == WebhookStore.FAILED and retry_status == 200,
+                   "first delivery failed ({}), the redelivery succeeded in {:.3f} s".format(status, seconds))
+    scenario.check((hls, dash) == (1, 1) and store.get(encoding_id).attempts == 2,
+                   "{} HLS and {} DASH manifest created over 2 deliveries".format(hls, dash))
+    failures += scenario.failures
+
+    # First delivery killed while it waits for the manifests, after it made a repeated delivery be rejected
+    encoding_id = new_encoding()
+    scenario = Scenario(server, store_name, "killed")
+    ttl, Config.WEBHOOK_CLAIM_TTL = Config.WEBHOOK_CLAIM_TTL, args.claim_ttl
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child',
+                                json.dumps(dict(settings, encoding_id=encoding_id))],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    started = time.time()
+    while time.time() - started < 60:
+        delivery = store.get(encoding_id)
+        phases = [p.get('phase') for p in (delivery.progress if delivery is not None else dict()).values()]
+        if phases.count(WebhookStore.STARTED) == 2:
+            break
+        time.sleep(0.02)
+    seconds, status, retry_after = deliver(ManifestGenerator, encoding_id)
+    process.kill()
+    process.wait()
+    state = store.get(encoding_id).state
+    scenario.check(status == 503 and retry_after is not None and state == WebhookStore.IN_PROGRESS,
+                   "a repeated delivery got a 503 (Retry-After {} s) in {:.3f} s, then the first one died".format(
+                       retry_after, seconds))
+
+    before = server.total_calls()
+    deliveries, seconds, status = redeliver(ManifestGenerator, encoding_id)
+    Config.WEBHOOK_CLAIM_TTL = ttl
+    hls, dash, calls = scenario.created()
+    scenario.check(status == 200 and (hls, dash) == (1, 1) and store.get(encoding_id).state == WebhookStore.DONE,
+                   "{} redeliveries after Retry-After resumed the manifests in {:.3f} s ({} API calls)".format(
+                       deliveries, seconds, server.total_calls() - before))
+    failures += scenario.failures
+
+    # Encoding whose manifests are written by Bitmovin
+    _, encoding = server.handle_call("POST", "/encoding/encodings", dict(),
+                                     dict(name="manifests at start", customData=dict(manifests_at_start=True)))
+    scenario = Scenario(server, store_name, "at start")
+    seconds, status, _ = deliver(ManifestGenerator, encoding['id'])
+    hls, dash, calls = scenario.created()
+    scenario.check(status == 200 and (hls, dash) == (0, 0),
+                   "returned in {:.3f} s with {} API calls, {} HLS and {} DASH manifests created".format(
+                       seconds, calls, hls, dash))
+    failures += scenario.failures
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stores', default="SQLITE,FILE,FIRESTORE")
+    parser.add_argument('--duplicates', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds per API call")
+    parser.add_argument('--manifest-duration', type=float, default=1.5,
+                        help="seconds the API takes to write a started manifest")
+    parser.add_argument('--claim-ttl', type=float, default=1.0,
+                        help="WEBHOOK_CLAIM_TTL of the killed scenario, in seconds")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+
+    # The SDK logs every request and response
+    logging.disable(logging.DEBUG)
+    sys.stdout = open(os.devnull, 'w')
+
+    workdir = tempfile.mkdtemp()
+    server = FakeBitmovinServer(latency=args.latency, manifest_duration=args.manifest_duration,
+                                input_duration=INPUT_DURATION)
+    # Calls of the killed child end in broken connections
+    server.handle_error = lambda request, client_address: None
+    server.start()
+    failures = []
+    try:
+        for store_name in args.stores.split(","):
+            failures += run_store(server, store_name, args, workdir)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
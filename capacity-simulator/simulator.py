@@ -0,0 +1,496 @@
+import argparse
+import heapq
+import itertools
+import json
+import math
+import os
+import random
+import sys
+
+from collections import deque, namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vod-basic-encoder'))
+
+import admission as Admission
+import config as Config
+import upload_trace as UploadTrace
+
+"""
+Discrete-event capacity simulator for the watchfolder pipeline.
+
+<p>Replays a trace of uploads (see upload_trace.py) through a model of the pipeline and reports how long the whole
+trace takes, how close every region comes to its GCE quota and what it costs. Per upload the model goes through
+  <ul>
+   <li>admission: the upload waits (first come, first served) until an encoding slot is free in a region and the
+       footprint of the encoding (Admission.footprint) fits into the quota of the region (Admission.fits), then
+       goes to the region with the lowest utilization,
+   <li>submission: SUBMISSION_LATENCY seconds to create and start the encoding (per SUBMISSION_MODE),
+   <li>spin-up of the coordinator and the instances, then the download and analysis of the source,
+   <li>encoding at speed_per_instance * instances ^ scaling_exponent seconds of source per second; every instance
+       is preempted at preemption_rate_per_hour and replaced after another spin-up, losing preemption_lost_work_s
+       of its work,
+   <li>manifest generation after the encoding finished, which no longer holds quota.
+ </ul>
+The quota of an encoding is held from admission until its encoding finished, as the release_encoding_quota
+webhook releases it. Instances are billed from submission until the encoding finished.
+
+<p>A configuration is the number of instances per encoding, the maximum number of encodings in flight per region
+and the regions used. sweep() simulates every combination with several seeds and returns the cheapest one whose
+makespan (90th percentile over the seeds) meets the deadline.
+
+<p>The model constants (DEFAULT_MODEL) are rough figures for the default 7-rendition H264 ladder on n1-standard-8
+instances and list prices; calibrate them with a few encodings of the actual catalog (speed_per_instance is
+source seconds per second with one instance) and pass the overrides in a scenario file:
+    {"model": {"speed_per_instance": 0.6, "bitmovin_price_per_minute": 0.02},
+     "regions": [{"name": "us-central", "quota": {"in_use_ips": 24, "cpus": 24, "preemptible_cpus": 192,
+                                                  "ssd_tb": 4.0}},
+                 {"name": "europe-west", "quota": {...}, "price_factor": 1.1, "preemption_rate_per_hour": 0.05}]}
+Without "regions" the simulator uses INFRASTRUCTURE_POOL, or CLOUD_REGION with GCE_QUOTA, of vod-basic-encoder.
+
+Usage:
+    python capacity-simulator/simulator.py run TRACE.csv --instances 4 [--max-encodings 3] [--scenario FILE]
+    python capacity-simulator/simulator.py sweep TRACE.csv --deadline 48h [--instances 1,2,4,8] [--seeds 5]
+    (TRACE.csv can be replaced by --synthetic UPLOADS, see upload_trace.py)
+"""
+
+SUBMISSION_LATENCY = dict(GRAPH=20.0, TEMPLATE=4.0)
+
+Model = namedtuple('Model', ['submission_latency_s',
+                             'spin_up_s',
+                             'spin_up_jitter_s',
+                             'input_throughput_bps',
+                             'analysis_s',
+                             'speed_per_instance',
+                             'scaling_exponent',
+                             'preemption_rate_per_hour',
+                             'preemption_lost_work_s',
+                             'manifest_s',
+                             'coordinator_price_per_hour',
+                             'instance_price_per_hour',
+                             'ssd_price_per_tb_hour',
+                             'bitmovin_price_per_minute'])
+
+DEFAULT_MODEL = Model(submission_latency_s=SUBMISSION_LATENCY.get(Config.SUBMISSION_MODE, 20.0),
+                      spin_up_s=150.0,
+                      spin_up_jitter_s=60.0,
+                      input_throughput_bps=800e6,
+                      analysis_s=60.0,
+                      speed_per_instance=0.5,
+                      scaling_exponent=0.85,
+                      preemption_rate_per_hour=0.1,
+                      preemption_lost_work_s=120.0,
+                      manifest_s=45.0,
+                      # n1-standard-8 on demand (coordinator) and preemptible, us-central1 list prices
+                      coordinator_price_per_hour=0.38,
+                      instance_price_per_hour=0.08,
+                      ssd_price_per_tb_hour=0.233,
+                      # Depends on the Bitmovin contract; per minute of source (all renditions)
+                      bitmovin_price_per_minute=0.0)
+
+Region = namedtuple('Region', ['name', 'quota', 'max_in_flight', 'price_factor', 'preemption_rate_per_hour'])
+
+Configuration = namedtuple('Configuration', ['instances', 'max_encodings', 'regions'])
+
+Result = namedtuple('Result', ['configuration',
+                               'makespan_s',
+                               'turnaround_p50_s',
+                               'turnaround_p95_s',
+                               'max_waiting',
+                               'preemptions',
+                               'cost',
+                               'regions'])
+
+
+def default_regions():
+    # type: () -> list
+    """
+    The regions of the infrastructure pool of vod-basic-encoder, or CLOUD_REGION alone, each with GCE_QUOTA
+    """
+
+    pool = Config.INFRASTRUCTURE_POOL or [dict(name=Config.CLOUD_REGION)]
+    return [region_of(dict(entry, quota=entry.get('quota', Config.GCE_QUOTA))) for entry in pool]
+
+
+def region_of(entry):
+    # type: (dict) -> Region
+    return Region(name=entry['name'],
+                  quota=dict(entry.get('quota') or Config.GCE_QUOTA),
+                  max_in_flight=entry.get('max_in_flight'),
+                  price_factor=float(entry.get('price_factor', 1.0)),
+                  preemption_rate_per_hour=entry.get('preemption_rate_per_hour'))
+
+
+def load_scenario(file_path):
+    # type: (str) -> tuple
+    """
+    Returns (model, regions) of a scenario file, see the module docstring
+    """
+
+    with open(file_path) as f:
+        scenario = json.load(f)
+    model = DEFAULT_MODEL._replace(**scenario.get('model', dict()))
+    regions = [region_of(entry) for entry in scenario['regions']] if scenario.get('regions') else default_regions()
+    return model, regions
+
+
+def capacity(region, instances):
+    # type: (Region, int) -> int
+    """
+    The number of encodings with the given instances whose footprints fit into the quota of the region together
+    """
+
+    job_footprint = Admission.footprint(instances)
+    used = dict()
+    count = 0
+    while Admission.fits(used, job_footprint, region.quota):
+        used = _add(used, job_footprint)
+        count += 1
+    return count
+
+
+def encode_speed(model, instances):
+    # type: (Model, int) -> float
+    return model.speed_per_instance * instances ** model.scaling_exponent if instances > 0 else 0.0
+
+
+class _Encoding(object):
+    __slots__ = ('upload', 'region', 'submitted', 'running', 'ended', 'completed', 'active', 'remaining',
+                 'progress_at', 'generation', 'preemptions')
+
+    def __init__(self, upload):
+        self.upload = upload
+        self.region = None
+        self.submitted = None
+        self.running = None
+        self.ended = None
+        self.completed = None
+        self.active = 0
+        self.remaining = upload.duration_s
+        self.progress_at = None
+        self.generation = 0
+        self.preemptions = 0
+
+
+class _RegionState(object):
+    __slots__ = ('region', 'limit', 'used', 'peak', 'in_flight', 'peak_in_flight', 'encodings')
+
+    def __init__(self, region, limit):
+        self.region = region
+        self.limit = limit
+        self.used = dict()
+        self.peak = dict()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.encodings = 0
+
+
+def simulate(uploads, configuration, model=DEFAULT_MODEL, seed=1):
+    # type: (list, Configuration, Model, int) -> Result
+    """
+    Replays the uploads through the pipeline with one configuration
+
+    :param uploads: Upload namedtuples of upload_trace.py
+    :param configuration: Instances per encoding, maximum encodings in flight per region (None for as many as the
+        quota allows) and the regions
+    :param seed: Seed of spin-up jitter and preemptions
+    """
+
+    rng = random.Random(seed)
+    job_footprint = Admission.footprint(configuration.instances)
+    states = []
+    for region in configuration.regions:
+        limit = capacity(region, configuration.instances)
+        for cap in (configuration.max_encodings, region.max_in_flight):
+            if cap is not None:
+                limit = min(limit, cap)
+        states.append(_RegionState(region, limit))
+    if not any(state.limit for state in states):
+        raise Exception("The footprint of an encoding with {} instances ({}) fits into no region".format(
+            configuration.instances, job_footprint))
+
+    events = []
+    sequence = itertools.count()
+    waiting = deque()
+    encodings = []
+    stats = dict(max_waiting=0, preemptions=0, coordinator=0.0, instances=0.0, ssd=0.0, bitmovin=0.0)
+
+    def schedule(at, kind, encoding, generation=None):
+        heapq.heappush(events, (at, next(sequence), kind, encoding, generation))
+
+    def spin_up():
+        return max(0.0, model.spin_up_s + rng.uniform(-model.spin_up_jitter_s, model.spin_up_jitter_s))
+
+    def preemption_rate(encoding):
+        rate = encoding.region.region.preemption_rate_per_hour
+        return (model.preemption_rate_per_hour if rate is None else rate) / 3600.0
+
+    def advance(encoding, now):
+        # Progress at the current speed since the last change of the active instances
+        if encoding.progress_at is not None:
+            encoding.remaining -= (now - encoding.progress_at) * encode_speed(model, encoding.active)
+        encoding.progress_at = now
+
+    def reschedule(encoding, now):
+        encoding.generation += 1
+        speed = encode_speed(model, encoding.active)
+        if speed > 0:
+            schedule(now + max(0.0, encoding.remaining) / speed, 'finish', encoding, encoding.generation)
+        rate = preemption_rate(encoding) * encoding.active
+        if rate > 0:
+            schedule(now + rng.expovariate(rate), 'preempt', encoding, encoding.generation)
+
+    def admit(now):
+        while waiting:
+            candidates = [state for state in states
+                          if state.in_flight < state.limit and Admission.fits(state.used, job_footprint,
+                                                                               state.region.quota)]
+            if not candidates:
+                return
+            state = min(candidates, key=lambda s: (s.in_flight / float(s.limit), s.region.price_factor))
+            encoding = waiting.popleft()
+            encoding.region = state
+            state.used = _add(state.used, job_footprint)
+            state.peak = dict((resource, max(state.peak.get(resource, 0), value))
+                              for resource, value in state.used.items())
+            state.in_flight += 1
+            state.peak_in_flight = max(state.peak_in_flight, state.in_flight)
+            state.encodings += 1
+            schedule(now + model.submission_latency_s, 'submitted', encoding)
+
+    for upload in uploads:
+        schedule(upload.arrival_s, 'arrival', _Encoding(upload))
+
+    while events:
+        now, _, kind, encoding, generation = heapq.heappop(events)
+
+        if kind == 'arrival':
+            encodings.append(encoding)
+            waiting.append(encoding)
+            admit(now)
+            stats['max_waiting'] = max(stats['max_waiting'], len(waiting))
+        elif kind == 'submitted':
+            encoding.submitted = now
+            preparation = spin_up() + encoding.upload.size_bytes * 8 / model.input_throughput_bps + model.analysis_s
+            schedule(now + preparation, 'running', encoding)
+        elif kind == 'running':
+            encoding.running = now
+            encoding.active = configuration.instances
+            encoding.progress_at = now
+            reschedule(encoding, now)
+        elif kind == 'preempt':
+            if generation != encoding.generation or encoding.ended is not None:
+                continue
+            advance(encoding, now)
+            encoding.active -= 1
+            encoding.preemptions += 1
+            stats['preemptions'] += 1
+            lost = model.preemption_lost_work_s * encode_speed(model, 1)
+            encoding.remaining = min(encoding.upload.duration_s, encoding.remaining + lost)
+            reschedule(encoding, now)
+            schedule(now + spin_up(), 'replaced', encoding)
+        elif kind == 'replaced':
+            if encoding.ended is not None:
+                continue
+            advance(encoding, now)
+            encoding.active += 1
+            reschedule(encoding, now)
+        elif kind == 'finish':
+            if generation != encoding.generation:
+                continue
+            encoding.ended = now
+            encoding.generation += 1
+            state = encoding.region
+            state.used = _subtract(state.used, job_footprint)
+            state.in_flight -= 1
+
+            hours = (now - encoding.submitted) / 3600.0
+            factor = state.region.price_factor
+            stats['coordinator'] += hours * model.coordinator_price_per_hour * factor
+            stats['instances'] += hours * configuration.instances * model.instance_price_per_hour * factor
+            stats['ssd'] += hours * job_footprint['ssd_tb'] * model.ssd_price_per_tb_hour * factor
+            stats['bitmovin'] += encoding.upload.duration_s / 60.0 * model.bitmovin_price_per_minute
+
+            schedule(now + model.manifest_s, 'manifest', encoding)
+            admit(now)
+        elif kind == 'manifest':
+            encoding.completed = now
+
+    start = min(upload.arrival_s for upload in uploads) if uploads else 0.0
+    turnarounds = sorted(e.completed - e.upload.arrival_s for e in encodings)
+    cost = dict((item, round(stats[item], 2)) for item in ('coordinator', 'instances', 'ssd', 'bitmovin'))
+    cost['total'] = round(sum(stats[item] for item in ('coordinator', 'instances', 'ssd', 'bitmovin')), 2)
+
+    regions = dict()
+    for state in states:
+        regions[state.region.name] = dict(encodings=state.encodings,
+                                          max_in_flight=state.limit,
+                                          peak_in_flight=state.peak_in_flight,
+                                          peak=state.peak,
+                                          headroom=dict((resource, round(limit - state.peak.get(resource, 0), 3))
+                                                        for resource, limit in state.region.quota.items()))
+
+    return Result(configuration=configuration,
+                  makespan_s=max(e.completed for e in encodings) - start if encodings else 0.0,
+                  turnaround_p50_s=percentile(turnarounds, 0.5),
+                  turnaround_p95_s=percentile(turnarounds, 0.95),
+                  max_waiting=stats['max_waiting'],
+                  preemptions=stats['preemptions'],
+                  cost=cost,
+                  regions=regions)
+
+
+def sweep(uploads, regions, deadline_s, instances=(1, 2, 4, 8, 16), model=DEFAULT_MODEL, seeds=5):
+    # type: (list, list, float, tuple, Model, int) -> tuple
+    """
+    Simulates every combination of instances per encoding, maximum encodings in flight per region and number of
+    regions (in the given order), each with the given number of seeds
+
+    :return: (cheapest configuration meeting the deadline or None, list of (configuration, p90 makespan, mean cost,
+        results) ordered by mean cost)
+    """
+
+    rows = []
+    for region_count in range(1, len(regions) + 1):
+        used_regions = regions[:region_count]
+        for instance_count in instances:
+            most = max(capacity(region, instance_count) for region in used_regions)
+            if most == 0:
+                continue
+            for max_encodings in _encoding_options(most):
+                configuration = Configuration(instances=instance_count, max_encodings=max_encodings,
+                                              regions=used_regions)
+                results = [simulate(uploads, configuration, model=model, seed=seed) for seed in range(1, seeds + 1)]
+                makespan = percentile(sorted(result.makespan_s for result in results), 0.9)
+                cost = sum(result.cost['total'] for result in results) / len(results)
+                rows.append((configuration, makespan, cost, results))
+
+    rows.sort(key=lambda row: (row[2], row[1]))
+    feasible = [row for row in rows if row[1] <= deadline_s]
+    return (feasible[0] if feasible else None), rows
+
+
+def percentile(ordered, fraction):
+    # type: (list, float) -> float
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def parse_duration(value):
+    # type: (str) -> float
+    """
+    Seconds of "3600", "90m", "48h" or "3d"
+    """
+
+    units = dict(s=1, m=60, h=3600, d=86400)
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def format_duration(seconds):
+    # type: (float) -> str
+    hours, rest = divmod(int(round(seconds)), 3600)
+    return "{}h{:02d}m".format(hours, rest // 60)
+
+
+def describe(configuration):
+    # type: (Configuration) -> str
+    return "{} instances, {} encodings/region, {}".format(
+        configuration.instances,
+        "quota" if configuration.max_encodings is None else configuration.max_encodings,
+        "+".join(region.name for region in configuration.regions))
+
+
+def _encoding_options(most):
+    options = set([most])
+    value = 1
+    while value < most:
+        options.add(value)
+        value *= 2
+    return sorted(options)
+
+
+def _add(used, job_footprint):
+    return dict((resource, used.get(resource, 0) + job_footprint.get(resource, 0))
+                for resource in set(used) | set(job_footprint))
+
+
+def _subtract(used, job_footprint):
+    return dict((resource, used.get(resource, 0) - job_footprint.get(resource, 0)) for resource in used)
+
+
+def print_result(result):
+    print("configuration:   {}".format(describe(result.configuration)))
+    print("makespan:        {}".format(format_duration(result.makespan_s)))
+    print("turnaround:      p50 {}, p95 {}".format(format_duration(result.turnaround_p50_s),
+                                                  format_duration(result.turnaround_p95_s)))
+    print("max waiting:     {} uploads".format(result.max_waiting))
+    print("preemptions:     {}".format(result.preemptions))
+    print("cost (USD):      {}".format(", ".join("{} {:.2f}".format(item, value)
+                                                 for item, value in sorted(result.cost.items()))))
+    for name, region in sorted(result.regions.items()):
+        print("region {}: {} encodings, peak {} of {} in flight, headroom {}".format(
+            name, region['encodings'], region['peak_in_flight'], region['max_in_flight'],
+            ", ".join("{} {:g}".format(resource, value) for resource, value in sorted(region['headroom'].items()))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['run', 'sweep'])
+    parser.add_argument('trace', nargs='?', help="trace CSV file, see upload_trace.py")
+    parser.add_argument('--synthetic', type=int, help="simulate this many synthetic uploads instead of a trace")
+    parser.add_argument('--rate', type=float, default=0.0, help="arrivals per hour of --synthetic")
+    parser.add_argument('--scenario', help="JSON file with model overrides and regions")
+    parser.add_argument('--instances', default=None,
+                        help="instances per encoding (run) or comma separated options (sweep)")
+    parser.add_argument('--max-encodings', type=int, default=None, help="per region, default as the quota allows")
+    parser.add_argument('--regions', type=int, default=None, help="use the first N regions")
+    parser.add_argument('--deadline', default="48h", help="sweep target, e.g. 36h or 2d")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--seeds', type=int, default=5, help="simulations per configuration in a sweep")
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        uploads = UploadTrace.synthetic(uploads=args.synthetic, rate_per_hour=args.rate, seed=args.seed)
+    elif args.trace:
+        uploads = UploadTrace.load(args.trace)
+    else:
+        parser.error("a trace file or --synthetic is required")
+
+    model, regions = load_scenario(args.scenario) if args.scenario else (DEFAULT_MODEL, default_regions())
+    if args.regions:
+        regions = regions[:args.regions]
+    hours = sum(upload.duration_s for upload in uploads) / 3600.0
+    print("{} uploads, {:.1f} hours of source, regions {}".format(len(uploads), hours,
+                                                                 ", ".join(region.name for region in regions)))
+
+    if args.command == 'run':
+        configuration = Configuration(instances=int(args.instances or Config.ENCODING_MAX_INSTANCES),
+                                      max_encodings=args.max_encodings,
+                                      regions=regions)
+        print_result(simulate(uploads, configuration, model=model, seed=args.seed))
+        return
+
+    deadline = parse_duration(args.deadline)
+    instances = tuple(int(value) for value in (args.instances or "1,2,4,8,16").split(','))
+    best, rows = sweep(uploads, regions, deadline, instances=instances, model=model, seeds=args.seeds)
+
+    print("{:<64} {:>10} {:>10} {:>9}".format("configuration", "p90 span", "cost USD", "deadline"))
+    for configuration, makespan, cost, _ in rows[:args.top]:
+        print("{:<64} {:>10} {:>10.2f} {:>9}".format(describe(configuration), format_duration(makespan), cost,
+                                                     "met" if makespan <= deadline else "missed"))
+    if best is None:
+        fastest = min(rows, key=lambda row: row[1])
+        print("No configuration meets {}; the fastest is {} with {}".format(
+            format_duration(deadline), describe(fastest[0]), format_duration(fastest[1])))
+        sys.exit(1)
+    print("Cheapest configuration meeting {}: {} ({}, {:.2f} USD)".format(
+        format_duration(deadline), describe(best[0]), format_duration(best[1]), best[2]))
+    print()
+    print_result(best[3][0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import argparse
+import csv
+import random
+import sys
+
+from collections import namedtuple
+
+"""
+Traces of upload events for the capacity simulator.
+
+<p>A trace is a CSV file with one upload per line and the columns
+  <ul>
+   <li>name: object name of the upload,
+   <li>size_bytes: size of the source file,
+   <li>duration_s: duration of the source in seconds,
+   <li>arrival_s: seconds after the start of the migration at which the upload lands in the input bucket.
+ </ul>
+For a catalog migration it is usually exported from the catalog (one line per title) with the planned upload
+schedule. synthetic() generates a trace with Poisson arrivals and log-normal durations for quick what-ifs.
+
+Usage:
+    python capacity-simulator/upload_trace.py --uploads 500 --rate 60 > my_trace.csv
+"""
+
+Upload = namedtuple('Upload', ['name', 'size_bytes', 'duration_s', 'arrival_s'])
+
+FIELDS = Upload._fields
+
+
+def load(file_path):
+    # type: (str) -> list
+    """
+    Reads a trace CSV file and returns its uploads ordered by arrival
+    """
+
+    with open(file_path) as f:
+        uploads = [Upload(name=row['name'],
+                          size_bytes=int(float(row['size_bytes'])),
+                          duration_s=float(row['duration_s']),
+                          arrival_s=float(row.get('arrival_s') or 0.0))
+                   for row in csv.DictReader(f)]
+    return sorted(uploads, key=lambda upload: upload.arrival_s)
+
+
+def write(uploads, f):
+    # type: (list, object) -> None
+    writer = csv.writer(f)
+    writer.writerow(FIELDS)
+    for upload in uploads:
+        writer.writerow([upload.name, upload.size_bytes, round(upload.duration_s, 1), round(upload.arrival_s, 1)])
+
+
+def synthetic(uploads, rate_per_hour, median_duration_s=2700.0, sigma=0.6, bitrate=50e6, seed=1):
+    # type: (int, float, float, float, float, int) -> list
+    """
+    Generates a trace with Poisson arrivals and log-normal source durations
+
+    :param uploads: Number of uploads
+    :param rate_per_hour: Mean arrivals per hour, 0 for all uploads at once
+    :param median_duration_s: Median source duration
+    :param sigma: Standard deviation of the log of the durations
+    :param bitrate: Bitrate of the sources (mezzanine files) in bit/s, gives their size
+    """
+
+    rng = random.Random(seed)
+    arrival = 0.0
+    trace = []
+    for index in range(uploads):
+        if rate_per_hour > 0 and index > 0:
+            arrival += rng.expovariate(rate_per_hour / 3600.0)
+        duration = max(10.0, rng.lognormvariate(0.0, sigma) * median_duration_s)
+        trace.append(Upload(name="catalog/title-{:05d}.mp4".format(index),
+                            size_bytes=int(duration * bitrate / 8),
+                            duration_s=duration,
+                            arrival_s=arrival))
+    return trace
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uploads', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=0.0, help="arrivals per hour, 0 for all at once")
+    parser.add_argument('--median-duration', type=float, default=2700.0, help="seconds")
+    parser.add_argument('--bitrate', type=float, default=50e6, help="bit/s of the sources")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    write(synthetic(uploads=args.uploads, rate_per_hour=args.rate, median_duration_s=args.median_duration,
+                    bitrate=args.bitrate, seed=args.seed), sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -29,11 +29,118 @@ ENCODING_LABELS = []
 INPUT_BASE_PATH = ""
 OUTPUT_BASE_PATH = ""
 
-# ASSET DETAILS
-#ASSET_NAME="high+(1).mp4"
+# STATUS POLLING
+# Manifests usually finish in under a second, so polling starts short and backs off exponentially (with jitter)
+# up to MANIFEST_POLL_MAX_INTERVAL. A manifest not done after MANIFEST_POLL_DEADLINE seconds fails the request.
+MANIFEST_POLL_INITIAL_INTERVAL = 0.25
+MANIFEST_POLL_MAX_INTERVAL = 5.0
+MANIFEST_POLL_DEADLINE = 300.0
+
+# MANIFEST WRITER
+# "API" creates the manifests through the Bitmovin manifest API. "LOCAL" renders them in the function from the muxing
+# metadata and writes them to GCS_OUTPUT_BUCKET_NAME directly (see manifest_writer.py), which takes milliseconds
+# instead of tens of seconds of create calls and polling. With MANIFEST_STORAGE_DIR set they are written to that local
+# folder instead of the bucket, e.g. for local runs.
+MANIFEST_WRITER = "API"
+MANIFEST_STORAGE_DIR = None
+# The HLS and DASH manifests are built side by side. Their create calls per muxing (and the metadata lookups of the
+# "LOCAL" writer) run on at most MANIFEST_MAX_WORKERS threads.
+MANIFEST_MAX_WORKERS = 8
+
+# RENDITION ORDER
+# Manifests list the video renditions by ascending bitrate, ordered from their stream and codec configuration metadata
+# (see rendition_index.py). Most HLS players start playback on the first variant of the master playlist, so one master
+# playlist is written per device class, starting on the highest video rendition at or below its start bitrate (bits
+# per second): "default" as hls-manifest.m3u8, others as hls-manifest-<device class>.m3u8, e.g.
+# dict(default=1500000, mobile=800000, tv=5000000). Each further device class costs one more manifest.
+HLS_START_BITRATES = dict(default=1500000)
+
+# WEBHOOK DELIVERIES
+# Bitmovin delivers a webhook again when it is not answered in time, possibly to another instance of the function.
+# Every finished webhook claims its encoding in the webhook store (see webhook_store.py): deliveries for an encoding
+# whose manifests are done return OK at once, deliveries while they are in progress get a 503 with Retry-After so
+# Bitmovin keeps delivering, and deliveries for a failed encoding or an interrupted one (no progress for
+# WEBHOOK_CLAIM_TTL seconds, which has to exceed the run time of the function) resume its manifests.
+# "FIRESTORE" keeps the claims in Firestore (see SHARED STATE), where every instance sees them. "SQLITE" keeps them in
+# WEBHOOK_STORE_DB_FILE, "FILE" as JSON files in WEBHOOK_STORE_DIR; both are local to an instance (SQLite does not work
+# on network filesystems) and only meant for local runs. None turns the store off.
+WEBHOOK_STORE = "FIRESTORE"
+WEBHOOK_STORE_DB_FILE = "/tmp/webhook-deliveries.db"
+WEBHOOK_STORE_DIR = "/tmp/webhook-deliveries"
+WEBHOOK_CLAIM_TTL = 600
+
+# SHARED STATE
+# Firestore database of the stores that have to be shared by all instances (see firestore_client.py). None uses the
+# project of the function and its "(default)" database. Collections are named FIRESTORE_COLLECTION_PREFIX + the name of
+# the store; with the same prefix as in vod-basic-encoder both functions share the encoding ledger. STATE_STORE
+# "FIRESTORE" keeps the ledger there, "SQLITE" in LEDGER_DB_FILE, which is local to an instance and only meant for
+# local runs.
+STATE_STORE = "FIRESTORE"
+FIRESTORE_PROJECT = None
+FIRESTORE_DATABASE = None
+FIRESTORE_COLLECTION_PREFIX = "bitmovin-"
+
+# MANIFESTS AT START
+# Encodings started with MANIFEST_GENERATION "START" in vod-basic-encoder get their manifests written by Bitmovin and
+# carry manifests_at_start in their custom data. With WEBHOOK_SCOPE "ORGANIZATION" their finished webhook reaches this
+# function as well; SKIP_MANIFESTS_AT_START ignores them instead of building their manifests a second time. Costs one
+# additional API call per finished encoding to read its custom data (the same call as SPLIT_STITCH_ENABLED); turn it
+# off if no encoding of the organization is started with "START".
+SKIP_MANIFESTS_AT_START = True
+
+# SPLIT AND STITCH
+# Stitch the chunks of split encodings (SPLIT_ENCODING_ENABLED in vod-basic-encoder) into single manifests once the
+# last chunk has finished. Costs one additional API call per finished encoding to read its custom data.
+SPLIT_STITCH_ENABLED = False
+
+# ENCODING LEDGER
+# Encodings started per asset, see ledger.py, kept in STATE_STORE. This function marks the encodings FINISHED. An
+# existing LEDGER_IMPORT_JSON_FILE (the former encodings.json) is imported once.
+LEDGER_DB_FILE = "/tmp/encoding-ledger.db"
+LEDGER_IMPORT_JSON_FILE = "encodings.json"
+
+# LIST CALLS
+# All list calls read every page (see pagination.py), API_LIST_PAGE_SIZE items per call (at most 100). With
+# API_LIST_PREFETCH the next page is requested while the items of the current one are processed.
+API_LIST_PAGE_SIZE = 100
+API_LIST_PREFETCH = True
+
+# HTTP TRANSPORT
+BITMOVIN_API_BASE_URL = "https://api.bitmovin.com/v1"
+# All Bitmovin API calls of an instance share one transport (see http_transport.py). "POOLED" keeps up to
+# HTTP_POOL_SIZE keep-alive connections open, so only the first call on a connection pays for the TLS handshake;
+# with HTTP_POOL_BLOCK further concurrent calls wait for a free connection instead of opening short-lived ones.
+# "HTTP2" multiplexes the calls over HTTP/2 and requires httpx[http2]; "SDK" opens a new connection per call.
+HTTP_TRANSPORT = "POOLED"
+HTTP_POOL_SIZE = 16
+HTTP_POOL_BLOCK = False
+HTTP_TIMEOUT = 60.0
+# Responses are requested compressed and decompressed transparently, "identity" turns compression off
+HTTP_ACCEPT_ENCODING = "gzip, deflate"
+# Connections opened in the background while the SDK is imported on first use of the API client. With
+# HTTP_WARM_UP_AT_START that already happens when an instance starts instead of on its first upload calling the API.
+HTTP_WARM_UP_CONNECTIONS = 2
+HTTP_WARM_UP_AT_START = False
+
+# INSTRUMENTATION
+# Every Bitmovin API call is recorded per endpoint: latency histogram (upper bounds in seconds), calls, errors,
+# retries and payload sizes, see instrumentation.py. Each invocation that called the API logs one JSON line with its
+# calls, and the totals of the instance are written to METRICS_FILE in the OpenMetrics text format (also served by
+# the api_metrics HTTP function).
+METRICS_ENABLED = True
+METRICS_FILE = "/tmp/bitmovin-api-metrics.txt"
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Opt-in profiling of every invocation: "SAMPLING" samples the stacks of all threads every PROFILE_SAMPLE_INTERVAL
+# seconds, "CPROFILE" traces every call of the invoked thread (slower). Profiles of invocations that took longer than
+# PROFILE_SLOW_THRESHOLD seconds are written to PROFILE_DIR and their top entries logged.
+PROFILE_MODE = None
+PROFILE_SLOW_THRESHOLD = 5.0
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_DIR = "/tmp/profiles"
 
 # Override with local config settings
 try:
     from config_local import *
 except ImportError:
-    print('no local settings to import')
+    # Deployed functions have no local settings; nothing is printed so cold starts stay quiet
+    pass
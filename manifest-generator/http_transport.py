@@ -0,0 +1,255 @@
+import threading
+
+import config as Config
+import instrumentation as Instrumentation
+
+"""
+Shared HTTP transport of all Bitmovin API calls of an instance.
+
+<p>The SDK sends every call with requests.request(), i.e. on a new connection with its own TCP and TLS handshake. A
+job makes dozens of calls, so most of their latency was connection setup. All calls of an instance (from every
+thread and every warm invocation) go through one transport instead:
+  <ul>
+   <li>"POOLED" keeps up to HTTP_POOL_SIZE keep-alive connections per host open in a requests session,
+   <li>"HTTP2" multiplexes all calls over a single HTTP/2 connection (requires httpx[http2]),
+   <li>"SDK" opens a new connection per call, as the SDK itself does.
+ </ul>
+Responses are requested compressed (HTTP_ACCEPT_ENCODING) and decompressed transparently.
+
+<p>Every transport reports the payload sizes and retries of a call to the instrumentation (see instrumentation.py).
+
+<p>install() hands the transport to the SDK by replacing the requests module its RestClient calls. warm_up() opens
+connections ahead of the first call; utils.py runs it in the background while the SDK is being imported.
+"""
+
+TRANSPORTS = ("POOLED", "HTTP2", "SDK")
+
+transport = None
+_transport_lock = threading.Lock()
+
+
+def init_transport():
+    # type: () -> object
+    """
+    Returns the transport of this instance, created on first use according to HTTP_TRANSPORT
+    """
+
+    global transport
+    with _transport_lock:
+        if transport is None:
+            transport = create_transport(Config.HTTP_TRANSPORT)
+    return transport
+
+
+def create_transport(kind, pool_size=None):
+    # type: (str, int) -> object
+    if kind not in TRANSPORTS:
+        raise Exception("Unknown HTTP_TRANSPORT '{}', expected one of {}".format(kind, TRANSPORTS))
+
+    pool_size = pool_size or Config.HTTP_POOL_SIZE
+    if kind == "HTTP2":
+        try:
+            return Http2Transport(pool_size=pool_size)
+        except ImportError as e:
+            print("HTTP/2 transport is not available ({}), using pooled HTTP/1.1 connections".format(e))
+    if kind == "SDK":
+        return UnpooledTransport()
+    return PooledTransport(pool_size=pool_size)
+
+
+def install(http_transport):
+    # type: (object) -> None
+    """
+    Makes the RestClient of the Bitmovin API SDK send its calls through the given transport. The SDK has to be
+    importable; calls of clients that were already created are redirected as well.
+    """
+
+    from bitmovin_api_sdk.common import rest_client
+
+    rest_client.requests = _SdkRequests(http_transport)
+
+
+def warm_up(http_transport, url, connections=None):
+    # type: (object, str, int) -> int
+    """
+    Opens connections to the host of url with concurrent HEAD requests, so they are in the pool before the first
+    API call. The responses do not matter (the host is reached unauthenticated); connections that cannot be opened
+    are left to the first calls.
+
+    :return: The number of requests that completed
+    """
+
+    connections = Config.HTTP_WARM_UP_CONNECTIONS if connections is None else connections
+    completed = []
+    barrier = threading.Barrier(connections) if connections > 0 else None
+
+    def open_connection():
+        try:
+            barrier.wait(timeout=Config.HTTP_TIMEOUT)
+            http_transport.request("HEAD", url)
+            completed.append(True)
+        except Exception as e:
+            print("Warming up a connection to {} failed: {}".format(url, e))
+
+    threads = [threading.Thread(target=open_connection, name="http-warm-up-{}".format(index), daemon=True)
+               for index in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(completed)
+
+
+def warm_up_in_background(http_transport, url, connections=None):
+    # type: (object, str, int) -> threading.Thread
+    thread = threading.Thread(target=warm_up, args=(http_transport, url, connections), name="http-warm-up",
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+class Transport(object):
+    """
+    Sends a call with _send() and records its payload sizes
+    """
+
+    def request(self, method, url, headers=None, data=None):
+        # type: (str, str, dict, object) -> requests.Response
+        response = self._send(method, url, headers, data)
+        Instrumentation.record_transfer(request_bytes=len(data) if data else 0,
+                                        response_bytes=len(response.content or b""))
+        return response
+
+    def _send(self, method, url, headers, data):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class PooledTransport(Transport):
+    """
+    Keep-alive HTTP/1.1 connections in a requests session. A call takes a free connection of its host or opens a
+    new one; at most pool_size connections per host are kept for reuse (with HTTP_POOL_BLOCK, calls beyond that
+    wait for a free connection instead of opening a short-lived one).
+    """
+
+    def __init__(self, pool_size):
+        # type: (int) -> None
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # Idempotent calls are retried once on a connection the server closed while it was idle; POSTs are not
+        # retried, as the resource might have been created
+        retries = _counted(Retry)(total=1, connect=1, read=1, status=0, redirect=0, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=Config.HTTP_POOL_BLOCK,
+                              max_retries=retries)
+
+        self.pool_size = pool_size
+        self._session = requests.Session()
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._session.headers.update({'Accept-Encoding': Config.HTTP_ACCEPT_ENCODING})
+
+    def _send(self, method, url, headers, data):
+        return self._session.request(method, url, headers=headers, data=data, timeout=Config.HTTP_TIMEOUT)
+
+    def close(self):
+        self._session.close()
+
+
+class UnpooledTransport(Transport):
+    """
+    A new connection per call, as the SDK sends its calls by default
+    """
+
+    def _send(self, method, url, headers, data):
+        import requests
+
+        headers = dict(headers or dict())
+        headers.setdefault('Accept-Encoding', Config.HTTP_ACCEPT_ENCODING)
+        return requests.request(method, url, headers=headers, data=data, timeout=Config.HTTP_TIMEOUT)
+
+
+class Http2Transport(Transport):
+    """
+    All calls multiplexed over HTTP/2 connections of an httpx client (at most pool_size). Responses are wrapped,
+    so the SDK sees them (and their errors) as it sees those of requests.
+    """
+
+    def __init__(self, pool_size):
+        # type: (int) -> None
+        import httpx
+
+        self.pool_size = pool_size
+        self._client = httpx.Client(http2=True,
+                                    timeout=Config.HTTP_TIMEOUT,
+                                    limits=httpx.Limits(max_connections=pool_size,
+                                                        max_keepalive_connections=pool_size),
+                                    headers={'Accept-Encoding': Config.HTTP_ACCEPT_ENCODING})
+
+    def _send(self, method, url, headers, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return _Http2Response(self._client.request(method, url, headers=headers, content=data))
+
+    def close(self):
+        self._client.close()
+
+
+class _Http2Response(object):
+    """
+    The parts of a requests.Response that the SDK and the other callers of the transport use
+    """
+
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.reason = response.reason_phrase
+        self.headers = response.headers
+        self.url = str(response.url)
+
+    @property
+    def content(self):
+        return self._response.content
+
+    @property
+    def text(self):
+        return self._response.text
+
+    def json(self):
+        return self._response.json()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+
+            raise requests.HTTPError("{} Error: {} for url: {}".format(self.status_code, self.reason, self.url),
+                                     response=self)
+
+
+def _counted(retry_class):
+    """
+    Subclass of urllib3's Retry that reports every retry it allows to the instrumentation
+    """
+
+    class CountedRetry(retry_class):
+        def increment(self, *args, **kwargs):
+            retry = super(CountedRetry, self).increment(*args, **kwargs)
+            Instrumentation.record_retry()
+            return retry
+
+    return CountedRetry
+
+
+class _SdkRequests(object):
+    """
+    Stands in for the requests module in the RestClient of the SDK, which only calls requests.request()
+    """
+
+    def __init__(self, http_transport):
+        self._transport = http_transport
+
+    def request(self, method, url, headers=None, data=None, **kwargs):
+        return self._transport.request(method, url, headers=headers, data=data)
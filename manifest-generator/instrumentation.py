@@ -0,0 +1,434 @@
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+
+import config as Config
+
+"""
+Instrumentation of the Bitmovin API calls of both functions.
+
+<p>The API client returned by utils.init_bitmovin_api() is wrapped in an InstrumentedApi, which times every call
+under the path of the SDK method, e.g. "encoding.encodings.streams.create" or "encoding.encodings.status". The HTTP
+transport adds the payload sizes and retries of the call. Per endpoint the instance keeps
+  <ul>
+   <li>a latency histogram (METRICS_LATENCY_BUCKETS),
+   <li>the number of calls, failed calls and transport retries,
+   <li>the request and response bytes.
+ </ul>
+
+<p>Entry points decorated with @instrumented additionally collect the calls of each invocation, including those
+made from the thread pools of the encoding graph and of split encodings (submitted with in_context). At the end of
+an invocation that called the API, one structured log line summarizes its calls and the totals of the instance are
+written to METRICS_FILE in the OpenMetrics text format.
+
+<p>With PROFILE_MODE, invocations are profiled ("SAMPLING": stacks of all threads every PROFILE_SAMPLE_INTERVAL
+seconds, "CPROFILE": every call of the invoked thread) and the profiles of those slower than PROFILE_SLOW_THRESHOLD
+are written to PROFILE_DIR.
+"""
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+METRIC_PREFIX = "bitmovin_api"
+
+_invocation = contextvars.ContextVar('invocation', default=None)
+_call = contextvars.ContextVar('call', default=None)
+
+metrics = None
+_metrics_lock = threading.Lock()
+
+_listeners = []
+
+
+def init_metrics():
+    # type: () -> ApiMetrics
+    """
+    Returns the metrics of all API calls of this instance
+    """
+
+    global metrics
+    with _metrics_lock:
+        if metrics is None:
+            metrics = ApiMetrics(buckets=Config.METRICS_LATENCY_BUCKETS)
+    return metrics
+
+
+class Call(object):
+    """
+    One API call while it is made. The transport adds its payload sizes and retries.
+    """
+
+    __slots__ = ('endpoint', 'failed', 'retries', 'request_bytes', 'response_bytes')
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.failed = False
+        self.retries = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+
+@contextmanager
+def record_call(endpoint):
+    # type: (str) -> Call
+    """
+    Times the API call made in the with block and records it for the instance and the current invocation
+    """
+
+    call = Call(endpoint)
+    token = _call.set(call)
+    started = time.perf_counter()
+    try:
+        yield call
+    except BaseException:
+        call.failed = True
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        _call.reset(token)
+        init_metrics().add(call, seconds)
+        invocation = _invocation.get()
+        if invocation is not None:
+            invocation.add(call, seconds)
+
+
+def record_transfer(request_bytes, response_bytes):
+    # type: (int, int) -> None
+    call = _call.get()
+    if call is not None:
+        call.request_bytes += request_bytes
+        call.response_bytes += response_bytes
+
+
+def record_retry():
+    call = _call.get()
+    if call is not None:
+        call.retries += 1
+
+
+def in_context(function):
+    # type: (callable) -> callable
+    """
+    Returns function bound to the current context, so calls it makes on a thread pool count for this invocation.
+    Every call runs in its own copy, a context cannot be entered by several threads at once.
+    """
+
+    context = contextvars.copy_context()
+
+    @functools.wraps(function)
+    def run(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+
+    return run
+
+
+class ApiMetrics(object):
+    """
+    Calls, failures, retries, payload sizes and a latency histogram per endpoint
+    """
+
+    def __init__(self, buckets):
+        # type: (tuple) -> None
+        self.buckets = tuple(sorted(buckets))
+        self._endpoints = dict()
+        self._lock = threading.Lock()
+
+    def add(self, call, seconds):
+        # type: (Call, float) -> None
+        with self._lock:
+            stats = self._endpoints.get(call.endpoint)
+            if stats is None:
+                stats = self._endpoints[call.endpoint] = dict(calls=0, errors=0, retries=0, seconds=0.0,
+                                                              max_seconds=0.0, request_bytes=0, response_bytes=0,
+                                                              buckets=[0] * (len(self.buckets) + 1))
+            stats['calls'] += 1
+            stats['errors'] += call.failed
+            stats['retries'] += call.retries
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['request_bytes'] += call.request_bytes
+            stats['response_bytes'] += call.response_bytes
+            stats['buckets'][self._bucket_of(seconds)] += 1
+
+    def endpoints(self):
+        # type: () -> dict
+        with self._lock:
+            return dict((endpoint, dict(stats, buckets=list(stats['buckets'])))
+                        for endpoint, stats in self._endpoints.items())
+
+    def total_calls(self):
+        # type: () -> int
+        with self._lock:
+            return sum(stats['calls'] for stats in self._endpoints.values())
+
+    def summary(self):
+        # type: () -> list
+        """
+        Per endpoint, slowest total first: calls, errors, retries, total/mean/max milliseconds and bytes
+        """
+
+        rows = []
+        for endpoint, stats in self.endpoints().items():
+            rows.append(dict(endpoint=endpoint,
+                             calls=stats['calls'],
+                             errors=stats['errors'],
+                             retries=stats['retries'],
+                             total_ms=round(stats['seconds'] * 1000.0, 1),
+                             mean_ms=round(stats['seconds'] * 1000.0 / stats['calls'], 1),
+                             max_ms=round(stats['max_seconds'] * 1000.0, 1),
+                             request_bytes=stats['request_bytes'],
+                             response_bytes=stats['response_bytes']))
+        return sorted(rows, key=lambda row: -row['total_ms'])
+
+    def render_openmetrics(self):
+        # type: () -> str
+        """
+        Returns the metrics in the OpenMetrics text format, see https://openmetrics.io
+        """
+
+        endpoints = sorted(self.endpoints().items())
+        duration = METRIC_PREFIX + "_request_duration_seconds"
+        lines = ["# TYPE {} histogram".format(duration),
+                 "# UNIT {} seconds".format(duration),
+                 "# HELP {} Latency of Bitmovin API calls.".format(duration)]
+        for endpoint, stats in endpoints:
+            label = _label(endpoint)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), stats['buckets']):
+                cumulative += count
+                lines.append('{}_bucket{{endpoint="{}",le="{}"}} {}'.format(
+                    duration, label, "+Inf" if bound == float('inf') else repr(float(bound)), cumulative))
+            lines.append('{}_sum{{endpoint="{}"}} {!r}'.format(duration, label, stats['seconds']))
+            lines.append('{}_count{{endpoint="{}"}} {}'.format(duration, label, stats['calls']))
+
+        for name, key, help_text in (("requests", 'calls', "Bitmovin API calls."),
+                                     ("errors", 'errors', "Bitmovin API calls that failed."),
+                                     ("retries", 'retries', "Retries of Bitmovin API calls by the HTTP transport."),
+                                     ("request_bytes", 'request_bytes', "Bytes sent in Bitmovin API calls."),
+                                     ("response_bytes", 'response_bytes', "Bytes received from Bitmovin API calls.")):
+            metric = METRIC_PREFIX + "_" + name
+            lines.append("# TYPE {} counter".format(metric))
+            lines.append("# HELP {} {}".format(metric, help_text))
+            for endpoint, stats in endpoints:
+                lines.append('{}_total{{endpoint="{}"}} {}'.format(metric, _label(endpoint), stats[key]))
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def _bucket_of(self, seconds):
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                return index
+        return len(self.buckets)
+
+
+class InstrumentedApi(object):
+    """
+    Stands in for the API client (or one of its sub-APIs) and records every method call under its path
+    """
+
+    def __init__(self, target, path=""):
+        self._target = target
+        self._path = path
+        self._children = dict()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        child = self._children.get(name)
+        if child is None:
+            child = self._children[name] = self._wrap(name, getattr(self._target, name))
+        return child
+
+    def _wrap(self, name, attribute):
+        endpoint = self._path + "." + name if self._path else name
+        if callable(attribute):
+            @functools.wraps(attribute)
+            def call(*args, **kwargs):
+                with record_call(endpoint):
+                    return attribute(*args, **kwargs)
+            return call
+        if attribute is None or isinstance(attribute, (str, bytes, int, float, list, dict, tuple)):
+            return attribute
+        return InstrumentedApi(attribute, endpoint)
+
+
+def add_listener(listener):
+    # type: (callable) -> None
+    """
+    Calls listener(function_name, invocation_metrics, seconds) at the end of every instrumented invocation, e.g. to
+    collect per-invocation statistics in a benchmark
+    """
+
+    _listeners.append(listener)
+
+
+def instrument_api(api):
+    # type: (BitmovinApi) -> BitmovinApi
+    return InstrumentedApi(api) if Config.METRICS_ENABLED else api
+
+
+def instrumented(entry_point):
+    # type: (callable) -> callable
+    """
+    Decorates the entry point of a function: collects the API calls of each invocation, logs them at its end and
+    profiles it if PROFILE_MODE is set
+    """
+
+    @functools.wraps(entry_point)
+    def invoke(*args, **kwargs):
+        if not Config.METRICS_ENABLED and not Config.PROFILE_MODE:
+            return entry_point(*args, **kwargs)
+
+        invocation = ApiMetrics(buckets=Config.METRICS_LATENCY_BUCKETS)
+        token = _invocation.set(invocation)
+        profiler = start_profiler(Config.PROFILE_MODE) if Config.PROFILE_MODE else None
+        started = time.perf_counter()
+        try:
+            return entry_point(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - started
+            _invocation.reset(token)
+            profile = _finish_profile(profiler, entry_point.__name__, seconds) if profiler else None
+            if Config.METRICS_ENABLED and (invocation.total_calls() or profile):
+                _report(entry_point.__name__, invocation, seconds, profile)
+            for listener in _listeners:
+                listener(entry_point.__name__, invocation, seconds)
+
+    return invoke
+
+
+def _report(function_name, invocation, seconds, profile):
+    calls = invocation.summary()
+    line = dict(message="bitmovin api calls",
+                function=function_name,
+                duration_ms=round(seconds * 1000.0, 1),
+                api_calls=sum(row['calls'] for row in calls),
+                api_ms=round(sum(row['total_ms'] for row in calls), 1),
+                endpoints=calls)
+    if profile:
+        line['profile'] = profile
+    print(json.dumps(line))
+
+    if Config.METRICS_FILE:
+        try:
+            _write_atomically(Config.METRICS_FILE, init_metrics().render_openmetrics())
+        except OSError as e:
+            print("Could not write metrics to {}: {}".format(Config.METRICS_FILE, e))
+
+
+def _write_atomically(file_path, text):
+    temporary = "{}.{}.tmp".format(file_path, threading.get_ident())
+    with open(temporary, 'w') as f:
+        f.write(text)
+    os.replace(temporary, file_path)
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def start_profiler(mode):
+    # type: (str) -> object
+    if mode == "CPROFILE":
+        return CProfileProfiler()
+    if mode == "SAMPLING":
+        return SamplingProfiler(interval=Config.PROFILE_SAMPLE_INTERVAL)
+    raise Exception("Unknown PROFILE_MODE '{}', expected SAMPLING or CPROFILE".format(mode))
+
+
+def _finish_profile(profiler, function_name, seconds):
+    profiler.stop()
+    if seconds < Config.PROFILE_SLOW_THRESHOLD:
+        return None
+
+    os.makedirs(Config.PROFILE_DIR, exist_ok=True)
+    file_path = os.path.join(Config.PROFILE_DIR, "{}-{}-{}{}".format(function_name, int(time.time() * 1000),
+                                                                     threading.get_ident(), profiler.SUFFIX))
+    profiler.write(file_path)
+    return dict(file=file_path, top=profiler.top(10))
+
+
+class CProfileProfiler(object):
+    """
+    Deterministic profile of the invoked thread; work on thread pools shows up as waiting for their futures.
+    Written in the pstats format (python -m pstats <file>).
+    """
+
+    SUFFIX = ".prof"
+
+    def __init__(self):
+        import cProfile
+
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def write(self, file_path):
+        self._profile.dump_stats(file_path)
+
+    def top(self, count):
+        # type: (int) -> list
+        import pstats
+
+        stats = pstats.Stats(self._profile).stats
+        ranked = sorted(stats.items(), key=lambda item: -item[1][3])[:count]
+        return ["{}:{}({}) {:.3f}s".format(os.path.basename(file_name), line, function, cumulative)
+                for (file_name, line, function), (_, _, _, cumulative, _) in ranked]
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stacks of all threads of the instance (including those of concurrent invocations) at a fixed
+    interval. Written as collapsed stacks, one "frame;frame;... count" line per stack, which flame graph tools read.
+    """
+
+    SUFFIX = ".folded"
+
+    def __init__(self, interval):
+        # type: (float) -> None
+        self._interval = interval
+        self._stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def write(self, file_path):
+        with open(file_path, 'w') as f:
+            for stack, count in self._stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+    def top(self, count):
+        # type: (int) -> list
+        """
+        The functions that were running in most samples
+        """
+
+        leaves = Counter()
+        for stack, samples in self._stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += samples
+        total = float(sum(leaves.values()) or 1)
+        return ["{} {:.0%}".format(frame, samples / total) for frame, samples in leaves.most_common(count)]
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self._interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                self._stacks[';'.join(reversed(stack))] += 1
@@ -0,0 +1,388 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import config as Config
+import firestore_client as Firestore
+
+"""
+Ledger of the encodings started per asset.
+
+<p>Replaces the encodings.json file that was read and rewritten completely on every access. Every encoding is one
+row, upserted by its encoding ID, so writes take the same time no matter how many jobs the ledger holds and an asset
+can have any number of encodings per codec type. The rows are indexed by asset, status and timestamps for the queries
+below. An existing encodings.json is imported once when the ledger is opened.
+
+<p>Encodings are recorded by vod-basic-encoder and their status is updated by the functions handling their webhooks
+(manifest-generator, release_encoding_quota), which run on other instances. The functions write through
+record_started and record_status, which never fail the invocation. FirestoreLedger keeps the rows in
+Firestore, where all of them see the same ledger. SqliteLedger keeps them in SQLite (WAL mode), which only the
+instance that wrote it sees, for local runs and the benchmarks.
+"""
+
+CREATED = "CREATED"
+FINISHED = "FINISHED"
+ERROR = "ERROR"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS encodings (
+    encoding_id TEXT PRIMARY KEY,
+    asset_name TEXT NOT NULL,
+    codec_type TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS encodings_by_asset ON encodings (asset_name, codec_type, created_at);
+CREATE INDEX IF NOT EXISTS encodings_by_status ON encodings (status, updated_at);
+CREATE INDEX IF NOT EXISTS encodings_by_updated ON encodings (updated_at);
+CREATE TABLE IF NOT EXISTS imports (
+    source TEXT PRIMARY KEY,
+    imported_at REAL NOT NULL,
+    rows INTEGER NOT NULL
+);
+"""
+
+_UPSERT = """
+INSERT INTO encodings (encoding_id, asset_name, codec_type, status, created_at, updated_at)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (encoding_id) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at
+"""
+
+ledger = None
+_ledger_lock = threading.Lock()
+
+
+def init_ledger():
+    # type: () -> object
+    """
+    Returns the ledger of STATE_STORE
+    """
+    global ledger
+    with _ledger_lock:
+        if ledger is None:
+            if Config.STATE_STORE == "FIRESTORE":
+                ledger = FirestoreLedger(collection_name="encoding-ledger")
+            elif Config.STATE_STORE == "SQLITE":
+                ledger = SqliteLedger(db_path=Config.LEDGER_DB_FILE)
+            else:
+                raise Exception("Unknown STATE_STORE {}".format(Config.STATE_STORE))
+            if Config.LEDGER_IMPORT_JSON_FILE:
+                ledger.import_json(Config.LEDGER_IMPORT_JSON_FILE)
+
+    return ledger
+
+
+def record_started(asset_name, codec_type, encoding_id):
+    # type: (str, str, str) -> bool
+    """
+    Records a started encoding. The ledger is bookkeeping only: the encoding already runs, and failing the invocation
+    would make the event be delivered again and start a second encoding, so errors (e.g. Firestore being
+    unavailable) are logged and False is returned.
+    """
+
+    try:
+        init_ledger().record(asset_name=asset_name, codec_type=codec_type, encoding_id=encoding_id)
+        return True
+    except Exception as e:
+        print("Could not record encoding {} of {} in the ledger: {}".format(encoding_id, asset_name, e))
+        return False
+
+
+def record_status(encoding_id, status):
+    # type: (str, str) -> bool
+    """
+    Updates the status of an encoding from its webhook. Errors are logged and False is returned, as for
+    record_started, so they do not fail the handling of the webhook.
+    """
+
+    try:
+        init_ledger().set_status(encoding_id=encoding_id, status=status)
+        return True
+    except Exception as e:
+        print("Could not set the status of encoding {} to {} in the ledger: {}".format(encoding_id, status, e))
+        return False
+
+
+class SqliteLedger(object):
+
+    def __init__(self, db_path):
+        # type: (str) -> None
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def record(self, asset_name, codec_type, encoding_id, status=CREATED):
+        # type: (str, str, str, str) -> None
+        """
+        Inserts an encoding or, if the encoding ID is already known, updates its status
+        """
+
+        now = time.time()
+        self._connection().execute(_UPSERT, (encoding_id, asset_name, codec_type, status, now, now))
+
+    def record_many(self, jobs):
+        # type: (list) -> None
+        """
+        Upserts many encodings in a single transaction
+
+        :param jobs: (asset_name, codec_type, encoding_id, status) tuples
+        """
+
+        now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(_UPSERT, ((encoding_id, asset_name, codec_type, status, now, now)
+                                             for asset_name, codec_type, encoding_id, status in jobs))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def set_status(self, encoding_id, status):
+        # type: (str, str) -> bool
+        """
+        Updates the status of a recorded encoding. Returns False if the encoding is not in the ledger.
+        """
+
+        cursor = self._connection().execute("UPDATE encodings SET status = ?, updated_at = ? WHERE encoding_id = ?",
+                                            (status, time.time(), encoding_id))
+        return cursor.rowcount > 0
+
+    def latest(self, asset_name, codec_type):
+        # type: (str, str) -> str
+        """
+        Returns the ID of the most recent encoding of an asset and codec type, or None
+        """
+
+        row = self._connection().execute(
+            "SELECT encoding_id FROM encodings WHERE asset_name = ? AND codec_type = ? "
+            "ORDER BY created_at DESC LIMIT 1", (asset_name, codec_type)).fetchone()
+        return row[0] if row is not None else None
+
+    def jobs_by_state(self, status, limit=100):
+        # type: (str, int) -> list
+        """
+        Returns the encodings in a status, most recently updated first
+        """
+
+        return self._query("SELECT * FROM encodings WHERE status = ? ORDER BY updated_at DESC LIMIT ?",
+                           (status, limit))
+
+    def jobs_by_asset(self, asset_name):
+        # type: (str) -> list
+        """
+        Returns all encodings of an asset, oldest first
+        """
+
+        return self._query("SELECT * FROM encodings WHERE asset_name = ? ORDER BY codec_type, created_at",
+                           (asset_name,))
+
+    def throughput_per_hour(self, since=None, status=FINISHED):
+        # type: (float, str) -> list
+        """
+        Returns (hour start timestamp, number of encodings) pairs for the encodings that reached a status, by the hour
+        of their last update
+
+        :param since: Only count updates after this timestamp, defaults to the last 24 hours
+        :param status: The status to count, defaults to FINISHED
+        """
+
+        since = time.time() - 24 * 3600 if since is None else since
+        return self._connection().execute(
+            "SELECT CAST(updated_at / 3600 AS INTEGER) * 3600 AS hour, COUNT(*) FROM encodings "
+            "WHERE updated_at >= ? AND status = ? GROUP BY hour ORDER BY hour", (since, status)).fetchall()
+
+    def import_json(self, filename):
+        # type: (str) -> int
+        """
+        Imports an encodings.json file ({asset name: {codec type: encoding ID}}) once. Returns the number of
+        encodings imported, 0 if the file does not exist or was imported before.
+        """
+
+        if not os.path.exists(filename):
+            return 0
+
+        source = os.path.abspath(filename)
+        connection = self._connection()
+        if connection.execute("SELECT 1 FROM imports WHERE source = ?", (source,)).fetchone() is not None:
+            return 0
+
+        with open(filename, 'r') as fp:
+            encoding_data = json.load(fp)
+
+        jobs = [(asset_name, codec_type, encoding_id, CREATED)
+                for asset_name, encodings in encoding_data.items()
+                for codec_type, encoding_id in encodings.items()]
+        self.record_many(jobs)
+        connection.execute("INSERT OR IGNORE INTO imports (source, imported_at, rows) VALUES (?, ?, ?)",
+                           (source, time.time(), len(jobs)))
+        return len(jobs)
+
+    def _query(self, sql, parameters):
+        cursor = self._connection().execute(sql, parameters)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(_SCHEMA)
+            self._local.connection = connection
+        return connection
+
+
+class FirestoreLedger(object):
+    """
+    Keeps every encoding in a document of <FIRESTORE_COLLECTION_PREFIX><collection_name> named by its encoding ID.
+    The encodings of an asset are few and sorted in memory; jobs_by_state and throughput_per_hour need a composite
+    index on (status, updated_at descending).
+    """
+
+    # Writes per batch, the Firestore limit
+    BATCH_SIZE = 500
+
+    def __init__(self, collection_name):
+        # type: (str) -> None
+        self.collection_name = collection_name
+
+    def record(self, asset_name, codec_type, encoding_id, status=CREATED):
+        # type: (str, str, str, str) -> None
+        """
+        Inserts an encoding or, if the encoding ID is already known, updates its status
+        """
+
+        from google.api_core.exceptions import AlreadyExists
+
+        now = time.time()
+        reference = self._encodings().document(encoding_id)
+        try:
+            reference.create(dict(encoding_id=encoding_id, asset_name=asset_name, codec_type=codec_type,
+                                  status=status, created_at=now, updated_at=now))
+        except AlreadyExists:
+            reference.update(dict(status=status, updated_at=now))
+
+    def record_many(self, jobs):
+        # type: (list) -> None
+        """
+        Upserts many encodings, BATCH_SIZE per batched write
+
+        :param jobs: (asset_name, codec_type, encoding_id, status) tuples
+        """
+
+        client = Firestore.init_firestore()
+        encodings = self._encodings()
+        jobs = list(jobs)
+
+        for offset in range(0, len(jobs), self.BATCH_SIZE):
+            chunk = jobs[offset:offset + self.BATCH_SIZE]
+            references = [encodings.document(encoding_id) for _, _, encoding_id, _ in chunk]
+            known = set(snapshot.id for snapshot in client.get_all(references) if snapshot.exists)
+
+            now = time.time()
+            batch = client.batch()
+            for (asset_name, codec_type, encoding_id, status), reference in zip(chunk, references):
+                if encoding_id in known:
+                    batch.update(reference, dict(status=status, updated_at=now))
+                else:
+                    batch.set(reference, dict(encoding_id=encoding_id, asset_name=asset_name, codec_type=codec_type,
+                                              status=status, created_at=now, updated_at=now))
+            batch.commit()
+
+    def set_status(self, encoding_id, status):
+        # type: (str, str) -> bool
+        """
+        Updates the status of a recorded encoding. Returns False if the encoding is not in the ledger.
+        """
+
+        from google.api_core.exceptions import NotFound
+
+        try:
+            self._encodings().document(encoding_id).update(dict(status=status, updated_at=time.time()))
+        except NotFound:
+            return False
+        return True
+
+    def latest(self, asset_name, codec_type):
+        # type: (str, str) -> str
+        """
+        Returns the ID of the most recent encoding of an asset and codec type, or None
+        """
+
+        rows = [row for row in self.jobs_by_asset(asset_name) if row['codec_type'] == codec_type]
+        return max(rows, key=lambda row: row['created_at'])['encoding_id'] if rows else None
+
+    def jobs_by_state(self, status, limit=100):
+        # type: (str, int) -> list
+        """
+        Returns the encodings in a status, most recently updated first
+        """
+
+        return [snapshot.to_dict() for snapshot in self._by_status(status).limit(limit).stream()]
+
+    def jobs_by_asset(self, asset_name):
+        # type: (str) -> list
+        """
+        Returns all encodings of an asset, oldest first
+        """
+
+        rows = [snapshot.to_dict() for snapshot in
+                self._encodings().where(filter=self._field("asset_name", asset_name)).stream()]
+        return sorted(rows, key=lambda row: (row['codec_type'], row['created_at']))
+
+    def throughput_per_hour(self, since=None, status=FINISHED):
+        # type: (float, str) -> list
+        """
+        Returns (hour start timestamp, number of encodings) pairs, see SqliteLedger.throughput_per_hour
+        """
+
+        since = time.time() - 24 * 3600 if since is None else since
+        hours = dict()
+        for snapshot in self._by_status(status).where(filter=self._field("updated_at", since, op=">=")).stream():
+            hour = int(snapshot.get('updated_at') / 3600) * 3600
+            hours[hour] = hours.get(hour, 0) + 1
+        return sorted(hours.items())
+
+    def import_json(self, filename):
+        # type: (str) -> int
+        """
+        Imports an encodings.json file once, see SqliteLedger.import_json. The import is recorded in the ledger, so
+        the file is imported once for all instances.
+        """
+
+        if not os.path.exists(filename):
+            return 0
+
+        source = os.path.abspath(filename)
+        imports = Firestore.collection(self.collection_name + "-imports").document(Firestore.document_id(source))
+        if imports.get().exists:
+            return 0
+
+        with open(filename, 'r') as fp:
+            encoding_data = json.load(fp)
+
+        jobs = [(asset_name, codec_type, encoding_id, CREATED)
+                for asset_name, encodings in encoding_data.items()
+                for codec_type, encoding_id in encodings.items()]
+        self.record_many(jobs)
+        imports.set(dict(source=source, imported_at=time.time(), rows=len(jobs)))
+        return len(jobs)
+
+    def _by_status(self, status):
+        from google.cloud import firestore
+        return self._encodings().where(filter=self._field("status", status)).order_by(
+            "updated_at", direction=firestore.Query.DESCENDING)
+
+    def _encodings(self):
+        return Firestore.collection(self.collection_name)
+
+    @staticmethod
+    def _field(name, value, op="=="):
+        from google.cloud.firestore import FieldFilter
+        return FieldFilter(name, op, value)
@@ -1,13 +1,20 @@
-import time
+import threading
 
-from bitmovin_api_sdk import BitmovinApi, BitmovinApiLogger, AclEntry, AclPermission, Status, MessageType, \
-    HlsManifest, AudioMediaInfo, StreamInfo, \
-    DashManifest, Period, VideoAdaptationSet, AudioAdaptationSet, \
-    DashMp4Representation, DashProfile
+from collections import OrderedDict
+from lazy_sdk import Sdk
 
 from os import path
 
 import utils as Utils
+import config as Config
+import poller as Poller
+import ledger as Ledger
+import stitcher as Stitcher
+import manifest_writer as ManifestWriter
+import pagination as Pagination
+import rendition_index as RenditionIndex
+import webhook_store as WebhookStore
+import instrumentation as Instrumentation
 
 """
 This example demonstrates how to create default DASH and HLS manifests for an encoding.
@@ -23,14 +30,26 @@ This example demonstrates how to create default DASH and HLS manifests for an en
 
 bitmovin_api = Utils.init_bitmovin_api()
 manifest_api = bitmovin_api.encoding.manifests
+if Config.HTTP_WARM_UP_AT_START:
+    Utils.warm_up_bitmovin_api()
 
+# HLS_START_BITRATES entry of the master playlist named hls-manifest.m3u8
+DEFAULT_DEVICE_CLASS = "default"
 
+# Codec configurations cannot be changed once created, and the encodings of a ladder share theirs (see
+# config_registry.py in vod-basic-encoder), so their details are kept per warm instance
+CONFIGURATION_CACHE_SIZE = 1024
+_configurations = OrderedDict()
+_configurations_lock = threading.Lock()
+
+
+@Instrumentation.instrumented
 def generate_hls_dash_manifests(request):
     """Responds to any HTTP request.
     Args:
         request (flask.Request): HTTP request object.
     Returns:
-        OK status
+        OK status, or 503 with Retry-After while another delivery is generating the manifests of the encoding
     """
     ENCODING_ID = _check_request(request)
     if ENCODING_ID != '':
@@ -38,12 +57,224 @@ def generate_hls_dash_manifests(request):
     else:
         raise Exception("Missing encoding id")
 
-    _generate_hls_ts_manifest(encoding_id=ENCODING_ID,
-                              name='HLS Manifest - H264 TS',
-                              manifest_name='hls-manifest')
-    _generate_dash_mp4_manifest(encoding_id=ENCODING_ID,
-                                name='DASH Manifest - H264 MP4',
-                                manifest_name='dash-manifest')
+    # Bitmovin redelivers webhooks that were not answered in time, the manifests are generated once per encoding
+    store = WebhookStore.init_webhook_store()
+    if store is not None:
+        claimed, delivery = store.claim(ENCODING_ID)
+        if not claimed and delivery.state == WebhookStore.DONE:
+            print("Manifests of encoding {} are done, ignoring the repeated webhook".format(ENCODING_ID))
+            return "OK"
+        if not claimed:
+            # Not a 2xx, so Bitmovin keeps delivering the webhook: if the delivery working on the manifests dies, the
+            # first one after its claim went stale takes over
+            retry_after = WebhookStore.retry_after(delivery, ttl=Config.WEBHOOK_CLAIM_TTL)
+            print("Manifests of encoding {} are in progress, asking for a redelivery in {} s".format(ENCODING_ID,
+                                                                                                  retry_after))
+            return "Manifests in progress", 503, {'Retry-After': str(retry_after)}
+        if delivery.attempts > 1:
+            print("Resuming the manifests of encoding {} (delivery {})".format(ENCODING_ID, delivery.attempts))
+
+    # Only the delivery holding the claim updates the ledger
+    Ledger.record_status(encoding_id=ENCODING_ID, status=Ledger.FINISHED)
+
+    try:
+        _handle_finished_encoding(encoding_id=ENCODING_ID)
+    except Exception as e:
+        if store is not None:
+            store.finish(ENCODING_ID, WebhookStore.FAILED, error=str(e))
+        raise
+
+    if store is not None:
+        store.finish(ENCODING_ID, WebhookStore.DONE)
+
+    return "OK"
+
+
+def _handle_finished_encoding(encoding_id):
+    if Config.SPLIT_STITCH_ENABLED or Config.SKIP_MANIFESTS_AT_START:
+        # Encodings that declared their manifests in the start request carry a flag in their custom data, chunks of a
+        # split encoding the path of their split plan
+        custom_data = bitmovin_api.encoding.encodings.customdata.get(encoding_id=encoding_id).custom_data or dict()
+        if Config.SKIP_MANIFESTS_AT_START and custom_data.get('manifests_at_start'):
+            print("Encoding {} writes its manifests itself, ignoring the webhook".format(encoding_id))
+            return
+        if Config.SPLIT_STITCH_ENABLED and 'split_plan' in custom_data:
+            _stitch_split_encoding(plan_path=custom_data['split_plan'])
+            return
+
+    # Manifest resources of independent muxings are created side by side, at most MANIFEST_MAX_WORKERS at a time
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=Config.MANIFEST_MAX_WORKERS) as executor:
+        _generate_manifests(encoding_id=encoding_id, executor=executor)
+
+
+def _generate_manifests(encoding_id, executor):
+    # Encodings written with MUXING_MODE "CMAF" only have fragmented MP4 muxings, which serve both HLS and DASH
+    fmp4_muxings = _retrieve_fmp4_muxings(encoding_id=encoding_id)
+
+    if fmp4_muxings:
+        fmp4_index = _index_renditions(encoding_id=encoding_id, muxing_lists=[fmp4_muxings], executor=executor)[0]
+        if Config.MANIFEST_WRITER == "LOCAL":
+            _write_local_manifests(encoding_id=encoding_id,
+                                   segmented_index=fmp4_index,
+                                   segmented_type="fmp4",
+                                   hls_version=7,
+                                   executor=executor)
+            return
+        _run_side_by_side(*_hls_pipelines(encoding_id=encoding_id,
+                                          index=fmp4_index,
+                                          name='HLS Manifest - H264 CMAF',
+                                          hls_version=Sdk.HlsVersion.HLS_V7,
+                                          executor=executor) + [
+            ('DASH Manifest - H264 CMAF',
+             lambda: _generate_dash_manifest(encoding_id=encoding_id,
+                                             index=fmp4_index,
+                                             name='DASH Manifest - H264 CMAF',
+                                             manifest_name='dash-manifest',
+                                             profile=Sdk.DashProfile.LIVE,
+                                             add_representation=_add_dash_fmp4_representation,
+                                             executor=executor))])
+        return
+
+    ts_muxings, mp4_muxings = _fan_out(executor, lambda retrieve: retrieve(encoding_id=encoding_id),
+                                       [_retrieve_ts_muxings, _retrieve_mp4_muxings])
+    ts_index, mp4_index = _index_renditions(encoding_id=encoding_id, muxing_lists=[ts_muxings, mp4_muxings],
+                                            executor=executor)
+
+    if Config.MANIFEST_WRITER == "LOCAL":
+        _write_local_manifests(encoding_id=encoding_id,
+                               segmented_index=ts_index,
+                               segmented_type="ts",
+                               mp4_index=mp4_index,
+                               executor=executor)
+        return
+
+    _run_side_by_side(*_hls_pipelines(encoding_id=encoding_id,
+                                      index=ts_index,
+                                      name='HLS Manifest - H264 TS',
+                                      executor=executor) + [
+        ('DASH Manifest - H264 MP4',
+         lambda: _generate_dash_manifest(encoding_id=encoding_id,
+                                         index=mp4_index,
+                                         name='DASH Manifest - H264 MP4',
+                                         manifest_name='dash-manifest',
+                                         profile=Sdk.DashProfile.ON_DEMAND,
+                                         add_representation=_add_dash_mp4_representation,
+                                         executor=executor))])
+
+
+def _hls_pipelines(encoding_id, index, name, executor, hls_version=None):
+    # type: (str, RenditionIndex.RenditionIndex, str, ThreadPoolExecutor, HlsVersion) -> list
+    """
+    Returns one (name, pipeline) per device class of HLS_START_BITRATES, each pipeline generating a master playlist
+    that starts on the start variant of the device class
+    """
+
+    def pipeline(device_class, start_bitrate):
+        return (_hls_name(name, device_class),
+                lambda: _generate_hls_manifest(encoding_id=encoding_id,
+                                               index=index,
+                                               name=_hls_name(name, device_class),
+                                               manifest_name=_hls_manifest_name(device_class),
+                                               start_bitrate=start_bitrate,
+                                               hls_version=hls_version,
+                                               executor=executor))
+
+    return [pipeline(device_class, start_bitrate) for device_class, start_bitrate in _hls_start_bitrates()]
+
+
+def _hls_start_bitrates():
+    # type: () -> list
+    # Without device classes the master playlist lists the variants by bitrate only
+    return sorted((Config.HLS_START_BITRATES or {DEFAULT_DEVICE_CLASS: None}).items())
+
+
+def _hls_name(name, device_class):
+    return name if device_class == DEFAULT_DEVICE_CLASS else "{} ({})".format(name, device_class)
+
+
+def _hls_manifest_name(device_class):
+    return 'hls-manifest' if device_class == DEFAULT_DEVICE_CLASS else 'hls-manifest-{}'.format(device_class)
+
+
+def _run_side_by_side(*pipelines):
+    """
+    Runs the HLS and DASH pipelines, given as (manifest name, pipeline) with each pipeline creating, starting and
+    polling its manifest, in threads of their own, so the webhook takes as long as the slowest of them. Raises once
+    all have ended if any of them failed: the error itself if only one ran, otherwise one naming the failed manifests.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=len(pipelines)) as pipeline_executor:
+        futures = [(name, pipeline_executor.submit(Instrumentation.in_context(pipeline)))
+                   for name, pipeline in pipelines]
+
+    errors = [(name, future.exception()) for name, future in futures if future.exception() is not None]
+    if len(errors) == 1 and len(pipelines) == 1:
+        raise errors[0][1]
+    if errors:
+        raise Exception("{} of {} manifests failed: {}".format(
+            len(errors), len(pipelines), "; ".join("{}: {}".format(name, e) for name, e in errors))) from errors[0][1]
+
+
+def _fan_out(executor, function, items):
+    # type: (ThreadPoolExecutor, callable, list) -> list
+    """
+    Calls function for every item on the executor and returns the results in the order of the items. Raises the
+    error of the first failed call once all calls have ended.
+    """
+    return _results(_submit_each(executor, function, items))
+
+
+def _submit_each(executor, function, items):
+    # type: (ThreadPoolExecutor, callable, list) -> list
+    # Only called from threads outside of the executor: a call waiting for others in the same bounded executor
+    # could wait forever
+    return [executor.submit(Instrumentation.in_context(function), item) for item in items]
+
+
+def _results(futures):
+    # type: (list) -> list
+    from concurrent.futures import wait
+
+    wait(futures)
+    return [future.result() for future in futures]
+
+
+def api_metrics(request):
+    """Reports the latency histograms, calls, errors, retries and payload sizes of the Bitmovin API calls of this
+    instance per endpoint.
+    Args:
+        request (flask.Request): HTTP request object.
+    Returns:
+        The metrics in the OpenMetrics text format
+    """
+    return Instrumentation.init_metrics().render_openmetrics(), 200, {'Content-Type': Instrumentation.CONTENT_TYPE}
+
+
+def _stitch_split_encoding(plan_path):
+    """
+    Stitches the chunks of a split encoding into single HLS and DASH manifests, with one master playlist per device
+    class of HLS_START_BITRATES, once all chunks have finished. Chunks finishing earlier only check the state of their
+    siblings.
+    """
+    storage = Stitcher.GcsStorage(bucket_name=Config.GCS_OUTPUT_BUCKET_NAME)
+    plan = Stitcher.load_plan(storage=storage, plan_path=plan_path)
+
+    statuses = [Poller.status_of(bitmovin_api.encoding.encodings.status(encoding_id=chunk['encoding_id']))
+                for chunk in plan['chunks']]
+    if "ERROR" in statuses or "CANCELED" in statuses:
+        raise Exception("Split encoding {} has failed chunks: {}".format(plan_path, statuses))
+    if any(status != "FINISHED" for status in statuses):
+        print("{} of {} chunks of {} finished".format(statuses.count("FINISHED"), len(statuses), plan_path))
+        return
+
+    start_bitrates = dict((_hls_manifest_name(device_class), start_bitrate)
+                          for device_class, start_bitrate in _hls_start_bitrates())
+    written = Stitcher.stitch(plan=plan, storage=storage, output_base_path=Config.OUTPUT_BASE_PATH,
+                              start_bitrates=start_bitrates)
+    print("Stitched {} chunks of {} into {}".format(len(plan['chunks']), plan_path, written))
 
 
 def _check_request(request):
@@ -69,270 +300,509 @@ def _check_request(request):
     return encoding_id
 
 
-def _generate_hls_ts_manifest(encoding_id, name, manifest_name):
-    muxings = _retrieve_ts_muxings(encoding_id=encoding_id)
-
-    # This assumes that all similar muxings are written to the same output and path
-    output_id = muxings['video'][0].outputs[0].output_id
-    output_path = muxings['video'][0].outputs[0].output_path
-    output_root = output_path[:output_path.index("/video")]
-
-    manifest = _create_base_hls_manifest(name=name,
-                                         manifest_name=manifest_name,
-                                         output_id=output_id,
-                                         output_path=output_root)
-
-    _add_hls_audio_media_infos(manifest=manifest,
-                               encoding_id=encoding_id,
-                               muxings=muxings['audio'],
-                               language="eng",
-                               output_root=output_root)
-
-    _add_hls_video_stream_infos(manifest=manifest,
-                                encoding_id=encoding_id,
-                                muxings=muxings['video'],
-                                output_root=output_root)
-
-    manifest_api.hls.start(manifest_id=manifest.id)
-
-    task = _wait_for_hls_manifest_to_finish(manifest_id=manifest.id)
-
-    while task.status is not Status.FINISHED and task.status is not Status.ERROR:
-        task = _wait_for_hls_manifest_to_finish(manifest_id=manifest.id)
-
-    if task.status is Status.ERROR:
-        Utils.log_task_errors(task=task)
-        raise Exception("HLS TS Manifest failed")
-
-    print("HLS TS Manifest finished successfully")
-
-
-def _generate_dash_mp4_manifest(encoding_id, name, manifest_name):
-    muxings = _retrieve_mp4_muxings(encoding_id=encoding_id)
+def _generate_hls_manifest(encoding_id, index, name, manifest_name, start_bitrate, executor, hls_version=None):
+    output_id, output_root = _output_of(index)
+
+    def build():
+        manifest = _create_base_hls_manifest(name=name,
+                                             manifest_name=manifest_name,
+                                             output_id=output_id,
+                                             output_path=output_root,
+                                             hls_version=hls_version)
+
+        # One create call per muxing, all side by side. The API lists them in creation order, so the start variant
+        # and the default audio rendition are created first and everything else after them.
+        audio_muxings = index.muxings(RenditionIndex.AUDIO)
+        video_muxings = [r.muxing for r in index.hls_video(start_bitrate)]
+        if not video_muxings:
+            # Audio-only: every audio rendition is a variant of its own, highest bitrate first
+            _results(_add_hls_stream_infos(manifest=manifest,
+                                           encoding_id=encoding_id,
+                                           muxings=audio_muxings,
+                                           media_type=RenditionIndex.AUDIO,
+                                           output_root=output_root,
+                                           executor=executor))
+            return manifest.id
+
+        for audio, video in ((audio_muxings[:1], video_muxings[:1]), (audio_muxings[1:], video_muxings[1:])):
+            _results(_add_hls_audio_media_infos(manifest=manifest,
+                                                encoding_id=encoding_id,
+                                                muxings=audio,
+                                                language="eng",
+                                                output_root=output_root,
+                                                executor=executor) +
+                     _add_hls_stream_infos(manifest=manifest,
+                                           encoding_id=encoding_id,
+                                           muxings=video,
+                                           media_type=RenditionIndex.VIDEO,
+                                           output_root=output_root,
+                                           executor=executor))
+        return manifest.id
+
+    _run_manifest(encoding_id=encoding_id,
+                  name=name,
+                  manifest_name=manifest_name,
+                  build=build,
+                  start=lambda manifest_id: manifest_api.hls.start(manifest_id=manifest_id),
+                  wait=_wait_for_hls_manifest_to_finish)
+
+
+def _generate_dash_manifest(encoding_id, index, name, manifest_name, profile, add_representation, executor):
+    output_id, output_root = _output_of(index)
+
+    def build():
+        manifest_info = _create_base_dash_manifest(name=name,
+                                                   manifest_name=manifest_name,
+                                                   output_id=output_id,
+                                                   output_path=output_root,
+                                                   profile=profile,
+                                                   with_video=bool(index.video),
+                                                   executor=executor)
+
+        # One create call per muxing, all side by side: players pick DASH representations by bandwidth, not by order
+        _results(_add_dash_representations(manifest_info=manifest_info,
+                                           adaptation_set=manifest_info['audio_adaptation_set'],
+                                           encoding_id=encoding_id,
+                                           muxings=index.muxings(RenditionIndex.AUDIO),
+                                           output_root=output_root,
+                                           filename="audio.mp4",
+                                           add_representation=add_representation,
+                                           executor=executor) +
+                 _add_dash_representations(manifest_info=manifest_info,
+                                           adaptation_set=manifest_info['video_adaptation_set'],
+                                           encoding_id=encoding_id,
+                                           muxings=index.muxings(RenditionIndex.VIDEO),
+                                           output_root=output_root,
+                                           filename="video.mp4",
+                                           add_representation=add_representation,
+                                           executor=executor))
+        return manifest_info['manifest'].id
+
+    _run_manifest(encoding_id=encoding_id,
+                  name=name,
+                  manifest_name=manifest_name,
+                  build=build,
+                  start=lambda manifest_id: manifest_api.dash.start(manifest_id=manifest_id),
+                  wait=_wait_for_dash_manifest_to_finish)
+
+
+def _output_of(index):
+    # type: (RenditionIndex.RenditionIndex) -> (str, str)
+    """
+    Returns the output ID and the output root of the muxings of an index. This assumes that all similar muxings are
+    written to the same output and path, e.g. <output root>/video/... and <output root>/audio/...
+    """
+    rendition = index.first()
+    output = rendition.muxing.outputs[0]
+    return output.output_id, output.output_path[:output.output_path.index("/" + rendition.media_type)]
 
-    # This assumes that all similar muxings are written to the same output and path
-    output_id = muxings['video'][0].outputs[0].output_id
-    output_path = muxings['video'][0].outputs[0].output_path
-    output_root = output_path[:output_path.index("/video")]
 
-    manifest_info = _create_base_dash_manifest(name=name,
-                                               manifest_name=manifest_name,
-                                               output_id=output_id,
-                                               output_path=output_root)
-    manifest_id = manifest_info['manifest'].id
+def _run_manifest(encoding_id, name, manifest_name, build, start, wait):
+    # type: (str, str, str, callable, callable, callable) -> None
+    """
+    Builds a manifest (build() creates it with all its resources and returns its ID), starts it and waits for it to
+    finish. The phases are saved in the progress of the webhook claim (see webhook_store.py), so a resumed delivery
+    skips a finished manifest and waits for a started one instead of building it again. A manifest interrupted while
+    it was built is built anew; it was never started, so it has written nothing.
+    """
 
-    _add_dash_audio_representations(manifest_info=manifest_info,
-                                    encoding_id=encoding_id,
-                                    muxings=muxings['audio'],
-                                    output_root=output_root)
+    store = WebhookStore.init_webhook_store()
+    delivery = store.get(encoding_id) if store is not None else None
+    progress = delivery.progress.get(manifest_name, dict()) if delivery is not None else dict()
 
-    _add_dash_video_representations(manifest_info=manifest_info,
-                                    encoding_id=encoding_id,
-                                    muxings=muxings['video'],
-                                    output_root=output_root)
+    def save(manifest_id, phase):
+        if store is not None:
+            store.save_progress(encoding_id, manifest_name, dict(manifest_id=manifest_id, phase=phase))
 
-    manifest_api.dash.start(manifest_id=manifest_id)
+    if progress.get('phase') == WebhookStore.FINISHED:
+        print("{} finished in an earlier delivery".format(name))
+        return
 
-    task = _wait_for_dash_manifest_to_finish(manifest_id=manifest_id)
+    if progress.get('phase') == WebhookStore.STARTED:
+        manifest_id = progress['manifest_id']
+        print("{} was started in an earlier delivery, waiting for manifest {}".format(name, manifest_id))
+    else:
+        manifest_id = build()
+        start(manifest_id)
+        save(manifest_id, WebhookStore.STARTED)
 
-    while task.status is not Status.FINISHED and task.status is not Status.ERROR:
-        task = _wait_for_dash_manifest_to_finish(manifest_id=manifest_id)
+    task = wait(manifest_id)
 
-    if task.status is Status.ERROR:
+    if task.status is Sdk.Status.ERROR:
         Utils.log_task_errors(task=task)
-        raise Exception("DASH MP4 Manifest failed")
+        # The next delivery builds the manifest anew
+        save(manifest_id, WebhookStore.FAILED)
+        raise Exception("{} failed".format(name))
 
-    print("DASH MP4 Manifest finished successfully")
+    save(manifest_id, WebhookStore.FINISHED)
+    print("{} finished successfully".format(name))
 
 
 # === HLS Manifests +++
 
-def _create_base_hls_manifest(name, manifest_name, output_id, output_path):
+def _create_base_hls_manifest(name, manifest_name, output_id, output_path, hls_version=None):
     """
-    Creates the structure of a basic HLS manifest object
+    Creates the structure of a basic HLS manifest object. Fragmented MP4 segments require at least HLS version 7.
     """
-    hls_manifest = HlsManifest(manifest_name='{}.m3u8'.format(manifest_name),
-                               outputs=[Utils.build_encoding_output_with_absolute_path(output_id=output_id,
-                                                                                       output_path=output_path)],
-                               name=name)
+    hls_manifest = Sdk.HlsManifest(manifest_name='{}.m3u8'.format(manifest_name),
+                                   outputs=[Utils.build_encoding_output_with_absolute_path(output_id=output_id,
+                                                                                           output_path=output_path)],
+                                   name=name,
+                                   hls_master_playlist_version=hls_version,
+                                   hls_media_playlist_version=hls_version)
     return manifest_api.hls.create(hls_manifest=hls_manifest)
 
 
-def _add_hls_audio_media_infos(manifest, encoding_id, muxings, language, output_root):
-    for muxing in muxings:
+def _add_hls_audio_media_infos(manifest, encoding_id, muxings, language, output_root, executor):
+    # type: (HlsManifest, str, list, str, str, ThreadPoolExecutor) -> list
+    """
+    Submits the creation of an audio media info per muxing to the executor, returns the futures
+    """
+    def add(muxing):
         relative_path = _extract_relative_muxing_path(muxing.outputs[0].output_path, output_root)
 
-        _add_hls_audio_media_info(manifest=manifest,
-                                  encoding_id=encoding_id,
-                                  muxing_id=muxing.id,
-                                  stream_id=muxing.streams[0].stream_id,
-                                  relative_path=relative_path,
-                                  segment_path="",
-                                  language=language)
-    return
+        return _add_hls_audio_media_info(manifest=manifest,
+                                         encoding_id=encoding_id,
+                                         muxing_id=muxing.id,
+                                         stream_id=muxing.streams[0].stream_id,
+                                         relative_path=relative_path,
+                                         segment_path="",
+                                         language=language)
+
+    return _submit_each(executor, add, muxings)
 
 
 def _add_hls_audio_media_info(manifest, encoding_id, muxing_id, stream_id, relative_path, segment_path, language):
-    audio_media = AudioMediaInfo(name="Audio Media Info for muxing {}".format(muxing_id),
-                                 group_id='audio',
-                                 segment_path=segment_path,
-                                 encoding_id=encoding_id,
-                                 stream_id=stream_id,
-                                 muxing_id=muxing_id,
-                                 language=language,
-                                 uri='{}audio.m3u8'.format(relative_path))
+    audio_media = Sdk.AudioMediaInfo(name="Audio Media Info for muxing {}".format(muxing_id),
+                                     group_id='audio',
+                                     segment_path=segment_path,
+                                     encoding_id=encoding_id,
+                                     stream_id=stream_id,
+                                     muxing_id=muxing_id,
+                                     language=language,
+                                     uri='{}audio.m3u8'.format(relative_path))
     return manifest_api.hls.media.audio.create(manifest_id=manifest.id, audio_media_info=audio_media)
 
 
-def _add_hls_video_stream_infos(manifest, encoding_id, muxings, output_root):
-    for muxing in muxings:
+def _add_hls_stream_infos(manifest, encoding_id, muxings, media_type, output_root, executor):
+    # type: (HlsManifest, str, list, str, str, ThreadPoolExecutor) -> list
+    """
+    Submits the creation of a stream info per muxing to the executor, returns the futures. Video variants play with
+    the audio media infos, audio variants (of an audio-only encoding) on their own.
+    """
+    def add(muxing):
         relative_path = _extract_relative_muxing_path(muxing.outputs[0].output_path, output_root)
 
-        _add_hls_video_stream_info(manifest=manifest,
-                                   encoding_id=encoding_id,
-                                   muxing_id=muxing.id,
-                                   stream_id=muxing.streams[0].stream_id,
-                                   segment_path="",
-                                   relative_path=relative_path)
+        return _add_hls_stream_info(manifest=manifest,
+                                    encoding_id=encoding_id,
+                                    muxing_id=muxing.id,
+                                    stream_id=muxing.streams[0].stream_id,
+                                    media_type=media_type,
+                                    segment_path="",
+                                    relative_path=relative_path)
 
+    return _submit_each(executor, add, muxings)
 
-def _add_hls_video_stream_info(manifest, encoding_id, muxing_id, stream_id, relative_path, segment_path):
-    stream_info = StreamInfo(name="Stream Info for muxing {}".format(muxing_id),
-                             audio='audio',
-                             closed_captions='NONE',
-                             segment_path=segment_path,
-                             uri='{}video.m3u8'.format(relative_path),
-                             encoding_id=encoding_id,
-                             stream_id=stream_id,
-                             muxing_id=muxing_id)
+
+def _add_hls_stream_info(manifest, encoding_id, muxing_id, stream_id, media_type, relative_path, segment_path):
+    stream_info = Sdk.StreamInfo(name="Stream Info for muxing {}".format(muxing_id),
+                                 audio='audio' if media_type == RenditionIndex.VIDEO else None,
+                                 closed_captions='NONE',
+                                 segment_path=segment_path,
+                                 uri='{}{}.m3u8'.format(relative_path, media_type),
+                                 encoding_id=encoding_id,
+                                 stream_id=stream_id,
+                                 muxing_id=muxing_id)
 
     return manifest_api.hls.streams.create(manifest_id=manifest.id, stream_info=stream_info)
 
 
 def _wait_for_hls_manifest_to_finish(manifest_id):
-    time.sleep(5)
-    task = manifest_api.hls.status(manifest_id=manifest_id)
-    print("Manifest status is {} (progress: {} %)".format(task.status, task.progress))
-    return task
+    return _wait_for_manifest_to_finish(fetch=lambda: manifest_api.hls.status(manifest_id=manifest_id))
 
 
 # === DASH manifests ===
 
-def _create_base_dash_manifest(name, manifest_name, output_id, output_path):
-    # Create a standard VOD DASH manifest and add one period with an adapation set for audio and video
-    manifest = DashManifest(manifest_name='{}.mpd'.format(manifest_name),
-                            outputs=[Utils.build_encoding_output_with_absolute_path(output_id=output_id,
-                                                                                    output_path=output_path)],
-                            name=name,
-                            profile=DashProfile.ON_DEMAND)
+def _create_base_dash_manifest(name, manifest_name, output_id, output_path, executor, profile=None, with_video=True):
+    # Create a standard VOD DASH manifest and add one period with an adapation set for audio and video (audio only
+    # without video renditions). Single-file MP4 representations use the on-demand profile, segmented CMAF
+    # representations the live profile.
+    manifest = Sdk.DashManifest(manifest_name='{}.mpd'.format(manifest_name),
+                                outputs=[Utils.build_encoding_output_with_absolute_path(output_id=output_id,
+                                                                                        output_path=output_path)],
+                                name=name,
+                                profile=profile or Sdk.DashProfile.ON_DEMAND)
     manifest = manifest_api.dash.create(dash_manifest=manifest)
 
-    period = Period()
+    period = Sdk.Period()
     period = manifest_api.dash.periods.create(period=period, manifest_id=manifest.id)
 
-    video_adaptation_set = VideoAdaptationSet()
-    video_adaptation_set = \
-        manifest_api.dash.periods.adaptationsets.video.create(video_adaptation_set=video_adaptation_set,
-                                                              manifest_id=manifest.id,
-                                                              period_id=period.id)
-
-    audio_adaptation_set = AudioAdaptationSet(lang='eng')
-    audio_adaptation_set = \
-        manifest_api.dash.periods.adaptationsets.audio.create(audio_adaptation_set=audio_adaptation_set,
-                                                              manifest_id=manifest.id,
-                                                              period_id=period.id)
+    def create_video_adaptation_set():
+        return manifest_api.dash.periods.adaptationsets.video.create(video_adaptation_set=Sdk.VideoAdaptationSet(),
+                                                                     manifest_id=manifest.id,
+                                                                     period_id=period.id)
+
+    def create_audio_adaptation_set():
+        return manifest_api.dash.periods.adaptationsets.audio.create(
+            audio_adaptation_set=Sdk.AudioAdaptationSet(lang='eng'),
+            manifest_id=manifest.id,
+            period_id=period.id)
+
+    # Video first, as the adaptation sets were created one after the other before
+    if with_video:
+        video_adaptation_set, audio_adaptation_set = _fan_out(executor, lambda create: create(),
+                                                              [create_video_adaptation_set,
+                                                               create_audio_adaptation_set])
+    else:
+        video_adaptation_set, audio_adaptation_set = None, create_audio_adaptation_set()
     return dict(manifest=manifest,
                 period=period,
                 video_adaptation_set=video_adaptation_set,
                 audio_adaptation_set=audio_adaptation_set)
 
 
-def _add_dash_audio_representations(manifest_info, encoding_id, muxings, output_root):
-    for muxing in muxings:
+def _add_dash_representations(manifest_info, adaptation_set, encoding_id, muxings, output_root, filename,
+                              add_representation, executor):
+    # type: (dict, object, str, list, str, str, callable, ThreadPoolExecutor) -> list
+    """
+    Submits the creation of a representation per muxing to the executor, returns the futures
+    """
+    def add(muxing):
         relative_path = _extract_relative_muxing_path(muxing.outputs[0].output_path, output_root)
 
-        _add_dash_audio_representation(manifest_info=manifest_info,
-                                       encoding_id=encoding_id,
-                                       muxing_id=muxing.id,
-                                       file_path=relative_path + "audio.mp4")
+        return add_representation(manifest_info=manifest_info,
+                                  adaptation_set=adaptation_set,
+                                  encoding_id=encoding_id,
+                                  muxing_id=muxing.id,
+                                  relative_path=relative_path,
+                                  filename=filename)
+
+    return _submit_each(executor, add, muxings)
 
 
-def _add_dash_audio_representation(manifest_info, encoding_id, muxing_id, file_path):
-    representation = DashMp4Representation( encoding_id=encoding_id,
-                                            muxing_id=muxing_id,
-                                            file_path=file_path)
+def _add_dash_mp4_representation(manifest_info, adaptation_set, encoding_id, muxing_id, relative_path, filename):
+    representation = Sdk.DashMp4Representation( encoding_id=encoding_id,
+                                                muxing_id=muxing_id,
+                                                file_path=relative_path + filename)
     return manifest_api.dash.periods.adaptationsets.representations.mp4.create(
         manifest_id=manifest_info['manifest'].id,
         period_id=manifest_info['period'].id,
-        adaptationset_id=manifest_info['audio_adaptation_set'].id,
+        adaptationset_id=adaptation_set.id,
         dash_mp4_representation=representation)
 
 
-def _add_dash_video_representations(manifest_info, encoding_id, muxings, output_root):
-    for muxing in muxings:
-        relative_path = _extract_relative_muxing_path(muxing.outputs[0].output_path, output_root)
-
-        _add_dash_video_representation(manifest_info=manifest_info,
-                                       encoding_id=encoding_id,
-                                       muxing_id=muxing.id,
-                                       file_path=relative_path + "video.mp4")
-
-
-def _add_dash_video_representation(manifest_info, encoding_id, muxing_id, file_path):
-    representation = DashMp4Representation( encoding_id=encoding_id,
-                                            muxing_id=muxing_id,
-                                            file_path=file_path)
-    return manifest_api.dash.periods.adaptationsets.representations.mp4.create(
+def _add_dash_fmp4_representation(manifest_info, adaptation_set, encoding_id, muxing_id, relative_path, filename):
+    # Segmented representations are addressed through a segment template relative to the manifest
+    representation = Sdk.DashFmp4Representation(type_=Sdk.DashRepresentationType.TEMPLATE,
+                                                encoding_id=encoding_id,
+                                                muxing_id=muxing_id,
+                                                segment_path=relative_path)
+    return manifest_api.dash.periods.adaptationsets.representations.fmp4.create(
         manifest_id=manifest_info['manifest'].id,
         period_id=manifest_info['period'].id,
-        adaptationset_id=manifest_info['video_adaptation_set'].id,
-        dash_mp4_representation=representation)
+        adaptationset_id=adaptation_set.id,
+        dash_fmp4_representation=representation)
 
 
 def _wait_for_dash_manifest_to_finish(manifest_id):
-    time.sleep(5)
-    task = manifest_api.dash.status(manifest_id=manifest_id)
-    print("Manifest status is {} (progress: {} %)".format(task.status, task.progress))
-    return task
+    return _wait_for_manifest_to_finish(fetch=lambda: manifest_api.dash.status(manifest_id=manifest_id))
+
+
+def _wait_for_manifest_to_finish(fetch):
+    # type: (callable) -> Task
+    """
+    Polls a manifest status until it is final. Raises Poller.PollTimeout after MANIFEST_POLL_DEADLINE seconds.
+    """
+
+    return Poller.poll(fetch,
+                       initial_interval=Config.MANIFEST_POLL_INITIAL_INTERVAL,
+                       max_interval=Config.MANIFEST_POLL_MAX_INTERVAL,
+                       deadline=Config.MANIFEST_POLL_DEADLINE,
+                       on_progress=Poller.log_progress("Manifest"))
+
+
+# === Local manifests ===
+
+def _write_local_manifests(encoding_id, segmented_index, segmented_type, executor, mp4_index=None, hls_version=3):
+    """
+    Renders the manifests in the function instead of through the manifest API and writes them to the output root
+    (see manifest_writer.py). HLS uses the segmented (TS or fragmented MP4) muxings, one master playlist per device
+    class, DASH the single-file MP4 muxings if there are any and the segmented muxings otherwise.
+    """
+    _, output_root = _output_of(segmented_index)
+    storage = _manifest_storage()
+
+    # All streams of an encoding have the same input
+    duration = bitmovin_api.encoding.encodings.streams.input.get(encoding_id=encoding_id,
+                                                                 stream_id=segmented_index.first().stream_id).duration
+
+    hls_manifests = dict()
+    for device_class, start_bitrate in _hls_start_bitrates():
+        hls_layout = _describe_layout(renditions=segmented_index.hls_video(start_bitrate) + segmented_index.audio,
+                                      muxing_type=segmented_type, duration=duration, output_root=output_root)
+        # The media playlists are the same for all device classes
+        hls_manifests.update(ManifestWriter.render_hls(hls_layout, manifest_name=_hls_manifest_name(device_class),
+                                                       version=hls_version))
+
+    dash_index, dash_type = (mp4_index, "mp4") if mp4_index is not None else (segmented_index, segmented_type)
+    dash_layout = _describe_layout(renditions=dash_index.video + dash_index.audio,
+                                   muxing_type=dash_type, duration=duration, output_root=output_root)
+    if mp4_index is not None:
+        renditions = dash_layout['renditions']
+        ranges = _fan_out(executor, lambda rendition: ManifestWriter.mp4_index_ranges(
+            storage, ManifestWriter.mp4_file_path(output_root, rendition)), renditions)
+        index_ranges = dict((rendition['muxing_id'], r) for rendition, r in zip(renditions, ranges))
+        dash_manifest = ManifestWriter.render_dash(dash_layout, index_ranges=index_ranges)
+    else:
+        dash_manifest = ManifestWriter.render_dash(dash_layout)
+
+    written = ManifestWriter.write(storage, output_root,
+                                   hls_manifests=hls_manifests,
+                                   dash_manifests={'dash-manifest.mpd': dash_manifest})
+    print("Wrote {} manifest files of encoding {} to {}".format(len(written), encoding_id, output_root))
+
+
+def _manifest_storage():
+    if Config.MANIFEST_STORAGE_DIR:
+        return ManifestWriter.LocalStorage(root=Config.MANIFEST_STORAGE_DIR)
+    return Stitcher.GcsStorage(bucket_name=Config.GCS_OUTPUT_BUCKET_NAME)
+
+
+def _describe_layout(renditions, muxing_type, duration, output_root):
+    # type: (list, str, float, str) -> dict
+    """
+    Returns the layout (see manifest_writer.py) of indexed renditions, in their order
+    """
+    return dict(duration=duration,
+                renditions=[_describe_rendition(rendition=rendition, muxing_type=muxing_type, output_root=output_root)
+                            for rendition in renditions])
+
+
+def _describe_rendition(rendition, muxing_type, output_root):
+    muxing = rendition.muxing
+    configuration = rendition.configuration
+    relative_path = _extract_relative_muxing_path(muxing.outputs[0].output_path, output_root)
+    if relative_path and not relative_path.endswith('/'):
+        relative_path += '/'
+
+    if rendition.media_type == RenditionIndex.VIDEO:
+        profile = getattr(configuration.profile, 'value', configuration.profile) or "HIGH"
+        codecs = ManifestWriter.H264_CODECS.get(profile, ManifestWriter.H264_CODECS["HIGH"])
+    else:
+        codecs = ManifestWriter.AAC_CODEC
+
+    filename = None
+    if muxing_type == "mp4":
+        filename = muxing.filename if muxing.filename.endswith(".mp4") else muxing.filename + ".mp4"
+
+    return dict(media_type=rendition.media_type,
+                muxing_id=muxing.id,
+                relative_path=relative_path,
+                bitrate=rendition.bitrate,
+                average_bitrate=muxing.avg_bitrate,
+                codecs=codecs,
+                width=rendition.width,
+                height=rendition.height,
+                language="eng",
+                segment_length=getattr(muxing, 'segment_length', None),
+                segment_count=getattr(muxing, 'segments_muxed', None),
+                segment_naming=getattr(muxing, 'segment_naming', None) or
+                ManifestWriter.DEFAULT_SEGMENT_NAMING.get(muxing_type),
+                init_segment_name=(getattr(muxing, 'init_segment_name', None) or
+                                   ManifestWriter.DEFAULT_INIT_SEGMENT_NAME) if muxing_type == "fmp4" else None,
+                filename=filename)
+
+
+# === Renditions ===
+
+def _index_renditions(encoding_id, muxing_lists, executor):
+    # type: (str, list, ThreadPoolExecutor) -> list
+    """
+    Builds the rendition index (see rendition_index.py) of every list of muxings from the streams of the encoding and
+    their codec configurations. Muxings of the same stream share the lookup of its configuration, all lookups are
+    made side by side, and only configurations this instance has not seen yet are looked up.
+    """
+
+    streams = dict((stream.id, stream) for stream in Pagination.iterate(bitmovin_api.encoding.encodings.streams.list,
+                                                                        Sdk.StreamListQueryParams,
+                                                                        encoding_id=encoding_id))
+    configuration_ids = sorted(set(streams[muxing.streams[0].stream_id].codec_config_id
+                                   for muxings in muxing_lists for muxing in muxings))
+    configurations = _get_configurations(configuration_ids, executor)
+    codec_types = dict((class_name, codec_type)
+                       for codec_type, class_name in Sdk.CodecConfiguration.discriminator_value_class_map.items())
+
+    indexes = []
+    for muxings in muxing_lists:
+        index = RenditionIndex.RenditionIndex([
+            RenditionIndex.describe(muxing=muxing,
+                                    configuration=configurations[streams[muxing.streams[0].stream_id].codec_config_id],
+                                    codec_types=codec_types)
+            for muxing in muxings])
+        if muxings and index.first() is None:
+            raise Exception("Encoding {} has no video or audio muxings".format(encoding_id))
+        indexes.append(index)
+    return indexes
+
+
+def _get_configurations(configuration_ids, executor):
+    # type: (list, ThreadPoolExecutor) -> dict
+    with _configurations_lock:
+        configurations = dict((configuration_id, _configurations[configuration_id])
+                              for configuration_id in configuration_ids if configuration_id in _configurations)
+    missing = [configuration_id for configuration_id in configuration_ids if configuration_id not in configurations]
+
+    # The details of a codec configuration come as the class of its type, e.g. H264VideoConfiguration
+    fetched = dict(zip(missing, _fan_out(
+        executor, lambda configuration_id: bitmovin_api.encoding.configurations.get(configuration_id=configuration_id),
+        missing)))
+
+    configurations.update(fetched)
+    with _configurations_lock:
+        for configuration_id, configuration in configurations.items():
+            _configurations[configuration_id] = configuration
+            _configurations.move_to_end(configuration_id)
+        while len(_configurations) > CONFIGURATION_CACHE_SIZE:
+            _configurations.popitem(last=False)
+    return configurations
 
 
 # === Muxings ===
 
 def _retrieve_ts_muxings(encoding_id):
-    # type: (str) -> dict
+    # type: (str) -> list
     """
     Retrieves the list of TS muxings from an encoding
 
     :param encoding_id: identifier of the encoding
     """
 
-    muxings = bitmovin_api.encoding.encodings.muxings.ts.list(encoding_id=encoding_id).items
-    return _identify_muxings(muxings)
+    return list(Pagination.iterate(bitmovin_api.encoding.encodings.muxings.ts.list, Sdk.TsMuxingListQueryParams,
+                                   encoding_id=encoding_id))
 
 
 def _retrieve_mp4_muxings(encoding_id):
-    # type: (str) -> dict
+    # type: (str) -> list
     """
     Retrieves the list of MP4 muxings from an encoding
 
     :param encoding_id: identifier of the encoding
     """
 
-    muxings = bitmovin_api.encoding.encodings.muxings.mp4.list(encoding_id=encoding_id).items
-    return _identify_muxings(muxings)
+    return list(Pagination.iterate(bitmovin_api.encoding.encodings.muxings.mp4.list, Sdk.Mp4MuxingListQueryParams,
+                                   encoding_id=encoding_id))
 
 
-def _identify_muxings(muxings):
-    audio_muxings = list()
-    video_muxings = list()
+def _retrieve_fmp4_muxings(encoding_id):
+    # type: (str) -> list
+    """
+    Retrieves the list of fragmented MP4 (CMAF) muxings from an encoding
 
-    for muxing in muxings:
-        if "/audio" in muxing.outputs[0].output_path:
-            audio_muxings.append(muxing)
-        if "/video" in muxing.outputs[0].output_path:
-            video_muxings.append(muxing)
+    :param encoding_id: identifier of the encoding
+    """
 
-    return dict(video=video_muxings, audio=audio_muxings)
+    return list(Pagination.iterate(bitmovin_api.encoding.encodings.muxings.fmp4.list, Sdk.Fmp4MuxingListQueryParams,
+                                   encoding_id=encoding_id))
 
 
 def _extract_relative_muxing_path(full_path, output_root):
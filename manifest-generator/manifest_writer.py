@@ -0,0 +1,301 @@
+import math
+import os
+import struct
+
+"""
+Renders the HLS and DASH manifests of an encoding locally instead of through the Bitmovin manifest API.
+
+<p>Through the API a manifest takes a create call for the manifest, its period and adaptation sets and every
+audio media info, stream info and representation, then a start call and status polling until the manifest has been
+written, tens of seconds per encoding. The manifests only depend on metadata main.py already has or reads with a few
+calls (see _index_renditions and _describe_layout there), so they are rendered here and written straight to the
+output bucket:
+  <ul>
+   <li>HLS: a master playlist with one EXT-X-MEDIA per audio and one EXT-X-STREAM-INF per video rendition (per audio
+       rendition for audio-only encodings), and a media playlist per rendition listing its TS or fragmented MP4
+       segments,
+   <li>DASH: one period with a video (unless audio-only) and an audio adaptation set. Single-file MP4 representations use the on-demand
+       profile with the byte ranges of their init and index (sidx) boxes, which are read from the head of the MP4
+       files; fragmented MP4 representations use the live profile with a segment template.
+ </ul>
+The layout follows what the manifest API writes for the same resources: the media playlists are written next to the
+segments of their rendition, the master playlist and the MPD to the output root. Renditions are listed in the order
+of the layout.
+
+<p>A layout describes an encoding:
+    dict(duration=<seconds>,
+         renditions=[dict(media_type="video" or "audio", muxing_id, relative_path (to the output root, ending in
+                          "/"), bitrate, average_bitrate, codecs, width, height, language, segment_length,
+                          segment_count, segment_naming, init_segment_name, filename), ...])
+"""
+
+# RFC 6381 codec strings of the H.264 profiles, as in vod-basic-encoder
+H264_CODECS = dict(HIGH="avc1.640028", MAIN="avc1.4d401f", BASELINE="avc1.42c01e")
+AAC_CODEC = "mp4a.40.2"
+
+# Segment names the API uses when a muxing does not set its own
+DEFAULT_SEGMENT_NAMING = dict(ts="segment_%number%.ts", fmp4="segment_%number%.m4s")
+DEFAULT_INIT_SEGMENT_NAME = "init.mp4"
+
+HLS_CONTENT_TYPE = "application/vnd.apple.mpegurl"
+DASH_CONTENT_TYPE = "application/dash+xml"
+
+ON_DEMAND_PROFILE = "urn:mpeg:dash:profile:isoff-on-demand:2011"
+LIVE_PROFILE = "urn:mpeg:dash:profile:isoff-live:2011"
+
+# Bytes read from the head of an MP4 file, usually enough for its ftyp, moov and sidx boxes
+MP4_HEAD_BYTES = 64 * 1024
+
+
+def segment_durations(layout, rendition):
+    # type: (dict, dict) -> list
+    """
+    Returns the durations of the segments of a rendition. Only the last segment can be shorter.
+    """
+
+    segment_length = rendition['segment_length']
+    count = rendition.get('segment_count') or max(1, int(math.ceil(layout['duration'] / segment_length - 1e-9)))
+    full = count - 1
+    return [segment_length] * full + [max(0.0, layout['duration'] - full * segment_length)]
+
+
+def render_hls(layout, manifest_name, version=3):
+    # type: (dict, str, int) -> dict
+    """
+    Renders the master and media playlists of a segmented (TS or fragmented MP4) layout, returns their contents by
+    path relative to the output root
+
+    :param manifest_name: Name of the master playlist without extension
+    :param version: EXT-X-VERSION, fragmented MP4 segments require at least 7
+    """
+
+    video = [r for r in layout['renditions'] if r['media_type'] == "video"]
+    audio = [r for r in layout['renditions'] if r['media_type'] == "audio"]
+    playlists = dict()
+
+    for rendition in layout['renditions']:
+        playlists[_media_playlist_path(rendition)] = _render_media_playlist(layout, rendition, version)
+
+    lines = ["#EXTM3U", "#EXT-X-VERSION:{}".format(version), "#EXT-X-INDEPENDENT-SEGMENTS"]
+    if not video:
+        # Audio-only: the audio renditions are the variants
+        for rendition in audio:
+            attributes = ["BANDWIDTH={}".format(rendition['bitrate'])]
+            if rendition['average_bitrate']:
+                attributes.append("AVERAGE-BANDWIDTH={}".format(rendition['average_bitrate']))
+            attributes.append('CODECS="{}"'.format(rendition['codecs']))
+            lines.append("#EXT-X-STREAM-INF:" + ",".join(attributes))
+            lines.append(_media_playlist_path(rendition))
+        playlists[manifest_name + ".m3u8"] = "\n".join(lines) + "\n"
+        return playlists
+
+    for index, rendition in enumerate(audio):
+        lines.append('#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="Audio Media Info for muxing {}",LANGUAGE="{}",'
+                     'DEFAULT={},AUTOSELECT=YES,URI="{}"'.format(rendition['muxing_id'], rendition['language'],
+                                                                 "YES" if index == 0 else "NO",
+                                                                 _media_playlist_path(rendition)))
+
+    audio_bitrate = max([r['bitrate'] for r in audio] or [0])
+    audio_average_bitrate = max([r['average_bitrate'] or r['bitrate'] for r in audio] or [0])
+    audio_codecs = audio[0]['codecs'] if audio else None
+    for rendition in video:
+        attributes = ["BANDWIDTH={}".format(rendition['bitrate'] + audio_bitrate)]
+        if rendition['average_bitrate']:
+            attributes.append("AVERAGE-BANDWIDTH={}".format(rendition['average_bitrate'] + audio_average_bitrate))
+        attributes.append('CODECS="{}"'.format(",".join(c for c in (rendition['codecs'], audio_codecs) if c)))
+        if rendition['width'] and rendition['height']:
+            attributes.append("RESOLUTION={}x{}".format(rendition['width'], rendition['height']))
+        if audio:
+            attributes.append('AUDIO="audio"')
+        attributes.append("CLOSED-CAPTIONS=NONE")
+        lines.append("#EXT-X-STREAM-INF:" + ",".join(attributes))
+        lines.append(_media_playlist_path(rendition))
+
+    playlists[manifest_name + ".m3u8"] = "\n".join(lines) + "\n"
+    return playlists
+
+
+def render_dash(layout, index_ranges=None):
+    # type: (dict, dict) -> str
+    """
+    Renders a single-period DASH manifest. With index_ranges (the result of mp4_index_ranges() by muxing ID) the
+    representations are single MP4 files (on-demand profile), otherwise segmented fragmented MP4 (live profile).
+    """
+
+    on_demand = index_ranges is not None
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" profiles="{}" type="static" '
+             'mediaPresentationDuration="{}" minBufferTime="PT1.500S">'.format(
+                 ON_DEMAND_PROFILE if on_demand else LIVE_PROFILE, _duration(layout['duration'])),
+             '  <Period id="0" start="PT0.000S">']
+
+    for adaptation_set_id, (media_type, mime_type) in enumerate((("video", "video/mp4"), ("audio", "audio/mp4"))):
+        renditions = [r for r in layout['renditions'] if r['media_type'] == media_type]
+        if not renditions:
+            continue
+
+        lang = ' lang="{}"'.format(renditions[0]['language']) if media_type == "audio" else ""
+        lines.append('    <AdaptationSet id="{}" mimeType="{}"{} segmentAlignment="true" startWithSAP="1">'.format(
+            adaptation_set_id, mime_type, lang))
+
+        for rendition in renditions:
+            attributes = 'id="{}" bandwidth="{}" codecs="{}"'.format(rendition['muxing_id'],
+                                                                   rendition['bitrate'], rendition['codecs'])
+            if media_type == "video" and rendition['width'] and rendition['height']:
+                attributes += ' width="{}" height="{}"'.format(rendition['width'], rendition['height'])
+            lines.append('      <Representation {}>'.format(attributes))
+
+            if on_demand:
+                initialization, index = index_ranges[rendition['muxing_id']]
+                lines.append('        <BaseURL>{}</BaseURL>'.format(_mp4_file_path(rendition)))
+                lines.append('        <SegmentBase indexRange="{}">'.format(index))
+                lines.append('          <Initialization range="{}"/>'.format(initialization))
+                lines.append('        </SegmentBase>')
+            else:
+                lines.append('        <SegmentTemplate timescale="1000" duration="{}" startNumber="0" '
+                             'initialization="{}" media="{}"/>'.format(
+                                 int(round(rendition['segment_length'] * 1000)),
+                                 rendition['relative_path'] + _init_segment_name(rendition),
+                                 rendition['relative_path'] + _segment_name(rendition, "$Number$")))
+            lines.append('      </Representation>')
+
+        lines.append('    </AdaptationSet>')
+
+    lines.append('  </Period>')
+    lines.append('</MPD>')
+    return "\n".join(lines) + "\n"
+
+
+def mp4_index_ranges(storage, object_path):
+    # type: (object, str) -> tuple
+    """
+    Returns the byte ranges ("first-last") of the init segment (up to the end of the moov box) and of the sidx box
+    of a single-file MP4, as the on-demand profile references them
+
+    :param storage: Has a read_bytes(object_path, start, length) method
+    """
+
+    head = storage.read_bytes(object_path, 0, MP4_HEAD_BYTES)
+    offset = 0
+    init_end = None
+
+    while True:
+        if offset + 16 <= len(head):
+            header = head[offset:offset + 16]
+        else:
+            # Box header beyond the head that was read
+            header = storage.read_bytes(object_path, offset, 16)
+        if len(header) < 8:
+            break
+
+        size, box_type = struct.unpack('>I4s', header[:8])
+        if size == 1:
+            size = struct.unpack('>Q', header[8:16])[0]
+        if size < 8:
+            break
+
+        if box_type == b'moov':
+            init_end = offset + size - 1
+        elif box_type == b'sidx':
+            if init_end is None:
+                break
+            return "0-{}".format(init_end), "{}-{}".format(offset, offset + size - 1)
+        elif box_type in (b'moof', b'mdat'):
+            break
+        offset += size
+
+    raise Exception("{} has no moov and sidx box ahead of its media, it is not a DASH on-demand MP4".format(
+        object_path))
+
+
+def write(storage, output_root, hls_manifests=None, dash_manifests=None):
+    # type: (object, str, dict, dict) -> list
+    """
+    Writes rendered manifests (contents by path relative to output_root) and returns the paths written. Writing is
+    idempotent, so a redelivered webhook does no harm.
+
+    :param storage: Has a write_text(object_path, text, content_type) method
+    """
+
+    written = []
+    for manifests, content_type in ((hls_manifests, HLS_CONTENT_TYPE), (dash_manifests, DASH_CONTENT_TYPE)):
+        for name, text in sorted((manifests or dict()).items()):
+            object_path = os.path.join(output_root, name)
+            storage.write_text(object_path, text, content_type=content_type)
+            written.append(object_path)
+    return written
+
+
+def mp4_file_path(output_root, rendition):
+    # type: (str, dict) -> str
+    return os.path.join(output_root, _mp4_file_path(rendition))
+
+
+def _media_playlist_path(rendition):
+    return "{}{}.m3u8".format(rendition['relative_path'], rendition['media_type'])
+
+
+def _mp4_file_path(rendition):
+    return rendition['relative_path'] + rendition['filename']
+
+
+def _segment_name(rendition, number):
+    return rendition['segment_naming'].replace("%number%", str(number))
+
+
+def _init_segment_name(rendition):
+    return rendition.get('init_segment_name') or DEFAULT_INIT_SEGMENT_NAME
+
+
+def _render_media_playlist(layout, rendition, version):
+    durations = segment_durations(layout, rendition)
+    lines = ["#EXTM3U",
+             "#EXT-X-VERSION:{}".format(version),
+             "#EXT-X-TARGETDURATION:{}".format(int(math.ceil(max(durations) - 1e-9))),
+             "#EXT-X-MEDIA-SEQUENCE:0",
+             "#EXT-X-PLAYLIST-TYPE:VOD",
+             "#EXT-X-INDEPENDENT-SEGMENTS"]
+
+    if rendition.get('init_segment_name'):
+        lines.append('#EXT-X-MAP:URI="{}"'.format(rendition['init_segment_name']))
+    for number, duration in enumerate(durations):
+        lines.append("#EXTINF:{:.6f},".format(duration))
+        lines.append(_segment_name(rendition, number))
+
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+def _duration(seconds):
+    return "PT{:.3f}S".format(seconds)
+
+
+class LocalStorage(object):
+    """
+    Stands in for the output bucket with a local folder (MANIFEST_STORAGE_DIR), e.g. for tests and local runs
+    """
+
+    def __init__(self, root):
+        # type: (str) -> None
+        self.root = root
+
+    def read_text(self, object_path):
+        # type: (str) -> str
+        with open(self._file_path(object_path), 'r') as fp:
+            return fp.read()
+
+    def read_bytes(self, object_path, start, length):
+        # type: (str, int, int) -> bytes
+        with open(self._file_path(object_path), 'rb') as fp:
+            fp.seek(start)
+            return fp.read(length)
+
+    def write_text(self, object_path, text, content_type):
+        # type: (str, str, str) -> None
+        file_path = self._file_path(object_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w') as fp:
+            fp.write(text)
+
+    def _file_path(self, object_path):
+        return os.path.join(self.root, object_path.lstrip("/"))
@@ -0,0 +1,96 @@
+import random
+import time
+
+"""
+Adaptive status poller for Bitmovin tasks (encodings, manifests, ...).
+
+<p>The interval starts short, because many tasks (manifests in particular) finish in well under a second, and grows
+exponentially with random jitter up to a maximum, so long tasks are not polled needlessly often. A hard deadline
+bounds how many billed function seconds a stuck task can burn, a threading.Event allows cancelling the wait from
+another thread and an optional callback is informed about every status received.
+"""
+
+FINAL_STATES = ("FINISHED", "ERROR", "CANCELED")
+
+
+class PollTimeout(Exception):
+
+    def __init__(self, message, last):
+        super(PollTimeout, self).__init__(message)
+        self.last = last
+
+
+class PollCancelled(Exception):
+
+    def __init__(self, message, last):
+        super(PollCancelled, self).__init__(message)
+        self.last = last
+
+
+def status_of(task):
+    # type: (Task) -> str
+    """
+    Returns the status of a task as plain string, independent of the SDK enum
+    """
+
+    return getattr(task.status, 'value', task.status)
+
+
+def is_final(task):
+    # type: (Task) -> bool
+    return status_of(task) in FINAL_STATES
+
+
+def poll(fetch, is_done=is_final, initial_interval=0.25, max_interval=10.0, backoff=2.0, jitter=0.2,
+         deadline=None, cancel=None, on_progress=None):
+    # type: (callable, callable, float, float, float, float, float, threading.Event, callable) -> object
+    """
+    Calls fetch until is_done returns True for its result and returns that result.
+
+    :param fetch: Called without arguments, returns the current task
+    :param is_done: Called with the task, returns True once polling can stop. Defaults to a final task status.
+    :param initial_interval: Seconds to wait before the second fetch
+    :param max_interval: Upper bound of the interval
+    :param backoff: Factor the interval grows by after every fetch
+    :param jitter: Relative random deviation applied to every interval, spreads out concurrent pollers
+    :param deadline: Seconds after which PollTimeout is raised (None waits forever)
+    :param cancel: threading.Event, raises PollCancelled once set
+    :param on_progress: Called with every task fetched
+    """
+
+    started = time.monotonic()
+    interval = initial_interval
+
+    while True:
+        task = fetch()
+        if on_progress is not None:
+            on_progress(task)
+        if is_done(task):
+            return task
+
+        wait = min(interval, max_interval) * random.uniform(1 - jitter, 1 + jitter)
+        if deadline is not None:
+            remaining = deadline - (time.monotonic() - started)
+            if remaining <= 0:
+                raise PollTimeout("Task not done after {:.1f} s".format(deadline), last=task)
+            wait = min(wait, remaining)
+
+        if cancel is not None:
+            if cancel.wait(wait):
+                raise PollCancelled("Polling cancelled", last=task)
+        else:
+            time.sleep(wait)
+
+        interval *= backoff
+
+
+def log_progress(label):
+    # type: (str) -> callable
+    """
+    Returns an on_progress callback printing the status and progress of a task
+    """
+
+    def callback(task):
+        print("{} status is {} (progress: {} %)".format(label, status_of(task), task.progress))
+
+    return callback
@@ -0,0 +1,105 @@
+from collections import namedtuple
+
+"""
+Orders the renditions of an encoding for its manifests, from the metadata of their streams and codec configurations.
+
+<p>Muxings are classified by the codec configuration of their stream (video or audio, codec, bitrate, resolution)
+rather than by their output path, and ordered independently of the order the API lists them in:
+  <ul>
+   <li>video by ascending bitrate, then resolution, so the HLS master playlist and the DASH video adaptation set list
+       the ladder from the lowest to the highest rendition,
+   <li>audio by descending bitrate: the first audio rendition is the HLS default, which players keep for the whole
+       playback,
+   <li>ties are ordered by muxing ID, so the same encoding always gives the same manifests.
+ </ul>
+Most HLS players start playback on the first variant of the master playlist. hls_video() moves the start variant of a
+device class, the highest video rendition at or below its start bitrate, to the front; the remaining variants keep
+their order.
+
+<p>The manifest API lists resources in the order they were created. To keep the creates side by side, main.py only
+creates the first video and audio rendition before the others, so manifests written through the API keep the start
+variant and the default audio rendition in front and the rest in any order. MANIFEST_WRITER "LOCAL" writes the
+complete order.
+"""
+
+VIDEO = "video"
+AUDIO = "audio"
+
+# A rendition of an encoding: the muxing, its stream and codec configuration and what is known about them
+Rendition = namedtuple('Rendition', ['muxing', 'stream_id', 'configuration', 'media_type', 'codec', 'bitrate',
+                                     'width', 'height'])
+
+
+def describe(muxing, configuration, codec_types):
+    # type: (object, object, dict) -> Rendition
+    """
+    Returns the rendition of a muxing with its codec configuration
+
+    :param codec_types: Codec type (e.g. "H264") by configuration class name, see CodecConfiguration in the SDK
+    """
+
+    class_name = type(configuration).__name__
+    if class_name.endswith("VideoConfiguration"):
+        media_type = VIDEO
+    elif class_name.endswith("AudioConfiguration"):
+        media_type = AUDIO
+    else:
+        media_type = None
+
+    return Rendition(muxing=muxing,
+                     stream_id=muxing.streams[0].stream_id,
+                     configuration=configuration,
+                     media_type=media_type,
+                     codec=codec_types.get(class_name),
+                     # The bitrates the muxing reached, once encoded, before the target of the configuration
+                     bitrate=muxing.max_bitrate or muxing.avg_bitrate or configuration.bitrate or 0,
+                     width=getattr(configuration, 'width', None),
+                     height=getattr(configuration, 'height', None))
+
+
+class RenditionIndex(object):
+    """
+    The video and audio renditions of one type of muxings of an encoding, in manifest order
+    """
+
+    def __init__(self, renditions):
+        # type: (list) -> None
+        self.video = sorted((r for r in renditions if r.media_type == VIDEO),
+                            key=lambda r: (r.bitrate, r.height or 0, r.width or 0, r.muxing.id))
+        self.audio = sorted((r for r in renditions if r.media_type == AUDIO),
+                            key=lambda r: (-r.bitrate, r.muxing.id))
+        # Other streams, e.g. subtitles, are not part of the manifests
+        self.skipped = [r for r in renditions if r.media_type not in (VIDEO, AUDIO)]
+
+    def first(self):
+        # type: () -> Rendition
+        """
+        Returns the first video rendition, or the first audio rendition of an audio-only encoding
+        """
+        return (self.video or self.audio or [None])[0]
+
+    def muxings(self, media_type):
+        # type: (str) -> list
+        return [r.muxing for r in (self.video if media_type == VIDEO else self.audio)]
+
+    def start_variant(self, start_bitrate):
+        # type: (int) -> Rendition
+        """
+        Returns the highest video rendition at or below start_bitrate, or the lowest one if none is
+        """
+
+        if not self.video:
+            return None
+        below = [r for r in self.video if r.bitrate <= start_bitrate]
+        return below[-1] if below else self.video[0]
+
+    def hls_video(self, start_bitrate=None):
+        # type: (int) -> list
+        """
+        Returns the video renditions in HLS master playlist order: the start variant, then all others by bitrate
+        """
+
+        if start_bitrate is None or not self.video:
+            return list(self.video)
+        start = self.start_variant(start_bitrate)
+        return [start] + [r for r in self.video if r is not start]
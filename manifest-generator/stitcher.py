@@ -0,0 +1,224 @@
+import json
+import math
+
+from os import path
+
+"""
+Stitches the chunks of a split encoding (see vod-basic-encoder/split_encode.py) into single HLS and DASH manifests.
+
+<p>Every chunk was encoded by its own encoding into its own folder, with segments numbered from 0. Because all chunk
+boundaries lie on the segment grid, the stitched rendition is simply the segments of all chunks in order:
+  <ul>
+   <li>HLS: one media playlist per rendition listing the segments of all chunks, with a discontinuity and the init
+       segment of the chunk at every chunk boundary, and one master playlist per device class referencing them,
+       starting on the start variant of the device class like the manifests of unsplit encodings.
+   <li>DASH: one period per chunk, starting at the chunk offset, with period continuity signalled between the
+       periods, so players present them as one timeline.
+ </ul>
+The manifests are rendered from the split plan alone, no muxing has to be looked up.
+"""
+
+HLS_MASTER_NAME = "hls-manifest"
+DASH_MANIFEST_NAME = "dash-manifest.mpd"
+
+_PERIOD_CONTINUITY = "urn:mpeg:dash:period-continuity:2015"
+
+
+def load_plan(storage, plan_path):
+    # type: (object, str) -> dict
+    return json.loads(storage.read_text(plan_path))
+
+
+def segment_durations(plan, chunk):
+    # type: (dict, dict) -> list
+    """
+    Returns the durations of the segments of a chunk. Only the last segment of a chunk can be shorter.
+    """
+
+    segment_length = plan['segment_length']
+    full = chunk['segment_count'] - 1
+    return [segment_length] * full + [chunk['duration'] - full * segment_length]
+
+
+def render_hls(plan, start_bitrates=None):
+    # type: (dict, dict) -> dict
+    """
+    Renders the master and media playlists, returns their contents by path relative to the output root
+
+    :param start_bitrates: Start bitrate by master playlist name without extension, see start_variant. Defaults to
+                           a single master playlist HLS_MASTER_NAME listing the variants by bitrate.
+    """
+
+    video = sorted((r for r in plan['renditions'] if r['media_type'] == "video"),
+                   key=lambda r: (r['bitrate'], r.get('height') or 0, r.get('width') or 0))
+    audio = [r for r in plan['renditions'] if r['media_type'] == "audio"]
+    playlists = dict()
+
+    for rendition in plan['renditions']:
+        playlists[_media_playlist_name(rendition)] = _render_media_playlist(plan, rendition)
+
+    for master_name, start_bitrate in (start_bitrates or {HLS_MASTER_NAME: None}).items():
+        start = start_variant(video, start_bitrate)
+        playlists[master_name + ".m3u8"] = _render_master_playlist(
+            [start] + [r for r in video if r is not start] if start is not None else video, audio)
+    return playlists
+
+
+def start_variant(video, start_bitrate):
+    # type: (list, int) -> dict
+    """
+    Returns the highest of the video renditions (by ascending bitrate) at or below start_bitrate, or the lowest one if
+    none is; None without a start bitrate
+    """
+
+    if start_bitrate is None or not video:
+        return None
+    below = [r for r in video if r['bitrate'] <= start_bitrate]
+    return below[-1] if below else video[0]
+
+
+def render_dash(plan):
+    # type: (dict) -> str
+    """
+    Renders the multi-period DASH manifest
+    """
+
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" profiles="urn:mpeg:dash:profile:isoff-live:2011" '
+             'type="static" mediaPresentationDuration="{}" minBufferTime="PT2S">'.format(_duration(plan['duration']))]
+
+    segment_length_ms = int(round(plan['segment_length'] * 1000))
+    for chunk in plan['chunks']:
+        lines.append('  <Period id="{}" start="{}" duration="{}">'.format(
+            chunk['index'], _duration(chunk['offset']), _duration(chunk['duration'])))
+
+        for media_type, mime_type in (("video", "video/mp4"), ("audio", "audio/mp4")):
+            renditions = [r for r in plan['renditions'] if r['media_type'] == media_type]
+            if not renditions:
+                continue
+
+            lines.append('    <AdaptationSet id="{}" mimeType="{}" segmentAlignment="true" startWithSAP="1"{}>'.format(
+                0 if media_type == "video" else 1, mime_type, ' lang="eng"' if media_type == "audio" else ""))
+            if chunk['index'] > 0:
+                lines.append('      <SupplementalProperty schemeIdUri="{}" value="{}"/>'.format(
+                    _PERIOD_CONTINUITY, chunk['index'] - 1))
+
+            for rendition in renditions:
+                attributes = 'id="{}" bandwidth="{}" codecs="{}"'.format(
+                    media_type + "-" + rendition['rendition_path'], rendition['bitrate'], rendition['codecs'])
+                if media_type == "video":
+                    attributes += ' width="{}" height="{}"'.format(rendition['width'], rendition['height'])
+                rendition_root = path.join(chunk['path'], rendition['output_path'])
+                lines.append('      <Representation {}>'.format(attributes))
+                lines.append('        <SegmentTemplate timescale="1000" duration="{}" startNumber="0" '
+                             'initialization="{}" media="{}"/>'.format(
+                                 segment_length_ms,
+                                 path.join(rendition_root, "init.mp4"),
+                                 path.join(rendition_root, "segment_$Number$.m4s")))
+                lines.append('      </Representation>')
+
+            lines.append('    </AdaptationSet>')
+        lines.append('  </Period>')
+
+    lines.append('</MPD>')
+    return "\n".join(lines) + "\n"
+
+
+def stitch(plan, storage, output_base_path="", start_bitrates=None):
+    # type: (dict, object, str, dict) -> list
+    """
+    Renders the HLS and DASH manifests of a split encoding and writes them to the output root of the asset.
+    Returns the paths written. Writing is idempotent, so two chunks finishing at the same time do no harm.
+
+    :param plan: The split plan
+    :param storage: Has a write_text(object_path, text, content_type) method
+    :param output_base_path: OUTPUT_BASE_PATH the output root of the plan is relative to
+    :param start_bitrates: Start bitrate by master playlist name, see render_hls
+    """
+
+    output_root = path.join(output_base_path, plan['output_root'])
+    written = []
+
+    for name, text in sorted(render_hls(plan, start_bitrates=start_bitrates).items()):
+        storage.write_text(path.join(output_root, name), text, content_type="application/vnd.apple.mpegurl")
+        written.append(path.join(output_root, name))
+
+    storage.write_text(path.join(output_root, DASH_MANIFEST_NAME), render_dash(plan),
+                       content_type="application/dash+xml")
+    written.append(path.join(output_root, DASH_MANIFEST_NAME))
+    return written
+
+
+def _render_master_playlist(video, audio):
+    lines = ["#EXTM3U", "#EXT-X-VERSION:7", "#EXT-X-INDEPENDENT-SEGMENTS"]
+    for index, rendition in enumerate(audio):
+        lines.append('#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="{}",LANGUAGE="eng",DEFAULT={},AUTOSELECT=YES,'
+                     'URI="{}"'.format(rendition['rendition_path'], "YES" if index == 0 else "NO",
+                                       _media_playlist_name(rendition)))
+
+    audio_bitrate = max([r['bitrate'] for r in audio] or [0])
+    audio_codecs = audio[0]['codecs'] if audio else None
+    for rendition in video:
+        attributes = ["BANDWIDTH={}".format(rendition['bitrate'] + audio_bitrate),
+                      "RESOLUTION={}x{}".format(rendition['width'], rendition['height']),
+                      'CODECS="{}"'.format(",".join(c for c in (rendition['codecs'], audio_codecs) if c))]
+        if audio:
+            attributes.append('AUDIO="audio"')
+        lines.append("#EXT-X-STREAM-INF:" + ",".join(attributes))
+        lines.append(_media_playlist_name(rendition))
+
+    return "\n".join(lines) + "\n"
+
+
+def _media_playlist_name(rendition):
+    return "{}-{}.m3u8".format(rendition['media_type'], rendition['rendition_path'])
+
+
+def _render_media_playlist(plan, rendition):
+    lines = ["#EXTM3U",
+             "#EXT-X-VERSION:7",
+             "#EXT-X-TARGETDURATION:{}".format(int(math.ceil(plan['segment_length']))),
+             "#EXT-X-MEDIA-SEQUENCE:0",
+             "#EXT-X-PLAYLIST-TYPE:VOD",
+             "#EXT-X-INDEPENDENT-SEGMENTS"]
+
+    for chunk in plan['chunks']:
+        rendition_root = path.join(chunk['path'], rendition['output_path'])
+        if chunk['index'] > 0:
+            # Every chunk starts its own timeline and has its own init segment
+            lines.append("#EXT-X-DISCONTINUITY")
+        lines.append('#EXT-X-MAP:URI="{}"'.format(path.join(rendition_root, "init.mp4")))
+        for number, duration in enumerate(segment_durations(plan, chunk)):
+            lines.append("#EXTINF:{:.6f},".format(duration))
+            lines.append(path.join(rendition_root, "segment_{}.m4s".format(number)))
+
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+def _duration(seconds):
+    return "PT{:.3f}S".format(seconds)
+
+
+class GcsStorage(object):
+    """
+    Reads and writes small text objects in a GCS bucket. google-cloud-storage is only imported when it is created.
+    """
+
+    def __init__(self, bucket_name):
+        # type: (str) -> None
+        from google.cloud import storage
+
+        self.bucket = storage.Client().bucket(bucket_name)
+
+    def read_text(self, object_path):
+        # type: (str) -> str
+        return self.bucket.blob(object_path.lstrip("/")).download_as_bytes().decode('utf-8')
+
+    def read_bytes(self, object_path, start, length):
+        # type: (str, int, int) -> bytes
+        return self.bucket.blob(object_path.lstrip("/")).download_as_bytes(start=start, end=start + length - 1)
+
+    def write_text(self, object_path, text, content_type):
+        # type: (str, str, str) -> None
+        self.bucket.blob(object_path.lstrip("/")).upload_from_string(text, content_type=content_type)
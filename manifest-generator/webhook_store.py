@@ -0,0 +1,352 @@
+import fcntl
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from collections import namedtuple
+
+import config as Config
+import firestore_client as Firestore
+
+"""
+Idempotent handling of the finished webhooks of encodings.
+
+<p>Bitmovin delivers a webhook again when it is not answered in time, and generating the manifests through the API
+takes longer than that. Every delivery therefore claims its encoding ID first:
+  <ul>
+   <li>the first delivery creates the claim IN_PROGRESS and generates the manifests, which ends the claim DONE or
+       FAILED,
+   <li>a delivery for an encoding that is DONE returns OK at once,
+   <li>a delivery for an encoding that is IN_PROGRESS and updated within WEBHOOK_CLAIM_TTL seconds (another
+       invocation is working on it) is answered with a 503 and a Retry-After of the rest of the TTL. Any 2xx would
+       end the redeliveries of Bitmovin, and with them the chance to resume if that invocation dies,
+   <li>a delivery for an encoding that FAILED, or whose IN_PROGRESS claim is older (the invocation was interrupted),
+       takes the claim over and resumes the work of the previous attempts.
+ </ul>
+Claims carry the progress of their manifests (manifest ID and phase per manifest name, see main.py), which is saved
+as the work goes on: a resumed delivery awaits manifests that were already started instead of creating new ones and
+skips finished ones.
+
+<p>The store is pluggable (WEBHOOK_STORE): FirestoreWebhookStore keeps the claims in a Firestore collection shared by
+all instances, so a redelivery that lands on another instance than the first delivery still finds its claim.
+SqliteWebhookStore (one SQLite table) and FileWebhookStore (one JSON file per encoding, locked with flock) only see
+the deliveries of their own instance and are meant for local runs. All of them take and update claims atomically, so
+of two concurrent deliveries exactly one wins.
+"""
+
+IN_PROGRESS = "IN_PROGRESS"
+DONE = "DONE"
+FAILED = "FAILED"
+
+# Phases of a manifest in the progress of a claim
+STARTED = "STARTED"
+FINISHED = "FINISHED"
+
+# The claim of an encoding: attempts counts the deliveries that took it, progress holds the manifests by name
+Delivery = namedtuple('Delivery', ['encoding_id', 'state', 'attempts', 'progress', 'error', 'claimed_at',
+                                   'updated_at'])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS deliveries (
+    encoding_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    progress TEXT NOT NULL,
+    error TEXT,
+    claimed_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+_COLUMNS = "encoding_id, state, attempts, progress, error, claimed_at, updated_at"
+
+store = None
+_store_lock = threading.Lock()
+
+
+def init_webhook_store():
+    # type: () -> object
+    """
+    Returns the store of WEBHOOK_STORE, None if it is turned off
+    """
+    global store
+    with _store_lock:
+        if store is None:
+            if Config.WEBHOOK_STORE == "FIRESTORE":
+                store = FirestoreWebhookStore(collection_name="webhook-deliveries")
+            elif Config.WEBHOOK_STORE == "SQLITE":
+                store = SqliteWebhookStore(db_path=Config.WEBHOOK_STORE_DB_FILE)
+            elif Config.WEBHOOK_STORE == "FILE":
+                store = FileWebhookStore(directory=Config.WEBHOOK_STORE_DIR)
+            elif Config.WEBHOOK_STORE:
+                raise Exception("Unknown WEBHOOK_STORE {}".format(Config.WEBHOOK_STORE))
+
+    return store
+
+
+def take(delivery, encoding_id, now, ttl):
+    # type: (Delivery, str, float, float) -> Delivery
+    """
+    Returns the claim a delivery takes given the stored one (None if there is none), or None if the delivery has to
+    leave the encoding alone. Shared by the stores, which call it while holding their lock.
+    """
+
+    if delivery is None:
+        return Delivery(encoding_id=encoding_id, state=IN_PROGRESS, attempts=1, progress=dict(), error=None,
+                        claimed_at=now, updated_at=now)
+    if delivery.state == DONE or (delivery.state == IN_PROGRESS and delivery.updated_at >= now - ttl):
+        return None
+    return delivery._replace(state=IN_PROGRESS, attempts=delivery.attempts + 1, claimed_at=now, updated_at=now)
+
+
+def retry_after(delivery, ttl, now=None):
+    # type: (Delivery, float, float) -> int
+    """
+    Returns the whole seconds until an IN_PROGRESS claim goes stale and can be taken over, at least 1
+    """
+
+    now = time.time() if now is None else now
+    return max(1, int(math.ceil(delivery.updated_at + ttl - now)))
+
+
+class FirestoreWebhookStore(object):
+    """
+    Keeps the claim of every encoding in a document of <FIRESTORE_COLLECTION_PREFIX><collection_name> named by its
+    encoding ID, taken and updated in transactions.
+    """
+
+    def __init__(self, collection_name):
+        # type: (str) -> None
+        self.collection_name = collection_name
+
+    def claim(self, encoding_id):
+        # type: (str) -> tuple
+        """
+        Claims an encoding for a delivery, see SqliteWebhookStore.claim
+        """
+
+        reference = self._reference(encoding_id)
+
+        def claim_in(transaction):
+            stored = self._from_snapshot(reference.get(transaction=transaction))
+            delivery = take(stored, encoding_id, time.time(), Config.WEBHOOK_CLAIM_TTL)
+            if delivery is not None:
+                transaction.set(reference, self._to_document(delivery))
+            return stored, delivery
+
+        stored, delivery = Firestore.run_transaction(claim_in)
+        return (True, delivery) if delivery is not None else (False, stored)
+
+    def save_progress(self, encoding_id, name, value):
+        # type: (str, str, dict) -> None
+        reference = self._reference(encoding_id)
+
+        def save_in(transaction):
+            delivery = self._from_snapshot(reference.get(transaction=transaction))
+            if delivery is not None:
+                progress = dict(delivery.progress)
+                progress[name] = value
+                transaction.set(reference, self._to_document(delivery._replace(progress=progress,
+                                                                                updated_at=time.time())))
+
+        Firestore.run_transaction(save_in)
+
+    def finish(self, encoding_id, state, error=None):
+        # type: (str, str, str) -> None
+        reference = self._reference(encoding_id)
+
+        def finish_in(transaction):
+            delivery = self._from_snapshot(reference.get(transaction=transaction))
+            if delivery is not None:
+                transaction.set(reference, self._to_document(delivery._replace(state=state, error=error,
+                                                                                updated_at=time.time())))
+
+        Firestore.run_transaction(finish_in)
+
+    def get(self, encoding_id):
+        # type: (str) -> Delivery
+        return self._from_snapshot(self._reference(encoding_id).get())
+
+    def _reference(self, encoding_id):
+        return Firestore.collection(self.collection_name).document(encoding_id)
+
+    @staticmethod
+    def _from_snapshot(snapshot):
+        if not snapshot.exists:
+            return None
+        delivery = Delivery(**snapshot.to_dict())
+        return delivery._replace(progress=json.loads(delivery.progress))
+
+    @staticmethod
+    def _to_document(delivery):
+        # Manifest names are not valid Firestore field paths, the progress is kept as JSON like in SQLite
+        return delivery._replace(progress=json.dumps(delivery.progress, sort_keys=True))._asdict()
+
+
+class SqliteWebhookStore(object):
+
+    def __init__(self, db_path):
+        # type: (str) -> None
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def claim(self, encoding_id):
+        # type: (str) -> tuple
+        """
+        Claims an encoding for a delivery. Returns (True, claim) if the delivery has to generate the manifests,
+        (False, stored claim) if it has to return.
+        """
+
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            stored = self._get(connection, encoding_id)
+            delivery = take(stored, encoding_id, time.time(), Config.WEBHOOK_CLAIM_TTL)
+            if delivery is not None:
+                self._put(connection, delivery)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        return (True, delivery) if delivery is not None else (False, stored)
+
+    def save_progress(self, encoding_id, name, value):
+        # type: (str, str, dict) -> None
+        """
+        Records the progress of a manifest of a claimed encoding, which also renews the claim
+        """
+
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            delivery = self._get(connection, encoding_id)
+            if delivery is not None:
+                progress = dict(delivery.progress)
+                progress[name] = value
+                self._put(connection, delivery._replace(progress=progress, updated_at=time.time()))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def finish(self, encoding_id, state, error=None):
+        # type: (str, str, str) -> None
+        """
+        Ends the claim of an encoding DONE or FAILED
+        """
+
+        self._connection().execute("UPDATE deliveries SET state = ?, error = ?, updated_at = ? WHERE encoding_id = ?",
+                                   (state, error, time.time(), encoding_id))
+
+    def get(self, encoding_id):
+        # type: (str) -> Delivery
+        return self._get(self._connection(), encoding_id)
+
+    def _get(self, connection, encoding_id):
+        row = connection.execute("SELECT {} FROM deliveries WHERE encoding_id = ?".format(_COLUMNS),
+                                 (encoding_id,)).fetchone()
+        if row is None:
+            return None
+        delivery = Delivery(*row)
+        return delivery._replace(progress=json.loads(delivery.progress))
+
+    def _put(self, connection, delivery):
+        connection.execute("INSERT OR REPLACE INTO deliveries ({}) VALUES (?, ?, ?, ?, ?, ?, ?)".format(_COLUMNS),
+                           tuple(delivery._replace(progress=json.dumps(delivery.progress, sort_keys=True))))
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_SCHEMA)
+            self._local.connection = connection
+        return connection
+
+
+class FileWebhookStore(object):
+    """
+    Keeps the claim of every encoding in <directory>/<encoding ID>.json. Every access holds an exclusive flock on
+    <encoding ID>.lock, and files are replaced atomically, so readers never see a partly written claim.
+    """
+
+    def __init__(self, directory):
+        # type: (str) -> None
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def claim(self, encoding_id):
+        # type: (str) -> tuple
+        """
+        Claims an encoding for a delivery, see SqliteWebhookStore.claim
+        """
+
+        with self._locked(encoding_id):
+            stored = self._get(encoding_id)
+            delivery = take(stored, encoding_id, time.time(), Config.WEBHOOK_CLAIM_TTL)
+            if delivery is not None:
+                self._put(delivery)
+
+        return (True, delivery) if delivery is not None else (False, stored)
+
+    def save_progress(self, encoding_id, name, value):
+        # type: (str, str, dict) -> None
+        with self._locked(encoding_id):
+            delivery = self._get(encoding_id)
+            if delivery is not None:
+                progress = dict(delivery.progress)
+                progress[name] = value
+                self._put(delivery._replace(progress=progress, updated_at=time.time()))
+
+    def finish(self, encoding_id, state, error=None):
+        # type: (str, str, str) -> None
+        with self._locked(encoding_id):
+            delivery = self._get(encoding_id)
+            if delivery is not None:
+                self._put(delivery._replace(state=state, error=error, updated_at=time.time()))
+
+    def get(self, encoding_id):
+        # type: (str) -> Delivery
+        with self._locked(encoding_id):
+            return self._get(encoding_id)
+
+    def _get(self, encoding_id):
+        try:
+            with open(self._path(encoding_id, ".json"), 'r') as fp:
+                return Delivery(**json.load(fp))
+        except (IOError, OSError):
+            return None
+
+    def _put(self, delivery):
+        file_path = self._path(delivery.encoding_id, ".json")
+        with open(file_path + ".tmp", 'w') as fp:
+            json.dump(delivery._asdict(), fp, sort_keys=True)
+        os.replace(file_path + ".tmp", file_path)
+
+    def _locked(self, encoding_id):
+        return _FileLock(self._path(encoding_id, ".lock"))
+
+    def _path(self, encoding_id, extension):
+        # Encoding IDs are UUIDs, anything else must not leave the directory
+        return os.path.join(self.directory, os.path.basename(encoding_id) + extension)
+
+
+class _FileLock(object):
+
+    def __init__(self, file_path):
+        self._file_path = file_path
+        self._fp = None
+
+    def __enter__(self):
+        self._fp = open(self._file_path, 'a')
+        fcntl.flock(self._fp.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._fp.fileno(), fcntl.LOCK_UN)
+        self._fp.close()
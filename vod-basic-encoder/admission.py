@@ -0,0 +1,148 @@
+import json
+import threading
+
+import config as Config
+import job_queue as JobQueue
+
+"""
+Quota-aware admission control for the watchfolder trigger.
+
+<p>Uploads are put into a persistent priority queue instead of being started right away. An encoding is only
+started when its GCE footprint fits into the configured quota, using the formulas from the README:
+  <ul>
+   <li>In-use IP addresses = instances per encoding
+   <li>CPUs = 8 (the n1-standard-8 coordinator)
+   <li>Preemptible CPUs = instances per encoding * 8
+   <li>Persistent Disk SSD (TB) = 0.5 + instances per encoding * 0.05
+ </ul>
+A split upload starts one encoding per chunk and is admitted with the footprint of all of them. The queue is drained
+whenever a job is submitted and whenever a finished or error webhook releases a footprint.
+"""
+
+CPUS_PER_INSTANCE = 8
+
+queue = None
+_queue_lock = threading.Lock()
+
+
+def init_job_queue():
+    # type: () -> object
+    """
+    Returns the job queue of STATE_STORE
+    """
+    global queue
+    with _queue_lock:
+        if queue is None:
+            if Config.STATE_STORE == "FIRESTORE":
+                queue = JobQueue.FirestoreJobQueue(collection_name="encoding-jobs")
+            elif Config.STATE_STORE == "SQLITE":
+                queue = JobQueue.SqliteJobQueue(db_path=Config.JOB_QUEUE_DB_FILE)
+            else:
+                raise Exception("Unknown STATE_STORE {}".format(Config.STATE_STORE))
+
+    return queue
+
+
+def footprint(instances=None, encodings=1):
+    # type: (int, int) -> dict
+    """
+    Computes the GCE quota footprint of a job
+
+    :param instances: Maximum number of instances of an encoding, defaults to ENCODING_MAX_INSTANCES
+    :param encodings: Number of encodings the job starts, e.g. the chunks of a split upload
+    """
+
+    instances = instances or Config.ENCODING_MAX_INSTANCES
+    return dict(in_use_ips=instances * encodings,
+                cpus=CPUS_PER_INSTANCE * encodings,
+                preemptible_cpus=instances * CPUS_PER_INSTANCE * encodings,
+                ssd_tb=(0.5 + instances * 0.05) * encodings)
+
+
+def fits(used, job_footprint, quota=None):
+    # type: (dict, dict, dict) -> bool
+    """
+    Checks whether a footprint fits into the quota on top of the footprint already in use
+    """
+
+    quota = quota or Config.GCE_QUOTA
+    for resource, limit in quota.items():
+        if used.get(resource, 0) + job_footprint.get(resource, 0) > limit + 1e-9:
+            return False
+    return True
+
+
+def priority_class_of(event):
+    # type: (dict) -> str
+    """
+    Returns the priority class of an upload: the 'priority' custom metadata of the object if it names a known class,
+    otherwise JOB_DEFAULT_PRIORITY_CLASS
+    """
+
+    metadata = event.get('metadata') or dict()
+    priority_class = metadata.get('priority', Config.JOB_DEFAULT_PRIORITY_CLASS)
+    if priority_class not in Config.JOB_PRIORITY_CLASSES:
+        priority_class = Config.JOB_DEFAULT_PRIORITY_CLASS
+    return priority_class
+
+
+def submit(event, start_job, priority_class=None, encodings=1):
+    # type: (dict, callable, str, int) -> list
+    """
+    Queues an upload and drains the queue. Returns the jobs started by this call.
+
+    :param event: The Cloud Storage event of the upload
+    :param start_job: Called with the event of an admitted job, starts its encodings and returns their IDs
+    :param priority_class: Overrides the priority class derived from the event
+    :param encodings: Number of encodings the upload starts, one per chunk of a split upload
+    """
+
+    priority_class = priority_class or priority_class_of(event)
+    init_job_queue().enqueue(payload=event,
+                             priority_class=priority_class,
+                             priority=Config.JOB_PRIORITY_CLASSES[priority_class],
+                             footprint=footprint(encodings=encodings),
+                             encodings=encodings)
+    return drain(start_job)
+
+
+def release(encoding_id, state, start_job):
+    # type: (str, str, callable) -> list
+    """
+    Releases the footprint of an ended encoding (its share of the footprint of a job starting several encodings) and
+    drains the queue. Returns the jobs started by this call.
+    """
+
+    if not init_job_queue().finish(state=state, encoding_id=encoding_id):
+        print("No running job for encoding {}".format(encoding_id))
+    return drain(start_job)
+
+
+def drain(start_job):
+    # type: (callable) -> list
+    """
+    Starts queued jobs in priority order for as long as their footprint fits into the quota, at most
+    ADMISSION_MAX_STARTS_PER_DRAIN per call
+    """
+
+    job_queue = init_job_queue()
+    started = list()
+
+    while len(started) < Config.ADMISSION_MAX_STARTS_PER_DRAIN:
+        job = job_queue.claim_next(admit=fits)
+        if job is None:
+            break
+
+        try:
+            encoding_ids = start_job(job['payload'])
+        except Exception as e:
+            print("Starting job {} failed: {}".format(job['id'], e))
+            job_queue.finish(state=JobQueue.ERROR, job_id=job['id'])
+            continue
+
+        job_queue.set_encoding_ids(job['id'], encoding_ids)
+        job['encoding_ids'] = encoding_ids
+        started.append(job)
+
+    print(json.dumps(dict(message="job queue metrics", **job_queue.metrics())))
+    return started
@@ -0,0 +1,156 @@
+import json
+import os
+import threading
+import time
+
+from collections import namedtuple
+
+import config as Config
+import utils as Utils
+
+"""
+Resolves the account-level resources every encoding needs (GCS input, GCS output and, optionally, the
+organization-wide finished webhook) once per warm Cloud Function instance.
+
+<p>Resolved resource IDs are kept in a module-level cache with a TTL. On a miss the small snapshot file written by a
+previous instance is consulted, and only if that is missing or too old the resource is looked up by its unique name
+(and created if it does not exist yet). Under upload bursts this removes the input, output and webhook round trips
+from every job.
+
+<p>A cached ID outlives the resource if it is deleted on the Bitmovin side. Callers that get the resource rejected
+invalidate its key and resolve it again (see _with_bootstrap_resource in main.py). Nothing references the
+organization webhook, so its ID is checked against the API whenever it is taken from the snapshot.
+"""
+
+Resource = namedtuple('Resource', ['id', 'name'])
+
+_cache = dict()
+_locks = dict()
+_locks_guard = threading.Lock()
+_snapshot_lock = threading.Lock()
+
+
+def get_input():
+    # type: () -> Resource
+    """
+    Returns the GCS input resource, creating it only if no input with GCS_INPUT_UNIQUE_NAME exists
+    """
+
+    return _resolve(input_key(), lambda: Utils.get_gcs_input(reuse_existing=True))
+
+
+def get_output():
+    # type: () -> Resource
+    """
+    Returns the GCS output resource, creating it only if no output with GCS_OUTPUT_UNIQUE_NAME exists
+    """
+
+    return _resolve(output_key(), lambda: Utils.get_gcs_output(reuse_existing=True))
+
+
+def ensure_organization_webhook():
+    # type: () -> Resource
+    """
+    Returns the organization-wide encoding finished webhook, registering it only if none points to
+    WEBHOOK_SUCCESS_URL yet
+    """
+
+    return _resolve(organization_webhook_key(), Utils.get_or_create_organization_finished_webhook,
+                    verify=Utils.organization_finished_webhook_exists)
+
+
+def input_key():
+    # type: () -> str
+    return "input:{}:{}".format(Config.GCS_INPUT_UNIQUE_NAME, Config.GCS_INPUT_BUCKET_NAME)
+
+
+def output_key():
+    # type: () -> str
+    return "output:{}:{}".format(Config.GCS_OUTPUT_UNIQUE_NAME, Config.GCS_OUTPUT_BUCKET_NAME)
+
+
+def organization_webhook_key():
+    # type: () -> str
+    return "webhook:finished:{}".format(Config.WEBHOOK_SUCCESS_URL)
+
+
+def invalidate(key=None, resource_id=None):
+    # type: (str, str) -> None
+    """
+    Drops one (or every) cached resource from memory and from the snapshot file, e.g. after a cached resource was
+    deleted on the Bitmovin side. With resource_id, the key is only dropped while it still resolves to that ID, so
+    concurrent callers rejecting the same stale resource do not drop the one resolved again in the meantime.
+    """
+
+    def stale(entry_id):
+        return resource_id is None or entry_id == resource_id
+
+    with _locks_guard:
+        if key is None:
+            _cache.clear()
+        elif key in _cache and stale(_cache[key]['resource'].id):
+            del _cache[key]
+
+    with _snapshot_lock:
+        snapshot = _read_snapshot()
+        if key is None:
+            snapshot = dict()
+        elif key in snapshot and stale(snapshot[key]['id']):
+            del snapshot[key]
+        _write_snapshot(snapshot)
+
+
+def _resolve(key, lookup, verify=None):
+    now = time.time()
+    entry = _cache.get(key)
+    if entry is not None and entry['expires_at'] > now:
+        return entry['resource']
+
+    # One lock per resource, so concurrent requests on a cold instance trigger a single lookup per resource
+    with _key_lock(key):
+        entry = _cache.get(key)
+        if entry is not None and entry['expires_at'] > now:
+            return entry['resource']
+
+        snapshot_entry = _read_snapshot().get(key)
+        if snapshot_entry is not None and snapshot_entry['resolved_at'] + Config.BOOTSTRAP_SNAPSHOT_TTL > now and \
+                (verify is None or verify(snapshot_entry['id'])):
+            resource = Resource(id=snapshot_entry['id'], name=snapshot_entry['name'])
+        else:
+            found = lookup()
+            resource = Resource(id=found.id, name=getattr(found, 'name', None))
+            with _snapshot_lock:
+                snapshot = _read_snapshot()
+                snapshot[key] = dict(id=resource.id, name=resource.name, resolved_at=now)
+                _write_snapshot(snapshot)
+
+        _cache[key] = dict(resource=resource, expires_at=now + Config.BOOTSTRAP_CACHE_TTL)
+        return resource
+
+
+def _key_lock(key):
+    with _locks_guard:
+        if key not in _locks:
+            _locks[key] = threading.Lock()
+        return _locks[key]
+
+
+def _read_snapshot():
+    if not Config.BOOTSTRAP_SNAPSHOT_FILE or not os.path.exists(Config.BOOTSTRAP_SNAPSHOT_FILE):
+        return dict()
+
+    try:
+        with open(Config.BOOTSTRAP_SNAPSHOT_FILE, 'r') as fp:
+            return json.load(fp)
+    except ValueError:
+        return dict()
+
+
+def _write_snapshot(snapshot):
+    if not Config.BOOTSTRAP_SNAPSHOT_FILE:
+        return
+
+    tmp_path = "{}.{}.tmp".format(Config.BOOTSTRAP_SNAPSHOT_FILE, os.getpid())
+    with open(tmp_path, 'w') as fp:
+        json.dump(snapshot, fp)
+    os.replace(tmp_path, Config.BOOTSTRAP_SNAPSHOT_FILE)
@@ -29,14 +29,213 @@ ENCODING_LABELS = []
 INPUT_BASE_PATH = ""
 OUTPUT_BASE_PATH = ""
 
-# ASSET DETAILS
-#ASSET_NAME="high+(1).mp4"
+# CODEC CONFIGURATION REGISTRY
+# Identical codec configurations are reused across uploads instead of being created for every encoding
+CONFIG_REGISTRY_ENABLED = True
+CONFIG_REGISTRY_INDEX_FILE = "/tmp/codec-configuration-index.json"
+CONFIG_REGISTRY_LRU_SIZE = 256
+
+# ENCODING GRAPH
+# Number of threads used to create the streams and muxings of an encoding concurrently
+ENCODING_GRAPH_MAX_WORKERS = 16
+
+# SUBMISSION
+# "GRAPH" creates the encoding resource by resource (see ENCODING_GRAPH_MAX_WORKERS). "TEMPLATE" compiles the
+# encoding into a single encoding template request; compiled templates are cached per ladder profile. Templates do
+# not declare manifests, so "TEMPLATE" requires MANIFEST_GENERATION "WEBHOOK".
+SUBMISSION_MODE = "GRAPH"
+ENCODING_TEMPLATE_CACHE_SIZE = 32
+BITMOVIN_API_BASE_URL = "https://api.bitmovin.com/v1"
+
+# LIST CALLS
+# All list calls read every page (see pagination.py), API_LIST_PAGE_SIZE items per call (at most 100). With
+# API_LIST_PREFETCH the next page is requested while the items of the current one are processed.
+API_LIST_PAGE_SIZE = 100
+API_LIST_PREFETCH = True
+
+# HTTP TRANSPORT
+# All Bitmovin API calls of an instance share one transport (see http_transport.py). "POOLED" keeps up to
+# HTTP_POOL_SIZE keep-alive connections open, so only the first call on a connection pays for the TLS handshake;
+# with HTTP_POOL_BLOCK further concurrent calls wait for a free connection instead of opening short-lived ones.
+# "HTTP2" multiplexes the calls over HTTP/2 and requires httpx[http2]; "SDK" opens a new connection per call.
+HTTP_TRANSPORT = "POOLED"
+HTTP_POOL_SIZE = 16
+HTTP_POOL_BLOCK = False
+HTTP_TIMEOUT = 60.0
+# Responses are requested compressed and decompressed transparently, "identity" turns compression off
+HTTP_ACCEPT_ENCODING = "gzip, deflate"
+# Connections opened in the background while the SDK is imported on first use of the API client. With
+# HTTP_WARM_UP_AT_START that already happens when an instance starts instead of on its first upload calling the API.
+HTTP_WARM_UP_CONNECTIONS = 2
+HTTP_WARM_UP_AT_START = False
+
+# INSTRUMENTATION
+# Every Bitmovin API call is recorded per endpoint: latency histogram (upper bounds in seconds), calls, errors,
+# retries and payload sizes, see instrumentation.py. Each invocation that called the API logs one JSON line with its
+# calls, and the totals of the instance are written to METRICS_FILE in the OpenMetrics text format (also served by
+# the api_metrics HTTP function).
+METRICS_ENABLED = True
+METRICS_FILE = "/tmp/bitmovin-api-metrics.txt"
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Opt-in profiling of every invocation: "SAMPLING" samples the stacks of all threads every PROFILE_SAMPLE_INTERVAL
+# seconds, "CPROFILE" traces every call of the invoked thread (slower). Profiles of invocations that took longer than
+# PROFILE_SLOW_THRESHOLD seconds are written to PROFILE_DIR and their top entries logged.
+PROFILE_MODE = None
+PROFILE_SLOW_THRESHOLD = 5.0
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_DIR = "/tmp/profiles"
+
+# MANIFESTS
+# "WEBHOOK" notifies the manifest generator function (WEBHOOK_SUCCESS_URL) when the encoding has finished, which then
+# builds the HLS and DASH manifests. "START" declares default HLS and DASH manifests in the start request, so the
+# encoding writes them itself as its last step and no finished webhook is registered. "START" requires
+# SUBMISSION_MODE "GRAPH", the function fails to load with "TEMPLATE"; keep "WEBHOOK" for custom manifest layouts.
+MANIFEST_GENERATION = "WEBHOOK"
+
+# MUXINGS
+# "TS_MP4" writes an MP4 muxing (DASH) and a TS muxing (HLS) per stream. "CMAF" writes a single fragmented MP4
+# muxing per stream that the manifest generator uses for both HLS and DASH, halving segment writes and storage.
+MUXING_MODE = "TS_MP4"
+
+# RESOURCE BOOTSTRAP
+# Input, output and webhook resources are resolved once per warm instance and cached for BOOTSTRAP_CACHE_TTL
+# seconds. The snapshot file lets cold starts skip the lookups for up to BOOTSTRAP_SNAPSHOT_TTL seconds. An input or
+# output the API rejects as not found is resolved again once; the organization webhook (WEBHOOK_SCOPE "ORGANIZATION")
+# is checked against the API when it is taken from the snapshot.
+BOOTSTRAP_ENABLED = True
+BOOTSTRAP_CACHE_TTL = 600
+BOOTSTRAP_SNAPSHOT_FILE = "/tmp/bitmovin-bootstrap-snapshot.json"
+BOOTSTRAP_SNAPSHOT_TTL = 86400
+
+# SOURCE PROBE
+# Only the MP4/MOV header of the source is read to drop renditions above the source resolution and audio bitrate.
+# The tolerances allow renditions slightly above the source (e.g. 1080p for a 1072p source). Sources without a video
+# track are encoded with the audio renditions only.
+SOURCE_PROBE_ENABLED = True
+SOURCE_PROBE_MAX_HEADER_BYTES = 64 * 1024 * 1024
+SOURCE_PROBE_RESOLUTION_TOLERANCE = 0.05
+SOURCE_PROBE_BITRATE_TOLERANCE = 0.1
+
+# SPLIT AND STITCH
+# Video sources of at least SPLIT_MIN_DURATION seconds (requires SOURCE_PROBE_ENABLED) are split into chunks of about
+# SPLIT_CHUNK_DURATION seconds that are encoded in parallel, each by its own encoding with CMAF muxings. Chunk
+# boundaries lie on the segment grid and are moved by up to SPLIT_KEYFRAME_WINDOW segments to reach a source keyframe.
+# Chunks are distributed round-robin over SPLIT_INFRASTRUCTURE_IDS (empty: the infrastructure of the upload's route).
+# The manifest generator stitches the chunks once all have finished (set SPLIT_STITCH_ENABLED there). With admission
+# control, a split upload is admitted as one job with the footprint of all its chunks (the source is probed before it
+# is queued), and every finished chunk releases its share.
+SPLIT_ENCODING_ENABLED = False
+SPLIT_MIN_DURATION = 1800
+SPLIT_CHUNK_DURATION = 600
+SPLIT_KEYFRAME_WINDOW = 2
+SPLIT_INFRASTRUCTURE_IDS = []
+SPLIT_MAX_PARALLEL_SUBMISSIONS = 4
+
+# SHARED STATE
+# The job queue, the infrastructure pool, the duplicate suppression and the encoding ledger have to be seen by every
+# instance of the function, otherwise every instance admits jobs against the full quota and fills every infrastructure,
+# duplicates reaching different instances are all encoded, and a webhook reaching another instance than the one that
+# started the encoding releases nothing. The ledger is shared with manifest-generator, which needs the same FIRESTORE_*
+# settings. "FIRESTORE" keeps them in Firestore (see firestore_client.py); None for FIRESTORE_PROJECT and
+# FIRESTORE_DATABASE uses the project of the function and its "(default)" database, collections are named
+# FIRESTORE_COLLECTION_PREFIX + the name of the store. "SQLITE" keeps them in the *_DB_FILE below, which are local to an
+# instance: SQLite (WAL) does not work on network filesystems, so they are only meant for local runs.
+STATE_STORE = "FIRESTORE"
+FIRESTORE_PROJECT = None
+FIRESTORE_DATABASE = None
+FIRESTORE_COLLECTION_PREFIX = "bitmovin-"
+
+# ADMISSION CONTROL
+# Uploads are queued and an encoding is only started when its footprint fits into the GCE quota below. The queue is
+# kept in STATE_STORE (JOB_QUEUE_DB_FILE with "SQLITE").
+ADMISSION_CONTROL_ENABLED = False
+ADMISSION_MAX_STARTS_PER_DRAIN = 5
+JOB_QUEUE_DB_FILE = "/tmp/encoding-job-queue.db"
+# A claimed job that has not started its encoding after JOB_CLAIM_TTL seconds (the invocation died) is queued again,
+# a running job without a finished or error webhook after JOB_RUNNING_TTL seconds expires. Either way its footprint
+# is released. JOB_RUNNING_TTL has to exceed the longest encoding.
+JOB_CLAIM_TTL = 600
+JOB_RUNNING_TTL = 6 * 3600
+ENCODING_MAX_INSTANCES = 4
+GCE_QUOTA = dict(in_use_ips=24, cpus=24, preemptible_cpus=192, ssd_tb=4.0)
+# Lower values are admitted first. The class is taken from the "priority" custom metadata of the uploaded object.
+JOB_PRIORITY_CLASSES = dict(rush=0, backlog=10)
+JOB_DEFAULT_PRIORITY_CLASS = "backlog"
+
+# INFRASTRUCTURE POOL
+# Infrastructures jobs are distributed over, e.g.
+#   dict(name="us-central", infrastructure_id="...", cloud_region="GOOGLE_US_CENTRAL_1", weight=2, max_in_flight=8),
+#   dict(name="europe-west", infrastructure_id="...", cloud_region="GOOGLE_EUROPE_WEST_1", locations=["EU"]),
+# Empty uses GCE_ACCOUNT_ID in CLOUD_REGION for every job. Each job goes to the infrastructure with the fewest
+# in-flight encodings per weight, penalized by its recent failure rate and by INFRASTRUCTURE_REMOTE_PENALTY if it is
+# outside the location of the input bucket. Rejected jobs fail over to the next infrastructure. Set WEBHOOK_QUEUE_URL
+# (release_encoding_quota) so ended encodings free their slot; infrastructure_utilization reports the pool state.
+# Assignments are kept in STATE_STORE (INFRASTRUCTURE_POOL_DB_FILE with "SQLITE").
+INFRASTRUCTURE_POOL = []
+INFRASTRUCTURE_POOL_DB_FILE = "/tmp/infrastructure-pool.db"
+INFRASTRUCTURE_DEFAULT_MAX_IN_FLIGHT = 4
+INFRASTRUCTURE_REMOTE_PENALTY = 2.0
+INFRASTRUCTURE_FAILOVER_ATTEMPTS = 2
+INFRASTRUCTURE_FAILURE_WINDOW = 3600
+# An infrastructure whose last INFRASTRUCTURE_MAX_CONSECUTIVE_FAILURES jobs failed is skipped for the cooldown
+INFRASTRUCTURE_MAX_CONSECUTIVE_FAILURES = 3
+INFRASTRUCTURE_COOLDOWN = 300
+# In-flight assignments without a finished or error webhook stop counting after this many seconds
+INFRASTRUCTURE_ASSIGNMENT_TTL = 6 * 3600
+# GCS locations of input buckets, e.g. {"my-bucket": "US-CENTRAL1"}; other buckets are looked up once per instance
+INPUT_BUCKET_LOCATIONS = dict()
+
+# UPLOAD EVENT RULES
+# Evaluated in order against every upload event, the first matching rule wins and events matching no rule are
+# ignored. Accepting rules route the upload to a ladder profile (see LADDER_PROFILES in main.py) and can override
+# the infrastructure ID, the output prefix and the admission priority class (see JOB_PRIORITY_CLASSES). Unknown
+# profiles and priority classes fail the function at cold start. See event_rules.py for all conditions.
+EVENT_RULES = [
+    dict(name="empty-placeholder", reject=True, max_size=0),
+    dict(name="metadata-update", reject=True, min_metageneration=2),
+    dict(name="temporary-object", reject=True, prefix=["tmp/", ".", "_"]),
+    dict(name="sidecar", reject=True, suffix=[".json", ".xml", ".txt", ".srt", ".vtt", ".md5", ".tmp", ".part"]),
+    dict(name="video", content_type=["video/*", "application/octet-stream", "application/mxf"], profile="default"),
+]
+
+# DUPLICATE SUPPRESSION
+# Redelivered upload events (same bucket, name and generation) are dropped, and uploads with the same md5Hash/crc32c
+# and size as an earlier upload are not encoded again. "ALIAS" writes an alias.json object pointing to the outputs of
+# the earlier upload, "COPY" copies its outputs once that encoding has finished (and aliases until then). The claims
+# are kept in STATE_STORE (DEDUPE_DB_FILE with "SQLITE"). Set WEBHOOK_QUEUE_URL (release_encoding_quota) so the
+# content of a failed encoding is encoded again when it is uploaded next.
+DEDUPE_ENABLED = False
+DEDUPE_ACTION = "ALIAS"
+DEDUPE_DB_FILE = "/tmp/upload-dedupe.db"
+# Seconds after which a content claim whose encoding was never submitted (e.g. crashed invocation) can be taken over.
+# Claims of uploads waiting in the job queue do not expire.
+DEDUPE_CLAIM_TTL = 900
+
+# STATUS POLLING
+# After starting an encoding its status is polled with an exponentially growing interval until it leaves the queue,
+# fails, or ENCODING_START_POLL_DEADLINE seconds have passed
+ENCODING_POLL_INITIAL_INTERVAL = 0.5
+ENCODING_POLL_MAX_INTERVAL = 5.0
+ENCODING_START_POLL_DEADLINE = 5.0
+
+# ENCODING LEDGER
+# Encodings started per asset, see ledger.py, kept in STATE_STORE. An existing LEDGER_IMPORT_JSON_FILE (the former
+# encodings.json) is imported once.
+LEDGER_DB_FILE = "/tmp/encoding-ledger.db"
+LEDGER_IMPORT_JSON_FILE = "encodings.json"
 
 #WEBHOOK DETAILS FOR TRIGGERING ANOTHER CLOUD FUNCTIONS ENDPOINT TO CREATE MANIFEST
 WEBHOOK_ERROR_URL = "http://www.bitmovin.com/"
 WEBHOOK_SUCCESS_URL = "<HTTP ENDPOINT URL OF THE MANIFEST GENERATOR CLOUD FUNCTIONS>"
+# "ENCODING" registers a finished webhook for every encoding, "ORGANIZATION" registers a single webhook that fires
+# for all encodings of the organization
+WEBHOOK_SCOPE = "ENCODING"
+# HTTP endpoint of the release_encoding_quota function, only used with ADMISSION_CONTROL_ENABLED, INFRASTRUCTURE_POOL
+# or DEDUPE_ENABLED
+WEBHOOK_QUEUE_URL = "<HTTP ENDPOINT URL OF THE RELEASE ENCODING QUOTA CLOUD FUNCTIONS>"
 # Override with local config settings
 try:
     from config_local import *
 except ImportError:
-    print('no local settings to import')
+    # Deployed functions have no local settings; nothing is printed so cold starts stay quiet
+    pass
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+from collections import OrderedDict
+
+import config as Config
+
+"""
+Content-addressed registry for codec configurations.
+
+<p>Codec configurations are immutable on the Bitmovin side, so two configurations with the same height, width,
+bitrate, profile, preset and codec are interchangeable. Instead of creating the same configurations on every upload,
+each configuration is fingerprinted and the fingerprint is resolved to an existing configuration ID through
+  <ul>
+   <li>an in-process LRU (warm Cloud Function instances)
+   <li>a persistent local index file (survives restarts when the file lives on persistent storage)
+   <li>a remote lookup by the fingerprint-tagged configuration name
+ </ul>
+A configuration is only created when none of the three levels knows the fingerprint. A configuration deleted on the
+Bitmovin side stays known to the local levels until the API rejects it: the caller then invalidates its fingerprint
+(found in the tagged name, see fingerprint_of) and resolves it again.
+"""
+
+FINGERPRINT_LENGTH = 16
+
+_TAG = re.compile(r" \[cfg:([0-9a-f]{%d})\]$" % FINGERPRINT_LENGTH)
+
+registry = None
+_registry_lock = threading.Lock()
+
+
+def init_config_registry():
+    # type: () -> ConfigRegistry
+    global registry
+    with _registry_lock:
+        if registry is None:
+            registry = ConfigRegistry(index_path=Config.CONFIG_REGISTRY_INDEX_FILE,
+                                      lru_size=Config.CONFIG_REGISTRY_LRU_SIZE)
+
+    return registry
+
+
+def fingerprint(codec, height=None, width=None, bitrate=None, profile=None, preset=None):
+    # type: (str, int, int, int, object, object) -> str
+    """
+    Builds a stable fingerprint for a codec configuration. Enum values (e.g. ProfileH264) are reduced to their
+    plain value so the fingerprint does not depend on the SDK version.
+    """
+
+    payload = dict(codec=codec,
+                   height=height,
+                   width=width,
+                   bitrate=bitrate,
+                   profile=getattr(profile, 'value', profile),
+                   preset=getattr(preset, 'value', preset))
+
+    digest = hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+    return digest[:FINGERPRINT_LENGTH]
+
+
+def tag_name(name, config_fingerprint):
+    # type: (str, str) -> str
+    """
+    Appends the fingerprint tag to a configuration name. The tagged name is what the remote lookup filters on.
+    """
+
+    return "{} [cfg:{}]".format(name, config_fingerprint)
+
+
+def fingerprint_of(name):
+    # type: (str) -> str
+    """
+    Returns the fingerprint a configuration name was tagged with by tag_name(), or None if it carries none
+    """
+
+    match = _TAG.search(name or "")
+    return match.group(1) if match else None
+
+
+class ConfigRegistry(object):
+
+    def __init__(self, index_path=None, lru_size=256):
+        # type: (str, int) -> None
+        self.index_path = index_path
+        self.lru_size = lru_size
+        self.stats = dict(lru_hits=0, index_hits=0, remote_hits=0, created=0)
+
+        self._lru = OrderedDict()
+        self._index = None
+        self._lock = threading.Lock()
+        self._fingerprint_locks = dict()
+
+    def resolve(self, config_fingerprint, lookup, create):
+        # type: (str, callable, callable) -> str
+        """
+        Resolves a fingerprint to a configuration ID, creating the configuration only if no level knows it.
+
+        :param config_fingerprint: fingerprint as returned by fingerprint()
+        :param lookup: called without arguments, returns the IDs of remote configurations carrying the tag
+        :param create: called without arguments, creates the configuration and returns its ID
+        """
+
+        configuration_id = self._lookup_local(config_fingerprint)
+        if configuration_id is not None:
+            return configuration_id
+
+        # Concurrent requests of an instance resolving the same fingerprint wait for the first one instead of
+        # creating the configuration twice
+        with self._fingerprint_lock(config_fingerprint):
+            configuration_id = self._lookup_local(config_fingerprint)
+            if configuration_id is not None:
+                return configuration_id
+
+            remote_ids = lookup()
+            if remote_ids:
+                configuration_id = remote_ids[0]
+                self._count('remote_hits')
+            else:
+                configuration_id = create()
+                self._count('created')
+
+            self._remember(config_fingerprint, configuration_id)
+        return configuration_id
+
+    def invalidate(self, config_fingerprint):
+        # type: (str) -> None
+        """
+        Forgets a fingerprint, e.g. after the referenced configuration was deleted on the Bitmovin side
+        """
+
+        with self._lock:
+            self._lru.pop(config_fingerprint, None)
+            if self._load_index().pop(config_fingerprint, None) is not None:
+                self._write_index()
+
+    def _lookup_local(self, config_fingerprint):
+        with self._lock:
+            configuration_id = self._lru.get(config_fingerprint)
+            if configuration_id is not None:
+                self._lru.move_to_end(config_fingerprint)
+                self.stats['lru_hits'] += 1
+                return configuration_id
+
+            configuration_id = self._load_index().get(config_fingerprint)
+            if configuration_id is not None:
+                self._put_lru(config_fingerprint, configuration_id)
+                self.stats['index_hits'] += 1
+
+            return configuration_id
+
+    def _remember(self, config_fingerprint, configuration_id):
+        with self._lock:
+            self._put_lru(config_fingerprint, configuration_id)
+            self._load_index()[config_fingerprint] = configuration_id
+            self._write_index()
+
+    def _fingerprint_lock(self, config_fingerprint):
+        with self._lock:
+            return self._fingerprint_locks.setdefault(config_fingerprint, threading.Lock())
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _put_lru(self, config_fingerprint, configuration_id):
+        self._lru[config_fingerprint] = configuration_id
+        self._lru.move_to_end(config_fingerprint)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def _load_index(self):
+        if self._index is None:
+            self._index = dict()
+            if self.index_path and os.path.exists(self.index_path):
+                try:
+                    with open(self.index_path, 'r') as fp:
+                        self._index = json.load(fp)
+                except ValueError:
+                    print("Ignoring unreadable codec configuration index {}".format(self.index_path))
+
+        return self._index
+
+    def _write_index(self):
+        if not self.index_path:
+            return
+
+        # Write to a temporary file first so a crash never leaves a truncated index behind
+        tmp_path = "{}.{}.tmp".format(self.index_path, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            json.dump(self._index, fp)
+        os.replace(tmp_path, self.index_path)
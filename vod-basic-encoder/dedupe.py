@@ -0,0 +1,372 @@
+import json
+import sqlite3
+import threading
+import time
+
+from collections import namedtuple
+from os import path
+
+import config as Config
+import firestore_client as Firestore
+
+"""
+Suppression of duplicate upload triggers.
+
+<p>Two kinds of duplicates are absorbed before an encoding is built:
+  <ul>
+   <li>Redelivered events: GCS finalize notifications are delivered at least once, so every event is claimed under
+       its bucket, object name and generation, and only the first delivery is processed.
+   <li>Identical content: an upload whose md5Hash (or crc32c) and size match an already claimed upload is not
+       encoded again. Its outputs are served from the original asset instead, either by copying the finished outputs
+       or by writing an alias object pointing to them.
+ </ul>
+Claims are atomic inserts keyed on the event and content keys, so of two concurrent invocations exactly one wins.
+A content claim lives as long as its encoding:
+  <ul>
+   <li>a claim that was never confirmed within DEDUPE_CLAIM_TTL seconds (e.g. the invocation crashed) can be taken
+       over, unless its upload is held in the job queue waiting for quota,
+   <li>the claim of an encoding that ended in ERROR is dropped (see release_encoding_quota in main.py), so the next
+       upload of the content is encoded again.
+ </ul>
+
+<p>Redeliveries and duplicates reach any instance of the function: FirestoreDedupeStore keeps the claims in
+Firestore, where every instance sees them. SqliteDedupeStore keeps them in an SQLite file, which only the instance
+that wrote it sees, for local runs.
+"""
+
+ContentClaim = namedtuple('ContentClaim', ['content_key', 'asset_name', 'output_root', 'encoding_id', 'claimed_at'])
+
+ALIAS_OBJECT_NAME = "alias.json"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    event_key TEXT PRIMARY KEY,
+    claimed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS contents (
+    content_key TEXT PRIMARY KEY,
+    asset_name TEXT NOT NULL,
+    output_root TEXT NOT NULL,
+    encoding_id TEXT,
+    claimed_at REAL NOT NULL,
+    held INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS contents_by_encoding ON contents (encoding_id);
+"""
+
+store = None
+_store_lock = threading.Lock()
+
+
+def init_dedupe_store():
+    # type: () -> object
+    """
+    Returns the dedupe store of STATE_STORE
+    """
+    global store
+    with _store_lock:
+        if store is None:
+            if Config.STATE_STORE == "FIRESTORE":
+                store = FirestoreDedupeStore(collection_name="upload-dedupe")
+            elif Config.STATE_STORE == "SQLITE":
+                store = SqliteDedupeStore(db_path=Config.DEDUPE_DB_FILE)
+            else:
+                raise Exception("Unknown STATE_STORE {}".format(Config.STATE_STORE))
+
+    return store
+
+
+def event_key(event):
+    # type: (dict) -> str
+    return "{}/{}#{}".format(event.get('bucket'), event.get('name'), event.get('generation'))
+
+
+def content_key(event):
+    # type: (dict) -> str
+    """
+    Returns the content key of an upload, or None if the event carries no checksum (e.g. for composite objects
+    without md5Hash, crc32c is used instead)
+    """
+
+    if event.get('md5Hash'):
+        return "md5:{}:{}".format(event['md5Hash'], event.get('size'))
+    if event.get('crc32c'):
+        return "crc32c:{}:{}".format(event['crc32c'], event.get('size'))
+    return None
+
+
+class SqliteDedupeStore(object):
+
+    def __init__(self, db_path):
+        # type: (str) -> None
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def claim_event(self, event):
+        # type: (dict) -> bool
+        """
+        Claims an event delivery. Returns False if the same bucket/name/generation was already claimed.
+        """
+
+        return self._claim("events", "event_key", event_key(event), (), ())
+
+    def claim_content(self, event, output_root):
+        # type: (dict, str) -> ContentClaim
+        """
+        Claims the content of an upload for the given output root. Returns None if the claim was won (the upload has
+        to be encoded), otherwise the claim of the upload that owns the content.
+        """
+
+        key = content_key(event)
+        if key is None:
+            return None
+
+        if self._claim("contents", "content_key", key, ("asset_name", "output_root"), (event['name'], output_root)):
+            return None
+
+        row = self._connection().execute(
+            "SELECT content_key, asset_name, output_root, encoding_id, claimed_at FROM contents WHERE content_key = ?",
+            (key,)).fetchone()
+        return ContentClaim(*row) if row is not None else None
+
+    def hold_content(self, event):
+        # type: (dict) -> None
+        """
+        Keeps the content claim of an upload from expiring while its job waits in the job queue
+        """
+
+        key = content_key(event)
+        if key is not None:
+            self._connection().execute("UPDATE contents SET held = 1 WHERE content_key = ? AND asset_name = ?",
+                                       (key, event['name']))
+
+    def confirm_content(self, event, encoding_id):
+        # type: (dict, str) -> bool
+        """
+        Records the encoding that produces the outputs of a claimed content, which makes the claim permanent. Returns
+        False if the upload does not hold the claim (any more).
+        """
+
+        key = content_key(event)
+        if key is None:
+            return True
+
+        cursor = self._connection().execute(
+            "UPDATE contents SET encoding_id = ?, held = 0 WHERE content_key = ? AND asset_name = ?",
+            (encoding_id, key, event['name']))
+        return cursor.rowcount > 0
+
+    def release(self, event):
+        # type: (dict) -> None
+        """
+        Drops the claims of an upload whose encoding could not be submitted, so a retry can claim them again
+        """
+
+        connection = self._connection()
+        connection.execute("DELETE FROM events WHERE event_key = ?", (event_key(event),))
+        key = content_key(event)
+        if key is not None:
+            connection.execute("DELETE FROM contents WHERE content_key = ? AND asset_name = ? AND encoding_id IS NULL",
+                               (key, event['name']))
+
+    def release_encoding(self, encoding_id):
+        # type: (str) -> bool
+        """
+        Drops the content claim of an encoding that ended in ERROR, so the next upload of the content is encoded.
+        Returns False if no claim belonged to the encoding.
+        """
+
+        cursor = self._connection().execute("DELETE FROM contents WHERE encoding_id = ?", (encoding_id,))
+        return cursor.rowcount > 0
+
+    def _claim(self, table, key_column, key, columns, values):
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO {} ({}, claimed_at{}) VALUES (?, ?{})".format(
+                    table, key_column, "".join(", " + c for c in columns), ", ?" * len(columns)),
+                (key, now) + tuple(values))
+            won = cursor.rowcount > 0
+
+            if not won and table == "contents":
+                # Unconfirmed content claims expire, so a crashed invocation does not block the content forever
+                cursor = connection.execute(
+                    "UPDATE contents SET asset_name = ?, output_root = ?, claimed_at = ? "
+                    "WHERE content_key = ? AND encoding_id IS NULL AND held = 0 AND claimed_at < ?",
+                    tuple(values) + (now, key, now - Config.DEDUPE_CLAIM_TTL))
+                won = cursor.rowcount > 0
+
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        return won
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_SCHEMA)
+            self._local.connection = connection
+        return connection
+
+
+class FirestoreDedupeStore(object):
+    """
+    Keeps the claims in the documents of <FIRESTORE_COLLECTION_PREFIX><collection_name>-events and -contents, named
+    by the hash of their key (object names contain slashes).
+    """
+
+    def __init__(self, collection_name):
+        # type: (str) -> None
+        self.collection_name = collection_name
+
+    def claim_event(self, event):
+        # type: (dict) -> bool
+        """
+        Claims an event delivery. Returns False if the same bucket/name/generation was already claimed.
+        """
+
+        from google.api_core.exceptions import AlreadyExists
+
+        try:
+            self._event(event).create(dict(event_key=event_key(event), claimed_at=time.time()))
+        except AlreadyExists:
+            return False
+        return True
+
+    def claim_content(self, event, output_root):
+        # type: (dict, str) -> ContentClaim
+        """
+        Claims the content of an upload for the given output root, see SqliteDedupeStore.claim_content
+        """
+
+        key = content_key(event)
+        if key is None:
+            return None
+        reference = self._content(key)
+
+        def claim_in(transaction):
+            now = time.time()
+            snapshot = reference.get(transaction=transaction)
+            if snapshot.exists:
+                claim = snapshot.to_dict()
+                # Unconfirmed content claims expire, so a crashed invocation does not block the content forever
+                expired = claim['encoding_id'] is None and not claim['held'] and \
+                    claim['claimed_at'] < now - Config.DEDUPE_CLAIM_TTL
+                if not expired:
+                    return ContentClaim(**dict((field, claim[field]) for field in ContentClaim._fields))
+
+            transaction.set(reference, dict(content_key=key, asset_name=event['name'], output_root=output_root,
+                                            encoding_id=None, claimed_at=now, held=False))
+            return None
+
+        return Firestore.run_transaction(claim_in)
+
+    def hold_content(self, event):
+        # type: (dict) -> None
+        """
+        Keeps the content claim of an upload from expiring while its job waits in the job queue
+        """
+
+        self._update_own_claim(event, dict(held=True))
+
+    def confirm_content(self, event, encoding_id):
+        # type: (dict, str) -> bool
+        """
+        Records the encoding that produces the outputs of a claimed content, see SqliteDedupeStore.confirm_content
+        """
+
+        if content_key(event) is None:
+            return True
+        return self._update_own_claim(event, dict(encoding_id=encoding_id, held=False))
+
+    def release(self, event):
+        # type: (dict) -> None
+        """
+        Drops the claims of an upload whose encoding could not be submitted, so a retry can claim them again
+        """
+
+        self._event(event).delete()
+        key = content_key(event)
+        if key is None:
+            return
+        reference = self._content(key)
+
+        def release_in(transaction):
+            snapshot = reference.get(transaction=transaction)
+            if snapshot.exists and snapshot.get('asset_name') == event['name'] and snapshot.get('encoding_id') is None:
+                transaction.delete(reference)
+
+        Firestore.run_transaction(release_in)
+
+    def release_encoding(self, encoding_id):
+        # type: (str) -> bool
+        """
+        Drops the content claim of an encoding that ended in ERROR, see SqliteDedupeStore.release_encoding
+        """
+
+        from google.cloud.firestore import FieldFilter
+
+        released = False
+        contents = Firestore.collection(self.collection_name + "-contents")
+        for snapshot in contents.where(filter=FieldFilter("encoding_id", "==", encoding_id)).stream():
+            snapshot.reference.delete()
+            released = True
+        return released
+
+    def _update_own_claim(self, event, values):
+        key = content_key(event)
+        if key is None:
+            return False
+        reference = self._content(key)
+
+        def update_in(transaction):
+            snapshot = reference.get(transaction=transaction)
+            if not snapshot.exists or snapshot.get('asset_name') != event['name']:
+                return False
+            transaction.update(reference, values)
+            return True
+
+        return Firestore.run_transaction(update_in)
+
+    def _event(self, event):
+        return Firestore.collection(self.collection_name + "-events").document(Firestore.document_id(event_key(event)))
+
+    def _content(self, key):
+        return Firestore.collection(self.collection_name + "-contents").document(Firestore.document_id(key))
+
+
+def serve_duplicate(original, output_root, encoding_finished):
+    # type: (ContentClaim, str, bool) -> str
+    """
+    Serves the outputs of a duplicate upload from the original asset. Finished outputs are copied server-side when
+    DEDUPE_ACTION is "COPY"; otherwise (or while the original is still encoding) an alias object pointing to the
+    original output root is written. Returns the action taken.
+
+    :param original: The content claim of the original upload
+    :param output_root: The output root of the duplicate upload, relative to OUTPUT_BASE_PATH
+    :param encoding_finished: Whether the encoding of the original has finished
+    """
+
+    from google.cloud import storage
+
+    bucket = storage.Client().bucket(Config.GCS_OUTPUT_BUCKET_NAME)
+    source_prefix = path.join(Config.OUTPUT_BASE_PATH, original.output_root) + "/"
+    target_prefix = path.join(Config.OUTPUT_BASE_PATH, output_root) + "/"
+
+    if Config.DEDUPE_ACTION == "COPY" and encoding_finished:
+        for blob in bucket.list_blobs(prefix=source_prefix):
+            bucket.copy_blob(blob, bucket, new_name=target_prefix + blob.name[len(source_prefix):])
+        return "COPY"
+
+    alias = dict(asset_name=original.asset_name,
+                 output_root=original.output_root,
+                 encoding_id=original.encoding_id)
+    bucket.blob(target_prefix + ALIAS_OBJECT_NAME).upload_from_string(json.dumps(alias),
+                                                                       content_type="application/json")
+    return "ALIAS"
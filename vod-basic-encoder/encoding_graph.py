@@ -0,0 +1,141 @@
+import instrumentation as Instrumentation
+
+"""
+Dependency-aware builder for the resources of an encoding.
+
+<p>Every resource (codec configuration, stream, muxing, ...) is a node with a build function and the keys of the
+nodes it depends on. A node is submitted to a bounded thread pool as soon as all of its dependencies are built, so
+independent nodes are created concurrently and the submission latency grows with the depth of the graph
+(encoding -> stream -> muxing) rather than with the number of renditions.
+
+<p>If any node fails, no further nodes are started, the nodes already in flight are allowed to finish, every
+successfully built node is rolled back in reverse completion order and the failure of the first failed node (in
+the order the nodes were added) is raised. Which of several failing nodes is reported therefore does not depend on
+the order they fail in, as long as both were started; benchmarks/encoding_graph_harness.py checks this.
+"""
+
+
+class EncodingGraphError(Exception):
+
+    def __init__(self, key, cause):
+        # type: (str, Exception) -> None
+        super(EncodingGraphError, self).__init__("Building '{}' failed: {}".format(key, cause))
+        self.key = key
+        self.cause = cause
+
+
+class _Node(object):
+
+    def __init__(self, key, build, depends_on, rollback, order):
+        self.key = key
+        self.build = build
+        self.depends_on = list(depends_on)
+        self.rollback = rollback
+        self.order = order
+
+
+class EncodingGraph(object):
+
+    def __init__(self, max_workers=8):
+        # type: (int) -> None
+        self.max_workers = max_workers
+        self._nodes = dict()
+
+    def add(self, key, build, depends_on=(), rollback=None):
+        # type: (str, callable, list, callable) -> None
+        """
+        Adds a node to the graph.
+
+        :param key: Unique key of the node, used to reference it from dependent nodes
+        :param build: Called with the results of depends_on (in that order), returns the created resource
+        :param depends_on: Keys of the nodes that have to be built before this one
+        :param rollback: Called with the created resource followed by the dependency results to undo the node
+        """
+
+        if key in self._nodes:
+            raise ValueError("Duplicate node '{}'".format(key))
+
+        self._nodes[key] = _Node(key=key, build=build, depends_on=depends_on, rollback=rollback,
+                                 order=len(self._nodes))
+
+    def depth(self):
+        # type: () -> int
+        """
+        Returns the length of the longest dependency chain, i.e. the number of sequential round trips needed
+        """
+
+        depths = dict()
+        visiting = set()
+
+        def node_depth(key):
+            if key not in depths:
+                if key in visiting:
+                    raise ValueError("Dependency cycle in encoding graph at '{}'".format(key))
+                visiting.add(key)
+                depths[key] = 1 + max([node_depth(dep) for dep in self._nodes[key].depends_on] or [0])
+                visiting.discard(key)
+            return depths[key]
+
+        return max([node_depth(key) for key in self._nodes] or [0])
+
+    def execute(self):
+        # type: () -> dict
+        """
+        Builds all nodes and returns a dict mapping each node key to its created resource
+        """
+
+        # Imported here, the thread pool (and the logging module it pulls in) is not needed at cold start
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+        self._validate()
+
+        results = dict()
+        completed = list()
+        failures = dict()
+        pending = sorted(self._nodes.values(), key=lambda n: n.order)
+        running = dict()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if not failures:
+                    ready = [node for node in pending if all(dep in results for dep in node.depends_on)]
+                    for node in ready:
+                        pending.remove(node)
+                        args = [results[dep] for dep in node.depends_on]
+                        running[executor.submit(Instrumentation.in_context(node.build), *args)] = node
+                elif not running:
+                    break
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    try:
+                        results[node.key] = future.result()
+                        completed.append(node)
+                    except Exception as e:
+                        failures[node.key] = e
+
+        if failures:
+            self._rollback(completed, results)
+            first = min(failures, key=lambda key: self._nodes[key].order)
+            raise EncodingGraphError(first, failures[first]) from failures[first]
+
+        return results
+
+    def _validate(self):
+        for node in self._nodes.values():
+            for dep in node.depends_on:
+                if dep not in self._nodes:
+                    raise ValueError("Node '{}' depends on unknown node '{}'".format(node.key, dep))
+
+        # depth() walks every dependency chain and raises on cycles
+        self.depth()
+
+    def _rollback(self, completed, results):
+        for node in reversed(completed):
+            if node.rollback is None:
+                continue
+            try:
+                node.rollback(results[node.key], *[results[dep] for dep in node.depends_on])
+            except Exception as e:
+                print("Rollback of '{}' failed: {}".format(node.key, e))
@@ -0,0 +1,183 @@
+import json
+import threading
+
+from collections import OrderedDict
+from os import path
+
+import config as Config
+import http_transport as HttpTransport
+import instrumentation as Instrumentation
+
+"""
+Compiles the encoding of an asset into a single Bitmovin encoding template and submits it in one request.
+
+<p>The template contains the encoding, one stream per rendition, the muxings of the configured MUXING_MODE and the
+start options; it mirrors the graph that main.py builds resource by resource. Everything that only depends on the
+ladder profile (codec configuration IDs, muxing layout) is compiled once and cached; the asset-specific values are
+placeholders that are substituted into the cached JSON text on every upload.
+
+<p>API endpoint:
+https://bitmovin.com/docs/encoding/api-reference/sections/templates#/Encoding/PostEncodingTemplatesStart
+"""
+
+PLACEHOLDERS = ('ENCODING_NAME', 'ENCODING_DESCRIPTION', 'INFRASTRUCTURE_ID', 'CLOUD_REGION', 'INPUT_ID', 'INPUT_PATH',
+                'OUTPUT_ID', 'OUTPUT_ROOT')
+
+ENCODING_KEY = "main"
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def get_template(cache_key, compile_template):
+    # type: (tuple, callable) -> str
+    """
+    Returns the compiled template for the cache key, calling compile_template() only on a miss
+
+    :param cache_key: Anything hashable that identifies the profile, e.g. (profile name, ladder, muxing mode)
+    :param compile_template: Called without arguments, returns the compiled template text
+    """
+
+    with _cache_lock:
+        template = _cache.get(cache_key)
+        if template is not None:
+            _cache.move_to_end(cache_key)
+            return template
+
+    template = compile_template()
+
+    with _cache_lock:
+        _cache[cache_key] = template
+        while len(_cache) > Config.ENCODING_TEMPLATE_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return template
+
+
+def compile_template(video_renditions, audio_renditions, muxing_mode):
+    # type: (list, list, str) -> str
+    """
+    Compiles the template of a ladder. Asset-specific values are left as {{PLACEHOLDER}} strings.
+
+    :param video_renditions: dicts with 'rendition_path' and 'configuration_id', highest quality first
+    :param audio_renditions: dicts with 'rendition_path' and 'configuration_id', highest quality first
+    :param muxing_mode: "CMAF" or "TS_MP4", see MUXING_MODE
+    """
+
+    streams = OrderedDict()
+    muxings = OrderedDict()
+
+    for media_type, renditions in (("video", video_renditions), ("audio", audio_renditions)):
+        for rendition in renditions:
+            key = "{}_{}".format(media_type, rendition['rendition_path'].replace("-", "_"))
+            streams[key] = dict(properties=dict(
+                inputStreams=[dict(inputId=_placeholder('INPUT_ID'),
+                                   inputPath=_placeholder('INPUT_PATH'),
+                                   selectionMode="AUTO")],
+                codecConfigId=rendition['configuration_id']))
+
+            stream_ref = [dict(streamId="$/encodings/{}/streams/{}".format(ENCODING_KEY, key))]
+            for muxing_type, properties in _muxings_of(media_type, rendition['rendition_path'], muxing_mode):
+                properties['streams'] = stream_ref
+                muxings.setdefault(muxing_type, OrderedDict())["{}_{}".format(key, muxing_type)] = \
+                    dict(properties=properties)
+
+    template = OrderedDict([
+        ("metadata", dict(type="VOD", name=_placeholder('ENCODING_NAME'))),
+        ("encodings", {ENCODING_KEY: OrderedDict([
+            ("properties", dict(name=_placeholder('ENCODING_NAME'),
+                                description=_placeholder('ENCODING_DESCRIPTION'),
+                                cloudRegion="EXTERNAL",
+                                infrastructure=dict(infrastructureId=_placeholder('INFRASTRUCTURE_ID'),
+                                                    cloudRegion=_placeholder('CLOUD_REGION')))),
+            ("streams", streams),
+            ("muxings", muxings),
+            ("start", dict(properties=dict()))
+        ])})
+    ])
+
+    return json.dumps(template, indent=1)
+
+
+def render(template, **values):
+    # type: (str, dict) -> str
+    """
+    Substitutes the asset-specific values into a compiled template. Every placeholder needs a value.
+    """
+
+    missing = set(PLACEHOLDERS) - set(values)
+    if missing:
+        raise ValueError("Missing template values {}".format(sorted(missing)))
+
+    for name, value in values.items():
+        # The template is JSON text, so values are inserted JSON-escaped (without the surrounding quotes)
+        template = template.replace(_placeholder(name), json.dumps(str(value))[1:-1])
+    return template
+
+
+def start(document):
+    # type: (str) -> str
+    """
+    Submits a rendered template, which creates and starts the encoding, and returns the ID of the encoding
+    """
+
+    headers = {'Content-Type': 'application/json', 'X-Api-Key': Config.BITMOVIN_API_KEY}
+    if Config.BITMOVIN_TENANT_ORG_ID:
+        headers['X-Tenant-Org-Id'] = Config.BITMOVIN_TENANT_ORG_ID
+
+    # Sent over the pooled connections shared with the SDK (see http_transport.py)
+    url = Config.BITMOVIN_API_BASE_URL + "/encoding/templates/start"
+    with Instrumentation.record_call("encoding.templates.start"):
+        response = HttpTransport.init_transport().request("POST", url, headers=headers, data=document.encode('utf-8'))
+        if response.status_code >= 300:
+            raise TemplateRejected(response)
+
+    result = response.json().get('data', dict()).get('result', dict())
+    return result.get('encodingId') or result.get('id')
+
+
+class TemplateRejected(Exception):
+    """
+    Raised when the API rejects a template. Carries the HTTP status and the messages of the error response under the
+    names BitmovinError uses, so callers can handle both alike.
+    """
+
+    def __init__(self, response):
+        try:
+            data = response.json().get('data') or dict()
+        except ValueError:
+            data = dict()
+        self.http_status_code = response.status_code
+        self.short_message = data.get('message')
+        self.developer_message = data.get('developerMessage')
+        super(TemplateRejected, self).__init__("Encoding template was rejected ({}): {}".format(
+            response.status_code, self.developer_message or self.short_message or response.text))
+
+
+def output_root_path(output_root):
+    # type: (str) -> str
+    return path.join(Config.OUTPUT_BASE_PATH, output_root)
+
+
+def _muxings_of(media_type, rendition_path, muxing_mode):
+    def output(layout):
+        return [dict(outputId=_placeholder('OUTPUT_ID'),
+                     outputPath=path.join(_placeholder('OUTPUT_ROOT'), media_type, layout, "clear", rendition_path),
+                     acl=[dict(permission="PUBLIC_READ")])]
+
+    if muxing_mode == "CMAF":
+        return [("fmp4", dict(segmentLength=4.0,
+                              segmentNaming="segment_%number%.m4s",
+                              initSegmentName="init.mp4",
+                              outputs=output("cmaf")))]
+
+    return [("mp4", dict(filename=media_type,
+                         fragmentDuration=4000,
+                         fragmentedMp4MuxingManifestType="DASH_ON_DEMAND",
+                         outputs=output("mp4"))),
+            ("ts", dict(segmentLength=4.0,
+                        outputs=output("ts")))]
+
+
+def _placeholder(name):
+    return "{{" + name + "}}"
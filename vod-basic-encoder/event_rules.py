@@ -0,0 +1,145 @@
+from collections import namedtuple
+
+"""
+Rule-based pre-filter and routing of Cloud Storage upload events.
+
+<p>Rules are evaluated in order against the event payload and the first matching rule wins. A rule either rejects
+the event (sidecar files, zero-byte placeholders, metadata-only rewrites, temporary objects, ...) or routes it to a
+ladder profile, an infrastructure and an output prefix. Events that match no rule are rejected.
+
+<p>Supported conditions (all optional, every given condition has to match):
+  <ul>
+   <li>prefix / suffix - lists of object name prefixes / suffixes (suffixes are compared case-insensitively)
+   <li>content_type - list of content types, "video/*" style wildcards allowed
+   <li>min_size / max_size - object size in bytes
+   <li>min_metageneration / max_metageneration - metageneration of the object (1 for a fresh upload)
+   <li>metadata - dict of custom metadata keys to the required value (or list of allowed values)
+ </ul>
+
+<p>Rules are compiled once into a list of predicates, so evaluating an event only runs the checks a rule actually
+uses, on values extracted from the payload a single time.
+"""
+
+Route = namedtuple('Route', ['rule', 'accepted', 'profile', 'infrastructure_id', 'output_prefix', 'priority_class'])
+
+_REJECTED = Route(rule=None, accepted=False, profile=None, infrastructure_id=None, output_prefix=None,
+                  priority_class=None)
+
+_CONDITIONS = ('prefix', 'suffix', 'content_type', 'min_size', 'max_size', 'min_metageneration',
+               'max_metageneration', 'metadata')
+_ROUTE_SETTINGS = ('reject', 'profile', 'infrastructure_id', 'output_prefix', 'priority_class')
+
+
+class EventMatcher(object):
+
+    def __init__(self, compiled_rules):
+        self._rules = compiled_rules
+
+    def route(self, event):
+        # type: (dict) -> Route
+        """
+        Returns the route of the first rule matching the event, or a rejected route if no rule matches
+        """
+
+        fields = _extract(event)
+        for route, predicates in self._rules:
+            for predicate in predicates:
+                if not predicate(fields):
+                    break
+            else:
+                return route
+        return _REJECTED
+
+
+def compile_rules(rules, default_profile="default", profiles=None, priority_classes=None):
+    # type: (list, str, object, object) -> EventMatcher
+    """
+    Compiles a list of rule dicts (see module documentation) into an EventMatcher. Raises ValueError for unknown
+    rule keys, ladder profiles and priority classes, so typos in the configuration fail at cold start instead of
+    silently matching everything or failing every upload the rule routes.
+
+    :param profiles: The names of the ladder profiles rules may route to (not checked if None)
+    :param priority_classes: The names of the priority classes rules may set (not checked if None)
+    """
+
+    compiled = list()
+    for index, rule in enumerate(rules):
+        name = rule.get('name', "rule-{}".format(index))
+        unknown = set(rule) - set(_CONDITIONS) - set(_ROUTE_SETTINGS) - {'name'}
+        if unknown:
+            raise ValueError("Unknown keys {} in event rule '{}'".format(sorted(unknown), name))
+
+        profile = rule.get('profile', default_profile)
+        if profiles is not None and not rule.get('reject', False) and profile not in profiles:
+            raise ValueError("Unknown ladder profile '{}' in event rule '{}', expected one of {}".format(
+                profile, name, sorted(profiles)))
+        priority_class = rule.get('priority_class')
+        if priority_classes is not None and priority_class is not None and priority_class not in priority_classes:
+            raise ValueError("Unknown priority class '{}' in event rule '{}', expected one of {}".format(
+                priority_class, name, sorted(priority_classes)))
+
+        if rule.get('reject', False):
+            route = Route(rule=name, accepted=False, profile=None, infrastructure_id=None, output_prefix=None,
+                          priority_class=None)
+        else:
+            route = Route(rule=name,
+                          accepted=True,
+                          profile=profile,
+                          infrastructure_id=rule.get('infrastructure_id'),
+                          output_prefix=rule.get('output_prefix', ""),
+                          priority_class=priority_class)
+
+        compiled.append((route, _compile_predicates(rule)))
+
+    return EventMatcher(compiled)
+
+
+def _compile_predicates(rule):
+    predicates = list()
+
+    if 'prefix' in rule:
+        prefixes = tuple(rule['prefix'])
+        predicates.append(lambda fields: fields['name'].startswith(prefixes))
+
+    if 'suffix' in rule:
+        suffixes = tuple(suffix.lower() for suffix in rule['suffix'])
+        predicates.append(lambda fields: fields['name_lower'].endswith(suffixes))
+
+    if 'content_type' in rule:
+        exact = frozenset(t for t in rule['content_type'] if not t.endswith('/*'))
+        wildcards = tuple(t[:-1] for t in rule['content_type'] if t.endswith('/*'))
+        predicates.append(lambda fields: fields['content_type'] in exact or
+                          fields['content_type'].startswith(wildcards))
+
+    if 'min_size' in rule:
+        min_size = rule['min_size']
+        predicates.append(lambda fields: fields['size'] >= min_size)
+
+    if 'max_size' in rule:
+        max_size = rule['max_size']
+        predicates.append(lambda fields: fields['size'] <= max_size)
+
+    if 'min_metageneration' in rule:
+        min_metageneration = rule['min_metageneration']
+        predicates.append(lambda fields: fields['metageneration'] >= min_metageneration)
+
+    if 'max_metageneration' in rule:
+        max_metageneration = rule['max_metageneration']
+        predicates.append(lambda fields: fields['metageneration'] <= max_metageneration)
+
+    for key, expected in (rule.get('metadata') or dict()).items():
+        allowed = frozenset(expected) if isinstance(expected, (list, tuple, set)) else frozenset([expected])
+        predicates.append(lambda fields, key=key, allowed=allowed: fields['metadata'].get(key) in allowed)
+
+    return tuple(predicates)
+
+
+def _extract(event):
+    # GCS events carry size and metageneration as strings
+    name = event.get('name') or ""
+    return dict(name=name,
+                name_lower=name.lower(),
+                content_type=event.get('contentType') or "",
+                size=int(event.get('size') or 0),
+                metageneration=int(event.get('metageneration') or 1),
+                metadata=event.get('metadata') or dict())
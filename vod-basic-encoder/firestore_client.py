@@ -0,0 +1,55 @@
+import hashlib
+import threading
+
+import config as Config
+
+"""
+Firestore client shared by the stores whose state has to be seen by every instance of the functions.
+
+<p>Cloud Functions scale out to many instances, each with its own /tmp, so state written to a local SQLite file only
+reaches the invocations of the instance that wrote it. The stores keep such state in Firestore collections named
+FIRESTORE_COLLECTION_PREFIX + the name of the store, and take and update their entries in Firestore transactions,
+which Firestore retries on contention, so of two concurrent writers exactly one wins. SQLite (WAL) does not work on
+network filesystems, so the SQLite stores remain for local runs and the harnesses only.
+
+<p>google-cloud-firestore is imported on first use, instances not using a Firestore store never pay for the import.
+"""
+
+client = None
+_client_lock = threading.Lock()
+
+
+def init_firestore():
+    # type: () -> object
+    global client
+    with _client_lock:
+        if client is None:
+            from google.cloud import firestore
+            client = firestore.Client(project=Config.FIRESTORE_PROJECT, database=Config.FIRESTORE_DATABASE)
+
+    return client
+
+
+def collection(name):
+    # type: (str) -> object
+    return init_firestore().collection(Config.FIRESTORE_COLLECTION_PREFIX + name)
+
+
+def run_transaction(function):
+    # type: (callable) -> object
+    """
+    Calls function(transaction) in a transaction and returns its result. Firestore calls it again when the
+    documents it read were changed before the commit, so it must not have side effects besides the transaction.
+    """
+
+    from google.cloud import firestore
+    return firestore.transactional(function)(init_firestore().transaction())
+
+
+def document_id(*keys):
+    # type: (*str) -> str
+    """
+    Builds a document ID from arbitrary keys (object names contain slashes, which Firestore IDs must not)
+    """
+
+    return hashlib.sha256("\n".join(str(key) for key in keys).encode('utf-8')).hexdigest()
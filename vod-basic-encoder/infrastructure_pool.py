@@ -0,0 +1,451 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+
+from collections import namedtuple
+
+import config as Config
+import firestore_client as Firestore
+
+"""
+Load-balanced pool of Bitmovin infrastructures (GCE accounts connected to Bitmovin), possibly in several regions.
+
+<p>Every job is assigned to the infrastructure with the lowest score, computed from:
+  <ul>
+   <li>in-flight encodings relative to the capacity weight of the infrastructure,
+   <li>the failure rate of its recent assignments,
+   <li>data locality: infrastructures outside the location of the input bucket are penalized.
+ </ul>
+Infrastructures at max_in_flight or cooling down after consecutive failures are skipped. If creating or starting
+the encoding fails, the assignment is recorded as failed and the job fails over to the next infrastructure.
+
+<p>Assignments are claimed in a transaction, so concurrent invocations see each other's in-flight encodings. The
+finished and error webhooks (see release_encoding_quota in main.py) end them, which can happen on any instance of the
+function: FirestoreInfrastructurePool keeps the assignments in Firestore, where every instance sees them.
+SqliteInfrastructurePool keeps them in an SQLite file, which only the instance that wrote it sees, for local runs.
+"""
+
+RUNNING = "RUNNING"
+FINISHED = "FINISHED"
+ERROR = "ERROR"
+REJECTED = "REJECTED"
+
+# Score multiplier per unit of failure rate, a region failing half of its jobs scores three times worse
+FAILURE_RATE_PENALTY = 4.0
+
+# Successful assignments assumed on top of the observed ones when scoring, so a single failure of a rarely used
+# infrastructure does not push it out of the rotation for the whole failure window
+FAILURE_RATE_PRIOR = 4
+
+Infrastructure = namedtuple('Infrastructure', ['name', 'infrastructure_id', 'cloud_region', 'weight', 'max_in_flight',
+                                               'locations'])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS assignments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    infrastructure TEXT NOT NULL,
+    encoding_id TEXT,
+    state TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    ended_at REAL
+);
+CREATE INDEX IF NOT EXISTS assignments_by_state ON assignments (state, infrastructure);
+CREATE INDEX IF NOT EXISTS assignments_by_encoding ON assignments (encoding_id);
+CREATE INDEX IF NOT EXISTS assignments_by_start ON assignments (started_at);
+"""
+
+pool = None
+_pool_lock = threading.Lock()
+_bucket_locations = dict()
+
+
+def init_pool():
+    # type: () -> object
+    """
+    Returns the pool of INFRASTRUCTURE_POOL, kept in STATE_STORE
+    """
+    global pool
+    with _pool_lock:
+        if pool is None:
+            infrastructures = [infrastructure_of(entry) for entry in Config.INFRASTRUCTURE_POOL]
+            if Config.STATE_STORE == "FIRESTORE":
+                pool = FirestoreInfrastructurePool(infrastructures=infrastructures,
+                                                   collection_name="infrastructure-assignments")
+            elif Config.STATE_STORE == "SQLITE":
+                pool = SqliteInfrastructurePool(infrastructures=infrastructures,
+                                                db_path=Config.INFRASTRUCTURE_POOL_DB_FILE)
+            else:
+                raise Exception("Unknown STATE_STORE {}".format(Config.STATE_STORE))
+
+    return pool
+
+
+def infrastructure_of(entry):
+    # type: (dict) -> Infrastructure
+    """
+    Builds a pool entry from an INFRASTRUCTURE_POOL dict. The locations default to the region of the infrastructure.
+    """
+
+    return Infrastructure(name=entry.get('name', entry['infrastructure_id']),
+                          infrastructure_id=entry['infrastructure_id'],
+                          cloud_region=entry['cloud_region'],
+                          weight=float(entry.get('weight', 1.0)),
+                          max_in_flight=int(entry.get('max_in_flight', Config.INFRASTRUCTURE_DEFAULT_MAX_IN_FLIGHT)),
+                          locations=tuple(location.upper() for location in
+                                          entry.get('locations') or [gcs_location_of(entry['cloud_region'])]))
+
+
+def gcs_location_of(cloud_region):
+    # type: (str) -> str
+    """
+    Maps a Bitmovin cloud region to the GCS location name, e.g. GOOGLE_US_CENTRAL_1 to US-CENTRAL1
+    """
+
+    region = cloud_region[len("GOOGLE_"):] if cloud_region.startswith("GOOGLE_") else cloud_region
+    return re.sub(r"_(\d+)$", r"\1", region).replace("_", "-")
+
+
+def bucket_location(bucket_name):
+    # type: (str) -> str
+    """
+    Returns the location of a bucket from INPUT_BUCKET_LOCATIONS, looking it up (once per instance) otherwise.
+    Returns None if the location is unknown, which disables the locality preference.
+    """
+
+    if bucket_name in Config.INPUT_BUCKET_LOCATIONS:
+        return Config.INPUT_BUCKET_LOCATIONS[bucket_name].upper()
+
+    if bucket_name not in _bucket_locations:
+        try:
+            from google.cloud import storage
+
+            bucket = storage.Client().bucket(bucket_name)
+            bucket.reload()
+            _bucket_locations[bucket_name] = bucket.location.upper()
+        except Exception as e:
+            print("Could not look up the location of bucket {}: {}".format(bucket_name, e))
+            _bucket_locations[bucket_name] = None
+
+    return _bucket_locations[bucket_name]
+
+
+def is_local(infrastructure, location):
+    # type: (Infrastructure, str) -> bool
+    """
+    Checks whether an infrastructure is close to a GCS location. Multi-regions (e.g. US, EU) contain all their
+    regions.
+    """
+
+    if location is None:
+        return True
+    return any(own == location or own.startswith(location + "-") for own in infrastructure.locations)
+
+
+def stats_of(in_flight, ended_recently, last_ended, now):
+    # type: (int, list, list, float) -> dict
+    """
+    Computes the load, failure rate and health of an infrastructure. Shared by the pools, which collect the
+    assignments of the infrastructure while holding their transaction.
+
+    :param in_flight: Number of RUNNING assignments started within INFRASTRUCTURE_ASSIGNMENT_TTL
+    :param ended_recently: States of the assignments ended within INFRASTRUCTURE_FAILURE_WINDOW
+    :param last_ended: (state, ended_at) of the last INFRASTRUCTURE_MAX_CONSECUTIVE_FAILURES ended assignments,
+        latest first
+    """
+
+    failed = sum(1 for state in ended_recently if state in (ERROR, REJECTED))
+    cooling_down = len(last_ended) == Config.INFRASTRUCTURE_MAX_CONSECUTIVE_FAILURES and \
+        all(state != FINISHED for state, _ in last_ended) and now - last_ended[0][1] < Config.INFRASTRUCTURE_COOLDOWN
+
+    return dict(in_flight=in_flight,
+                failure_rate=failed / float(len(ended_recently)) if ended_recently else 0.0,
+                ended_recently=len(ended_recently),
+                failed=failed,
+                healthy=not cooling_down)
+
+
+def pick(infrastructures, stats, location=None, exclude=()):
+    # type: (list, dict, str, tuple) -> Infrastructure
+    """
+    Returns the infrastructure with the lowest score, or None if every infrastructure is full, cooling down or
+    excluded, see SqliteInfrastructurePool.acquire
+    """
+
+    candidates = []
+    for infrastructure in infrastructures:
+        entry = stats[infrastructure.name]
+        if infrastructure.name in exclude or not entry['healthy'] or \
+                entry['in_flight'] >= infrastructure.max_in_flight:
+            continue
+
+        score = (entry['in_flight'] + 1) / infrastructure.weight
+        score *= 1 + FAILURE_RATE_PENALTY * entry['failed'] / float(entry['ended_recently'] + FAILURE_RATE_PRIOR)
+        if not is_local(infrastructure, location):
+            score *= Config.INFRASTRUCTURE_REMOTE_PENALTY
+        candidates.append((score, infrastructure))
+
+    return min(candidates, key=lambda candidate: candidate[0])[1] if candidates else None
+
+
+def utilization_of(infrastructures, stats):
+    # type: (list, dict) -> list
+    return [dict(stats[infrastructure.name],
+                 name=infrastructure.name,
+                 infrastructure_id=infrastructure.infrastructure_id,
+                 cloud_region=infrastructure.cloud_region,
+                 weight=infrastructure.weight,
+                 max_in_flight=infrastructure.max_in_flight,
+                 utilization=stats[infrastructure.name]['in_flight'] / float(infrastructure.max_in_flight))
+            for infrastructure in infrastructures]
+
+
+class SqliteInfrastructurePool(object):
+
+    def __init__(self, infrastructures, db_path):
+        # type: (list, str) -> None
+        self.infrastructures = list(infrastructures)
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def acquire(self, location=None, exclude=()):
+        # type: (str, tuple) -> (Infrastructure, int)
+        """
+        Picks the infrastructure with the lowest score and records an in-flight assignment on it.
+        Returns the infrastructure and the assignment ID, or (None, None) if every infrastructure is full, cooling
+        down or excluded.
+
+        :param location: GCS location of the input, see bucket_location
+        :param exclude: Names of infrastructures that already failed for this job
+        """
+
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            infrastructure = pick(self.infrastructures, self._stats(connection), location=location, exclude=exclude)
+            if infrastructure is None:
+                connection.execute("COMMIT")
+                return None, None
+
+            cursor = connection.execute("INSERT INTO assignments (infrastructure, state, started_at) VALUES (?, ?, ?)",
+                                        (infrastructure.name, RUNNING, time.time()))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        return infrastructure, cursor.lastrowid
+
+    def started(self, assignment_id, encoding_id):
+        # type: (int, str) -> None
+        self._connection().execute("UPDATE assignments SET encoding_id = ? WHERE id = ?", (encoding_id, assignment_id))
+
+    def reject(self, assignment_id):
+        # type: (int) -> None
+        """
+        Records that an infrastructure rejected or failed a job before the encoding was running
+        """
+
+        self._connection().execute("UPDATE assignments SET state = ?, ended_at = ? WHERE id = ?",
+                                   (REJECTED, time.time(), assignment_id))
+
+    def finish(self, encoding_id, state):
+        # type: (str, str) -> bool
+        """
+        Ends the in-flight assignment of an encoding as FINISHED or ERROR. Returns False if none matched.
+        """
+
+        cursor = self._connection().execute(
+            "UPDATE assignments SET state = ?, ended_at = ? WHERE encoding_id = ? AND state = ?",
+            (state, time.time(), encoding_id, RUNNING))
+        return cursor.rowcount > 0
+
+    def utilization(self):
+        # type: () -> list
+        """
+        Returns in-flight encodings, capacity, failure rate and health of every infrastructure
+        """
+
+        return utilization_of(self.infrastructures, self._stats(self._connection()))
+
+    def _stats(self, connection):
+        now = time.time()
+        # Assignments whose webhook never arrived stop counting as in flight after INFRASTRUCTURE_ASSIGNMENT_TTL
+        in_flight = dict(connection.execute(
+            "SELECT infrastructure, COUNT(*) FROM assignments WHERE state = ? AND started_at >= ? "
+            "GROUP BY infrastructure", (RUNNING, now - Config.INFRASTRUCTURE_ASSIGNMENT_TTL)).fetchall())
+
+        ended = dict()
+        for name, state in connection.execute(
+                "SELECT infrastructure, state FROM assignments WHERE state != ? AND ended_at >= ?",
+                (RUNNING, now - Config.INFRASTRUCTURE_FAILURE_WINDOW)):
+            ended.setdefault(name, list()).append(state)
+
+        stats = dict()
+        for infrastructure in self.infrastructures:
+            last_ended = connection.execute(
+                "SELECT state, ended_at FROM assignments WHERE infrastructure = ? AND state != ? "
+                "ORDER BY ended_at DESC LIMIT ?",
+                (infrastructure.name, RUNNING, Config.INFRASTRUCTURE_MAX_CONSECUTIVE_FAILURES)).fetchall()
+            stats[infrastructure.name] = stats_of(in_flight=in_flight.get(infrastructure.name, 0),
+                                                  ended_recently=ended.get(infrastructure.name, []),
+                                                  last_ended=last_ended,
+                                                  now=now)
+        return stats
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_SCHEMA)
+            self._local.connection = connection
+        return connection
+
+
+class FirestoreInfrastructurePool(object):
+    """
+    Keeps every assignment in a document of <FIRESTORE_COLLECTION_PREFIX><collection_name>. Acquiring reads the
+    running and recently ended assignments of all infrastructures in one transaction; the last ended assignments of
+    an infrastructure need a composite index on (infrastructure, ended_at descending).
+    """
+
+    def __init__(self, infrastructures, collection_name):
+        # type: (list, str) -> None
+        self.infrastructures = list(infrastructures)
+        self.collection_name = collection_name
+
+    def acquire(self, location=None, exclude=()):
+        # type: (str, tuple) -> (Infrastructure, str)
+        """
+        Picks the infrastructure with the lowest score and records an in-flight assignment on it, see
+        SqliteInfrastructurePool.acquire
+        """
+
+        assignments = self._assignments()
+
+        def acquire_in(transaction):
+            infrastructure = pick(self.infrastructures, self._stats(transaction.get), location=location,
+                                  exclude=exclude)
+            if infrastructure is None:
+                return None, None
+
+            # ended_at is only set once the assignment ends, assignments without it are not ordered by it
+            reference = assignments.document()
+            transaction.create(reference, dict(infrastructure=infrastructure.name, encoding_id=None, state=RUNNING,
+                                               started_at=time.time()))
+            return infrastructure, reference.id
+
+        return Firestore.run_transaction(acquire_in)
+
+    def started(self, assignment_id, encoding_id):
+        # type: (str, str) -> None
+        self._assignments().document(assignment_id).update(dict(encoding_id=encoding_id))
+
+    def reject(self, assignment_id):
+        # type: (str) -> None
+        self._assignments().document(assignment_id).update(dict(state=REJECTED, ended_at=time.time()))
+
+    def finish(self, encoding_id, state):
+        # type: (str, str) -> bool
+        """
+        Ends the in-flight assignment of an encoding as FINISHED or ERROR. Returns False if none matched.
+        """
+
+        running = self._assignments().where(filter=self._field("encoding_id", encoding_id)).where(
+            filter=self._field("state", RUNNING))
+
+        def finish_in(transaction):
+            matches = list(transaction.get(running))
+            for snapshot in matches:
+                transaction.update(snapshot.reference, dict(state=state, ended_at=time.time()))
+            return len(matches) > 0
+
+        return Firestore.run_transaction(finish_in)
+
+    def utilization(self):
+        # type: () -> list
+        """
+        Returns in-flight encodings, capacity, failure rate and health of every infrastructure
+        """
+
+        return utilization_of(self.infrastructures, self._stats(lambda query: query.stream()))
+
+    def _stats(self, read):
+        from google.cloud import firestore
+
+        now = time.time()
+        assignments = self._assignments()
+
+        # Assignments whose webhook never arrived stop counting as in flight after INFRASTRUCTURE_ASSIGNMENT_TTL
+        in_flight = dict()
+        for snapshot in read(assignments.where(filter=self._field("state", RUNNING))):
+            if snapshot.get('started_at') >= now - Config.INFRASTRUCTURE_ASSIGNMENT_TTL:
+                name = snapshot.get('infrastructure')
+                in_flight[name] = in_flight.get(name, 0) + 1
+
+        ended = dict()
+        for snapshot in read(assignments.where(
+                filter=self._field("ended_at", now - Config.INFRASTRUCTURE_FAILURE_WINDOW, op=">="))):
+            ended.setdefault(snapshot.get('infrastructure'), list()).append(snapshot.get('state'))
+
+        stats = dict()
+        for infrastructure in self.infrastructures:
+            last_ended = [(snapshot.get('state'), snapshot.get('ended_at')) for snapshot in read(
+                assignments.where(filter=self._field("infrastructure", infrastructure.name))
+                .order_by("ended_at", direction=firestore.Query.DESCENDING)
+                .limit(Config.INFRASTRUCTURE_MAX_CONSECUTIVE_FAILURES))]
+            stats[infrastructure.name] = stats_of(in_flight=in_flight.get(infrastructure.name, 0),
+                                                  ended_recently=ended.get(infrastructure.name, []),
+                                                  last_ended=last_ended,
+                                                  now=now)
+        return stats
+
+    def _assignments(self):
+        return Firestore.collection(self.collection_name)
+
+    @staticmethod
+    def _field(name, value, op="=="):
+        from google.cloud.firestore import FieldFilter
+        return FieldFilter(name, op, value)
+
+
+def submit_with_failover(location, submit):
+    # type: (str, callable) -> str
+    """
+    Runs submit(infrastructure) on the best infrastructure of the pool and fails over to the next one if it raises,
+    up to INFRASTRUCTURE_FAILOVER_ATTEMPTS infrastructures. Returns the encoding IDs returned by submit.
+
+    :param location: GCS location of the input, see bucket_location
+    :param submit: Creates and starts the encodings of a job on the given Infrastructure, returns their IDs
+    """
+
+    infrastructure_pool = init_pool()
+    tried = []
+    last_error = None
+
+    while len(tried) < Config.INFRASTRUCTURE_FAILOVER_ATTEMPTS:
+        infrastructure, assignment_id = infrastructure_pool.acquire(location=location, exclude=tried)
+        if infrastructure is None:
+            break
+
+        try:
+            encoding_ids = submit(infrastructure)
+        except Exception as e:
+            print("Infrastructure {} failed, failing over: {}".format(infrastructure.name, e))
+            infrastructure_pool.reject(assignment_id)
+            tried.append(infrastructure.name)
+            last_error = e
+            continue
+
+        # A job holds one slot of the infrastructure, tracked through its first encoding
+        infrastructure_pool.started(assignment_id, encoding_ids[0])
+        print(json.dumps(dict(message="infrastructure utilization", assigned=infrastructure.name,
+                              infrastructures=infrastructure_pool.utilization())))
+        return encoding_ids
+
+    if last_error is not None:
+        raise last_error
+    raise Exception("No infrastructure of the pool has capacity left (tried: {})".format(tried))
@@ -0,0 +1,57 @@
+from collections import namedtuple
+from os import path
+from types import MappingProxyType
+
+import utils as Utils
+
+"""
+Per-request context of an encoding job.
+
+<p>Everything that identifies a job (the asset, its ladder profile and renditions, the input and output paths, the
+encoding name and the infrastructure) is derived once from the upload event and passed to every builder explicitly.
+No job state is kept in modules (as Config.ASSET_NAME used to be), so one instance can serve several uploads
+concurrently without mixing up their outputs.
+
+<p>The context is an immutable namedtuple with read-only renditions. Variants, e.g. for the infrastructure picked by
+the pool or the output folder of a split chunk, are derived with _replace.
+"""
+
+JobContext = namedtuple('JobContext', ['asset_name', 'bucket', 'profile_name', 'video_ladder', 'audio_ladder',
+                                       'source_info', 'input_path', 'output_root', 'encoding_name',
+                                       'infrastructure'])
+
+
+def create(event, profile_name, output_prefix, video_ladder, audio_ladder, source_info=None, name_prefix=""):
+    # type: (dict, str, str, list, list, SourceProbe.SourceInfo, str) -> JobContext
+    """
+    Builds the context of the job for an upload. The infrastructure is set once it has been picked.
+
+    :param event: The Cloud Storage event of the upload
+    :param profile_name: The ladder profile the upload was routed to
+    :param output_prefix: Prefix of the output root of the upload (see EVENT_RULES)
+    :param video_ladder: The (pruned) video renditions
+    :param audio_ladder: The (pruned) audio renditions
+    :param source_info: The probed source, None if it was not probed
+    :param name_prefix: Prefix of the encoding name, followed by the asset name
+    """
+
+    asset_name = event['name']
+    return JobContext(asset_name=asset_name,
+                      bucket=event.get('bucket'),
+                      profile_name=profile_name,
+                      video_ladder=tuple(MappingProxyType(dict(rendition)) for rendition in video_ladder),
+                      audio_ladder=tuple(MappingProxyType(dict(rendition)) for rendition in audio_ladder),
+                      source_info=source_info,
+                      input_path=Utils.build_absolute_input_path("", asset_name),
+                      output_root=output_root(output_prefix, asset_name),
+                      encoding_name=name_prefix + "-" + asset_name,
+                      infrastructure=None)
+
+
+def output_root(output_prefix, asset_name):
+    # type: (str, str) -> str
+    """
+    Returns the root of all outputs of an asset, relative to OUTPUT_BASE_PATH
+    """
+
+    return path.join(output_prefix, asset_name)
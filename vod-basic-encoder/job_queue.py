@@ -0,0 +1,419 @@
+import json
+import sqlite3
+import threading
+import time
+
+import config as Config
+import firestore_client as Firestore
+
+"""
+Persistent priority queue of encoding jobs.
+
+<p>Jobs move from QUEUED to RUNNING when the admission controller claims them and to FINISHED or ERROR when the
+encoding ends. Claims run in a transaction, so two invocations draining the queue at the same time can never admit
+more jobs than the quota allows.
+
+<p>A RUNNING job holds a lease: JOB_CLAIM_TTL seconds for the claiming invocation to start its encoding, then
+JOB_RUNNING_TTL seconds for the encoding to end. Leases are checked whenever a job is claimed:
+  <ul>
+   <li>a job whose encoding was never started (the invocation died after claiming it) goes back to QUEUED,
+   <li>a job whose finished or error webhook never arrived becomes EXPIRED.
+ </ul>
+Either way its footprint no longer counts against the quota.
+
+<p>A job may start several encodings, e.g. one per chunk of a split upload, and is admitted with their summed
+footprint. Every ended encoding releases its share of the footprint; the job ends with its last encoding, as ERROR if
+any of them failed.
+
+<p>FirestoreJobQueue keeps the jobs in Firestore, where every instance of the function sees them. SqliteJobQueue
+keeps them in an SQLite file, which only the instance that wrote it sees, for local runs.
+"""
+
+QUEUED = "QUEUED"
+RUNNING = "RUNNING"
+FINISHED = "FINISHED"
+ERROR = "ERROR"
+EXPIRED = "EXPIRED"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    priority INTEGER NOT NULL,
+    priority_class TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    footprint TEXT NOT NULL,
+    state TEXT NOT NULL,
+    encodings INTEGER NOT NULL DEFAULT 1,
+    enqueued_at REAL NOT NULL,
+    started_at REAL,
+    ended_at REAL,
+    lease_expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, priority, id);
+CREATE TABLE IF NOT EXISTS job_encodings (
+    encoding_id TEXT PRIMARY KEY,
+    job_id INTEGER NOT NULL,
+    state TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_encodings_by_job ON job_encodings (job_id, state);
+"""
+
+
+def summed_footprint(footprints):
+    # type: (list) -> dict
+    used = dict()
+    for footprint in footprints:
+        for resource, amount in footprint.items():
+            used[resource] = used.get(resource, 0) + amount
+    return used
+
+
+def held_footprint(footprint, encodings, ended):
+    # type: (dict, int, int) -> dict
+    """
+    Returns the share of a running job's footprint still held by its encodings that have not ended
+    """
+
+    share = float(max(0, encodings - ended)) / encodings
+    return dict((resource, amount * share) for resource, amount in footprint.items())
+
+
+def wait_metrics(waits):
+    # type: (list) -> dict
+    waits = sorted(waits)
+    return dict(wait_time_avg=sum(waits) / len(waits) if waits else 0.0,
+                wait_time_p95=waits[int(len(waits) * 0.95)] if waits else 0.0,
+                wait_time_max=waits[-1] if waits else 0.0)
+
+
+class SqliteJobQueue(object):
+
+    def __init__(self, db_path):
+        # type: (str) -> None
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def enqueue(self, payload, priority_class, priority, footprint, encodings=1):
+        # type: (dict, str, int, dict, int) -> int
+        """
+        Adds a job to the queue and returns its ID
+
+        :param payload: The upload event of the job
+        :param priority_class: Name of the priority class, e.g. rush or backlog
+        :param priority: Numeric priority of the class, lower values are admitted first
+        :param footprint: Quota footprint of all encodings of the job
+        :param encodings: Number of encodings the job starts
+        """
+
+        cursor = self._connection().execute(
+            "INSERT INTO jobs (priority, priority_class, payload, footprint, state, encodings, enqueued_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (priority, priority_class, json.dumps(payload), json.dumps(footprint), QUEUED, encodings, time.time()))
+        return cursor.lastrowid
+
+    def claim_next(self, admit):
+        # type: (callable) -> dict
+        """
+        Claims the queued job with the highest priority if admit(used, footprint) allows it, where used is the summed
+        footprint still held by all running jobs. Returns the claimed job or None.
+        """
+
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            started_at = time.time()
+            self._expire_leases(connection, started_at)
+
+            row = connection.execute(
+                "SELECT id, priority_class, payload, footprint, enqueued_at FROM jobs "
+                "WHERE state = ? ORDER BY priority, id LIMIT 1", (QUEUED,)).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+
+            footprint = json.loads(row[3])
+            if not admit(self._used_footprint(connection), footprint):
+                connection.execute("COMMIT")
+                return None
+
+            connection.execute("UPDATE jobs SET state = ?, started_at = ?, lease_expires_at = ? WHERE id = ?",
+                               (RUNNING, started_at, started_at + Config.JOB_CLAIM_TTL, row[0]))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        return dict(id=row[0], priority_class=row[1], payload=json.loads(row[2]), footprint=footprint,
+                    enqueued_at=row[4], started_at=started_at)
+
+    def set_encoding_ids(self, job_id, encoding_ids):
+        # type: (int, list) -> None
+        """
+        Records the encodings started for a claimed job, which extends its lease to JOB_RUNNING_TTL
+        """
+
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany("INSERT INTO job_encodings (encoding_id, job_id, state) VALUES (?, ?, ?)",
+                                   [(encoding_id, job_id, RUNNING) for encoding_id in encoding_ids])
+            connection.execute("UPDATE jobs SET lease_expires_at = ? WHERE id = ?",
+                               (time.time() + Config.JOB_RUNNING_TTL, job_id))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def finish(self, state, job_id=None, encoding_id=None):
+        # type: (str, int, str) -> bool
+        """
+        Marks a running job, or one encoding of a running job, as FINISHED or ERROR, which releases its footprint or
+        the share of the encoding. Returns False if no running job matched.
+        """
+
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if job_id is None:
+                row = connection.execute(
+                    "SELECT e.job_id FROM job_encodings e JOIN jobs j ON j.id = e.job_id "
+                    "WHERE e.encoding_id = ? AND e.state = ? AND j.state = ?",
+                    (encoding_id, RUNNING, RUNNING)).fetchone()
+                job_id = row[0] if row is not None else None
+                if job_id is not None:
+                    connection.execute("UPDATE job_encodings SET state = ? WHERE encoding_id = ?",
+                                       (state, encoding_id))
+                    states = [row[0] for row in connection.execute(
+                        "SELECT state FROM job_encodings WHERE job_id = ?", (job_id,))]
+                    if RUNNING in states:
+                        connection.execute("COMMIT")
+                        return True
+                    state = ERROR if ERROR in states else state
+
+            matched = job_id is not None and connection.execute(
+                "UPDATE jobs SET state = ?, ended_at = ? WHERE id = ? AND state = ?",
+                (state, time.time(), job_id, RUNNING)).rowcount > 0
+            if matched:
+                connection.execute("UPDATE job_encodings SET state = ? WHERE job_id = ? AND state = ?",
+                                   (state, job_id, RUNNING))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        return matched
+
+    def metrics(self, window=3600):
+        # type: (int) -> dict
+        """
+        Returns queue depth per priority class, the number of running jobs, the summed footprint they hold and the wait
+        times of the jobs started within the last window seconds
+        """
+
+        connection = self._connection()
+        now = time.time()
+
+        depth = dict(connection.execute(
+            "SELECT priority_class, COUNT(*) FROM jobs WHERE state = ? GROUP BY priority_class", (QUEUED,)).fetchall())
+        oldest = connection.execute("SELECT MIN(enqueued_at) FROM jobs WHERE state = ?", (QUEUED,)).fetchone()[0]
+        waits = [row[0] for row in connection.execute(
+            "SELECT started_at - enqueued_at FROM jobs WHERE started_at >= ?", (now - window,))]
+        running = connection.execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (RUNNING,)).fetchone()[0]
+
+        return dict(queue_depth=depth,
+                    running=running,
+                    used_footprint=self._used_footprint(connection),
+                    oldest_queued_age=now - oldest if oldest is not None else 0.0,
+                    **wait_metrics(waits))
+
+    def _expire_leases(self, connection, now):
+        requeued = connection.execute(
+            "UPDATE jobs SET state = ?, started_at = NULL, lease_expires_at = NULL "
+            "WHERE state = ? AND lease_expires_at < ? AND id NOT IN (SELECT job_id FROM job_encodings)",
+            (QUEUED, RUNNING, now)).rowcount
+        expired = connection.execute(
+            "UPDATE jobs SET state = ?, ended_at = ? "
+            "WHERE state = ? AND lease_expires_at < ? AND id IN (SELECT job_id FROM job_encodings)",
+            (EXPIRED, now, RUNNING, now)).rowcount
+        if requeued or expired:
+            print("Requeued {} jobs whose encoding was never started, expired {} jobs without an ended webhook".format(
+                requeued, expired))
+
+    def _used_footprint(self, connection):
+        rows = connection.execute(
+            "SELECT footprint, encodings, "
+            "(SELECT COUNT(*) FROM job_encodings e WHERE e.job_id = jobs.id AND e.state != ?) "
+            "FROM jobs WHERE state = ?", (RUNNING, RUNNING))
+        return summed_footprint(held_footprint(json.loads(footprint), encodings, ended)
+                                for footprint, encodings, ended in rows)
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_SCHEMA)
+            self._local.connection = connection
+        return connection
+
+
+class FirestoreJobQueue(object):
+    """
+    Keeps every job in a document of <FIRESTORE_COLLECTION_PREFIX><collection_name>. Claiming reads the best queued
+    job and all running jobs in one transaction, which needs a composite index on (state, priority, enqueued_at).
+    """
+
+    def __init__(self, collection_name):
+        # type: (str) -> None
+        self.collection_name = collection_name
+
+    def enqueue(self, payload, priority_class, priority, footprint, encodings=1):
+        # type: (dict, str, int, dict, int) -> str
+        """
+        Adds a job to the queue and returns its ID, see SqliteJobQueue.enqueue
+        """
+
+        _, reference = self._jobs().add(dict(priority=priority,
+                                             priority_class=priority_class,
+                                             payload=json.dumps(payload),
+                                             footprint=json.dumps(footprint),
+                                             state=QUEUED,
+                                             encodings=encodings,
+                                             encoding_ids=None,
+                                             ended_encoding_ids=[],
+                                             failed=False,
+                                             enqueued_at=time.time(),
+                                             started_at=None,
+                                             ended_at=None,
+                                             lease_expires_at=None))
+        return reference.id
+
+    def claim_next(self, admit):
+        # type: (callable) -> dict
+        """
+        Claims the queued job with the highest priority if admit(used, footprint) allows it, see
+        SqliteJobQueue.claim_next
+        """
+
+        jobs = self._jobs()
+        best = jobs.where(filter=self._is(QUEUED)).order_by("priority").order_by("enqueued_at").limit(1)
+
+        def claim_in(transaction):
+            # Firestore transactions read everything before they write
+            queued = list(transaction.get(best))
+            running = list(transaction.get(jobs.where(filter=self._is(RUNNING))))
+
+            started_at = time.time()
+            used = list()
+            requeued = list()
+            for snapshot in running:
+                job = snapshot.to_dict()
+                if job['lease_expires_at'] >= started_at:
+                    used.append(self._held_footprint(job))
+                elif not job['encoding_ids']:
+                    # Back in the queue, and a candidate of this claim as in SqliteJobQueue
+                    requeued.append(snapshot)
+                else:
+                    transaction.update(snapshot.reference, dict(state=EXPIRED, ended_at=started_at))
+
+            claimed = None
+            candidates = sorted(queued + requeued,
+                                key=lambda snapshot: (snapshot.get('priority'), snapshot.get('enqueued_at')))
+            if candidates:
+                job = candidates[0].to_dict()
+                footprint = json.loads(job['footprint'])
+                if admit(summed_footprint(used), footprint):
+                    claimed = candidates[0]
+
+            # A transaction writes every document once
+            for snapshot in requeued:
+                if claimed is None or snapshot.id != claimed.id:
+                    transaction.update(snapshot.reference, dict(state=QUEUED, started_at=None, lease_expires_at=None))
+            if claimed is None:
+                return None
+
+            transaction.update(claimed.reference, dict(state=RUNNING, started_at=started_at,
+                                                       lease_expires_at=started_at + Config.JOB_CLAIM_TTL))
+            return dict(id=claimed.id, priority_class=job['priority_class'], payload=json.loads(job['payload']),
+                        footprint=footprint, enqueued_at=job['enqueued_at'], started_at=started_at)
+
+        return Firestore.run_transaction(claim_in)
+
+    def set_encoding_ids(self, job_id, encoding_ids):
+        # type: (str, list) -> None
+        self._jobs().document(job_id).update(dict(encoding_ids=list(encoding_ids),
+                                                  lease_expires_at=time.time() + Config.JOB_RUNNING_TTL))
+
+    def finish(self, state, job_id=None, encoding_id=None):
+        # type: (str, str, str) -> bool
+        """
+        Marks a running job, or one encoding of a running job, as FINISHED or ERROR, see SqliteJobQueue.finish
+        """
+
+        jobs = self._jobs()
+
+        def finish_in(transaction):
+            if job_id is not None:
+                snapshot = jobs.document(job_id).get(transaction=transaction)
+                if not snapshot.exists or snapshot.get('state') != RUNNING:
+                    return False
+                transaction.update(snapshot.reference, dict(state=state, ended_at=time.time()))
+                return True
+
+            matched = False
+            for snapshot in transaction.get(jobs.where(filter=self._is(RUNNING)).where(
+                    filter=self._field("encoding_ids", encoding_id, op="array_contains"))):
+                job = snapshot.to_dict()
+                if encoding_id in job['ended_encoding_ids']:
+                    continue
+                ended = job['ended_encoding_ids'] + [encoding_id]
+                failed = job['failed'] or state == ERROR
+                update = dict(ended_encoding_ids=ended, failed=failed)
+                if len(ended) >= len(job['encoding_ids']):
+                    update.update(state=ERROR if failed else state, ended_at=time.time())
+                transaction.update(snapshot.reference, update)
+                matched = True
+            return matched
+
+        return Firestore.run_transaction(finish_in)
+
+    def metrics(self, window=3600):
+        # type: (int) -> dict
+        """
+        Returns queue depth per priority class, the number of running jobs, the summed footprint they hold and the wait
+        times of the jobs started within the last window seconds
+        """
+
+        jobs = self._jobs()
+        now = time.time()
+
+        queued = [snapshot.to_dict() for snapshot in jobs.where(filter=self._is(QUEUED)).stream()]
+        running = [snapshot.to_dict() for snapshot in jobs.where(filter=self._is(RUNNING)).stream()]
+        started = jobs.where(filter=self._field("started_at", now - window, op=">=")).stream()
+
+        depth = dict()
+        for job in queued:
+            depth[job['priority_class']] = depth.get(job['priority_class'], 0) + 1
+        oldest = min(job['enqueued_at'] for job in queued) if queued else None
+
+        return dict(queue_depth=depth,
+                    running=len(running),
+                    used_footprint=summed_footprint(self._held_footprint(job) for job in running),
+                    oldest_queued_age=now - oldest if oldest is not None else 0.0,
+                    **wait_metrics([snapshot.get('started_at') - snapshot.get('enqueued_at') for snapshot in started]))
+
+    def _jobs(self):
+        return Firestore.collection(self.collection_name)
+
+    @staticmethod
+    def _held_footprint(job):
+        return held_footprint(json.loads(job['footprint']), job['encodings'], len(job['ended_encoding_ids']))
+
+    def _is(self, state):
+        return self._field("state", state)
+
+    @staticmethod
+    def _field(name, value, op="=="):
+        from google.cloud.firestore import FieldFilter
+        return FieldFilter(name, op, value)
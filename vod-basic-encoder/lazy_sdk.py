@@ -0,0 +1,82 @@
+import importlib
+import threading
+
+"""
+Deferred loading of the Bitmovin API SDK.
+
+<p>Importing bitmovin_api_sdk imports every API and model module of the SDK, which takes most of the cold start of
+the function. Invocations that never call the API (ignored uploads, suppressed duplicates, queued jobs, quota
+releases) should not pay for it, so the SDK is only imported when a model or the client is first used:
+  <ul>
+   <li>Sdk.Encoding, Sdk.Status, ... resolve to the SDK classes, importing the SDK on first access.
+   <li>LazyClient builds the BitmovinApi client on first use of one of its attributes. Attributes taken from it
+       before that (e.g. encoding_api = bitmovin_api.encoding at module level) are deferred as well.
+ </ul>
+"""
+
+SDK_MODULE = "bitmovin_api_sdk"
+
+
+class LazyModule(object):
+    """
+    Stands in for a module that is imported on first attribute access
+    """
+
+    def __init__(self, name):
+        # type: (str) -> None
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Imports the module now, e.g. to warm up an instance before its first request
+        """
+
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def loaded(self):
+        # type: () -> bool
+        return self._module is not None
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+
+class LazyClient(object):
+    """
+    Stands in for an object that is created by factory() on first use. Attributes taken before that are deferred,
+    attributes taken afterwards are those of the created object.
+    """
+
+    def __init__(self, factory):
+        # type: (callable) -> None
+        self._factory = factory
+        self._target = None
+        self._lock = threading.Lock()
+
+    def resolve(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._factory()
+        return self._target
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if self._target is not None:
+            return getattr(self._target, name)
+        return LazyClient(lambda: getattr(self.resolve(), name))
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+
+Sdk = LazyModule(SDK_MODULE)
@@ -1,114 +1,718 @@
-import time
+from lazy_sdk import Sdk
 
-from bitmovin_api_sdk import AacAudioConfiguration, MuxingStream, PresetConfiguration, \
-    Encoding, Mp4Muxing, H264VideoConfiguration, FragmentedMp4MuxingManifestType, \
-    Status, Stream, StreamInput, ProfileH264, TsMuxing, InfrastructureSettings, CloudRegion, GceAccount
+import json
 
+from concurrent.futures import ThreadPoolExecutor
 from os import path
 
 import utils as Utils
 import config as Config
+import config_registry as ConfigRegistry
+import encoding_graph as EncodingGraph
+import bootstrap as Bootstrap
+import source_probe as SourceProbe
+import admission as Admission
+import job_queue as JobQueue
+import event_rules as EventRules
+import poller as Poller
+import encoding_template as EncodingTemplate
+import dedupe as Dedupe
+import ledger as Ledger
+import split_encode as SplitEncode
+import infrastructure_pool as InfrastructurePool
+import job_context as JobContext
+import instrumentation as Instrumentation
+import pagination as Pagination
 
 """
-This example demonstrates how to create H264 video and AAC encoded output with MP4 and MPEG2 TS muxings.
+This example demonstrates how to create H264 video and AAC encoded output with MP4 and MPEG2 TS muxings,
+or with a single fragmented MP4 (CMAF) muxing per stream.
 
 """
 
 EXAMPLE_NAME = "SonyLIVEncodingVODPreset"
 EXAMPLE_DESCRIPTION = "Basic encoding example for SonyLIV with Preset VOD configuration"
 
+# H.264 renditions of the ladder, from the highest to the lowest quality. Profiles are ProfileH264 names.
+VIDEO_LADDER = [
+    dict(height=1080, width=1980, bitrate=3500000, profile="HIGH"),
+    dict(height=720, width=1280, bitrate=2000000, profile="HIGH"),
+    dict(height=720, width=1280, bitrate=1200000, profile="MAIN"),
+    dict(height=540, width=960, bitrate=900000, profile="MAIN"),
+    dict(height=360, width=640, bitrate=664000, profile="BASELINE"),
+    dict(height=288, width=512, bitrate=412000, profile="BASELINE"),
+    dict(height=216, width=384, bitrate=224000, profile="BASELINE")
+]
+
+# AAC renditions of the ladder
+AUDIO_LADDER = [
+    dict(bitrate=256000),
+    dict(bitrate=128000),
+    dict(bitrate=96000),
+    dict(bitrate=64000)
+]
+
+# Segment length of the segmented (TS and fragmented MP4) muxings in seconds
+SEGMENT_LENGTH = 4.0
+
+# RFC 6381 codec strings of the H.264 profiles, used in the manifests of split encodings
+H264_CODECS = dict(HIGH="avc1.640028", MAIN="avc1.4d401f", BASELINE="avc1.42c01e")
+AAC_CODEC = "mp4a.40.2"
+
+# Ladder profiles upload events can be routed to by EVENT_RULES
+LADDER_PROFILES = dict(
+    default=dict(video=VIDEO_LADDER, audio=AUDIO_LADDER),
+    preview=dict(video=VIDEO_LADDER[-3:], audio=AUDIO_LADDER[-1:])
+)
+
+event_matcher = EventRules.compile_rules(Config.EVENT_RULES, profiles=LADDER_PROFILES,
+                                         priority_classes=Config.JOB_PRIORITY_CLASSES)
+
+# Encoding templates only declare the encoding, its streams and muxings (see encoding_template.py), so the default
+# manifests of MANIFEST_GENERATION "START" would silently be missing
+if Config.SUBMISSION_MODE == "TEMPLATE" and Config.MANIFEST_GENERATION == "START":
+    raise ValueError('MANIFEST_GENERATION "START" requires SUBMISSION_MODE "GRAPH", use MANIFEST_GENERATION "WEBHOOK" '
+                     'with SUBMISSION_MODE "TEMPLATE"')
+
 bitmovin_api = Utils.init_bitmovin_api()
 encoding_api = bitmovin_api.encoding
+if Config.HTTP_WARM_UP_AT_START:
+    Utils.warm_up_bitmovin_api()
 
+@Instrumentation.instrumented
 def encoding_h264_vod_preset(event, context):
     """Triggered by a change to a Cloud Storage bucket.
     Args:
          event (dict): Event payload.
          context (google.cloud.functions.Context): Metadata for the event.
     """
-    file = event
-    Config.ASSET_NAME=file['name']
-    #print("Encoding Input Asset: ", Config.ASSET_NAME):
+    route = event_matcher.route(event)
+    if not route.accepted:
+        print("Ignoring upload {} (rule: {})".format(event.get('name'), route.rule))
+        return
+
+    if Config.DEDUPE_ENABLED and _suppress_duplicate(
+            event=event, output_root=JobContext.output_root(route.output_prefix, event['name'])):
+        return
+
+    if Config.ADMISSION_CONTROL_ENABLED:
+        if Config.DEDUPE_ENABLED:
+            # The content claim must not expire while the job waits for quota, however long that takes
+            Dedupe.init_dedupe_store().hold_content(event)
+        Admission.submit(event=event, start_job=_start_encoding, priority_class=route.priority_class,
+                         encodings=_planned_encodings(event))
+        return
+
+    _start_encoding(event=event)
+
+
+@Instrumentation.instrumented
+def release_encoding_quota(request):
+    """Responds to the finished and error webhooks of encodings started through the job queue or the infrastructure pool,
+    or with duplicate suppression. Releases the quota footprint and the in-flight slot of the encoding, drops the
+    content claim of a failed encoding and starts queued jobs that fit into the freed quota.
+    Args:
+        request (flask.Request): HTTP request object.
+    Returns:
+        OK status
+    """
+    request_json = request.get_json(silent=True) or dict()
+    event_type = request_json.get('eventType')
+    encoding_id = (request_json.get('encoding') or dict()).get('id')
+
+    if not encoding_id or event_type not in ("ENCODING_FINISHED", "ENCODING_ERROR"):
+        print("Ignoring webhook {}".format(request_json))
+        return "OK"
+
+    state = JobQueue.FINISHED if event_type == "ENCODING_FINISHED" else JobQueue.ERROR
+    Ledger.record_status(encoding_id=encoding_id, status=state)
+
+    if Config.INFRASTRUCTURE_POOL:
+        InfrastructurePool.init_pool().finish(encoding_id=encoding_id, state=state)
+
+    if Config.DEDUPE_ENABLED and state == JobQueue.ERROR:
+        # The next upload of the content is encoded instead of being served the outputs of the failed encoding
+        Dedupe.init_dedupe_store().release_encoding(encoding_id)
+
+    if not Config.ADMISSION_CONTROL_ENABLED:
+        return "OK"
+
+    Admission.release(encoding_id=encoding_id, state=state, start_job=_start_encoding)
+    return "OK"
+
+
+def infrastructure_utilization(request):
+    """Reports the in-flight encodings, capacity, failure rate and health of every infrastructure of the pool.
+    Args:
+        request (flask.Request): HTTP request object.
+    Returns:
+        JSON list with one entry per infrastructure
+    """
+    return json.dumps(InfrastructurePool.init_pool().utilization())
+
+
+def api_metrics(request):
+    """Reports the latency histograms, calls, errors, retries and payload sizes of the Bitmovin API calls of this
+    instance per endpoint.
+    Args:
+        request (flask.Request): HTTP request object.
+    Returns:
+        The metrics in the OpenMetrics text format
+    """
+    return Instrumentation.init_metrics().render_openmetrics(), 200, {'Content-Type': Instrumentation.CONTENT_TYPE}
+
+
+def _suppress_duplicate(event, output_root):
+    # type: (dict, str) -> bool
+    """
+    Claims the event and the content of an upload. Returns True if the upload needs no encoding, because the event
+    is a redelivery or the same content was already claimed by another upload (whose outputs are then served for
+    this upload as well).
+
+    :param event: The Cloud Storage event of the upload
+    :param output_root: The output root of the upload, relative to OUTPUT_BASE_PATH
+    """
+    store = Dedupe.init_dedupe_store()
+
+    if not store.claim_event(event):
+        print("Ignoring redelivered event for {} (generation {})".format(event['name'], event.get('generation')))
+        return True
+
+    original = store.claim_content(event, output_root=output_root)
+    if original is None:
+        return False
+
+    if original.asset_name == event['name'] and original.output_root == output_root:
+        # The object was uploaded again with the same content, its outputs are already where they belong
+        print("Upload {} has the same content as before, keeping the outputs of encoding {}".format(
+            event['name'], original.encoding_id))
+        return True
+
+    encoding_finished = original.encoding_id is not None and Poller.status_of(
+        encoding_api.encodings.status(encoding_id=original.encoding_id)) == "FINISHED"
+    action = Dedupe.serve_duplicate(original, output_root=output_root, encoding_finished=encoding_finished)
+    print("Upload {} has the same content as {}, outputs served by {} instead of encoding".format(
+        event['name'], original.asset_name, action))
+    return True
+
+
+def _start_encoding(event):
+    # type: (dict) -> list
+    """
+    Submits the encoding of an upload and records it for the content of the upload. Returns the IDs of the started
+    encodings, one per chunk of a split upload. If the submission fails, the claims of the upload are released so a
+    redelivery of the event can try again.
+
+    :param event: The Cloud Storage event of the upload
+    """
+    try:
+        encoding_ids = _submit_encoding(event=event)
+    except Exception:
+        if Config.DEDUPE_ENABLED:
+            Dedupe.init_dedupe_store().release(event)
+        raise
+
+    encoding_id = encoding_ids[0]
+    if Config.DEDUPE_ENABLED and not Dedupe.init_dedupe_store().confirm_content(event, encoding_id=encoding_id):
+        print("The content claim of {} was taken over by another upload, the content may be encoded twice".format(
+            event['name']))
+    Ledger.record_started(asset_name=event['name'], codec_type="h264", encoding_id=encoding_id)
+    return encoding_ids
+
+
+def _planned_encodings(event):
+    # type: (dict) -> int
+    """
+    Returns the number of encodings an upload starts: one per chunk if its source is long enough to be split,
+    otherwise one. Probes the source only with SPLIT_ENCODING_ENABLED.
+
+    :param event: The Cloud Storage event of the upload
+    """
+
+    if not Config.SPLIT_ENCODING_ENABLED:
+        return 1
+
+    source_info = _probe_source(event)
+    return len(_plan_chunks(source_info)) if SplitEncode.should_split(source_info) else 1
+
+
+def _submit_encoding(event):
+    # type: (dict) -> list
+    """
+    Builds and starts the encoding for an uploaded file and returns the IDs of the encodings, one per chunk of a split
+    upload. All state of the job is kept in its JobContext, so concurrent calls for different uploads do not
+    interfere.
+
+    :param event: The Cloud Storage event of the upload
+    """
+    route = event_matcher.route(event)
+    profile = LADDER_PROFILES[route.profile]
+
+    video_ladder, audio_ladder, source_info = _select_ladder(event=event,
+                                                             video_ladder=profile['video'],
+                                                             audio_ladder=profile['audio'])
+
+    context = JobContext.create(event=event,
+                                profile_name=route.profile,
+                                output_prefix=route.output_prefix,
+                                video_ladder=video_ladder,
+                                audio_ladder=audio_ladder,
+                                source_info=source_info,
+                                name_prefix=EXAMPLE_NAME)
+
+    def submit_to(infrastructure):
+        return _submit_to_infrastructure(context=context._replace(infrastructure=infrastructure))
+
+    if Config.INFRASTRUCTURE_POOL and not route.infrastructure_id:
+        # The pool picks the infrastructure per job and fails over to the next one if it rejects the encoding
+        return InfrastructurePool.submit_with_failover(
+            location=InfrastructurePool.bucket_location(event['bucket']),
+            submit=lambda pooled: submit_to(Sdk.InfrastructureSettings(
+                cloud_region=Sdk.CloudRegion[pooled.cloud_region],
+                infrastructure_id=pooled.infrastructure_id)))
 
     #gce_account = Utils.create_gce_account()
-    infrastructure = InfrastructureSettings(
-        cloud_region=CloudRegion[Config.CLOUD_REGION],
-        infrastructure_id=Config.GCE_ACCOUNT_ID
-    )
+    return submit_to(Sdk.InfrastructureSettings(
+        cloud_region=Sdk.CloudRegion[Config.CLOUD_REGION],
+        infrastructure_id=route.infrastructure_id or Config.GCE_ACCOUNT_ID
+    ))
 
-    encoding = _create_encoding_external_gce_infra(
-        name=EXAMPLE_NAME + "-" + Config.ASSET_NAME,
-        description=EXAMPLE_DESCRIPTION,
-        infra=infrastructure
-    )
 
-    input = Utils.get_gcs_input(reuse_existing=False)
-    input_file_path = Utils.build_absolute_input_path("", Config.ASSET_NAME);
-    output = Utils.get_gcs_output(reuse_existing=False)
+def _submit_to_infrastructure(context):
+    # type: (JobContext.JobContext) -> list
+    """
+    Builds and starts the encoding of an upload on the infrastructure of its context and returns the IDs of the
+    encodings, one per chunk of a split upload
+
+    :param context: The job, with the infrastructure to run the encoding on
+    """
+
+    if SplitEncode.should_split(context.source_info):
+        return _submit_split_encoding(context=context)
+
+    if Config.SUBMISSION_MODE == "TEMPLATE":
+        return [_submit_encoding_template(context=context)]
+
+    graph = EncodingGraph.EncodingGraph(max_workers=Config.ENCODING_GRAPH_MAX_WORKERS)
+    manifests_at_start = Config.MANIFEST_GENERATION == "START"
+
+    # With WEBHOOK_SCOPE "ORGANIZATION" the manifest generator is notified of every encoding; the custom data tells
+    # it the manifests of this one are written by the encoding itself
+    graph.add("encoding",
+              lambda: _create_encoding_external_gce_infra(name=context.encoding_name,
+                                                          description=EXAMPLE_DESCRIPTION,
+                                                          infra=context.infrastructure,
+                                                          custom_data=dict(manifests_at_start=True)
+                                                          if manifests_at_start else None),
+              rollback=lambda encoding: encoding_api.encodings.delete(encoding_id=encoding.id))
+    if Config.BOOTSTRAP_ENABLED:
+        graph.add("input", Bootstrap.get_input)
+        graph.add("output", Bootstrap.get_output)
+    else:
+        graph.add("input", lambda: Utils.get_gcs_input(reuse_existing=False))
+        graph.add("output", lambda: Utils.get_gcs_output(reuse_existing=False))
 
     # Add H.264 video streams to the encoding
-    video_configurations = [
-        _create_h264_video_configuration(height=1080, width=1980, bitrate=3500000, profile=ProfileH264.HIGH),
-        _create_h264_video_configuration(height=720, width=1280, bitrate=2000000, profile=ProfileH264.HIGH),
-        _create_h264_video_configuration(height=720, width=1280, bitrate=1200000, profile=ProfileH264.MAIN),
-        _create_h264_video_configuration(height=540, width=960, bitrate=900000, profile=ProfileH264.MAIN),
-        _create_h264_video_configuration(height=360, width=640, bitrate=664000, profile=ProfileH264.BASELINE),
-        _create_h264_video_configuration(height=288, width=512, bitrate=412000, profile=ProfileH264.BASELINE),
-        _create_h264_video_configuration(height=216, width=384, bitrate=224000, profile=ProfileH264.BASELINE)
-    ]
-
-    for video_configuration in video_configurations:
-        video_stream = _create_stream(encoding=encoding,
-                                      encoding_input=input,
-                                      input_path=input_file_path,
-                                      codec_configuration=video_configuration)
-        _create_mp4_muxing(encoding=encoding,
-                           output=output,
-                           output_path="video/mp4/clear/" + str(video_configuration.height) + "-" + str(video_configuration.width) + "-" + str(video_configuration.bitrate),
-                           filename="video",
-                           fragment_duration=4000,
-                           stream=video_stream)
-
-        _create_ts_muxing(encoding=encoding,
-                            output=output,
-                            output_path="video/ts/clear/" + str(video_configuration.height) + "-" + str(video_configuration.width) + "-" + str(video_configuration.bitrate),
-                            stream=video_stream)
+    for rendition in context.video_ladder:
+        _add_rendition(graph=graph,
+                       context=context,
+                       media_type="video",
+                       rendition_path=_video_rendition_path(rendition),
+                       create_configuration=lambda rendition=rendition: _create_h264_video_configuration(**rendition))
 
     # Add AAC audio streams to the encoding
-    aac_audio_configurations = [
-        _create_aac_audio_configuration(bitrate=256000),
-        _create_aac_audio_configuration(bitrate=128000),
-        _create_aac_audio_configuration(bitrate=96000),
-        _create_aac_audio_configuration(bitrate=64000)
-    ]
-
-    for audio_configuration in aac_audio_configurations:
-        audio_stream = _create_stream(encoding=encoding,
-                                      encoding_input=input,
-                                      input_path=input_file_path,
-                                      codec_configuration=audio_configuration)
-        _create_mp4_muxing(encoding=encoding,
-                           output=output,
-                           output_path="audio/mp4/clear/" + str(audio_configuration.bitrate),
-                           filename="audio",
-                           fragment_duration=4000,
-                           stream=audio_stream)
-
-        _create_ts_muxing(encoding=encoding,
-                           output=output,
-                           output_path="audio/ts/clear/" + str(audio_configuration.bitrate),
-                           stream=audio_stream)
+    for rendition in context.audio_ladder:
+        _add_rendition(graph=graph,
+                       context=context,
+                       media_type="audio",
+                       rendition_path=_audio_rendition_path(rendition),
+                       create_configuration=lambda rendition=rendition: _create_aac_audio_configuration(**rendition))
+
+    if manifests_at_start:
+        graph.add("hls_manifest",
+                  lambda encoding, output: _with_output(
+                      lambda output: _create_default_hls_manifest(encoding=encoding,
+                                                                  output=output,
+                                                                  output_root=context.output_root),
+                      output=output),
+                  depends_on=["encoding", "output"],
+                  rollback=lambda manifest, *_: bitmovin_api.encoding.manifests.hls.delete(manifest_id=manifest.id))
+        graph.add("dash_manifest",
+                  lambda encoding, output: _with_output(
+                      lambda output: _create_default_dash_manifest(encoding=encoding,
+                                                                   output=output,
+                                                                   output_root=context.output_root),
+                      output=output),
+                  depends_on=["encoding", "output"],
+                  rollback=lambda manifest, *_: bitmovin_api.encoding.manifests.dash.delete(manifest_id=manifest.id))
+
+    graph.add("webhooks",
+              lambda encoding: Utils.add_webhooks(encoding=encoding, manifests_at_start=manifests_at_start),
+              depends_on=["encoding"])
+
+    resources = graph.execute()
+    encoding = resources["encoding"]
 
+    # Execute the encoding
+    _execute_encoding(encoding=encoding,
+                      vod_hls_manifests=[resources["hls_manifest"]] if manifests_at_start else None,
+                      vod_dash_manifests=[resources["dash_manifest"]] if manifests_at_start else None)
+
+    return [encoding.id]
+
+
+def _submit_encoding_template(context):
+    # type: (JobContext.JobContext) -> str
+    """
+    Creates and starts the encoding with a single encoding template request instead of one request per resource.
+    The compiled template is cached per profile and ladder; only the asset-specific values are substituted.
+    Returns the ID of the encoding.
+
+    :param context: The job, with the infrastructure to run the encoding on
+    """
+
+    def compile_template():
+        return EncodingTemplate.compile_template(
+            video_renditions=[dict(rendition_path=_video_rendition_path(rendition),
+                                   configuration_id=_create_h264_video_configuration(**rendition).id)
+                              for rendition in context.video_ladder],
+            audio_renditions=[dict(rendition_path=_audio_rendition_path(rendition),
+                                   configuration_id=_create_aac_audio_configuration(**rendition).id)
+                              for rendition in context.audio_ladder],
+            muxing_mode=Config.MUXING_MODE)
+
+    cache_key = (context.profile_name, Config.MUXING_MODE, repr(context.video_ladder), repr(context.audio_ladder))
+    template = EncodingTemplate.get_template(cache_key, compile_template)
+
+    if Config.BOOTSTRAP_ENABLED:
+        encoding_input, output = Bootstrap.get_input(), Bootstrap.get_output()
+    else:
+        # Without bootstrapping every encoding gets an input and output of its own, as on the graph path
+        encoding_input, output = Utils.get_gcs_input(reuse_existing=False), Utils.get_gcs_output(reuse_existing=False)
+
+    def start(encoding_input, output):
+        return EncodingTemplate.start(EncodingTemplate.render(
+            template,
+            ENCODING_NAME=context.encoding_name,
+            ENCODING_DESCRIPTION=EXAMPLE_DESCRIPTION,
+            INFRASTRUCTURE_ID=context.infrastructure.infrastructure_id,
+            CLOUD_REGION=getattr(context.infrastructure.cloud_region, 'value', context.infrastructure.cloud_region),
+            INPUT_ID=encoding_input.id,
+            INPUT_PATH=context.input_path,
+            OUTPUT_ID=output.id,
+            OUTPUT_ROOT=EncodingTemplate.output_root_path(context.output_root)))
+
+    encoding = Sdk.Encoding()
+    encoding.id = _with_input(lambda encoding_input: _with_output(lambda output: start(encoding_input, output),
+                                                                  output=output),
+                              encoding_input=encoding_input)
+
+    # Webhooks are not part of the template. With WEBHOOK_SCOPE "ORGANIZATION" this does not call the API.
     Utils.add_webhooks(encoding=encoding)
 
-    # Execute the encoding
-    _execute_encoding(encoding=encoding)
+    _wait_for_encoding_to_start(encoding=encoding)
+    return encoding.id
 
 
-def _execute_encoding(encoding):
-    # type: (Encoding) -> None
+def _submit_split_encoding(context):
+    # type: (JobContext.JobContext) -> list
+    """
+    Splits a long source into chunks on the segment grid and encodes every chunk with its own encoding, all built
+    and started in parallel. The chunks always use CMAF muxings; the manifest generator stitches their segments into
+    single HLS and DASH manifests once all chunks have finished. Returns the IDs of the chunk encodings.
+
+    :param context: The job, with the probed source (duration and keyframes) and the infrastructure of chunks
+                    without an entry in SPLIT_INFRASTRUCTURE_IDS
+    """
+
+    source_info = context.source_info
+    chunks = _plan_chunks(source_info)
+    plan_path = SplitEncode.plan_object_path(context.output_root)
+    print("Splitting {} ({:.0f} s) into {} chunks".format(context.input_path, source_info.duration, len(chunks)))
+
+    with ThreadPoolExecutor(max_workers=Config.SPLIT_MAX_PARALLEL_SUBMISSIONS) as executor:
+        # Bound to the context of the invocation, so the API calls of the chunks count for it
+        build_chunk_encoding = Instrumentation.in_context(_build_chunk_encoding)
+        futures = [executor.submit(build_chunk_encoding, context=context, chunk=chunk, plan_path=plan_path)
+                   for chunk in chunks]
+        failures = [future.exception() for future in futures if future.exception() is not None]
+        if failures:
+            # Chunks that were built are not started yet, delete them so no partial asset is encoded
+            for future in futures:
+                if future.exception() is None:
+                    encoding_api.encodings.delete(encoding_id=future.result().id)
+            raise failures[0]
+
+        encodings = [future.result() for future in futures]
+
+        renditions = [dict(media_type="video",
+                           rendition_path=_video_rendition_path(rendition),
+                           output_path="video/cmaf/clear/" + _video_rendition_path(rendition),
+                           bitrate=rendition['bitrate'],
+                           width=rendition['width'],
+                           height=rendition['height'],
+                           codecs=H264_CODECS[rendition['profile']])
+                      for rendition in context.video_ladder]
+        renditions += [dict(media_type="audio",
+                            rendition_path=_audio_rendition_path(rendition),
+                            output_path="audio/cmaf/clear/" + _audio_rendition_path(rendition),
+                            bitrate=rendition['bitrate'],
+                            codecs=AAC_CODEC)
+                       for rendition in context.audio_ladder]
+
+        # The plan has to exist before the first chunk can finish
+        SplitEncode.write_plan(SplitEncode.build_plan(output_root=context.output_root,
+                                                      duration=source_info.duration,
+                                                      segment_length=SEGMENT_LENGTH,
+                                                      chunks=chunks,
+                                                      encoding_ids=[encoding.id for encoding in encodings],
+                                                      renditions=renditions))
+
+        list(executor.map(lambda encoding: _execute_encoding(encoding=encoding), encodings))
+
+    for chunk, encoding in zip(chunks, encodings):
+        Ledger.record_started(asset_name=context.asset_name, codec_type="h264/chunk-{:04d}".format(chunk.index),
+                              encoding_id=encoding.id)
+
+    return [encoding.id for encoding in encodings]
+
+
+def _plan_chunks(source_info):
+    # type: (SourceProbe.SourceInfo) -> list
+    return SplitEncode.plan_chunks(duration=source_info.duration,
+                                   segment_length=SEGMENT_LENGTH,
+                                   chunk_duration=Config.SPLIT_CHUNK_DURATION,
+                                   keyframes=source_info.keyframes,
+                                   keyframe_window=Config.SPLIT_KEYFRAME_WINDOW,
+                                   infrastructure_ids=Config.SPLIT_INFRASTRUCTURE_IDS)
+
+
+def _build_chunk_encoding(context, chunk, plan_path):
+    # type: (JobContext.JobContext, SplitEncode.Chunk, str) -> Encoding
+    """
+    Builds (but does not start) the encoding of one chunk. The chunk is read through a time-based trimming input
+    stream and written below its own folder of the output root.
+    """
+
+    infrastructure = context.infrastructure
+    if chunk.infrastructure_id:
+        infrastructure = Sdk.InfrastructureSettings(cloud_region=infrastructure.cloud_region,
+                                                    infrastructure_id=chunk.infrastructure_id)
+
+    context = context._replace(
+        output_root=SplitEncode.chunk_output_root(context.output_root, chunk),
+        encoding_name="{}-{}-chunk-{:04d}".format(EXAMPLE_NAME, path.basename(context.input_path), chunk.index),
+        infrastructure=infrastructure)
+
+    graph = EncodingGraph.EncodingGraph(max_workers=Config.ENCODING_GRAPH_MAX_WORKERS)
+
+    graph.add("encoding",
+              lambda: _create_encoding_external_gce_infra(
+                  name=context.encoding_name,
+                  description=EXAMPLE_DESCRIPTION,
+                  infra=context.infrastructure,
+                  custom_data=dict(split_plan=plan_path, chunk=chunk.index)),
+              rollback=lambda encoding: encoding_api.encodings.delete(encoding_id=encoding.id))
+    if Config.BOOTSTRAP_ENABLED:
+        graph.add("input", Bootstrap.get_input)
+        graph.add("output", Bootstrap.get_output)
+    else:
+        graph.add("input", lambda: Utils.get_gcs_input(reuse_existing=False))
+        graph.add("output", lambda: Utils.get_gcs_output(reuse_existing=False))
+
+    graph.add("ingest",
+              lambda encoding, encoding_input: _with_input(
+                  lambda encoding_input: _create_ingest_input_stream(encoding=encoding,
+                                                                     encoding_input=encoding_input,
+                                                                     input_path=context.input_path),
+                  encoding_input=encoding_input),
+              depends_on=["encoding", "input"])
+    graph.add("trimmed",
+              lambda encoding, ingest: _create_time_based_trimming_input_stream(encoding=encoding,
+                                                                                input_stream=ingest,
+                                                                                offset=chunk.offset,
+                                                                                duration=chunk.duration),
+              depends_on=["encoding", "ingest"])
+
+    for rendition in context.video_ladder:
+        _add_rendition(graph=graph,
+                       context=context,
+                       media_type="video",
+                       rendition_path=_video_rendition_path(rendition),
+                       create_configuration=lambda rendition=rendition: _create_h264_video_configuration(**rendition),
+                       input_stream_key="trimmed",
+                       muxing_mode="CMAF")
+
+    for rendition in context.audio_ladder:
+        _add_rendition(graph=graph,
+                       context=context,
+                       media_type="audio",
+                       rendition_path=_audio_rendition_path(rendition),
+                       create_configuration=lambda rendition=rendition: _create_aac_audio_configuration(**rendition),
+                       input_stream_key="trimmed",
+                       muxing_mode="CMAF")
+
+    # Every chunk notifies the manifest generator, which stitches once the last chunk has finished
+    graph.add("webhooks", lambda encoding: Utils.add_webhooks(encoding=encoding), depends_on=["encoding"])
+
+    return graph.execute()["encoding"]
+
+
+def _video_rendition_path(rendition):
+    # type: (dict) -> str
+    return "{}-{}-{}".format(rendition['height'], rendition['width'], rendition['bitrate'])
+
+
+def _audio_rendition_path(rendition):
+    # type: (dict) -> str
+    return str(rendition['bitrate'])
+
+
+def _select_ladder(event, video_ladder, audio_ladder):
+    # type: (dict, list, list) -> (list, list, SourceProbe.SourceInfo)
+    """
+    Probes the header of the uploaded object and drops the renditions above the source resolution and audio
+    bitrate, and all video renditions if the source has no video track. Falls back to the full ladder if the source
+    cannot be probed (e.g. it is not an MP4/MOV file).
+    Returns the video and audio ladder and the probed source (None if it was not probed).
+
+    :param event: The Cloud Storage event of the upload
+    :param video_ladder: The video renditions of the ladder profile
+    :param audio_ladder: The audio renditions of the ladder profile
+    """
+
+    source_info = _probe_source(event)
+    if source_info is None:
+        return video_ladder, audio_ladder, None
+
+    video_ladder, audio_ladder = SourceProbe.prune_ladder(video_ladder, audio_ladder, source_info)
+    video = "{}x{} @ {} fps".format(source_info.width, source_info.height, source_info.frame_rate) \
+        if source_info.has_video else "no video"
+    print("Source {}: {}, {} s, audio {} ch @ {} bit/s -> {} video and {} audio renditions".format(
+        event['name'], video, source_info.duration, source_info.audio_channels, source_info.audio_bitrate,
+        len(video_ladder), len(audio_ladder)))
+    return video_ladder, audio_ladder, source_info
+
+
+def _probe_source(event):
+    # type: (dict) -> SourceProbe.SourceInfo
+    """
+    Probes the header of the uploaded object. Returns None if SOURCE_PROBE_ENABLED is off or the source cannot be
+    probed (e.g. it is not an MP4/MOV file).
+
+    :param event: The Cloud Storage event of the upload
     """
-    Starts the actual encoding process and periodically polls its status until it reaches a final state
+
+    if not Config.SOURCE_PROBE_ENABLED:
+        return None
+
+    try:
+        reader = SourceProbe.GcsRangeReader(bucket_name=event['bucket'],
+                                            object_name=event['name'],
+                                            size=event.get('size'))
+        return SourceProbe.probe(reader)
+    except Exception as e:
+        print("Could not probe source {}, using the full ladder: {}".format(event['name'], e))
+        return None
+
+
+def _add_rendition(graph, context, media_type, rendition_path, create_configuration, input_stream_key=None,
+                   muxing_mode=None):
+    # type: (EncodingGraph.EncodingGraph, JobContext.JobContext, str, str, callable, str, str) -> None
+    """
+    Adds the codec configuration, stream and muxings of one rendition to the encoding graph.
+    The configuration is independent of the encoding, the stream needs both, and the muxings only need the stream,
+    so renditions are built side by side.
+
+    <p>With MUXING_MODE "CMAF" a single fragmented MP4 muxing serves both HLS and DASH. With "TS_MP4" an MP4 muxing
+    (for DASH) and a TS muxing (for HLS) are created, as in the original layout.
+
+    :param graph: The graph of the encoding
+    :param context: The job, providing the input path and the output root
+    :param media_type: "video" or "audio", used for the node keys, output paths and filenames
+    :param rendition_path: Unique name of the rendition within its media type, used for node keys and output paths
+    :param create_configuration: Creates (or resolves) the codec configuration of the rendition
+    :param input_stream_key: Graph key of an input stream (e.g. a trimmed range) to read from instead of the input file
+    :param muxing_mode: Overrides MUXING_MODE
+    """
+
+    key = media_type + "/" + rendition_path
+
+    graph.add(key + "/configuration", create_configuration)
+
+    if input_stream_key is not None:
+        graph.add(key + "/stream",
+                  lambda encoding, input_stream, configuration: _with_codec_configuration(
+                      create_stream=lambda codec_configuration: _create_input_stream_stream(
+                          encoding=encoding,
+                          input_stream=input_stream,
+                          codec_configuration=codec_configuration),
+                      configuration=configuration,
+                      create_configuration=create_configuration),
+                  depends_on=["encoding", input_stream_key, key + "/configuration"],
+                  rollback=lambda stream, encoding, *_: encoding_api.encodings.streams.delete(encoding_id=encoding.id,
+                                                                                                stream_id=stream.id))
+    else:
+        graph.add(key + "/stream",
+                  lambda encoding, encoding_input, configuration: _with_codec_configuration(
+                      create_stream=lambda codec_configuration: _with_input(
+                          lambda encoding_input: _create_stream(encoding=encoding,
+                                                                encoding_input=encoding_input,
+                                                                input_path=context.input_path,
+                                                                codec_configuration=codec_configuration),
+                          encoding_input=encoding_input),
+                      configuration=configuration,
+                      create_configuration=create_configuration),
+                  depends_on=["encoding", "input", key + "/configuration"],
+                  rollback=lambda stream, encoding, *_: encoding_api.encodings.streams.delete(encoding_id=encoding.id,
+                                                                                                stream_id=stream.id))
+
+    if (muxing_mode or Config.MUXING_MODE) == "CMAF":
+        graph.add(key + "/fmp4",
+                  lambda encoding, output, stream: _with_output(
+                      lambda output: _create_fmp4_muxing(encoding=encoding,
+                                                         output=output,
+                                                         output_root=context.output_root,
+                                                         output_path=media_type + "/cmaf/clear/" + rendition_path,
+                                                         stream=stream),
+                      output=output),
+                  depends_on=["encoding", "output", key + "/stream"],
+                  rollback=lambda muxing, encoding, *_: encoding_api.encodings.muxings.fmp4.delete(
+                      encoding_id=encoding.id, muxing_id=muxing.id))
+        return
+
+    graph.add(key + "/mp4",
+              lambda encoding, output, stream: _with_output(
+                  lambda output: _create_mp4_muxing(encoding=encoding,
+                                                    output=output,
+                                                    output_root=context.output_root,
+                                                    output_path=media_type + "/mp4/clear/" + rendition_path,
+                                                    filename=media_type,
+                                                    fragment_duration=4000,
+                                                    stream=stream),
+                  output=output),
+              depends_on=["encoding", "output", key + "/stream"],
+              rollback=lambda muxing, encoding, *_: encoding_api.encodings.muxings.mp4.delete(encoding_id=encoding.id,
+                                                                                                muxing_id=muxing.id))
+
+    graph.add(key + "/ts",
+              lambda encoding, output, stream: _with_output(
+                  lambda output: _create_ts_muxing(encoding=encoding,
+                                                   output=output,
+                                                   output_root=context.output_root,
+                                                   output_path=media_type + "/ts/clear/" + rendition_path,
+                                                   stream=stream),
+                  output=output),
+              depends_on=["encoding", "output", key + "/stream"],
+              rollback=lambda muxing, encoding, *_: encoding_api.encodings.muxings.ts.delete(encoding_id=encoding.id,
+                                                                                               muxing_id=muxing.id))
+
+
+def _execute_encoding(encoding, vod_hls_manifests=None, vod_dash_manifests=None):
+    # type: (Encoding, list, list) -> None
+    """
+    Starts the actual encoding process and periodically polls its status until it reaches a final state.
+    Manifests passed in are declared in the start request and written by the encoding itself when it finishes.
 
     <p>API endpoints:
     https://bitmovin.com/docs/encoding/api-reference/all#/Encoding/PostEncodingEncodingsStartByEncodingId
@@ -119,23 +723,52 @@ def _execute_encoding(encoding):
     https://bitmovin.com/docs/encoding/api-reference/sections/notifications-webhooks
 
     :param encoding: The encoding to be started
+    :param vod_hls_manifests: HLS manifests to generate at the end of the encoding
+    :param vod_dash_manifests: DASH manifests to generate at the end of the encoding
     """
 
-    bitmovin_api.encoding.encodings.start(encoding_id=encoding.id)
+    start_encoding_request = None
+    if vod_hls_manifests or vod_dash_manifests:
+        start_encoding_request = Sdk.StartEncodingRequest(
+            vod_hls_manifests=[Sdk.ManifestResource(manifest_id=manifest.id) for manifest in vod_hls_manifests or []],
+            vod_dash_manifests=[Sdk.ManifestResource(manifest_id=manifest.id) for manifest in vod_dash_manifests or []],
+            manifest_generator=Sdk.ManifestGenerator.V2
+        )
+
+    bitmovin_api.encoding.encodings.start(encoding_id=encoding.id, start_encoding_request=start_encoding_request)
 
-    time.sleep(5)
-    task = bitmovin_api.encoding.encodings.status(encoding_id=encoding.id)
-    print("Encoding status is {} (progress: {} %)".format(task.status, task.progress))
+    _wait_for_encoding_to_start(encoding=encoding)
 
-    if task.status is Status.ERROR:
+
+def _wait_for_encoding_to_start(encoding):
+    # type: (Encoding) -> None
+    """
+    Polls the status of a started encoding and raises if it failed right away
+
+    :param encoding: The started encoding
+    """
+
+    # Only wait until the encoding has either left the queue or failed validation; the finished webhook reports
+    # the end of the encoding. An encoding still queued at the deadline is considered started.
+    try:
+        task = Poller.poll(lambda: bitmovin_api.encoding.encodings.status(encoding_id=encoding.id),
+                           is_done=lambda task: Poller.status_of(task) not in ("CREATED", "QUEUED"),
+                           initial_interval=Config.ENCODING_POLL_INITIAL_INTERVAL,
+                           max_interval=Config.ENCODING_POLL_MAX_INTERVAL,
+                           deadline=Config.ENCODING_START_POLL_DEADLINE,
+                           on_progress=Poller.log_progress("Encoding"))
+    except Poller.PollTimeout as e:
+        task = e.last
+
+    if task.status is Sdk.Status.ERROR:
         Utils.log_task_errors(task=task)
         raise Exception("Encoding failed")
 
     print("Encoding started successfully")
 
 
-def _create_encoding_external_gce_infra(name, description, infra):
-    # type: (str, str, InfrastructureSettings) -> Encoding
+def _create_encoding_external_gce_infra(name, description, infra, custom_data=None):
+    # type: (str, str, InfrastructureSettings, dict) -> Encoding
     """
     Creates an Encoding object. This is the base object to configure your encoding.
 
@@ -144,13 +777,15 @@ def _create_encoding_external_gce_infra(name, description, infra):
 
     :param name: A name that will help you identify the encoding in our dashboard (required)
     :param description: A description of the encoding (optional)
+    :param custom_data: User-specific meta data stored with the encoding (optional)
     """
 
-    encoding = Encoding(
+    encoding = Sdk.Encoding(
         name=name,
         description=description,
         infrastructure=infra,
-        cloud_region=CloudRegion.EXTERNAL
+        cloud_region=Sdk.CloudRegion.EXTERNAL,
+        custom_data=custom_data
     )
 
     return bitmovin_api.encoding.encodings.create(encoding=encoding)
@@ -173,16 +808,24 @@ def _create_h264_video_configuration(height, width, bitrate, profile):
     https://bitmovin.com/docs/encoding/api-reference/sections/configurations#/Encoding/PostEncodingConfigurationsVideoH264
     """
 
-    config = H264VideoConfiguration(
+    config = Sdk.H264VideoConfiguration(
         name="H.264 "+ str(height) +"p " + str(bitrate/1000) + " Kbit/s",
-        preset_configuration=PresetConfiguration.VOD_STANDARD,
+        preset_configuration=Sdk.PresetConfiguration.VOD_STANDARD,
         height=height,
         width=width,
         bitrate=bitrate,
-        profile=profile
+        profile=Sdk.ProfileH264[profile]
     )
 
-    return bitmovin_api.encoding.configurations.video.h264.create(h264_video_configuration=config)
+    h264_api = bitmovin_api.encoding.configurations.video.h264
+
+    return _register_codec_configuration(
+        codec="h264",
+        config=config,
+        lookup=lambda name: list(Pagination.iterate(h264_api.list, Sdk.H264VideoConfigurationListQueryParams,
+                                                    filters=dict(name=name))),
+        create=lambda: h264_api.create(h264_video_configuration=config)
+    )
 
 
 def _create_stream(encoding, encoding_input, input_path, codec_configuration):
@@ -199,12 +842,12 @@ def _create_stream(encoding, encoding_input, input_path, codec_configuration):
     :param codec_configuration: The codec configuration to be applied to the stream
     """
 
-    stream_input = StreamInput(
+    stream_input = Sdk.StreamInput(
         input_id=encoding_input.id,
         input_path=input_path
     )
 
-    stream = Stream(
+    stream = Sdk.Stream(
         input_streams=[stream_input],
         codec_config_id=codec_configuration.id
     )
@@ -212,6 +855,74 @@ def _create_stream(encoding, encoding_input, input_path, codec_configuration):
     return bitmovin_api.encoding.encodings.streams.create(encoding_id=encoding.id, stream=stream)
 
 
+def _create_ingest_input_stream(encoding, encoding_input, input_path):
+    # type: (Encoding, Input, str) -> IngestInputStream
+    """
+    Creates an ingest input stream, which reads the input file and can be referenced by other input streams
+
+    <p>API endpoint:
+    https://bitmovin.com/docs/encoding/api-reference/sections/encodings#/Encoding/PostEncodingEncodingsInputStreamsIngestByEncodingId
+
+    :param encoding: The encoding to which the input stream will be added
+    :param encoding_input: The input resource providing the input file
+    :param input_path: The path to the input file
+    """
+
+    ingest_input_stream = Sdk.IngestInputStream(
+        input_id=encoding_input.id,
+        input_path=input_path,
+        selection_mode=Sdk.StreamSelectionMode.AUTO
+    )
+
+    return bitmovin_api.encoding.encodings.input_streams.ingest.create(encoding_id=encoding.id,
+                                                                       ingest_input_stream=ingest_input_stream)
+
+
+def _create_time_based_trimming_input_stream(encoding, input_stream, offset, duration):
+    # type: (Encoding, IngestInputStream, float, float) -> TimeBasedTrimmingInputStream
+    """
+    Creates an input stream that only contains the given time range of another input stream
+
+    <p>API endpoint:
+    https://bitmovin.com/docs/encoding/api-reference/sections/encodings#/Encoding/PostEncodingEncodingsInputStreamsTrimmingTimeBasedByEncodingId
+
+    :param encoding: The encoding to which the input stream will be added
+    :param input_stream: The input stream to trim
+    :param offset: Start of the range in seconds
+    :param duration: Duration of the range in seconds
+    """
+
+    trimming_input_stream = Sdk.TimeBasedTrimmingInputStream(
+        input_stream_id=input_stream.id,
+        offset=offset,
+        duration=duration
+    )
+
+    return bitmovin_api.encoding.encodings.input_streams.trimming.time_based.create(
+        encoding_id=encoding.id, time_based_trimming_input_stream=trimming_input_stream)
+
+
+def _create_input_stream_stream(encoding, input_stream, codec_configuration):
+    # type: (Encoding, InputStream, CodecConfiguration) -> Stream
+    """
+    Adds a video or audio stream reading from an input stream (e.g. a trimmed range) instead of the input file
+
+    <p>API endpoint:
+    https://bitmovin.com/docs/encoding/api-reference/sections/encodings#/Encoding/PostEncodingEncodingsStreamsByEncodingId
+
+    :param encoding: The encoding to which the stream will be added
+    :param input_stream: The input stream to read from
+    :param codec_configuration: The codec configuration to be applied to the stream
+    """
+
+    stream = Sdk.Stream(
+        input_streams=[Sdk.StreamInput(input_stream_id=input_stream.id)],
+        codec_config_id=codec_configuration.id
+    )
+
+    return bitmovin_api.encoding.encodings.streams.create(encoding_id=encoding.id, stream=stream)
+
+
 def _create_aac_audio_configuration(bitrate):
     # type: () -> AacAudioConfiguration
     """
@@ -221,15 +932,126 @@ def _create_aac_audio_configuration(bitrate):
     https://bitmovin.com/docs/encoding/api-reference/sections/configurations#/Encoding/PostEncodingConfigurationsAudioAac
     """
 
-    config = AacAudioConfiguration(
+    config = Sdk.AacAudioConfiguration(
         name="AAC " + str(bitrate/1000) + " kbit/s",
         bitrate=bitrate
     )
 
-    return bitmovin_api.encoding.configurations.audio.aac.create(aac_audio_configuration=config)
+    aac_api = bitmovin_api.encoding.configurations.audio.aac
+
+    return _register_codec_configuration(
+        codec="aac",
+        config=config,
+        lookup=lambda name: list(Pagination.iterate(aac_api.list, Sdk.AacAudioConfigurationListQueryParams,
+                                                    filters=dict(name=name))),
+        create=lambda: aac_api.create(aac_audio_configuration=config)
+    )
+
+
+def _register_codec_configuration(codec, config, lookup, create):
+    # type: (str, CodecConfiguration, callable, callable) -> CodecConfiguration
+    """
+    Resolves a codec configuration through the content-addressed registry, so that identical configurations are
+    created only once per account instead of once per upload. The returned object is the local configuration with
+    the ID of the existing (or newly created) configuration set on it.
+
+    :param codec: The codec identifier used in the fingerprint
+    :param config: The configuration to resolve
+    :param lookup: Called with the tagged configuration name, returns matching remote configurations
+    :param create: Called without arguments, creates the configuration remotely
+    """
+
+    if not Config.CONFIG_REGISTRY_ENABLED:
+        return create()
+
+    config_fingerprint = ConfigRegistry.fingerprint(codec=codec,
+                                                    height=getattr(config, 'height', None),
+                                                    width=getattr(config, 'width', None),
+                                                    bitrate=config.bitrate,
+                                                    profile=getattr(config, 'profile', None),
+                                                    preset=getattr(config, 'preset_configuration', None))
+    config.name = ConfigRegistry.tag_name(config.name, config_fingerprint)
+
+    registry = ConfigRegistry.init_config_registry()
+    config.id = registry.resolve(config_fingerprint,
+                                 lookup=lambda: [item.id for item in lookup(config.name) if item.name == config.name],
+                                 create=lambda: create().id)
+    return config
+
 
-def _create_mp4_muxing(encoding, output, output_path, filename, fragment_duration, stream):
-    # type: (Encoding, Output, str, str, Stream) -> Mp4Muxing
+def _with_codec_configuration(create_stream, configuration, create_configuration):
+    # type: (callable, CodecConfiguration, callable) -> Stream
+    """
+    Creates a stream with a codec configuration resolved through the registry. The registry keeps configuration IDs
+    in memory and in its index file, so it still hands out a configuration that was deleted on the Bitmovin side.
+    If the API rejects the configuration as not found or invalid, its fingerprint is invalidated and the stream is
+    created once more with the configuration resolved again, which looks it up remotely or creates it.
+
+    :param create_stream: Called with the codec configuration, creates the stream
+    :param configuration: The resolved codec configuration
+    :param create_configuration: Resolves the codec configuration, as for the configuration node of the graph
+    """
+
+    try:
+        return create_stream(configuration)
+    except Exception as e:
+        config_fingerprint = ConfigRegistry.fingerprint_of(configuration.name)
+        if not Config.CONFIG_REGISTRY_ENABLED or config_fingerprint is None or \
+                not _is_stale_resource_error(e, "config"):
+            raise
+        print("Codec configuration {} was rejected ({}), resolving it again".format(configuration.id, e))
+
+    ConfigRegistry.init_config_registry().invalidate(config_fingerprint)
+    return create_stream(create_configuration())
+
+
+def _with_input(use, encoding_input):
+    # type: (callable, Input) -> object
+    return _with_bootstrap_resource(use=use, resource=encoding_input, key=Bootstrap.input_key(),
+                                    resolve=Bootstrap.get_input, resource_type="input")
+
+
+def _with_output(use, output):
+    # type: (callable, Output) -> object
+    return _with_bootstrap_resource(use=use, resource=output, key=Bootstrap.output_key(),
+                                    resolve=Bootstrap.get_output, resource_type="output")
+
+
+def _with_bootstrap_resource(use, resource, key, resolve, resource_type):
+    # type: (callable, object, str, callable, str) -> object
+    """
+    Creates a resource referencing an input or output resolved through the bootstrap cache. The cache keeps their
+    IDs in memory and in the snapshot file, so it still hands out an input or output that was deleted on the
+    Bitmovin side. If the API rejects the reference as not found or invalid, the key is invalidated and the resource
+    is created once more with the input or output resolved again, which looks it up remotely or creates it.
+
+    :param use: Called with the input or output, creates the resource referencing it
+    :param resource: The resolved input or output
+    :param key: The key of the input or output in the bootstrap cache
+    :param resolve: Resolves the input or output, as for the input and output nodes of the graph
+    :param resource_type: "input" or "output", as named by the error messages of the API
+    """
+
+    try:
+        return use(resource)
+    except Exception as e:
+        if not Config.BOOTSTRAP_ENABLED or not _is_stale_resource_error(e, resource_type):
+            raise
+        print("{} {} was rejected ({}), resolving it again".format(resource_type.capitalize(), resource.id, e))
+
+    Bootstrap.invalidate(key, resource_id=resource.id)
+    return use(resolve())
+
+
+def _is_stale_resource_error(error, resource_type):
+    # type: (Exception, str) -> bool
+    # BitmovinError carries the HTTP status and the messages of the API response
+    status = getattr(error, 'http_status_code', None)
+    messages = " ".join(str(getattr(error, name, None) or "") for name in ('short_message', 'developer_message'))
+    return status == 404 or (status == 400 and resource_type in messages.lower())
+
+def _create_mp4_muxing(encoding, output, output_root, output_path, filename, fragment_duration, stream):
+    # type: (Encoding, Output, str, str, str, int, Stream) -> Mp4Muxing
     """
     Creates an MP4 muxing.
 
@@ -238,25 +1060,26 @@ def _create_mp4_muxing(encoding, output, output_path, filename, fragment_duratio
 
     :param encoding: The encoding to add the MP4 muxing to
     :param output: The output that should be used for the muxing to write the segments to
+    :param output_root: The root of all outputs of the asset
     :param output_path: The output path where the fragments will be written to
     :param filename: The filename for the MP4 file
     :param stream: The stream to be added to the muxing
     """
 
-    muxing = Mp4Muxing(
+    muxing = Sdk.Mp4Muxing(
         filename=filename,
         outputs=[Utils.build_encoding_output(output_id=output.id,
-                                             asset_name=Config.ASSET_NAME,
+                                             asset_name=output_root,
                                              output_path=output_path)],
-        streams=[MuxingStream(stream_id=stream.id)],
+        streams=[Sdk.MuxingStream(stream_id=stream.id)],
         fragment_duration=fragment_duration,
-        fragmented_mp4_muxing_manifest_type=FragmentedMp4MuxingManifestType.DASH_ON_DEMAND
+        fragmented_mp4_muxing_manifest_type=Sdk.FragmentedMp4MuxingManifestType.DASH_ON_DEMAND
     )
 
     return encoding_api.encodings.muxings.mp4.create(encoding_id=encoding.id, mp4_muxing=muxing)
 
-def _create_ts_muxing(encoding, output, output_path, stream):
-    # type: (Encoding, Output, str, Stream) -> TsMuxing
+def _create_ts_muxing(encoding, output, output_root, output_path, stream):
+    # type: (Encoding, Output, str, str, Stream) -> TsMuxing
     """
     Creates a fragmented MP4 muxing. This will generate segments with a given segment length for
     adaptive streaming.
@@ -266,17 +1089,99 @@ def _create_ts_muxing(encoding, output, output_path, stream):
 
     @param encoding The encoding where to add the muxing to
     @param output The output that should be used for the muxing to write the segments to
+    @param output_root The root of all outputs of the asset
     @param output_path The output path where the fragmented segments will be written to
     @param stream The stream that is associated with the muxing
     """
 
-    muxing = TsMuxing(
-        segment_length=4.0,
+    muxing = Sdk.TsMuxing(
+        segment_length=SEGMENT_LENGTH,
         outputs=[Utils.build_encoding_output(output_id=output.id,
-                                             asset_name=Config.ASSET_NAME,
+                                             asset_name=output_root,
                                              output_path=output_path)],
-        streams=[MuxingStream(stream_id=stream.id)]
+        streams=[Sdk.MuxingStream(stream_id=stream.id)]
     )
 
     return bitmovin_api.encoding.encodings.muxings.ts.create(encoding_id=encoding.id, ts_muxing=muxing)
 
+
+def _create_fmp4_muxing(encoding, output, output_root, output_path, stream):
+    # type: (Encoding, Output, str, str, Stream) -> Fmp4Muxing
+    """
+    Creates a fragmented MP4 (CMAF) muxing. Its segments are referenced by both the HLS and the DASH manifest, so a
+    single muxing per stream replaces the MP4 and TS muxings of the dual layout.
+
+    <p>API endpoint:
+    https://bitmovin.com/docs/encoding/api-reference/all#/Encoding/PostEncodingEncodingsMuxingsFmp4ByEncodingId
+
+    @param encoding The encoding where to add the muxing to
+    @param output The output that should be used for the muxing to write the segments to
+    @param output_root The root of all outputs of the asset
+    @param output_path The output path where the fragmented segments will be written to
+    @param stream The stream that is associated with the muxing
+    """
+
+    muxing = Sdk.Fmp4Muxing(
+        segment_length=SEGMENT_LENGTH,
+        segment_naming="segment_%number%.m4s",
+        init_segment_name="init.mp4",
+        outputs=[Utils.build_encoding_output(output_id=output.id,
+                                             asset_name=output_root,
+                                             output_path=output_path)],
+        streams=[Sdk.MuxingStream(stream_id=stream.id)]
+    )
+
+    return bitmovin_api.encoding.encodings.muxings.fmp4.create(encoding_id=encoding.id, fmp4_muxing=muxing)
+
+
+def _create_default_hls_manifest(encoding, output, output_root):
+    # type: (Encoding, Output, str) -> HlsManifestDefault
+    """
+    Creates a default HLS manifest for the encoding. The playlists are derived from the muxings of the encoding when
+    the manifest is generated, so no media or stream infos have to be added. CMAF segments require HLS version 7.
+
+    <p>API endpoint:
+    https://bitmovin.com/docs/encoding/api-reference/sections/manifests#/Encoding/PostEncodingManifestsHlsDefault
+
+    :param encoding: The encoding the manifest is generated for
+    :param output: The output the manifest is written to
+    :param output_root: The root of all outputs of the asset
+    """
+
+    hls_version = Sdk.HlsVersion.HLS_V7 if Config.MUXING_MODE == "CMAF" else None
+    manifest = Sdk.HlsManifestDefault(
+        encoding_id=encoding.id,
+        manifest_name="hls-manifest.m3u8",
+        outputs=[Utils.build_encoding_output(output_id=output.id, asset_name=output_root, output_path="")],
+        name="HLS Manifest - " + encoding.name,
+        hls_master_playlist_version=hls_version,
+        hls_media_playlist_version=hls_version,
+        version=Sdk.HlsManifestDefaultVersion.V1
+    )
+
+    return bitmovin_api.encoding.manifests.hls.default.create(hls_manifest_default=manifest)
+
+
+def _create_default_dash_manifest(encoding, output, output_root):
+    # type: (Encoding, Output, str) -> DashManifestDefault
+    """
+    Creates a default DASH manifest for the encoding, derived from its muxings when the manifest is generated
+
+    <p>API endpoint:
+    https://bitmovin.com/docs/encoding/api-reference/sections/manifests#/Encoding/PostEncodingManifestsDashDefault
+
+    :param encoding: The encoding the manifest is generated for
+    :param output: The output the manifest is written to
+    :param output_root: The root of all outputs of the asset
+    """
+
+    manifest = Sdk.DashManifestDefault(
+        encoding_id=encoding.id,
+        manifest_name="dash-manifest.mpd",
+        outputs=[Utils.build_encoding_output(output_id=output.id, asset_name=output_root, output_path="")],
+        name="DASH Manifest - " + encoding.name,
+        profile=Sdk.DashProfile.LIVE if Config.MUXING_MODE == "CMAF" else Sdk.DashProfile.ON_DEMAND,
+        version=Sdk.DashManifestDefaultVersion.V1
+    )
+
+    return bitmovin_api.encoding.manifests.dash.default.create(dash_manifest_default=manifest)
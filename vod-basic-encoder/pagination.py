@@ -0,0 +1,102 @@
+import threading
+
+import config as Config
+import instrumentation as Instrumentation
+
+"""
+Iterates over all items of a Bitmovin API list endpoint, page by page.
+
+<p>A list call returns a single page of items (25 unless the limit is set, at most 100), so reading the items of one
+call silently drops everything beyond the first page, e.g. the renditions of a long ladder. iterate() requests pages
+of API_LIST_PAGE_SIZE items until the API reports no more and yields their items one by one:
+  <ul>
+   <li>with API_LIST_PREFETCH the next page is requested in a background thread while the caller works through the
+       current one, so a long list costs about one call latency per page less,
+   <li>filters are passed as query parameters of the endpoint and applied by the API (e.g. name for inputs,
+       outputs and codec configurations), so only matching items are transferred.
+ </ul>
+The calls of the background thread are recorded for the invocation that iterates (see instrumentation.py).
+"""
+
+MAX_PAGE_SIZE = 100
+
+
+def iterate(list_call, query_params_class, filters=None, page_size=None, prefetch=None, **path_params):
+    # type: (callable, type, dict, int, bool, dict) -> iter
+    """
+    Yields all items of a list endpoint
+
+    :param list_call: The list method of the endpoint, e.g. bitmovin_api.encoding.encodings.muxings.ts.list
+    :param query_params_class: The query parameters of the endpoint, e.g. Sdk.TsMuxingListQueryParams
+    :param filters: Further query parameters, e.g. dict(name="...")
+    :param page_size: Items per call, defaults to API_LIST_PAGE_SIZE
+    :param prefetch: Request the next page while the current one is consumed, defaults to API_LIST_PREFETCH
+    :param path_params: Path parameters of the call, e.g. encoding_id
+    """
+
+    page_size = min(page_size or Config.API_LIST_PAGE_SIZE, MAX_PAGE_SIZE)
+    prefetch = Config.API_LIST_PREFETCH if prefetch is None else prefetch
+
+    def fetch(offset):
+        query_params = query_params_class(offset=offset, limit=page_size, **(filters or dict()))
+        return list_call(query_params=query_params, **path_params)
+
+    offset = 0
+    page = fetch(offset)
+    while True:
+        items = page.items or []
+        offset += len(items)
+        more = _has_more(page, offset, len(items), page_size)
+
+        following = _Prefetch(fetch, offset) if more and prefetch else None
+        for item in items:
+            yield item
+
+        if not more:
+            return
+        page = following.result() if following is not None else fetch(offset)
+
+
+def first(list_call, query_params_class, filters=None, **path_params):
+    # type: (callable, type, dict, dict) -> object
+    """
+    Returns the first item of a list endpoint matching the filters, or None. Makes a single call.
+    """
+
+    return next(iterate(list_call, query_params_class, filters=filters, page_size=1, prefetch=False, **path_params),
+                None)
+
+
+def _has_more(page, offset, count, page_size):
+    if count == 0:
+        return False
+    total_count = getattr(page, 'total_count', None)
+    if total_count is not None:
+        return offset < total_count
+    # Endpoints that do not report the total end with a page that is not full
+    return count == page_size
+
+
+class _Prefetch(object):
+    """
+    Requests a page in a background thread, result() waits for it and raises its error
+    """
+
+    def __init__(self, fetch, offset):
+        self._page = None
+        self._error = None
+        self._thread = threading.Thread(target=Instrumentation.in_context(self._run), args=(fetch, offset),
+                                        name="list-prefetch", daemon=True)
+        self._thread.start()
+
+    def _run(self, fetch, offset):
+        try:
+            self._page = fetch(offset)
+        except Exception as e:
+            self._error = e
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._page
@@ -0,0 +1,348 @@
+import struct
+
+from collections import namedtuple
+
+import config as Config
+
+"""
+Header-only probe of the source file and ladder pruning based on its properties.
+
+<p>Only the container header is read: top-level MP4/MOV boxes are walked with ranged reads (skipping the media data
+by its box size) until the 'moov' box is found, and only that box is downloaded and parsed. The result is used to
+drop video renditions above the source resolution and audio renditions above the source bitrate before any stream
+is created.
+
+<p>Readers only need a size attribute and a read(offset, length) method, so the GCS object can be replaced by a
+local file for tests.
+"""
+
+SourceInfo = namedtuple('SourceInfo', ['width', 'height', 'frame_rate', 'duration',
+                                       'audio_channels', 'audio_bitrate', 'audio_sample_rate', 'keyframes',
+                                       'has_video'])
+
+# Bytes fetched by the first read. Files optimized for streaming ("faststart") keep 'moov' right after 'ftyp',
+# so a single request usually covers the whole header.
+INITIAL_READ_SIZE = 64 * 1024
+
+# Boxes an MP4 or QuickTime file can start with
+_TOP_LEVEL_BOXES = (b'ftyp', b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot')
+
+
+class ProbeError(Exception):
+    pass
+
+
+class GcsRangeReader(object):
+    """
+    Reads byte ranges of a GCS object. google-cloud-storage is only imported when the reader is created.
+    """
+
+    def __init__(self, bucket_name, object_name, size=None):
+        # type: (str, str, int) -> None
+        from google.cloud import storage
+
+        self.blob = storage.Client().bucket(bucket_name).blob(object_name)
+        if size is None:
+            self.blob.reload()
+            size = self.blob.size
+        self.size = int(size)
+
+    def read(self, offset, length):
+        # type: (int, int) -> bytes
+        end = min(offset + length, self.size) - 1
+        if end < offset:
+            return b''
+        return self.blob.download_as_bytes(start=offset, end=end)
+
+
+class LocalFileReader(object):
+    """
+    Reads byte ranges of a local file, the stand-in for GCS objects in tests
+    """
+
+    def __init__(self, file_path):
+        # type: (str) -> None
+        self.file_path = file_path
+        with open(file_path, 'rb') as fp:
+            fp.seek(0, 2)
+            self.size = fp.tell()
+
+    def read(self, offset, length):
+        # type: (int, int) -> bytes
+        with open(self.file_path, 'rb') as fp:
+            fp.seek(offset)
+            return fp.read(length)
+
+
+def probe(reader):
+    # type: (object) -> SourceInfo
+    """
+    Reads the 'moov' box of an MP4/MOV file through the given reader and extracts resolution, frame rate,
+    duration and audio properties. Raises ProbeError if the source is not an MP4/MOV file or the header is
+    incomplete.
+    """
+
+    moov = _read_moov(reader)
+
+    info = dict(width=None, height=None, frame_rate=None, duration=None,
+                audio_channels=None, audio_bitrate=None, audio_sample_rate=None, keyframes=None, has_video=False)
+
+    for box_type, start, end in _iter_boxes(moov):
+        if box_type == 'mvhd':
+            timescale, duration = _parse_timing(moov, start)
+            if timescale:
+                info['duration'] = float(duration) / timescale
+        elif box_type == 'trak':
+            _parse_track(moov, start, end, info)
+
+    return SourceInfo(**info)
+
+
+def prune_ladder(video_ladder, audio_ladder, source_info):
+    # type: (list, list, SourceInfo) -> (list, list)
+    """
+    Drops video renditions taller than the source and audio renditions above the source audio bitrate.
+    The lowest rendition of each ladder is always kept, and a ladder is left untouched if the source property it
+    depends on is unknown. A source without a video track (e.g. a podcast) gets no video renditions at all.
+
+    :param video_ladder: video renditions (dicts with at least 'height'), highest first
+    :param audio_ladder: audio renditions (dicts with at least 'bitrate'), highest first
+    :param source_info: the probed source
+    :return: the pruned video and audio ladders
+    """
+
+    video = list(video_ladder)
+    if not source_info.has_video:
+        video = []
+    elif source_info.height:
+        # Compare the short sides, so portrait phone videos are not mistaken for low resolution sources
+        source_size = min(source_info.width or source_info.height, source_info.height)
+        tolerance = source_size * Config.SOURCE_PROBE_RESOLUTION_TOLERANCE
+        video = [rung for rung in video_ladder if rung['height'] <= source_size + tolerance] or video_ladder[-1:]
+
+    audio = list(audio_ladder)
+    if source_info.audio_bitrate:
+        tolerance = source_info.audio_bitrate * Config.SOURCE_PROBE_BITRATE_TOLERANCE
+        audio = [rung for rung in audio_ladder
+                 if rung['bitrate'] <= source_info.audio_bitrate + tolerance] or audio_ladder[-1:]
+
+    return video, audio
+
+
+def _read_moov(reader):
+    buffer = reader.read(0, min(INITIAL_READ_SIZE, reader.size))
+    offset = 0
+
+    while offset + 8 <= reader.size:
+        if offset + 16 <= len(buffer):
+            header = buffer[offset:offset + 16]
+        else:
+            header = reader.read(offset, 16)
+
+        if len(header) < 8:
+            break
+
+        size, box_type = struct.unpack_from('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = reader.size - offset
+
+        if offset == 0 and box_type not in _TOP_LEVEL_BOXES:
+            raise ProbeError("Source is not an MP4/MOV file")
+
+        if size < header_size:
+            raise ProbeError("Invalid box size at offset {}".format(offset))
+
+        if box_type == b'moov':
+            if size > Config.SOURCE_PROBE_MAX_HEADER_BYTES:
+                raise ProbeError("moov box of {} bytes exceeds the probe limit".format(size))
+            if offset + size <= len(buffer):
+                return buffer[offset + header_size:offset + size]
+            payload = reader.read(offset + header_size, size - header_size)
+            if len(payload) < size - header_size:
+                raise ProbeError("Truncated moov box")
+            return payload
+
+        offset += size
+
+    raise ProbeError("No moov box found")
+
+
+def _iter_boxes(data, offset=0, end=None):
+    end = len(data) if end is None else end
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+
+        if size < header_size or offset + size > end:
+            return
+
+        yield box_type.decode('latin-1'), offset + header_size, offset + size
+        offset += size
+
+
+def _find_box(data, start, end, path):
+    for box_type, box_start, box_end in _iter_boxes(data, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return box_start, box_end
+            return _find_box(data, box_start, box_end, path[1:])
+    return None
+
+
+def _parse_timing(data, start):
+    # mvhd and mdhd share the layout up to the duration
+    version = data[start]
+    if version == 1:
+        return struct.unpack_from('>IQ', data, start + 20)
+    return struct.unpack_from('>II', data, start + 12)
+
+
+def _parse_track(data, start, end, info):
+    hdlr = _find_box(data, start, end, ('mdia', 'hdlr'))
+    mdhd = _find_box(data, start, end, ('mdia', 'mdhd'))
+    stbl = _find_box(data, start, end, ('mdia', 'minf', 'stbl'))
+    if hdlr is None or mdhd is None or stbl is None:
+        return
+
+    handler = data[hdlr[0] + 8:hdlr[0] + 12]
+    timescale, duration = _parse_timing(data, mdhd[0])
+    seconds = float(duration) / timescale if timescale else None
+
+    if handler == b'vide' and info['height'] is None:
+        info['has_video'] = True
+        _parse_video_track(data, start, end, stbl, timescale, seconds, info)
+    elif handler == b'soun' and info['audio_channels'] is None:
+        _parse_audio_track(data, stbl, seconds, info)
+
+
+def _parse_video_track(data, start, end, stbl, timescale, seconds, info):
+    tkhd = _find_box(data, start, end, ('tkhd',))
+    if tkhd is not None:
+        width, height = struct.unpack_from('>II', data, tkhd[1] - 8)
+        width, height = width >> 16, height >> 16
+        # A zero first matrix coefficient means the track is displayed rotated by 90 or 270 degrees
+        matrix_offset = tkhd[1] - 8 - 36
+        if struct.unpack_from('>i', data, matrix_offset)[0] == 0:
+            width, height = height, width
+        info['width'], info['height'] = width, height
+
+    entry = _first_sample_entry(data, stbl)
+    if entry is not None and not info['height']:
+        entry_start = entry[1]
+        info['width'], info['height'] = struct.unpack_from('>HH', data, entry_start + 24)
+
+    stts = _find_box(data, stbl[0], stbl[1], ('stts',))
+    if stts is not None and seconds:
+        entry_count = struct.unpack_from('>I', data, stts[0] + 4)[0]
+        samples = sum(struct.unpack_from('>I', data, stts[0] + 8 + 8 * i)[0] for i in range(entry_count))
+        info['frame_rate'] = round(samples / seconds, 3)
+
+    # Without a sync sample table every sample is a keyframe, which is left as None (no constraint)
+    stss = _find_box(data, stbl[0], stbl[1], ('stss',))
+    if stss is not None and stts is not None and timescale:
+        info['keyframes'] = _keyframe_times(data, stts[0], stss[0], timescale)
+
+
+def _keyframe_times(data, stts_start, stss_start, timescale):
+    # Decode times (in seconds) of the sync samples, walking the run-length coded sample durations once
+    sync_count = struct.unpack_from('>I', data, stss_start + 4)[0]
+    sync_samples = struct.unpack_from('>{}I'.format(sync_count), data, stss_start + 8)
+
+    keyframes = []
+    run_count = struct.unpack_from('>I', data, stts_start + 4)[0]
+    run, run_first_sample, run_first_time = 0, 1, 0
+    run_samples, run_delta = struct.unpack_from('>II', data, stts_start + 8) if run_count else (0, 0)
+
+    for sample in sync_samples:
+        while run_samples and sample >= run_first_sample + run_samples and run + 1 < run_count:
+            run_first_time += run_samples * run_delta
+            run_first_sample += run_samples
+            run += 1
+            run_samples, run_delta = struct.unpack_from('>II', data, stts_start + 8 + 8 * run)
+        keyframes.append(float(run_first_time + (sample - run_first_sample) * run_delta) / timescale)
+
+    return tuple(keyframes)
+
+
+def _parse_audio_track(data, stbl, seconds, info):
+    entry = _first_sample_entry(data, stbl)
+    if entry is None:
+        return
+
+    entry_type, entry_start, entry_end = entry
+    sound_version, = struct.unpack_from('>H', data, entry_start + 8)
+    channels, = struct.unpack_from('>H', data, entry_start + 16)
+    sample_rate, = struct.unpack_from('>I', data, entry_start + 24)
+    info['audio_channels'] = channels
+    info['audio_sample_rate'] = sample_rate >> 16
+
+    # QuickTime sound sample descriptions version 1 and 2 carry 16 and 36 additional bytes
+    children_start = entry_start + 28 + {1: 16, 2: 36}.get(sound_version, 0)
+    esds = _find_box(data, children_start, entry_end, ('esds',))
+    if esds is None:
+        wave = _find_box(data, children_start, entry_end, ('wave',))
+        if wave is not None:
+            esds = _find_box(data, wave[0], wave[1], ('esds',))
+
+    if esds is not None:
+        info['audio_bitrate'] = _parse_esds_bitrate(data, esds[0] + 4, esds[1])
+
+    if not info['audio_bitrate'] and seconds:
+        stsz = _find_box(data, stbl[0], stbl[1], ('stsz',))
+        if stsz is not None:
+            info['audio_bitrate'] = int(_total_sample_bytes(data, stsz[0]) * 8 / seconds)
+
+
+def _first_sample_entry(data, stbl):
+    stsd = _find_box(data, stbl[0], stbl[1], ('stsd',))
+    if stsd is None:
+        return None
+    for entry in _iter_boxes(data, stsd[0] + 8, stsd[1]):
+        return entry
+    return None
+
+
+def _parse_esds_bitrate(data, offset, end):
+    while offset < end:
+        tag = data[offset]
+        offset += 1
+        length = 0
+        for _ in range(4):
+            byte = data[offset]
+            offset += 1
+            length = (length << 7) | (byte & 0x7F)
+            if not byte & 0x80:
+                break
+
+        if tag == 0x03:
+            flags = data[offset + 2]
+            offset += 3
+            if flags & 0x80:
+                offset += 2
+            if flags & 0x40:
+                offset += 1 + data[offset]
+            if flags & 0x20:
+                offset += 2
+        elif tag == 0x04:
+            max_bitrate, avg_bitrate = struct.unpack_from('>II', data, offset + 5)
+            return avg_bitrate or max_bitrate or None
+        else:
+            offset += length
+
+    return None
+
+
+def _total_sample_bytes(data, start):
+    sample_size, sample_count = struct.unpack_from('>II', data, start + 4)
+    if sample_size:
+        return sample_size * sample_count
+    return sum(struct.unpack_from('>{}I'.format(sample_count), data, start + 12))
@@ -0,0 +1,177 @@
+import json
+import math
+import threading
+
+from collections import namedtuple
+from os import path
+
+import config as Config
+
+"""
+Planning of split-and-stitch encodings for long-form sources.
+
+<p>A long source is split into time ranges ("chunks") that are encoded by separate encodings in parallel, each one
+reading its range through a time-based trimming input stream. Every chunk boundary lies on the segment grid of the
+source timeline, so the chunks produce whole segments only and the segments of all chunks form one continuous
+sequence: segment n of the stitched rendition is segment n - first_segment of its chunk. Where possible, boundaries
+are moved to grid points that coincide with a keyframe of the source, so no chunk has to decode frames before its
+range.
+
+<p>The plan is written next to the outputs of the asset as split-plan.json. Once the last chunk encoding has
+finished, the manifest generator stitches the chunk segments into single HLS and DASH manifests from it
+(see manifest-generator/stitcher.py).
+"""
+
+PLAN_OBJECT_NAME = "split-plan.json"
+
+# Seconds a source keyframe may deviate from a segment boundary to still count as aligned (half a frame at 25 fps)
+KEYFRAME_TOLERANCE = 0.02
+
+Chunk = namedtuple('Chunk', ['index', 'offset', 'duration', 'first_segment', 'segment_count', 'infrastructure_id'])
+
+plan_storage = None
+_plan_storage_lock = threading.Lock()
+
+
+def init_plan_storage():
+    # type: () -> GcsStorage
+    global plan_storage
+    with _plan_storage_lock:
+        if plan_storage is None:
+            plan_storage = GcsStorage(bucket_name=Config.GCS_OUTPUT_BUCKET_NAME)
+
+    return plan_storage
+
+
+def should_split(source_info):
+    # type: (SourceInfo) -> bool
+    # Audio-only sources encode fast enough on their own, and the stitched manifests are built around video chunks
+    return bool(Config.SPLIT_ENCODING_ENABLED and source_info is not None and source_info.has_video and
+                source_info.duration and source_info.duration >= Config.SPLIT_MIN_DURATION)
+
+
+def plan_chunks(duration, segment_length, chunk_duration, keyframes=None, keyframe_window=0, infrastructure_ids=()):
+    # type: (float, float, float, tuple, int, tuple) -> list
+    """
+    Splits a source into chunks of about chunk_duration seconds whose boundaries lie on the segment grid
+
+    :param duration: Duration of the source in seconds
+    :param segment_length: Segment length of the muxings in seconds
+    :param chunk_duration: Target duration of a chunk, rounded to whole segments
+    :param keyframes: Sorted keyframe times of the source; None if every frame is a keyframe
+    :param keyframe_window: Number of segments a boundary may be moved to reach a keyframe-aligned grid point
+    :param infrastructure_ids: Infrastructures the chunks are distributed over round-robin (empty: None for all)
+    """
+
+    total_segments = int(math.ceil(duration / segment_length - 1e-9))
+    segments_per_chunk = max(1, int(round(chunk_duration / segment_length)))
+
+    boundaries = [0]
+    target = segments_per_chunk
+    # The last chunk is not allowed to shrink below half a chunk, it is merged into the previous one instead
+    while total_segments - target >= max(1, segments_per_chunk // 2):
+        boundary = _align_boundary(target, segment_length, keyframes, keyframe_window,
+                                   lower=boundaries[-1] + 1, upper=total_segments - 1)
+        boundaries.append(boundary)
+        target = boundary + segments_per_chunk
+    boundaries.append(total_segments)
+
+    chunks = []
+    for index, (first, end) in enumerate(zip(boundaries, boundaries[1:])):
+        offset = first * segment_length
+        chunks.append(Chunk(index=index,
+                            offset=offset,
+                            duration=min(end * segment_length, duration) - offset,
+                            first_segment=first,
+                            segment_count=end - first,
+                            infrastructure_id=infrastructure_ids[index % len(infrastructure_ids)]
+                            if infrastructure_ids else None))
+    return chunks
+
+
+def chunk_output_root(output_root, chunk):
+    # type: (str, Chunk) -> str
+    return path.join(output_root, "chunk-{:04d}".format(chunk.index))
+
+
+def build_plan(output_root, duration, segment_length, chunks, encoding_ids, renditions):
+    # type: (str, float, float, list, list, list) -> dict
+    """
+    Builds the plan document the manifest generator stitches the chunks from
+
+    :param output_root: The output root of the asset, relative to OUTPUT_BASE_PATH
+    :param duration: Duration of the source in seconds
+    :param segment_length: Segment length of the muxings in seconds
+    :param chunks: The planned chunks
+    :param encoding_ids: The encoding ID of every chunk
+    :param renditions: dicts with media_type, rendition_path, bitrate, codecs and (for video) width and height
+    """
+
+    return dict(output_root=output_root,
+                duration=duration,
+                segment_length=segment_length,
+                renditions=renditions,
+                chunks=[dict(chunk._asdict(),
+                             encoding_id=encoding_id,
+                             path=path.relpath(chunk_output_root(output_root, chunk), output_root))
+                        for chunk, encoding_id in zip(chunks, encoding_ids)])
+
+
+def plan_object_path(output_root):
+    # type: (str) -> str
+    return path.join(Config.OUTPUT_BASE_PATH, output_root, PLAN_OBJECT_NAME)
+
+
+def write_plan(plan):
+    # type: (dict) -> str
+    """
+    Writes the plan next to the outputs of the asset and returns its object path
+    """
+
+    object_path = plan_object_path(plan['output_root'])
+    init_plan_storage().write_text(object_path, json.dumps(plan, indent=1), content_type="application/json")
+    return object_path
+
+
+def _align_boundary(target, segment_length, keyframes, window, lower, upper):
+    if not keyframes or not window:
+        return max(lower, min(target, upper))
+
+    # Try the target first, then alternate outwards up to the window
+    for distance in range(window + 1):
+        for candidate in ((target,) if distance == 0 else (target - distance, target + distance)):
+            if lower <= candidate <= upper and _is_keyframe(keyframes, candidate * segment_length):
+                return candidate
+    return max(lower, min(target, upper))
+
+
+def _is_keyframe(keyframes, time):
+    # Binary search for the keyframe closest to the given time
+    low, high = 0, len(keyframes)
+    while low < high:
+        middle = (low + high) // 2
+        if keyframes[middle] < time:
+            low = middle + 1
+        else:
+            high = middle
+    return any(abs(keyframes[i] - time) <= KEYFRAME_TOLERANCE for i in (low - 1, low) if 0 <= i < len(keyframes))
+
+
+class GcsStorage(object):
+    """
+    Reads and writes small text objects in a GCS bucket. google-cloud-storage is only imported when it is created.
+    """
+
+    def __init__(self, bucket_name):
+        # type: (str) -> None
+        from google.cloud import storage
+
+        self.bucket = storage.Client().bucket(bucket_name)
+
+    def read_text(self, object_path):
+        # type: (str) -> str
+        return self.bucket.blob(object_path.lstrip("/")).download_as_bytes().decode('utf-8')
+
+    def write_text(self, object_path, text, content_type):
+        # type: (str, str, str) -> None
+        self.bucket.blob(object_path.lstrip("/")).upload_from_string(text, content_type=content_type)
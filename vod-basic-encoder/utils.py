@@ -1,23 +1,58 @@
+import threading
+
 from os import path
 import config as Config
+import http_transport as HttpTransport
+import instrumentation as Instrumentation
+import ledger as Ledger
+import pagination as Pagination
 
-import json
-
-from bitmovin_api_sdk import AclEntry, AclPermission, EncodingOutput, MessageType, BitmovinApi, BitmovinApiLogger, \
-    GcsOutput, Task, GcsInput, InputListQueryParams, Webhook, WebhookHttpMethod, Encoding, OutputListQueryParams, GceAccount
+import lazy_sdk as LazySdk
+from lazy_sdk import Sdk
 
 bitmovin_api = None
 
 def init_bitmovin_api():
+    # type: () -> BitmovinApi
+    """
+    Returns the API client. The SDK is imported and the client constructed on first use of one of its attributes,
+    so invocations that never call the API start without it (see lazy_sdk.py).
+    """
     global bitmovin_api
     if bitmovin_api is None:
-        bitmovin_api = BitmovinApi(api_key=Config.BITMOVIN_API_KEY,
-                                   tenant_org_id=Config.BITMOVIN_TENANT_ORG_ID,
-                                   logger=BitmovinApiLogger())
+        bitmovin_api = LazySdk.LazyClient(_create_bitmovin_api)
 
     return bitmovin_api
 
 
+def warm_up_bitmovin_api():
+    # type: () -> threading.Thread
+    """
+    Constructs the API client in a background thread, e.g. when an instance starts, so its first request finds the
+    SDK imported and the connections of the HTTP transport open
+    """
+
+    thread = threading.Thread(target=init_bitmovin_api().resolve, name="bitmovin-api-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def _create_bitmovin_api():
+    # All API calls share the pooled connections of the HTTP transport (see http_transport.py). They are opened while
+    # the SDK is imported, which takes long enough for the TLS handshakes.
+    transport = HttpTransport.init_transport()
+    if Config.HTTP_WARM_UP_CONNECTIONS > 0:
+        HttpTransport.warm_up_in_background(transport, Config.BITMOVIN_API_BASE_URL)
+
+    api = Sdk.BitmovinApi(api_key=Config.BITMOVIN_API_KEY,
+                          tenant_org_id=Config.BITMOVIN_TENANT_ORG_ID,
+                          base_url=Config.BITMOVIN_API_BASE_URL,
+                          logger=Sdk.BitmovinApiLogger())
+    HttpTransport.install(transport)
+    # Every call is timed per endpoint (see instrumentation.py)
+    return Instrumentation.instrument_api(api)
+
+
 def get_gcs_input(reuse_existing=True):
     # type: (bool) -> GcsInput
     """
@@ -30,11 +65,11 @@ def get_gcs_input(reuse_existing=True):
     if not reuse_existing:
         return create_gcs_input()
     else:
-        params = InputListQueryParams(name=Config.GCS_INPUT_UNIQUE_NAME)
-        named_inputs = bitmovin_api.encoding.inputs.list(query_params=params)
+        named_input = Pagination.first(bitmovin_api.encoding.inputs.list, Sdk.InputListQueryParams,
+                                       filters=dict(name=Config.GCS_INPUT_UNIQUE_NAME))
 
-        if named_inputs.total_count > 0:
-            return named_inputs.items[0]
+        if named_input is not None:
+            return named_input
         else:
             return create_gcs_input()
 
@@ -51,11 +86,11 @@ def get_gcs_output(reuse_existing=True):
     if not reuse_existing:
         return create_gcs_output()
     else:
-        params = OutputListQueryParams(name=Config.GCS_OUTPUT_UNIQUE_NAME)
-        named_outputs = bitmovin_api.encoding.outputs.list(query_params=params)
+        named_output = Pagination.first(bitmovin_api.encoding.outputs.list, Sdk.OutputListQueryParams,
+                                        filters=dict(name=Config.GCS_OUTPUT_UNIQUE_NAME))
 
-        if named_outputs.total_count > 0:
-            return named_outputs.items[0]
+        if named_output is not None:
+            return named_output
         else:
             return create_gcs_output()
 
@@ -85,7 +120,7 @@ def create_gcs_output():
     https://bitmovin.com/docs/encoding/api-reference/sections/outputs#/Encoding/PostEncodingOutputsGcs
     """
 
-    gcs_output = GcsOutput(
+    gcs_output = Sdk.GcsOutput(
         name=Config.GCS_OUTPUT_UNIQUE_NAME,
         bucket_name=Config.GCS_OUTPUT_BUCKET_NAME,
         access_key=Config.GCS_OUTPUT_ACCESS_KEY,
@@ -110,7 +145,7 @@ def create_gcs_input():
 
     """
 
-    gcs_input = GcsInput(
+    gcs_input = Sdk.GcsInput(
         name=Config.GCS_INPUT_UNIQUE_NAME,
         bucket_name=Config.GCS_INPUT_BUCKET_NAME,
         access_key=Config.GCS_INPUT_ACCESS_KEY,
@@ -130,7 +165,7 @@ def create_gce_account():
     :param name: A name that will help you identify the encoding in our dashboard (required)
     :param description: A description of the encoding (optional)
     """
-    gce_account = GceAccount(
+    gce_account = Sdk.GceAccount(
         name="Name your infrastructure",
         description="Add a description here",
         service_account_email=Config.GCE_SERVICE_ACCOUNT_EMAIL,
@@ -153,11 +188,11 @@ def build_encoding_output(output_id, asset_name, output_path):
     :param output_path: The path where the content will be written to
     """
 
-    acl_entry = AclEntry(
-        permission=AclPermission.PUBLIC_READ
+    acl_entry = Sdk.AclEntry(
+        permission=Sdk.AclPermission.PUBLIC_READ
     )
 
-    return EncodingOutput(
+    return Sdk.EncodingOutput(
         output_path=build_absolute_output_path(relative_path=output_path, relative_root=asset_name),
         output_id=output_id,
         acl=[acl_entry]
@@ -174,11 +209,11 @@ def build_encoding_output_with_absolute_path(output_id, output_path):
     :param output_path: The path where the content will be written to
     """
 
-    acl_entry = AclEntry(
-        permission=AclPermission.PUBLIC_READ
+    acl_entry = Sdk.AclEntry(
+        permission=Sdk.AclPermission.PUBLIC_READ
     )
 
-    return EncodingOutput(
+    return Sdk.EncodingOutput(
         output_path=output_path,
         output_id=output_id,
         acl=[acl_entry]
@@ -224,10 +259,15 @@ def retrieve_output_info(encoding_id):
     :return: a dict containing output ID and relative root
     """
 
-    all_muxings = bitmovin_api.encoding.encodings.muxings.list(encoding_id=encoding_id)
-
-    # TODO: filter to only return muxings that have an output
-    muxing_output = all_muxings.items[0].outputs[0]
+    # Muxings without an output (e.g. of streams only used for analysis) are skipped. The first muxing with an
+    # output is almost always on the first page, which makes prefetching the next one a wasted call.
+    muxing = next((muxing for muxing in Pagination.iterate(bitmovin_api.encoding.encodings.muxings.list,
+                                                           Sdk.MuxingListQueryParams,
+                                                           prefetch=False,
+                                                           encoding_id=encoding_id) if muxing.outputs), None)
+    if muxing is None:
+        raise Exception("Encoding {} has no muxing with an output".format(encoding_id))
+    muxing_output = muxing.outputs[0]
 
     relative_path = path.relpath(muxing_output.output_path, start=Config.OUTPUT_BASE_PATH)
     relative_root = relative_path.split('/')[0]
@@ -241,16 +281,40 @@ def log_task_errors(task):
     if task is None:
         return
 
-    filtered = filter(lambda msg: msg.type is MessageType.ERROR, task.messages)
+    filtered = filter(lambda msg: msg.type is Sdk.MessageType.ERROR, task.messages)
 
     for message in filtered:
         print(message.text)
 
 
-def add_webhooks(encoding):
-    # type: (Encoding) -> None
-    webhook_success = Webhook(url=Config.WEBHOOK_SUCCESS_URL,
-                              method=WebhookHttpMethod.POST)
+def add_webhooks(encoding, manifests_at_start=False):
+    # type: (Encoding, bool) -> None
+    if Config.ADMISSION_CONTROL_ENABLED or Config.INFRASTRUCTURE_POOL or Config.DEDUPE_ENABLED:
+        # Finished and failed encodings release their quota footprint in the job queue, their infrastructure slot and
+        # (failed ones) their content claim
+        webhook_queue = Sdk.Webhook(url=Config.WEBHOOK_QUEUE_URL,
+                                    method=Sdk.WebhookHttpMethod.POST)
+        bitmovin_api.notifications.webhooks.encoding.encodings.finished.create_by_encoding_id(
+            webhook=webhook_queue,
+            encoding_id=encoding.id
+        )
+        bitmovin_api.notifications.webhooks.encoding.encodings.error.create_by_encoding_id(
+            webhook=webhook_queue,
+            encoding_id=encoding.id
+        )
+
+    if manifests_at_start:
+        # The manifests are written by the encoding itself, the manifest generator does not need to be notified
+        return
+
+    if Config.WEBHOOK_SCOPE == "ORGANIZATION":
+        # The organization-wide webhook already covers this encoding
+        import bootstrap as Bootstrap
+        Bootstrap.ensure_organization_webhook()
+        return
+
+    webhook_success = Sdk.Webhook(url=Config.WEBHOOK_SUCCESS_URL,
+                                  method=Sdk.WebhookHttpMethod.POST)
     bitmovin_api.notifications.webhooks.encoding.encodings.finished.create_by_encoding_id(
         webhook=webhook_success,
         encoding_id=encoding.id
@@ -264,33 +328,54 @@ def add_webhooks(encoding):
    # )
 
 
-def write_encoding_info_to_file(codec_type, encoding_id):
-    filename = 'encodings.json'
-    encoding_data = dict()
+def get_or_create_organization_finished_webhook():
+    # type: () -> Webhook
+    """
+    Retrieves the organization-wide encoding finished webhook pointing to WEBHOOK_SUCCESS_URL or registers it.
+    Unlike the per-encoding webhook, this one fires for every encoding of the organization.
 
-    if path.exists(filename):
-        with open(filename, 'r') as fp:
-            encoding_data = json.load(fp)
+    <p>API endpoints:
+    https://bitmovin.com/docs/encoding/api-reference/sections/notifications-webhooks#/Encoding/GetNotificationsWebhooksEncodingEncodingsFinished
+    https://bitmovin.com/docs/encoding/api-reference/sections/notifications-webhooks#/Encoding/PostNotificationsWebhooksEncodingEncodingsFinished
+    """
 
-    if Config.ASSET_NAME not in encoding_data:
-        encoding_data[Config.ASSET_NAME] = dict()
+    finished_api = bitmovin_api.notifications.webhooks.encoding.encodings.finished
 
-    encoding_data[Config.ASSET_NAME][codec_type] = encoding_id
+    for webhook in Pagination.iterate(finished_api.list, Sdk.WebhookListQueryParams):
+        if webhook.url == Config.WEBHOOK_SUCCESS_URL:
+            return webhook
 
-    with open(filename, 'w') as fp:
-        json.dump(encoding_data, fp)
+    webhook_success = Sdk.Webhook(url=Config.WEBHOOK_SUCCESS_URL,
+                                  method=Sdk.WebhookHttpMethod.POST)
+    return finished_api.create(webhook=webhook_success)
 
 
-def read_encoding_info_from_file(codec_type):
-    filename = 'encodings.json'
+def organization_finished_webhook_exists(webhook_id):
+    # type: (str) -> bool
+    """
+    Checks that the organization-wide encoding finished webhook with the given ID is still registered, e.g. one
+    remembered by a previous instance
 
-    if path.exists(filename):
-        with open(filename, 'r') as fp:
-            encoding_data = json.load(fp)
-    else:
-        return None
+    <p>API endpoint:
+    https://bitmovin.com/docs/encoding/api-reference/sections/notifications-webhooks#/Encoding/GetNotificationsWebhooksEncodingEncodingsFinishedByWebhookId
+    """
 
-    if Config.ASSET_NAME in encoding_data:
-        return encoding_data[Config.ASSET_NAME][codec_type]
-    else:
-        return None
+    try:
+        webhook = bitmovin_api.notifications.webhooks.encoding.encodings.finished.get_by_webhook_id(
+            webhook_id=webhook_id)
+    except Exception as e:
+        # BitmovinError carries the HTTP status of the API response
+        if getattr(e, 'http_status_code', None) == 404:
+            return False
+        raise
+    return webhook.url == Config.WEBHOOK_SUCCESS_URL
+
+
+def write_encoding_info_to_file(asset_name, codec_type, encoding_id):
+    # Kept for compatibility, the encodings are recorded in the ledger of STATE_STORE (Firestore by default, see
+    # ledger.py) instead of encodings.json. The asset is passed explicitly, there is no per-job state in Config.
+    Ledger.init_ledger().record(asset_name=asset_name, codec_type=codec_type, encoding_id=encoding_id)
+
+
+def read_encoding_info_from_file(asset_name, codec_type):
+    return Ledger.init_ledger().latest(asset_name=asset_name, codec_type=codec_type)